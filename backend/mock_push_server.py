@@ -0,0 +1,127 @@
+"""
+Local stand-in for the Expo push and Resend APIs, to measure notification
+throughput without reaching the real providers.
+
+    python mock_push_server.py serve [--port 8090]
+        Then start the backend with
+        EXPO_API_URL=http://127.0.0.1:8090/--/api/v2 RESEND_API_URL=http://127.0.0.1:8090
+
+    python mock_push_server.py bench [--messages 20000] [--concurrency 4] [--url http://127.0.0.1:8090]
+        Pushes synthetic messages through NotificationService, in-process
+        (no sockets) unless --url points at a running mock.
+
+MOCK_PUSH_LATENCY_MS delays every request and MOCK_PUSH_FAILURE_RATE (0..1)
+answers that share of push requests with a 503.  Tokens containing "Dead"
+get a DeviceNotRegistered ticket.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import time
+import uuid
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI(title="Mock push provider")
+stats = {"push_requests": 0, "push_messages": 0, "email_requests": 0, "emails": 0}
+receipts = {}
+
+
+async def _simulate_latency() -> None:
+    latency_ms = float(os.environ.get("MOCK_PUSH_LATENCY_MS", "0") or 0)
+    if latency_ms > 0:
+        await asyncio.sleep(latency_ms / 1000)
+
+
+@app.post("/--/api/v2/push/send")
+async def push_send(request: Request):
+    await _simulate_latency()
+    if random.random() < float(os.environ.get("MOCK_PUSH_FAILURE_RATE", "0") or 0):
+        return JSONResponse({"errors": [{"code": "INTERNAL_SERVER_ERROR"}]}, status_code=503)
+    payload = await request.json()
+    messages = payload if isinstance(payload, list) else [payload]
+    if len(messages) > 100:
+        return JSONResponse({"errors": [{"code": "PUSH_TOO_MANY_NOTIFICATIONS"}]}, status_code=400)
+    stats["push_requests"] += 1
+    stats["push_messages"] += len(messages)
+    tickets = []
+    for message in messages:
+        ticket_id = uuid.uuid4().hex
+        if "Dead" in str(message.get("to")):
+            receipts[ticket_id] = {"status": "error", "details": {"error": "DeviceNotRegistered"}}
+            tickets.append({"status": "error", "message": "not registered", "details": {"error": "DeviceNotRegistered"}})
+        else:
+            receipts[ticket_id] = {"status": "ok"}
+            tickets.append({"status": "ok", "id": ticket_id})
+    return {"data": tickets}
+
+
+@app.post("/--/api/v2/push/getReceipts")
+async def push_receipts(request: Request):
+    await _simulate_latency()
+    ids = (await request.json()).get("ids") or []
+    return {"data": {ticket_id: receipts.pop(ticket_id) for ticket_id in ids if ticket_id in receipts}}
+
+
+@app.post("/emails")
+async def send_email(request: Request):
+    await _simulate_latency()
+    await request.json()
+    stats["email_requests"] += 1
+    stats["emails"] += 1
+    return {"id": uuid.uuid4().hex}
+
+
+@app.post("/emails/batch")
+async def send_email_batch(request: Request):
+    await _simulate_latency()
+    payload = await request.json()
+    stats["email_requests"] += 1
+    stats["emails"] += len(payload)
+    return {"data": [{"id": uuid.uuid4().hex} for _ in payload]}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+async def bench(total: int, concurrency: int, url: str = "") -> None:
+    if url:
+        os.environ["EXPO_API_URL"] = f"{url.rstrip('/')}/--/api/v2"
+    from services.notification_service import NotificationService
+
+    service = NotificationService(transport=None if url else httpx.ASGITransport(app=app))
+    messages = [
+        {"to": f"ExponentPushToken[bench-{index}]", "title": "Bench", "body": f"Message {index}", "sound": "default"}
+        for index in range(total)
+    ]
+    share = -(-total // max(concurrency, 1))
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        service.send_push_messages(messages[start:start + share]) for start in range(0, total, share)
+    ))
+    elapsed = time.perf_counter() - started
+    await service.stop()
+    ok = sum(1 for tickets in results for ticket in tickets if ticket.get("status") == "ok")
+    print(f"{total} messages, {ok} accepted in {elapsed:.2f}s -> {total / elapsed:.0f} msg/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=["serve", "bench"])
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--url", default="")
+    args = parser.parse_args()
+    if args.mode == "serve":
+        import uvicorn
+
+        uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+    else:
+        asyncio.run(bench(args.messages, args.concurrency, args.url))
@@ -12,7 +12,7 @@ import hmac
 import google.generativeai as genai
 from pathlib import Path as PathLib
 from pydantic import BaseModel, Field, EmailStr
-from typing import Any, Dict, List, Literal, Optional, Set
+from typing import Any, Dict, List, Literal, Optional, Set, Tuple
 import uuid
 import secrets
 from datetime import datetime, timezone, timedelta
@@ -26,7 +26,6 @@ import html
 import asyncio
 import base64
 import re
-import socket
 from urllib.parse import quote, urlparse
 from decimal import Decimal, InvalidOperation
 from PIL import Image
@@ -88,6 +87,7 @@ from services.pricing import (
     resolve_plan_amount,
 )
 from services.demo_service import (
+    DEMO_COLLECTIONS,
     capture_demo_session_contact,
     cleanup_expired_demo_sessions,
     create_demo_session as create_demo_session_data,
@@ -105,12 +105,36 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 from services.import_service import ImportService
-from services.notification_service import NotificationService
+from services.notification_service import NotificationService, ensure_notification_outbox_indexes, is_expo_push_token
 from services.catalog_service import CatalogService
 from services.firebase_service import init_firebase, verify_firebase_phone_token, verify_firebase_id_token
 from constants.sectors import BUSINESS_SECTORS, normalize_sector, PRODUCTION_SECTORS, RESTAURANT_SECTORS, is_production_sector
 from services import production_service
 from services import ai_governance
+from services import voice_matcher
+from services import basket_analysis
+from services import demand_forecast
+from services import inventory_summary
+from services import product_activity
+from services import analytics_snapshot
+from services import accounting_periods
+from services import general_ledger
+from services import customer_stats
+from services import birthday_calendar
+from services import platform_metrics
+from services import alert_scanner
+from services import anomaly_scheduler
+from services import reminder_queue
+from services import retention
+from services import broadcast_campaigns
+from services import domain_events
+from services import storefront_cache
+from services import storefront_events
+from services import storefront_domains
+from services import receipt_renderer
+from services import restaurant_stream
+from services import chat_inbox
+from services import sequences
 try:
     from services.rag_service import RAGService
 except Exception:
@@ -257,6 +281,8 @@ def schedule_product_import_job(job_id: str, user_id: str) -> None:
             logger.error(f"Product import job {job_id} failed: {exc}")
         finally:
             product_import_tasks.pop(job_id, None)
+            _invalidate_catalog_caches(user_id)
+            await _reconcile_owner_inventory_summaries(user_id)
 
     product_import_tasks[job_id] = asyncio.create_task(_runner())
 
@@ -341,6 +367,7 @@ async def process_product_delete_job(job_id: str, user_id: str) -> None:
                     {"$set": {"is_active": False, "deleted_at": batch_now, "updated_at": batch_now}},
                 )
                 deleted_count += int(result.modified_count or 0)
+                await _sync_inventory_summary(active_ids, catalog_changed=True)
 
             missing_ids = [product_id for product_id in batch_ids if product_id not in set(active_ids)]
             for missing_id in missing_ids:
@@ -363,6 +390,7 @@ async def process_product_delete_job(job_id: str, user_id: str) -> None:
 
         for store_id in touched_store_ids:
             _invalidate_dashboard_ai_caches(user_id, store_id)
+            _invalidate_catalog_caches(user_id, store_id)
 
         await db.product_delete_jobs.update_one(
             {"job_id": job_id, "user_id": user_id},
@@ -868,14 +896,23 @@ async def run_startup_migrations():
                 )
             except Exception as account_err:
                 logger.warning(f"Business account migration skipped for {owner_doc.get('user_id')}: {account_err}")
+        await birthday_calendar.backfill_birthday_doy(db)
+        await alert_scanner.normalize_batch_expiry_dates(db)
+        await storefront_events.backfill_rollups(db)
+        await retention.backfill_expires_at(db)
         logger.info("Background Migration: store_id + is_active backfill completed")
         # Supervised tasks
         asyncio.create_task(supervised_loop("alerts", check_alerts_loop, 300))
-        asyncio.create_task(supervised_loop("planner_reminders", check_planner_reminders_loop, 120))
+        asyncio.create_task(supervised_loop("planner_reminders", check_planner_reminders_loop, 5))
         # DÃ©tection d'anomalies IA : passÃ© de 30 min (1800s) Ã  12 heures (43200s) pour Ã©conomiser des tokens
         asyncio.create_task(supervised_loop("ai_anomalies", check_ai_anomalies_loop, 43200))
         asyncio.create_task(supervised_loop("log_cleanup", cleanup_logs_loop, 86400))
         asyncio.create_task(supervised_loop("late_deliveries", check_late_deliveries_loop, 21600))
+        asyncio.create_task(supervised_loop("basket_insights", refresh_basket_insights_loop, 21600))
+        asyncio.create_task(supervised_loop("inventory_summaries", reconcile_inventory_summaries_loop, 3600))
+        asyncio.create_task(supervised_loop("product_activity_backfill", backfill_product_activity_loop, 3600))
+        asyncio.create_task(supervised_loop("customer_stats_rebuild", rebuild_customer_stats_loop, 3600))
+        asyncio.create_task(supervised_loop("platform_metrics", reconcile_platform_metrics_loop, 900))
     except Exception as e:
         logger.error(f"Migration error: {e}")
 
@@ -992,6 +1029,11 @@ async def create_indexes_and_init():
                 await db.users.create_index("demo_session_id")
                 await db.business_accounts.create_index([("is_demo", 1), ("demo_expires_at", 1)])
                 await db.sales.create_index("public_receipt_token", unique=True, sparse=True)
+                await db.sales.create_index(
+                    [("user_id", 1), ("receipt_number", 1)],
+                    unique=True,
+                    partialFilterExpression={"receipt_number": {"$type": "string"}},
+                )
                 await db.demo_sessions.create_index("demo_session_id", unique=True)
                 await db.demo_sessions.create_index([("status", 1), ("expires_at", 1)])
                 await db.demo_sessions.create_index([("contact_email", 1), ("demo_type", 1), ("status", 1)])
@@ -1019,6 +1061,26 @@ async def create_indexes_and_init():
 
                 # AI governance indexes
                 await ai_governance.ensure_ai_indexes(db)
+                await basket_analysis.ensure_basket_indexes(db)
+                await demand_forecast.ensure_forecast_indexes(db)
+                await inventory_summary.ensure_inventory_summary_indexes(db)
+                await product_activity.ensure_product_activity_indexes(db)
+                await accounting_periods.ensure_accounting_period_indexes(db)
+                await customer_stats.ensure_customer_stats_indexes(db)
+                await birthday_calendar.ensure_birthday_indexes(db)
+                await platform_metrics.ensure_platform_metrics_indexes(db)
+                await alert_scanner.ensure_alert_indexes(db)
+                await anomaly_scheduler.ensure_anomaly_scheduler_indexes(db)
+                await reminder_queue.ensure_reminder_queue_indexes(db)
+                await retention.ensure_retention_indexes(db, DEMO_COLLECTIONS)
+                await ensure_notification_outbox_indexes(db)
+                await broadcast_campaigns.ensure_broadcast_indexes(db)
+                await domain_events.ensure_domain_event_indexes(db)
+                await storefront_events.ensure_storefront_event_indexes(db)
+                await storefront_domains.ensure_domain_indexes(db)
+                await receipt_renderer.ensure_receipt_render_indexes(db)
+                await chat_inbox.ensure_chat_indexes(db)
+                await sequences.ensure_sequence_indexes(db)
 
                 # Init CGU if missing
                 exists_cgu = await db.system_configs.find_one({"config_id": "cgu"})
@@ -1306,15 +1368,33 @@ Vous pouvez régulariser maintenant pour éviter toute limitation d’accès.<br
                         {"$set": {f"payment_reminder_{days_left}d_sent": True, "payment_reminder_last_sent_at": now}}
                     )
 
+        async def flush_storefront_events_loop():
+            await storefront_events.flush(db)
+
+        async def verify_custom_domains_loop():
+            await run_custom_domain_checks()
+
         async def cleanup_demo_sessions_loop():
             result = await cleanup_expired_demo_sessions(db)
             cleaned_count = result.get("cleaned_sessions", 0)
             if cleaned_count:
                 logger.info("Cleaned %s expired demo session(s)", cleaned_count)
 
+        async def drain_notification_outbox_loop():
+            recovered = await notification_service.recover_outbox(db)
+            if recovered:
+                logger.info("Dispatched %s pending push notification(s) from the outbox", recovered)
+            await notification_service.process_receipts(db)
+
+        await notification_service.start(db)
         asyncio.create_task(supervised_loop("subscriptions", check_expired_subscriptions, 86400))
         asyncio.create_task(supervised_loop("demo_cleanup", cleanup_demo_sessions_loop, 1800))
         asyncio.create_task(supervised_loop("activation_campaigns", check_activation_campaigns_loop, 21600))
+        asyncio.create_task(supervised_loop("notification_outbox", drain_notification_outbox_loop, 30))
+        asyncio.create_task(supervised_loop("broadcasts", run_broadcast_campaigns_loop, 15))
+        asyncio.create_task(supervised_loop("domain_events", dispatch_domain_events_loop, 1))
+        asyncio.create_task(supervised_loop("storefront_events", flush_storefront_events_loop, 2))
+        asyncio.create_task(supervised_loop("domain_checks", verify_custom_domains_loop, 60))
 
     except Exception as e:
         logger.error(f"Error in startup: {e}")
@@ -1383,6 +1463,9 @@ class EcommerceSiteInfo(BaseModel):
     domain_request_notes: Optional[str] = None
     domain_status: str = "not_configured"
     domain_verified_at: Optional[datetime] = None
+    domain_check_pending: bool = False
+    domain_last_checked_at: Optional[datetime] = None
+    domain_last_check_error: Optional[str] = None
     domain_verification_target: Optional[str] = None
     domain_record_type: Optional[str] = None
     domain_record_name: Optional[str] = None
@@ -1491,6 +1574,7 @@ class PublicReceipt(BaseModel):
     store_name: str
     store_address: Optional[str] = None
     receipt_footer: Optional[str] = None
+    receipt_number: Optional[str] = None
 
 
 class DuplicateResolution(BaseModel):
@@ -1519,14 +1603,8 @@ async def get_legacy_public_receipt(sale_id: str):
     raise HTTPException(status_code=410, detail="Ce lien de reÃ§u a Ã©tÃ© rÃ©voquÃ©. Utilisez le nouveau lien sÃ©curisÃ©.")
 
 
-@app.get("/api/public/receipts/t/{public_token}", response_model=PublicReceipt)
-async def get_public_receipt(public_token: str):
-    """Public endpoint to view receipt details without authentication."""
-    sale = await db.sales.find_one({"public_receipt_token": public_token})
-    if not sale:
-        raise HTTPException(status_code=404, detail="ReÃ§u non trouvÃ©")
-
-    # Get store info
+async def _load_public_receipt_data(sale: Dict[str, Any]) -> Dict[str, Any]:
+    """Receipt content of a sale; store details are captured when the receipt is first rendered."""
     store = await db.stores.find_one({"store_id": sale["store_id"]})
     store_name = (store or {}).get("receipt_business_name") or (store or {}).get("name") or "Ma Boutique"
     store_address = store.get("address") if store else None
@@ -1551,23 +1629,84 @@ async def get_public_receipt(public_token: str):
         created_at=sale["created_at"],
         store_name=store_name,
         store_address=store_address,
-        receipt_footer=receipt_footer
+        receipt_footer=receipt_footer,
+        receipt_number=sale.get("receipt_number"),
+    ).model_dump()
+
+
+async def _find_receipt_sale(public_token: str) -> Dict[str, Any]:
+    sale = await db.sales.find_one(
+        {"public_receipt_token": public_token},
+        {"_id": 0, "sale_id": 1, "public_receipt_token": 1, "receipt_version": 1},
     )
+    if not sale:
+        raise HTTPException(status_code=404, detail="ReÃ§u non trouvÃ©")
+    return sale
+
+
+async def render_public_receipt(sale: Dict[str, Any]) -> Dict[str, Any]:
+    """Stored render of the current version of a sale's receipt, rendered on first access."""
+    async def load() -> Dict[str, Any]:
+        full_sale = await db.sales.find_one({"sale_id": sale["sale_id"], "public_receipt_token": sale["public_receipt_token"]})
+        if not full_sale:
+            raise HTTPException(status_code=404, detail="ReÃ§u non trouvÃ©")
+        return await _load_public_receipt_data(full_sale)
+
+    return await receipt_renderer.get_or_render(db, sale, load)
+
+
+@app.get("/api/public/receipts/t/{public_token}", response_model=PublicReceipt)
+async def get_public_receipt(public_token: str):
+    """Public endpoint to view receipt details without authentication."""
+    render = await render_public_receipt(await _find_receipt_sale(public_token))
+    return PublicReceipt(**render["receipt"])
+
+
+async def serve_public_ecommerce_storefront(
+    request: Request,
+    account_doc: Dict[str, Any],
+    category: Optional[str],
+    page: Optional[int],
+    page_size: int,
+    vary_host: bool = False,
+) -> Response:
+    """Storefront from the versioned snapshot cache, with ETag revalidation."""
+    snapshot = await storefront_cache.get_snapshot(
+        storefront_cache.snapshot_key(account_doc),
+        lambda: build_public_ecommerce_payload(account_doc),
+    )
+    body, etag = storefront_cache.render(snapshot, category, page, page_size)
+    headers = {"ETag": etag, "Cache-Control": storefront_cache.CACHE_CONTROL}
+    if vary_host:
+        headers["Vary"] = "Host"
+    if storefront_cache.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 
 @app.get("/api/public/ecommerce/by-domain")
 async def get_public_ecommerce_site_by_domain(
     request: Request,
     domain: Optional[str] = Query(None, max_length=255),
+    category: Optional[str] = Query(None, max_length=120),
+    page: Optional[int] = Query(None, ge=1),
+    page_size: int = Query(storefront_cache.PAGE_SIZE, ge=1, le=storefront_cache.MAX_PAGE_SIZE),
 ):
     requested_domain = domain or get_normalized_request_host(request)
     account_doc = await get_public_ecommerce_account_by_domain(requested_domain)
-    return await build_public_ecommerce_payload(account_doc)
+    return await serve_public_ecommerce_storefront(request, account_doc, category, page, page_size, vary_host=not domain)
 
 
 @app.get("/api/public/ecommerce/{slug}")
-async def get_public_ecommerce_site(slug: str = Path(..., pattern="^[a-z0-9-]{2,80}$")):
+async def get_public_ecommerce_site(
+    request: Request,
+    slug: str = Path(..., pattern="^[a-z0-9-]{2,80}$"),
+    category: Optional[str] = Query(None, max_length=120),
+    page: Optional[int] = Query(None, ge=1),
+    page_size: int = Query(storefront_cache.PAGE_SIZE, ge=1, le=storefront_cache.MAX_PAGE_SIZE),
+):
     account_doc = await get_public_ecommerce_account_by_slug(slug)
-    return await build_public_ecommerce_payload(account_doc)
+    return await serve_public_ecommerce_storefront(request, account_doc, category, page, page_size)
 
 
 @app.post("/api/public/ecommerce/{slug}/events")
@@ -1578,7 +1717,7 @@ async def record_public_ecommerce_event(
 ):
     account_doc = await db.business_accounts.find_one(
         {"ecommerce_slug": slug, "ecommerce_enabled": True},
-        {"_id": 0, "owner_user_id": 1, "account_id": 1, "ecommerce_default_store_id": 1},
+        {"_id": 0, "owner_user_id": 1, "account_id": 1, "ecommerce_default_store_id": 1, storefront_cache.VERSION_FIELD: 1},
     )
     if not account_doc:
         raise HTTPException(status_code=404, detail="Boutique en ligne introuvable")
@@ -1597,16 +1736,19 @@ async def record_public_ecommerce_event(
         "visitor_key": hashlib.sha256(
             f"{request.client.host if request.client else ''}|{request.headers.get('user-agent', '')}".encode("utf-8")
         ).hexdigest()[:24],
+        "expires_at": retention.expires_at("ecommerce_events", at=now),
     }
     if payload.product_id:
-        product = await db.products.find_one(
-            {
-                "product_id": payload.product_id,
-                "user_id": owner_id,
-                "is_active": {"$ne": False},
-            },
-            {"_id": 0, "product_id": 1, "name": 1, "selling_price": 1},
-        )
+        product = storefront_cache.cached_product(storefront_cache.snapshot_key(account_doc), payload.product_id)
+        if not product:
+            product = await db.products.find_one(
+                {
+                    "product_id": payload.product_id,
+                    "user_id": owner_id,
+                    "is_active": {"$ne": False},
+                },
+                {"_id": 0, "product_id": 1, "name": 1, "selling_price": 1},
+            )
         if product:
             event_doc.update({
                 "product_id": product.get("product_id"),
@@ -1614,7 +1756,7 @@ async def record_public_ecommerce_event(
                 "unit_price": float(product.get("selling_price") or 0),
                 "quantity": float(payload.quantity or 1),
             })
-    await db.ecommerce_events.insert_one(event_doc)
+    storefront_events.record(db, event_doc)
     return {"status": "ok"}
 
 
@@ -1856,7 +1998,7 @@ async def create_public_ecommerce_order(
 
     now = datetime.now(timezone.utc)
     order_id = f"eord_{uuid.uuid4().hex[:12]}"
-    order_number = f"WEB-{now.strftime('%Y%m%d')}-{uuid.uuid4().hex[:5].upper()}"
+    order_number = await sequences.next_number(db, owner_id, "ecommerce_order", "WEB", now, width=6)
     customer_id = await upsert_ecommerce_customer(owner_id, store_id, payload, order_number, now)
     order_doc = {
         "order_id": order_id,
@@ -1879,120 +2021,227 @@ async def create_public_ecommerce_order(
         "created_at": now,
         "updated_at": now,
     }
-    await db.ecommerce_orders.insert_one(order_doc)
     title = "Nouvelle commande E-com"
     message = f"{payload.customer_name.strip()} a envoyé une commande de {round(total_amount, 2)} {account_doc.get('currency') or 'XOF'}."
     notification_deeplink = build_notification_deeplink("orders", {"order_id": order_id, "source": "ecommerce", "tab": "web"})
-    try:
-        await notification_service.notify_user(
-            db,
-            owner_id,
-            title,
-            message,
-            {"type": "ecommerce_order", "order_id": order_id, **notification_deeplink},
-        )
-    except Exception as notify_err:
-        logger.warning(f"E-commerce order push notification failed: {notify_err}")
-    try:
-        await db.admin_messages.insert_one({
-            "message_id": f"msg_{uuid.uuid4().hex[:12]}",
+    in_app_message = {
+        "message_id": f"msg_{uuid.uuid4().hex[:12]}",
+        "title": title,
+        "content": message,
+        "message": message,
+        "type": "ecommerce_order",
+        "target": owner_id,
+        "target_user_ids": [owner_id],
+        "sent_by": "system",
+        "sent_at": now,
+        "created_at": now,
+        "read_by": [],
+        "read_count": 0,
+        "metadata": {"order_id": order_id, "screen": "orders", "tab": "web", "source": "ecommerce"},
+        "deeplink": notification_deeplink,
+    }
+    events = [
+        domain_events.new_event("push.notify_user", {
+            "user_id": owner_id,
             "title": title,
-            "content": message,
-            "message": message,
-            "type": "ecommerce_order",
-            "target": owner_id,
-            "target_user_ids": [owner_id],
-            "sent_by": "system",
-            "sent_at": now,
-            "created_at": now,
-            "read_by": [],
-            "read_count": 0,
-            "metadata": {"order_id": order_id, "screen": "orders", "tab": "web", "source": "ecommerce"},
-            "deeplink": notification_deeplink,
-        })
-    except Exception as in_app_err:
-        logger.warning(f"E-commerce order in-app notification failed: {in_app_err}")
-    try:
-        owner_doc = await db.users.find_one({"user_id": owner_id}, {"_id": 0, "email": 1, "name": 1})
-        def format_order_value(value: Any) -> str:
-            numeric = float(value or 0)
-            return str(int(numeric)) if numeric.is_integer() else f"{numeric:.2f}".rstrip("0").rstrip(".")
+            "body": message,
+            "data": {"type": "ecommerce_order", "order_id": order_id, **notification_deeplink},
+        }, order_id, now),
+        domain_events.new_event("ecommerce_order.owner_email", {"order_id": order_id}, order_id, now),
+    ]
+    if order_doc["customer_email"]:
+        events.append(domain_events.new_event("ecommerce_order.customer_email", {"order_id": order_id}, order_id, now))
 
-        notification_rule = {
-            "recipient_keys": ["default", "crm"],
-            "recipient_emails": [account_doc.get("ecommerce_contact_email")] if account_doc.get("ecommerce_contact_email") else [],
-        }
-        email_recipients = resolve_notification_recipients(account_doc, store_doc, notification_rule)
-        owner_email = ((owner_doc or {}).get("email") or "").strip().lower()
-        if owner_email and owner_email not in email_recipients:
-            email_recipients.append(owner_email)
-        if email_recipients:
-            order_url = build_web_dashboard_hash_url("orders")
-            app_open_url = build_signed_app_open_link(str(notification_deeplink.get("url") or ""), purpose="ecommerce_order")
-            items_html = "".join(
-                f"<li>{html.escape(str(item.get('product_name') or 'Produit'))} x {format_order_value(item.get('quantity'))} - "
-                f"{format_order_value(item.get('total'))} {html.escape(str(order_doc.get('currency') or 'XOF'))}</li>"
-                for item in order_items
-            )
-            items_text = "\n".join(
-                f"- {item.get('product_name') or 'Produit'} x {format_order_value(item.get('quantity'))} - {format_order_value(item.get('total'))} {order_doc.get('currency') or 'XOF'}"
-                for item in order_items
-            )
-            html_body = (
-                f"<p>Bonjour {(owner_doc or {}).get('name') or ''},</p>"
-                f"<p>Vous avez reçu la commande E-com <strong>{order_number}</strong> pour un total de "
-                f"<strong>{round(total_amount, 2)} {account_doc.get('currency') or 'XOF'}</strong>.</p>"
-                f"<p>Client : {html.escape(payload.customer_name.strip())}</p>"
-                f"<ul>{items_html}</ul>"
-                f"<p><a href=\"{app_open_url}\">Ouvrir directement la commande dans l'application</a></p>"
-                f"<p><a href=\"{order_url}\">Ouvrir les commandes sur le web</a></p>"
-            )
-            text_body = (
-                f"Nouvelle commande E-com {order_number}\n"
-                f"Total : {round(total_amount, 2)} {account_doc.get('currency') or 'XOF'}\n"
-                f"Client : {payload.customer_name.strip()}\n"
-                f"{items_text}\n"
-                f"Ouvrir dans l'application : {app_open_url}\n"
-                f"Ouvrir sur le web : {order_url}"
-            )
-            await notification_service.send_email_notification(
-                email_recipients,
-                title,
-                html_body,
-                text_body=text_body,
-                reply_to=str(payload.customer_email).strip().lower() if payload.customer_email else None,
-            )
-        customer_email = str(payload.customer_email).strip().lower() if payload.customer_email else ""
-        if customer_email:
-            store_name = (
-                account_doc.get("ecommerce_site_name")
-                or account_doc.get("ecommerce_site_display_name")
-                or ((store_doc or {}).get("name"))
-                or account_doc.get("ecommerce_slug")
-            )
-            customer_html = (
-                f"<p>Bonjour {html.escape(payload.customer_name.strip())},</p>"
-                f"<p>Votre commande <strong>{order_number}</strong> a bien été reçue par {html.escape(str(store_name or 'la boutique'))}.</p>"
-                f"<ul>{items_html}</ul>"
-                f"<p>Total : <strong>{round(total_amount, 2)} {html.escape(str(order_doc.get('currency') or 'XOF'))}</strong></p>"
-                f"<p>Nous vous contacterons dès qu'elle sera confirmée.</p>"
-            )
-            customer_text = (
-                f"Bonjour {payload.customer_name.strip()},\n"
-                f"Votre commande {order_number} a bien été reçue.\n"
-                f"{items_text}\n"
-                f"Total : {round(total_amount, 2)} {order_doc.get('currency') or 'XOF'}\n"
-                "Nous vous contacterons dès qu'elle sera confirmée."
-            )
-            await notification_service.send_email_notification([customer_email], f"Commande reçue {order_number}", customer_html, text_body=customer_text)
-    except Exception as email_err:
-        logger.warning(f"E-commerce order email notification failed: {email_err}")
+    async def write_order(session):
+        await db.ecommerce_orders.insert_one(order_doc, session=session)
+        await db.admin_messages.insert_one(in_app_message, session=session)
+        return None, events
+
+    await commit_with_events(write_order)
+    try:
+        await customer_stats.record_ecommerce_order(db, order_doc)
+    except Exception as stats_err:
+        logger.warning(f"Customer stats update failed for e-commerce order {order_id}: {stats_err}")
     return PublicEcommerceOrderResponse(
         order_id=order_id,
         order_number=order_number,
         status="pending",
         total_amount=round(total_amount, 2),
     )
+
+
+def _format_order_value(value: Any) -> str:
+    numeric = float(value or 0)
+    return str(int(numeric)) if numeric.is_integer() else f"{numeric:.2f}".rstrip("0").rstrip(".")
+
+
+def _ecommerce_order_items_summary(order_doc: dict) -> Tuple[str, str]:
+    currency = order_doc.get("currency") or "XOF"
+    items = order_doc.get("items") or []
+    items_html = "".join(
+        f"<li>{html.escape(str(item.get('product_name') or 'Produit'))} x {_format_order_value(item.get('quantity'))} - "
+        f"{_format_order_value(item.get('total'))} {html.escape(str(currency))}</li>"
+        for item in items
+    )
+    items_text = "\n".join(
+        f"- {item.get('product_name') or 'Produit'} x {_format_order_value(item.get('quantity'))} - {_format_order_value(item.get('total'))} {currency}"
+        for item in items
+    )
+    return items_html, items_text
+
+
+async def _load_ecommerce_order(order_id: str) -> Tuple[Optional[dict], dict, Optional[dict]]:
+    order_doc = await db.ecommerce_orders.find_one({"order_id": order_id}, {"_id": 0})
+    if not order_doc:
+        return None, {}, None
+    account_doc = None
+    if order_doc.get("account_id"):
+        account_doc = await db.business_accounts.find_one({"account_id": order_doc["account_id"]}, {"_id": 0})
+    if not account_doc:
+        account_doc = await db.business_accounts.find_one({"ecommerce_slug": order_doc.get("site_slug")}, {"_id": 0})
+    store_doc = await db.stores.find_one({"store_id": order_doc.get("store_id"), "user_id": order_doc.get("user_id")}, {"_id": 0})
+    return order_doc, account_doc or {}, store_doc
+
+
+async def _send_event_email(to_emails: List[str], subject: str, html_body: str, **kwargs) -> None:
+    """Email sent by a domain event handler; raising lets the dispatcher retry it."""
+    if not notification_service.resend_api_key:
+        return
+    if await notification_service.send_email_notification(to_emails, subject, html_body, **kwargs) is None:
+        raise RuntimeError("the email provider did not accept the message")
+
+
+async def notify_user_from_event(payload: Dict[str, Any]) -> None:
+    await notification_service.notify_user(
+        db,
+        payload["user_id"],
+        payload["title"],
+        payload["body"],
+        payload.get("data"),
+        caller_owner_id=payload.get("caller_owner_id"),
+    )
+
+
+async def send_ecommerce_order_owner_email(payload: Dict[str, Any]) -> None:
+    order_doc, account_doc, store_doc = await _load_ecommerce_order(payload["order_id"])
+    if not order_doc:
+        return
+    owner_doc = await db.users.find_one({"user_id": order_doc.get("user_id")}, {"_id": 0, "email": 1, "name": 1})
+    notification_rule = {
+        "recipient_keys": ["default", "crm"],
+        "recipient_emails": [account_doc.get("ecommerce_contact_email")] if account_doc.get("ecommerce_contact_email") else [],
+    }
+    email_recipients = resolve_notification_recipients(account_doc, store_doc, notification_rule)
+    owner_email = ((owner_doc or {}).get("email") or "").strip().lower()
+    if owner_email and owner_email not in email_recipients:
+        email_recipients.append(owner_email)
+    if not email_recipients:
+        return
+    order_number = order_doc.get("order_number")
+    currency = order_doc.get("currency") or "XOF"
+    customer_name = order_doc.get("customer_name") or ""
+    customer_email = str(order_doc.get("customer_email") or "").strip().lower()
+    notification_deeplink = build_notification_deeplink("orders", {"order_id": order_doc["order_id"], "source": "ecommerce", "tab": "web"})
+    order_url = build_web_dashboard_hash_url("orders")
+    app_open_url = build_signed_app_open_link(str(notification_deeplink.get("url") or ""), purpose="ecommerce_order")
+    items_html, items_text = _ecommerce_order_items_summary(order_doc)
+    html_body = (
+        f"<p>Bonjour {(owner_doc or {}).get('name') or ''},</p>"
+        f"<p>Vous avez reçu la commande E-com <strong>{order_number}</strong> pour un total de "
+        f"<strong>{order_doc.get('total_amount')} {currency}</strong>.</p>"
+        f"<p>Client : {html.escape(customer_name)}</p>"
+        f"<ul>{items_html}</ul>"
+        f"<p><a href=\"{app_open_url}\">Ouvrir directement la commande dans l'application</a></p>"
+        f"<p><a href=\"{order_url}\">Ouvrir les commandes sur le web</a></p>"
+    )
+    text_body = (
+        f"Nouvelle commande E-com {order_number}\n"
+        f"Total : {order_doc.get('total_amount')} {currency}\n"
+        f"Client : {customer_name}\n"
+        f"{items_text}\n"
+        f"Ouvrir dans l'application : {app_open_url}\n"
+        f"Ouvrir sur le web : {order_url}"
+    )
+    await _send_event_email(
+        email_recipients,
+        "Nouvelle commande E-com",
+        html_body,
+        text_body=text_body,
+        reply_to=customer_email or None,
+    )
+
+
+async def send_ecommerce_order_customer_email(payload: Dict[str, Any]) -> None:
+    order_doc, account_doc, store_doc = await _load_ecommerce_order(payload["order_id"])
+    customer_email = str((order_doc or {}).get("customer_email") or "").strip().lower()
+    if not customer_email:
+        return
+    order_number = order_doc.get("order_number")
+    currency = order_doc.get("currency") or "XOF"
+    customer_name = order_doc.get("customer_name") or ""
+    store_name = (
+        account_doc.get("ecommerce_site_name")
+        or account_doc.get("ecommerce_site_display_name")
+        or ((store_doc or {}).get("name"))
+        or account_doc.get("ecommerce_slug")
+    )
+    items_html, items_text = _ecommerce_order_items_summary(order_doc)
+    customer_html = (
+        f"<p>Bonjour {html.escape(customer_name)},</p>"
+        f"<p>Votre commande <strong>{order_number}</strong> a bien été reçue par {html.escape(str(store_name or 'la boutique'))}.</p>"
+        f"<ul>{items_html}</ul>"
+        f"<p>Total : <strong>{order_doc.get('total_amount')} {html.escape(str(currency))}</strong></p>"
+        f"<p>Nous vous contacterons dès qu'elle sera confirmée.</p>"
+    )
+    customer_text = (
+        f"Bonjour {customer_name},\n"
+        f"Votre commande {order_number} a bien été reçue.\n"
+        f"{items_text}\n"
+        f"Total : {order_doc.get('total_amount')} {currency}\n"
+        "Nous vous contacterons dès qu'elle sera confirmée."
+    )
+    await _send_event_email([customer_email], f"Commande reçue {order_number}", customer_html, text_body=customer_text)
+
+
+async def run_delivery_alert_checks(payload: Dict[str, Any]) -> None:
+    product_ids = payload.get("product_ids") or []
+    products = await db.products.find(
+        {"product_id": {"$in": product_ids}, "user_id": payload["owner_id"]},
+        {"_id": 0},
+    ).to_list(len(product_ids))
+    for product in products:
+        await check_and_create_alerts(Product(**product), payload["owner_id"], store_id=payload.get("store_id"))
+
+
+DOMAIN_EVENT_HANDLERS = {
+    "push.notify_user": notify_user_from_event,
+    "ecommerce_order.owner_email": send_ecommerce_order_owner_email,
+    "ecommerce_order.customer_email": send_ecommerce_order_customer_email,
+    "order.delivery_alerts": run_delivery_alert_checks,
+}
+
+
+DOMAIN_EVENTS_POLL_INTERVAL = 10
+domain_events_wakeup = asyncio.Event()
+
+
+async def dispatch_domain_events_loop():
+    """Delivers due domain events until none is left, then waits for a wake-up or the next poll."""
+    # Cleared before the pass: a wake-up arriving during it triggers another pass.
+    domain_events_wakeup.clear()
+    while await domain_events.dispatch_due(db, DOMAIN_EVENT_HANDLERS):
+        pass
+    try:
+        await asyncio.wait_for(domain_events_wakeup.wait(), timeout=DOMAIN_EVENTS_POLL_INTERVAL)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def commit_with_events(write):
+    """Runs a business write and saves its domain events atomically, then wakes the dispatcher."""
+    result = await domain_events.commit(db, write)
+    domain_events_wakeup.set()
+    return result
 
 
 @app.post("/api/public/ecommerce/{slug}/contact", response_model=PublicEcommerceContactResponse)
@@ -2116,250 +2365,40 @@ async def create_public_ecommerce_contact_request(
 
 
 @app.get("/public/receipts/t/{public_token}", response_class=HTMLResponse)
-async def view_public_receipt_page(public_token: str, download: bool = Query(False)):
-    """Public HTML receipt page for QR scans."""
-    receipt = await get_public_receipt(public_token)
-
-    def fmt_amount(value: float) -> str:
-        try:
-            return f"{float(value):,.0f}".replace(",", " ")
-        except Exception:
-            return str(value)
-
-    created_label = receipt.created_at.astimezone(timezone.utc).strftime("%d/%m/%Y %H:%M UTC") if receipt.created_at else ""
-    items_html = "".join(
-        f"""
-        <tr>
-            <td>{escape(item.product_name)}</td>
-            <td style="text-align:center;">{escape(str(item.sold_quantity_input if item.sold_quantity_input is not None else item.quantity))}{f" {escape(item.sold_unit)}" if item.sold_unit else ""}</td>
-            <td style="text-align:right;">{fmt_amount(item.selling_price)}</td>
-            <td style="text-align:right;">{fmt_amount(item.total)}</td>
-        </tr>
-        """
-        for item in receipt.items
-    )
-
+async def view_public_receipt_page(request: Request, public_token: str, download: bool = Query(False)):
+    """Public HTML receipt page for QR scans, served from the pre-rendered receipt."""
+    sale = await _find_receipt_sale(public_token)
+    key = receipt_renderer.render_key(sale["public_receipt_token"], sale["sale_id"], sale.get("receipt_version") or 0)
+    headers = {"ETag": receipt_renderer.etag_for(key), "Cache-Control": receipt_renderer.PAGE_CACHE_CONTROL}
     if download:
-        receipt_html = f"""<!DOCTYPE html>
-<html lang="fr">
-<head>
-    <meta charset="utf-8" />
-    <meta name="viewport" content="width=device-width, initial-scale=1" />
-    <title>ReÃ§u {escape(receipt.sale_id)}</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; color: #1f2937; margin: 0; padding: 24px; }}
-        .card {{ max-width: 760px; margin: 0 auto; border: 1px solid #eadfcb; border-radius: 20px; padding: 24px; }}
-        .eyebrow {{ color: #2563eb; font-size: 12px; font-weight: 700; letter-spacing: 0.12em; text-transform: uppercase; }}
-        h1 {{ margin: 8px 0 4px; }}
-        .meta, .footer {{ color: #6b7280; font-size: 14px; }}
-        .total {{ display: flex; justify-content: space-between; margin: 20px 0; padding: 16px; background: #eff6ff; border-radius: 14px; font-weight: 700; }}
-        table {{ width: 100%; border-collapse: collapse; }}
-        th, td {{ padding: 12px 8px; border-bottom: 1px solid #eadfcb; font-size: 14px; }}
-        th {{ color: #6b7280; font-size: 12px; text-align: left; text-transform: uppercase; }}
-        .footer {{ margin-top: 20px; text-align: center; }}
-    </style>
-</head>
-<body>
-    <div class="card">
-        <div class="eyebrow">ReÃ§u numÃ©rique</div>
-        <h1>{escape(receipt.store_name)}</h1>
-        <div class="meta">
-            {escape(receipt.store_address or "")}<br />
-            RÃ©fÃ©rence vente : {escape(receipt.sale_id)}<br />
-            Date : {escape(created_label)}<br />
-            Paiement : {escape(receipt.payment_method)}
-        </div>
-        <div class="total"><span>Total</span><span>{fmt_amount(receipt.total_amount)}</span></div>
-        <table>
-            <thead>
-                <tr>
-                    <th>Produit</th>
-                    <th style="text-align:center;">QuantitÃ©</th>
-                    <th style="text-align:right;">Prix</th>
-                    <th style="text-align:right;">Total</th>
-                </tr>
-            </thead>
-            <tbody>{items_html}</tbody>
-        </table>
-        <div class="footer">{escape(receipt.receipt_footer or "Merci de votre visite.")}</div>
-    </div>
-</body>
-</html>"""
-        filename = f"recu-{receipt.sale_id}.html"
-        return Response(
-            content=receipt_html,
-            media_type="text/html; charset=utf-8",
-            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
-        )
-
-    return HTMLResponse(content=f"""
-        <!DOCTYPE html>
-        <html lang="fr">
-        <head>
-            <meta charset="utf-8" />
-            <meta name="viewport" content="width=device-width, initial-scale=1" />
-            <title>ReÃ§u {escape(receipt.sale_id)}</title>
-            <style>
-                :root {{
-                    color-scheme: light;
-                    --bg: #f5f1e8;
-                    --card: #fffdf8;
-                    --ink: #1f2937;
-                    --muted: #6b7280;
-                    --line: #eadfcb;
-                    --accent: #2563eb;
-                }}
-                * {{ box-sizing: border-box; }}
-                body {{
-                    margin: 0;
-                    font-family: Arial, sans-serif;
-                    background: linear-gradient(180deg, #f8f4ec 0%, #efe7d8 100%);
-                    color: var(--ink);
-                    padding: 20px;
-                }}
-                .wrap {{
-                    max-width: 760px;
-                    margin: 0 auto;
-                }}
-                .card {{
-                    background: var(--card);
-                    border: 1px solid var(--line);
-                    border-radius: 24px;
-                    padding: 24px;
-                    box-shadow: 0 16px 40px rgba(15, 23, 42, 0.08);
-                }}
-                .eyebrow {{
-                    font-size: 12px;
-                    text-transform: uppercase;
-                    letter-spacing: 0.12em;
-                    color: var(--accent);
-                    font-weight: 700;
-                }}
-                h1 {{
-                    margin: 8px 0 4px;
-                    font-size: 28px;
-                    line-height: 1.1;
-                }}
-                .meta {{
-                    color: var(--muted);
-                    font-size: 14px;
-                    margin-bottom: 20px;
-                }}
-                .total {{
-                    margin: 20px 0;
-                    padding: 16px 18px;
-                    border-radius: 16px;
-                    background: #eff6ff;
-                    display: flex;
-                    justify-content: space-between;
-                    align-items: center;
-                    gap: 12px;
-                    font-weight: 700;
-                }}
-                table {{
-                    width: 100%;
-                    border-collapse: collapse;
-                    margin-top: 8px;
-                }}
-                th, td {{
-                    padding: 12px 8px;
-                    border-bottom: 1px solid var(--line);
-                    font-size: 14px;
-                    vertical-align: top;
-                }}
-                th {{
-                    text-align: left;
-                    color: var(--muted);
-                    font-size: 12px;
-                    text-transform: uppercase;
-                    letter-spacing: 0.04em;
-                }}
-                .footer {{
-                    margin-top: 20px;
-                    color: var(--muted);
-                    font-size: 14px;
-                    text-align: center;
-                }}
-                .actions {{
-                    display: flex;
-                    gap: 12px;
-                    flex-wrap: wrap;
-                    margin-top: 20px;
-                }}
-                .btn {{
-                    display: inline-flex;
-                    align-items: center;
-                    justify-content: center;
-                    padding: 12px 16px;
-                    border-radius: 999px;
-                    text-decoration: none;
-                    font-weight: 700;
-                    border: 1px solid var(--line);
-                    color: var(--ink);
-                    background: white;
-                }}
-                .btn-primary {{
-                    background: var(--accent);
-                    color: white;
-                    border-color: var(--accent);
-                }}
-                @media print {{
-                    body {{
-                        background: white;
-                        padding: 0;
-                    }}
-                    .card {{
-                        box-shadow: none;
-                        border: none;
-                        border-radius: 0;
-                        padding: 0;
-                    }}
-                    .actions {{ display: none; }}
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="wrap">
-                <div class="card">
-                    <div class="eyebrow">ReÃ§u numÃ©rique</div>
-                    <h1>{escape(receipt.store_name)}</h1>
-                    <div class="meta">
-                        {escape(receipt.store_address or "")}<br />
-                        RÃ©fÃ©rence vente : {escape(receipt.sale_id)}<br />
-                        Date : {escape(created_label)}<br />
-                        Paiement : {escape(receipt.payment_method)}
-                    </div>
-
-                    <div class="total">
-                        <span>Total</span>
-                        <span>{fmt_amount(receipt.total_amount)}</span>
-                    </div>
-
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>Produit</th>
-                                <th style="text-align:center;">QuantitÃ©</th>
-                                <th style="text-align:right;">Prix</th>
-                                <th style="text-align:right;">Total</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {items_html}
-                        </tbody>
-                    </table>
+        headers["Content-Disposition"] = f'attachment; filename="recu-{sale["sale_id"]}.html"'
+    if storefront_cache.etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    render = await render_public_receipt(sale)
+    return Response(
+        content=render["download_html"] if download else render["html"],
+        media_type="text/html; charset=utf-8",
+        headers=headers,
+    )
 
-                    <div class="actions">
-                        <a class="btn btn-primary" href="javascript:window.print()">Imprimer / PDF</a>
-                        <a class="btn" href="/public/receipts/t/{quote(public_token)}?download=1">TÃ©lÃ©charger le reÃ§u</a>
-                    </div>
 
-                    <div class="footer">{escape(receipt.receipt_footer or "Merci de votre visite.")}</div>
-                </div>
-            </div>
-        </body>
-        </html>
-    """)
+@app.get("/public/receipts/r/{key}.{fmt}")
+async def get_rendered_public_receipt(request: Request, key: str, fmt: str):
+    """Immutable receipt render (page or PDF) addressed by its render key."""
+    if fmt not in {"html", "pdf"}:
+        raise HTTPException(status_code=404, detail="ReÃ§u non trouvÃ©")
+    headers = {"ETag": receipt_renderer.etag_for(key), "Cache-Control": receipt_renderer.IMMUTABLE_CACHE_CONTROL}
+    if storefront_cache.etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    render = await receipt_renderer.cached(db, key)
+    if not render:
+        raise HTTPException(status_code=404, detail="ReÃ§u non trouvÃ©")
+    if fmt == "html":
+        return Response(content=render["html"], media_type="text/html; charset=utf-8", headers=headers)
+    headers["Content-Disposition"] = f'inline; filename="recu-{render["sale_id"]}.pdf"'
+    pdf = await receipt_renderer.ensure_pdf(db, render)
+    return Response(content=pdf, media_type="application/pdf", headers=headers)
 
 # ===================== PUBLIC FORMS MODELS =====================
 class ContactMessage(BaseModel):
@@ -3011,6 +3050,16 @@ NON_LOSS_STOCK_MOVEMENT_REASON_TOKENS = (
     "stock.reasons.pos_sale",
 )
 
+def loss_stock_movement_query() -> Dict[str, Any]:
+    """Query-side version of ``is_loss_stock_movement``; it matches the same movements so server-side totals agree."""
+    reason_pattern = "|".join(re.escape(token) for token in NON_LOSS_STOCK_MOVEMENT_REASON_TOKENS)
+    source_pattern = "|".join(re.escape(source) for source in sorted(NON_LOSS_STOCK_MOVEMENT_SOURCE_TYPES))
+    return {
+        "type": re.compile(r"^out$", re.IGNORECASE),
+        "source_type": {"$not": re.compile(rf"^\s*({source_pattern})\s*$", re.IGNORECASE)},
+        "reason": {"$not": re.compile(reason_pattern, re.IGNORECASE)},
+    }
+
 def is_loss_stock_movement(movement: Dict[str, Any]) -> bool:
     if (movement.get("type") or "").lower() != "out":
         return False
@@ -3283,6 +3332,7 @@ class Sale(BaseModel):
     cancelled_at: Optional[datetime] = None
     cancelled_by_user_id: Optional[str] = None
     cancellation_reason: Optional[str] = None
+    receipt_number: Optional[str] = None  # numero de ticket, continu par annee
 
 
 class SaleCreate(BaseModel):
@@ -3300,6 +3350,7 @@ class SaleCreate(BaseModel):
     kitchen_sent: Optional[bool] = False
     status: Optional[str] = "completed"  # "open" pour commande restaurant en cours
     service_type: Optional[str] = "dine_in"
+    receipt_number: Optional[str] = None  # pris dans une plage reservee (ventes hors ligne)
 
 class SaleCancelRequest(BaseModel):
     reason: Optional[str] = None
@@ -3459,6 +3510,7 @@ class ActivityLog(BaseModel):
     description: str
     details: Dict[str, Any] = {}
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    expires_at: Optional[datetime] = None
 
 class Expense(BaseModel):
     expense_id: str = Field(default_factory=lambda: f"exp_{uuid.uuid4().hex[:12]}")
@@ -3903,32 +3955,25 @@ def build_ecommerce_domain_dns_config(custom_domain: Optional[str]) -> Dict[str,
     }
 
 
-async def resolve_host_ip_set(host: Optional[str]) -> set[str]:
-    if not host:
-        return set()
-    loop = asyncio.get_running_loop()
-    try:
-        addrinfo = await loop.run_in_executor(None, socket.getaddrinfo, host, 443, socket.AF_UNSPEC, socket.SOCK_STREAM)
-    except Exception:
-        return set()
-    resolved_ips: set[str] = set()
-    for entry in addrinfo:
-        sockaddr = entry[4]
-        if sockaddr and sockaddr[0]:
-            resolved_ips.add(str(sockaddr[0]))
-    return resolved_ips
+async def run_custom_domain_checks() -> Dict[str, int]:
+    """Run the DNS checks waiting in the queue, batch after batch."""
+    totals: Dict[str, int] = {}
+    while True:
+        counts = await storefront_domains.run_due_checks(db, get_ecommerce_domain_target(), datetime.now(timezone.utc))
+        if not counts:
+            return totals
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + value
 
 
-async def verify_ecommerce_domain_resolution(domain: Optional[str]) -> bool:
-    if not domain:
-        return False
-    domain_ips = await resolve_host_ip_set(domain)
-    if not domain_ips:
-        return False
-    target_ips = await resolve_host_ip_set(get_ecommerce_domain_target())
-    if not target_ips:
-        return False
-    return bool(domain_ips.intersection(target_ips))
+_custom_domain_check_task: Optional[asyncio.Task] = None
+
+
+def start_custom_domain_checks() -> None:
+    """Run the requested DNS checks now rather than at the next poll; one runner at a time."""
+    global _custom_domain_check_task
+    if _custom_domain_check_task is None or _custom_domain_check_task.done():
+        _custom_domain_check_task = asyncio.create_task(run_custom_domain_checks())
 
 
 async def build_unique_ecommerce_slug(seed: Optional[str], owner_id: str) -> str:
@@ -4029,6 +4074,9 @@ async def ensure_ecommerce_site_for_owner(owner_id: str, store_id: Optional[str]
         "domain_request_notes": account_doc.get("ecommerce_domain_request_notes"),
         "domain_status": domain_status,
         "domain_verified_at": account_doc.get("ecommerce_domain_verified_at"),
+        "domain_check_pending": bool(custom_domain and account_doc.get("ecommerce_domain_check_requested_at")),
+        "domain_last_checked_at": account_doc.get("ecommerce_domain_last_check_at"),
+        "domain_last_check_error": (account_doc.get("ecommerce_domain_last_check") or {}).get("error"),
         "domain_verification_target": get_ecommerce_domain_target(),
         "domain_record_type": dns_config["record_type"],
         "domain_record_name": dns_config["record_name"],
@@ -4141,12 +4189,18 @@ async def get_public_ecommerce_account_by_slug(slug: str) -> Dict[str, Any]:
     return account_doc
 
 
+async def find_public_ecommerce_account_by_domain(domain: str, account_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    query: Dict[str, Any] = {"ecommerce_custom_domain": domain, "ecommerce_enabled": True}
+    if account_id:
+        query["account_id"] = account_id
+    return await db.business_accounts.find_one(query, {"_id": 0})
+
+
 async def get_public_ecommerce_account_by_domain(domain: Optional[str]) -> Dict[str, Any]:
     normalized_domain = normalize_ecommerce_domain(domain)
-    account_doc = await db.business_accounts.find_one(
-        {"ecommerce_custom_domain": normalized_domain, "ecommerce_enabled": True},
-        {"_id": 0},
-    )
+    account_doc = None
+    if normalized_domain:
+        account_doc = await storefront_domains.route(normalized_domain, find_public_ecommerce_account_by_domain)
     if not account_doc:
         raise HTTPException(status_code=404, detail="Boutique en ligne introuvable")
     return account_doc
@@ -4673,6 +4727,7 @@ async def send_system_activation_push(user_doc: dict, account_doc: Optional[dict
             "url": target["deeplink"],
         },
         caller_owner_id=user_id,
+        wait=True,
     )
     sent_count = int((result or {}).get("sent", 0) or 0)
     status = "sent" if sent_count > 0 else "failed"
@@ -4890,45 +4945,72 @@ async def check_activation_campaigns_loop():
     for session_doc in demo_sessions:
         await send_demo_conversion_email(session_doc, now)
 
-    owner_users = await db.users.find(
-        {
-            "is_demo": {"$ne": True},
-            "is_active": {"$ne": False},
-            "role": {"$nin": ["supplier", "staff", "admin", "superadmin"]},
-            "$or": [{"parent_user_id": {"$exists": False}}, {"parent_user_id": None}],
-        },
-        {"_id": 0, "hashed_password": 0},
-    ).sort("created_at", -1).limit(500).to_list(500)
+    # Owners are evaluated by the broadcast runner, page by page.
+    if not await broadcast_campaigns.active_campaign(db, "activation"):
+        await broadcast_campaigns.create_campaign(db, broadcast_campaigns.new_campaign(
+            "activation",
+            {"type": "activation_owners"},
+            {},
+            now,
+            campaign_id=f"activation_{now.strftime('%Y%m%d%H')}",
+        ))
+
+
+async def _activation_owner_stats(owner_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Product and sale counts and dates for a chunk of owners, in two grouped queries."""
+    stats: Dict[str, Dict[str, Any]] = {owner_id: {"product_count": 0, "sale_count": 0} for owner_id in owner_ids}
+    async for row in db.products.aggregate([
+        {"$match": {"user_id": {"$in": owner_ids}, "is_demo": {"$ne": True}}},
+        {"$group": {
+            "_id": "$user_id",
+            "count": {"$sum": 1},
+            "first_created_at": {"$min": "$created_at"},
+            "last_updated_at": {"$max": {"$ifNull": ["$updated_at", "$created_at"]}},
+        }},
+    ]):
+        stats[row["_id"]].update(
+            product_count=row["count"],
+            first_product_at=row.get("first_created_at"),
+            last_product_at=row.get("last_updated_at"),
+        )
+    async for row in db.sales.aggregate([
+        {"$match": {"user_id": {"$in": owner_ids}, "is_demo": {"$ne": True}}},
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}, "last_created_at": {"$max": "$created_at"}}},
+    ]):
+        stats[row["_id"]].update(sale_count=row["count"], last_sale_at=row.get("last_created_at"))
+    return stats
+
 
+async def send_activation_campaign_chunk(owner_users: List[dict], now: datetime) -> Dict[str, int]:
+    stats = await _activation_owner_stats([user_doc["user_id"] for user_doc in owner_users])
+    counts = {"evaluated": 0, "targeted": 0}
     for user_doc in owner_users:
         account_doc = await ensure_business_account_for_user_doc(user_doc)
         if not account_doc:
             continue
+        counts["evaluated"] += 1
         access_context = build_effective_access_context(user_doc, account_doc)
         owner_id = user_doc.get("user_id")
-        product_count = await db.products.count_documents({"user_id": owner_id, "is_demo": {"$ne": True}})
-        sale_count = await db.sales.count_documents({"user_id": owner_id, "is_demo": {"$ne": True}})
-        first_product = await db.products.find_one({"user_id": owner_id, "is_demo": {"$ne": True}}, {"_id": 0, "created_at": 1}, sort=[("created_at", 1)])
-        last_sale = await db.sales.find_one({"user_id": owner_id, "is_demo": {"$ne": True}}, {"_id": 0, "created_at": 1}, sort=[("created_at", -1)])
-        last_product = await db.products.find_one({"user_id": owner_id, "is_demo": {"$ne": True}}, {"_id": 0, "updated_at": 1, "created_at": 1}, sort=[("updated_at", -1), ("created_at", -1)])
+        owner_stats = stats[owner_id]
         last_candidates = [
             parse_datetime_value(user_doc.get("last_login_at") or user_doc.get("last_login")),
-            parse_datetime_value((last_sale or {}).get("created_at")),
-            parse_datetime_value((last_product or {}).get("updated_at") or (last_product or {}).get("created_at")),
+            parse_datetime_value(owner_stats.get("last_sale_at")),
+            parse_datetime_value(owner_stats.get("last_product_at")),
         ]
         last_activity = max([date for date in last_candidates if date], default=parse_datetime_value(user_doc.get("created_at")) or now)
         target = choose_system_activation_target(
             user_doc,
             account_doc,
             access_context,
-            product_count,
-            sale_count,
-            parse_datetime_value((first_product or {}).get("created_at")),
+            owner_stats["product_count"],
+            owner_stats["sale_count"],
+            parse_datetime_value(owner_stats.get("first_product_at")),
             last_activity,
             now,
         )
         if not target:
             continue
+        counts["targeted"] += 1
         milestone_filter = {
             "target_user_id": owner_id,
             "scenario": target["scenario"],
@@ -4936,6 +5018,7 @@ async def check_activation_campaigns_loop():
         }
         await send_system_activation_email(user_doc, account_doc, target, milestone_filter, now)
         await send_system_activation_push(user_doc, account_doc, target, milestone_filter, now)
+    return counts
 
 
 def is_login_locked(user_doc: dict) -> bool:
@@ -4960,6 +5043,7 @@ async def log_security_event(
         "user_agent": request.headers.get("user-agent") if request else None,
         "details": details,
         "created_at": datetime.now(timezone.utc),
+        "expires_at": retention.expires_at("security_events"),
     })
 
 
@@ -6071,7 +6155,7 @@ async def log_subscription_event(
             except Exception:
                 resolved_amount = None
 
-        await db.subscription_events.insert_one({
+        event_doc = {
             "event_id": f"subevt_{uuid.uuid4().hex[:12]}",
             "event_type": event_type,
             "provider": provider,
@@ -6087,9 +6171,34 @@ async def log_subscription_event(
             "message": message,
             "metadata": metadata or {},
             "created_at": datetime.now(timezone.utc),
-        })
+        }
+        await db.subscription_events.insert_one(event_doc)
     except Exception as exc:
         logger.warning("Could not log subscription event %s/%s: %s", provider, event_type, exc)
+        return
+    try:
+        await platform_metrics.record_subscription_event(db, event_doc)
+    except Exception as exc:
+        logger.warning("Platform metrics update failed for subscription event %s: %s", event_type, exc)
+
+
+async def _record_platform_signup(user_doc: Dict[str, Any]) -> None:
+    try:
+        await platform_metrics.record_signup(db, user_doc)
+    except Exception as exc:
+        logger.warning("Platform metrics update failed for signup %s: %s", user_doc.get("user_id"), exc)
+
+
+def _platform_account_profile(account: Dict[str, Any]) -> Dict[str, Any]:
+    """Plan, paying flag and monthly list price of a business account, for the platform metrics."""
+    plan = normalize_plan(account.get("plan"))
+    resolved = resolve_plan_amount(plan, account.get("currency"), country_code=account.get("country_code"))
+    return {
+        "plan": plan,
+        "paying": _is_paying_account(account),
+        "currency": resolved["currency"],
+        "amount": float(_decimal_or_zero(resolved["amount"])),
+    }
 
 
 def _is_paying_account(account: dict) -> bool:
@@ -6857,7 +6966,6 @@ async def flutterwave_webhook(request: Request):
 
     # Notify user to refresh app data (I5)
     try:
-        from services.notification_service import notification_service
         await notification_service.notify_user(
             db, pending["user_id"],
             "ðŸŽ‰ Plan mis Ã  jour !",
@@ -6874,6 +6982,7 @@ async def flutterwave_webhook(request: Request):
         "transaction_id": transaction_id,
         "plan": plan,
         "created_at": datetime.now(timezone.utc).isoformat(),
+        "expires_at": retention.expires_at("security_events"),
     })
 
     await db.pending_transactions.delete_one({"transaction_id": transaction_id})
@@ -7218,6 +7327,11 @@ async def log_activity(
             description=description or f"{module}:{action}",
             details=details or {},
         )
+        log.expires_at = retention.expires_at(
+            "activity_logs",
+            normalize_plan(resolved_user.effective_plan) if resolved_user else None,
+            log.created_at,
+        )
         await db.activity_logs.insert_one(log.model_dump())
     except Exception as e:
         logger.error(f"Error logging activity: {e}")
@@ -7311,6 +7425,7 @@ async def create_sub_user(sub_user_data: UserCreate, user: User = Depends(requir
         "auth_version": 1,
     })
     await db.users.insert_one(new_user_payload)
+    await _record_platform_signup(new_user_payload)
     await db.credentials.insert_one({
         "user_id": new_user_id,
         "parent_user_id": owner_parent_id,
@@ -7489,7 +7604,8 @@ async def test_push_notification(user: User = Depends(require_auth)):
         user.user_id,
         "Stockman Test",
         "Ceci est une notification de test pour Stockman.",
-        caller_owner_id=get_owner_id(user)
+        caller_owner_id=get_owner_id(user),
+        wait=True,
     )
     if result.get("ok"):
         return {"message": "Notification de test envoyee", "details": result}
@@ -8216,9 +8332,13 @@ async def admin_list_all_products(
 @admin_router.delete("/products/{product_id}")
 async def admin_delete_product(product_id: str, user: User = Depends(require_superadmin)):
     """Permanently delete any product (Superadmin only)"""
+    product = await db.products.find_one(
+        {"product_id": product_id}, {"_id": 0, "product_id": 1, "user_id": 1, "store_id": 1, "inventory_class": 1}
+    )
     result = await db.products.delete_one({"product_id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Produit non trouvÃ©")
+    await _retire_from_inventory_summary([product] if product else [])
 
     # Log the action
     await log_activity(
@@ -8241,6 +8361,7 @@ async def admin_toggle_product(product_id: str, user: User = Depends(require_sup
         {"product_id": product_id},
         {"$set": {"is_active": new_status, "updated_at": datetime.now(timezone.utc)}}
     )
+    await _sync_inventory_summary([product_id], catalog_changed=True)
 
     # Log the action
     await log_activity(
@@ -8715,100 +8836,28 @@ async def admin_close_ticket(ticket_id: str):
 
 @admin_router.get("/stats/detailed")
 async def admin_detailed_stats():
-    """Rich admin statistics with breakdowns"""
-    from datetime import timedelta
+    """Rich admin statistics with breakdowns, read from the platform metrics snapshots"""
     now = datetime.now(timezone.utc)
-    seven_days_ago = now - timedelta(days=7)
-    thirty_days_ago = now - timedelta(days=30)
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    current = await platform_metrics.get_current(db, _platform_account_profile)
+    today = await platform_metrics.window_totals(db, today_start, now)
+    week = await platform_metrics.window_totals(db, now - timedelta(days=7), now)
+    month = await platform_metrics.window_totals(db, now - timedelta(days=30), now)
 
-    # Users by role
-    role_pipeline = [{"$group": {"_id": "$role", "count": {"$sum": 1}}}]
-    role_data = await db.users.aggregate(role_pipeline).to_list(10)
-    users_by_role = {r["_id"] or "shopkeeper": r["count"] for r in role_data}
-
-    # Recent signups (last 7 days)
-    recent_signups = await db.users.count_documents({"created_at": {"$gte": seven_days_ago}})
-
-    # Top 5 stores by revenue
-    top_stores_pipeline = [
-        {"$group": {"_id": "$store_id", "revenue": {"$sum": "$total_amount"}, "sales_count": {"$sum": 1}}},
-        {"$sort": {"revenue": -1}},
-        {"$limit": 5},
-        {"$lookup": {
-            "from": "stores",
-            "localField": "_id",
-            "foreignField": "store_id",
-            "as": "store_info"
-        }},
-        {"$unwind": {"path": "$store_info", "preserveNullAndEmptyArrays": True}},
-        {"$project": {
-            "_id": 0,
-            "store_id": "$_id",
-            "name": {"$ifNull": ["$store_info.name", "Inconnu"]},
-            "revenue": 1,
-            "sales_count": 1
-        }}
-    ]
-    top_stores = await db.sales.aggregate(top_stores_pipeline).to_list(5)
-
-    # Revenue today / this week / this month
-    revenue_today_agg = await db.sales.aggregate([
-        {"$match": {"created_at": {"$gte": today_start}}},
-        {"$group": {"_id": None, "total": {"$sum": "$total_amount"}}}
-    ]).to_list(1)
-
-    revenue_week_agg = await db.sales.aggregate([
-        {"$match": {"created_at": {"$gte": seven_days_ago}}},
-        {"$group": {"_id": None, "total": {"$sum": "$total_amount"}}}
-    ]).to_list(1)
-
-    revenue_month_agg = await db.sales.aggregate([
-        {"$match": {"created_at": {"$gte": thirty_days_ago}}},
-        {"$group": {"_id": None, "total": {"$sum": "$total_amount"}}}
-    ]).to_list(1)
-
-    # Open tickets count
-    open_tickets = await db.support_tickets.count_documents({"status": "open"})
-
-    # Low stock products count (quantity <= 5)
-    low_stock_count = await db.products.count_documents({"quantity": {"$lte": 5}})
-
-    # Users by country
-    country_pipeline = [{"$group": {"_id": "$country_code", "count": {"$sum": 1}}}]
-    country_data = await db.users.aggregate(country_pipeline).to_list(100)
-    users_by_country = {r["_id"] or "Unknown": r["count"] for r in country_data}
-
-    # Accounts by plan (source of truth = business_accounts)
-    plan_pipeline = [{"$group": {"_id": "$plan", "count": {"$sum": 1}}}]
-    plan_data = await db.business_accounts.aggregate(plan_pipeline).to_list(10)
-    users_by_plan = {normalize_plan(r["_id"]) or "starter": r["count"] for r in plan_data}
-
-    # Trials expiring in next 7 days
-    in_7_days = now + timedelta(days=7)
-    trials_expiring_soon = await db.business_accounts.count_documents({
-        "trial_ends_at": {"$gte": now, "$lte": in_7_days},
-        "subscription_provider": {"$in": ["none", None, ""]},
-        "subscription_status": "active",
-    })
-
-    # New signups today
-    signups_today = await db.users.count_documents({"created_at": {"$gte": today_start}})
-
-    return {
-        "users_by_role": users_by_role,
-        "users_by_plan": users_by_plan,
-        "users_by_country": users_by_country,
-        "recent_signups": recent_signups,
-        "signups_today": signups_today,
-        "trials_expiring_soon": trials_expiring_soon,
-        "top_stores": top_stores,
-        "revenue_today": revenue_today_agg[0]["total"] if revenue_today_agg else 0,
-        "revenue_week": revenue_week_agg[0]["total"] if revenue_week_agg else 0,
-        "revenue_month": revenue_month_agg[0]["total"] if revenue_month_agg else 0,
-        "open_tickets": open_tickets,
-        "low_stock_count": low_stock_count,
-    }
+    return {
+        "users_by_role": current.get("users_by_role", {}),
+        "users_by_plan": current.get("by_plan", {}),
+        "users_by_country": current.get("users_by_country", {}),
+        "recent_signups": int(week.get("signups", {}).get("total", 0)),
+        "signups_today": int(today.get("signups", {}).get("total", 0)),
+        "trials_expiring_soon": current.get("trials_expiring_soon", 0),
+        "top_stores": await platform_metrics.top_stores(db, 5),
+        "revenue_today": today.get("sales", {}).get("revenue", 0),
+        "revenue_week": week.get("sales", {}).get("revenue", 0),
+        "revenue_month": month.get("sales", {}).get("revenue", 0),
+        "open_tickets": current.get("open_tickets", 0),
+        "low_stock_count": current.get("low_stock_count", 0),
+    }
 
 
 @admin_router.get("/stats/onboarding")
@@ -9058,112 +9107,33 @@ async def admin_conversion_stats():
 async def admin_subscriptions_overview(days: int = 30):
     now = datetime.now(timezone.utc)
     window_days = max(1, min(days, 90))
-    week_ahead = now + timedelta(days=7)
-    three_days_ahead = now + timedelta(days=3)
-    window_start = now - timedelta(days=window_days)
-
-    accounts = await db.business_accounts.find(
-        {},
-        {
-            "_id": 0,
-            "account_id": 1,
-            "plan": 1,
-            "subscription_status": 1,
-            "subscription_provider": 1,
-            "subscription_provider_id": 1,
-            "subscription_end": 1,
-            "trial_ends_at": 1,
-            "manual_access_grace_until": 1,
-            "manual_read_only_enabled": 1,
-            "country_code": 1,
-            "currency": 1,
-        },
-    ).to_list(None)
-
-    by_plan: Dict[str, int] = defaultdict(int)
-    by_provider: Dict[str, int] = defaultdict(int)
-    by_currency: Dict[str, int] = defaultdict(int)
-    mrr_by_currency: Dict[str, Decimal] = defaultdict(lambda: Decimal("0"))
-
-    active_paid_accounts = 0
-    active_trials = 0
-    trials_expiring_3d = 0
-    trials_expiring_7d = 0
-    subscriptions_expiring_soon = 0
-    expired_accounts = 0
-    cancelled_accounts = 0
-
-    for account in accounts:
-        normalized_plan = normalize_plan(account.get("plan"))
-        by_plan[normalized_plan] += 1
-        provider = (account.get("subscription_provider") or "none").lower()
-        by_provider[provider] += 1
-        if account.get("currency"):
-            by_currency[(account.get("currency") or DEFAULT_CURRENCY).upper()] += 1
-
-        is_paying = _is_paying_account(account)
-        status = account.get("subscription_status") or "active"
-        sub_end = account.get("subscription_end")
-        trial_ends_at = account.get("trial_ends_at")
-
-        if is_paying and status == "active":
-            active_paid_accounts += 1
-            resolved = resolve_plan_amount(
-                normalized_plan,
-                account.get("currency"),
-                country_code=account.get("country_code"),
-            )
-            mrr_by_currency[resolved["currency"]] += _decimal_or_zero(resolved["amount"])
-            if sub_end:
-                sub_end_aware = sub_end if sub_end.tzinfo else sub_end.replace(tzinfo=timezone.utc)
-                if sub_end_aware >= now and sub_end_aware <= week_ahead:
-                    subscriptions_expiring_soon += 1
-        elif trial_ends_at and status == "active":
-            trial_end_aware = trial_ends_at if trial_ends_at.tzinfo else trial_ends_at.replace(tzinfo=timezone.utc)
-            if trial_end_aware >= now:
-                active_trials += 1
-                if trial_end_aware <= three_days_ahead:
-                    trials_expiring_3d += 1
-                if trial_end_aware <= week_ahead:
-                    trials_expiring_7d += 1
-
-        if status == "expired":
-            expired_accounts += 1
-        if status == "cancelled":
-            cancelled_accounts += 1
-
-    payment_events = await db.subscription_events.find(
-        {"created_at": {"$gte": window_start}, "event_type": "payment_succeeded"},
-        {"_id": 0, "provider": 1, "source": 1, "currency": 1, "amount": 1},
-    ).to_list(None)
-
-    payments_by_provider: Dict[str, int] = defaultdict(int)
-    payments_by_source: Dict[str, int] = defaultdict(int)
-    payment_volume_by_currency: Dict[str, Decimal] = defaultdict(lambda: Decimal("0"))
-    for event in payment_events:
-        payments_by_provider[(event.get("provider") or "unknown").lower()] += 1
-        payments_by_source[(event.get("source") or "unknown").lower()] += 1
-        currency = (event.get("currency") or DEFAULT_CURRENCY).upper()
-        payment_volume_by_currency[currency] += _decimal_or_zero(event.get("amount"))
+    current = await platform_metrics.get_current(db, _platform_account_profile)
+    payments = (await platform_metrics.window_totals(db, now - timedelta(days=window_days), now)).get("payments", {})
 
     return {
         "window_days": window_days,
-        "total_accounts": len(accounts),
-        "active_paid_accounts": active_paid_accounts,
-        "active_trials": active_trials,
-        "trials_expiring_3d": trials_expiring_3d,
-        "trials_expiring_7d": trials_expiring_7d,
-        "subscriptions_expiring_soon": subscriptions_expiring_soon,
-        "expired_accounts": expired_accounts,
-        "cancelled_accounts": cancelled_accounts,
-        "by_plan": dict(by_plan),
-        "by_provider": dict(by_provider),
-        "by_currency": dict(by_currency),
-        "mrr_estimate": [{"currency": currency, "amount": str(amount)} for currency, amount in mrr_by_currency.items()],
-        "payments_count_30d": len(payment_events),
-        "payments_by_provider_30d": dict(payments_by_provider),
-        "payments_by_source_30d": dict(payments_by_source),
-        "payment_volume_30d": [{"currency": currency, "amount": str(amount)} for currency, amount in payment_volume_by_currency.items()],
+        "total_accounts": current.get("total_accounts", 0),
+        "active_paid_accounts": current.get("active_paid_accounts", 0),
+        "active_trials": current.get("active_trials", 0),
+        "trials_expiring_3d": current.get("trials_expiring_3d", 0),
+        "trials_expiring_7d": current.get("trials_expiring_7d", 0),
+        "subscriptions_expiring_soon": current.get("subscriptions_expiring_soon", 0),
+        "expired_accounts": current.get("expired_accounts", 0),
+        "cancelled_accounts": current.get("cancelled_accounts", 0),
+        "by_plan": current.get("by_plan", {}),
+        "by_provider": current.get("by_provider", {}),
+        "by_currency": current.get("by_currency", {}),
+        "mrr_estimate": [
+            {"currency": currency, "amount": platform_metrics.format_amount(amount)}
+            for currency, amount in (current.get("mrr") or {}).items()
+        ],
+        "payments_count_30d": int(payments.get("count", 0)),
+        "payments_by_provider_30d": payments.get("by_provider", {}),
+        "payments_by_source_30d": payments.get("by_source", {}),
+        "payment_volume_30d": [
+            {"currency": currency, "amount": platform_metrics.format_amount(amount)}
+            for currency, amount in (payments.get("volume") or {}).items()
+        ],
     }
 
 
@@ -9304,47 +9274,20 @@ async def admin_mrr_stats(months: int = 12, user: User = Depends(require_superad
     now = datetime.now(timezone.utc)
     since = now - timedelta(days=months * 31)
 
-    # Monthly payments from subscription_events
-    events = await db.subscription_events.find(
-        {"event_type": "payment_succeeded", "created_at": {"$gte": since}},
-        {"_id": 0, "created_at": 1, "amount": 1, "currency": 1, "plan": 1, "source": 1},
-    ).to_list(None)
-
-    # Group by YYYY-MM and plan
-    monthly: Dict[str, Dict[str, Any]] = {}
-    for ev in events:
-        dt = ev.get("created_at")
-        if not dt:
+    daily_docs = await platform_metrics.daily_documents(db, since)
+    monthly = []
+    for month_key, counters in sorted(platform_metrics.monthly_counters(daily_docs).items()):
+        payments = counters.get("payments", {})
+        if not payments.get("count"):
             continue
-        dt_aware = dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
-        month_key = dt_aware.strftime("%Y-%m")
-        plan = (ev.get("plan") or "unknown").lower()
-        currency = (ev.get("currency") or "XOF").upper()
-        amount = float(_decimal_or_zero(ev.get("amount")))
-        if month_key not in monthly:
-            monthly[month_key] = {"month": month_key, "total": {}, "by_plan": {}}
-        monthly[month_key]["total"][currency] = monthly[month_key]["total"].get(currency, 0) + amount
-        if plan not in monthly[month_key]["by_plan"]:
-            monthly[month_key]["by_plan"][plan] = {}
-        monthly[month_key]["by_plan"][plan][currency] = monthly[month_key]["by_plan"][plan].get(currency, 0) + amount
-
-    # Current MRR by plan (active paid accounts)
-    accounts = await db.business_accounts.find(
-        {"subscription_status": "active"},
-        {"_id": 0, "plan": 1, "currency": 1, "country_code": 1},
-    ).to_list(None)
-    current_mrr: Dict[str, Dict[str, float]] = {}
-    for acc in accounts:
-        plan = (acc.get("plan") or "starter").lower()
-        resolved = resolve_plan_amount(plan, acc.get("currency"), country_code=acc.get("country_code"))
-        currency = resolved["currency"]
-        amount = float(_decimal_or_zero(resolved["amount"]))
-        if plan not in current_mrr:
-            current_mrr[plan] = {}
-        current_mrr[plan][currency] = current_mrr[plan].get(currency, 0) + amount
+        monthly.append({
+            "month": month_key,
+            "total": payments.get("volume", {}),
+            "by_plan": payments.get("volume_by_plan", {}),
+        })
 
-    sorted_months = sorted(monthly.values(), key=lambda x: x["month"])
-    return {"monthly": sorted_months, "current_mrr_by_plan": current_mrr}
+    current = await platform_metrics.get_current(db, _platform_account_profile)
+    return {"monthly": monthly, "current_mrr_by_plan": current.get("mrr_by_plan", {})}
 
 
 @admin_router.get("/stats/retention")
@@ -9353,53 +9296,24 @@ async def admin_retention_stats(months: int = 12, user: User = Depends(require_s
     months = max(1, min(months, 24))
     now = datetime.now(timezone.utc)
     since = now - timedelta(days=months * 31)
-
-    # Signups by month
-    new_users = await db.users.find(
-        {"role": "shopkeeper", "created_at": {"$gte": since}},
-        {"_id": 0, "created_at": 1, "plan": 1},
-    ).to_list(None)
-
-    # Churn events (subscription expired / cancelled) by month
-    churn_events = await db.subscription_events.find(
-        {"event_type": {"$in": ["subscription_expired", "subscription_cancelled", "payment_failed"]}, "created_at": {"$gte": since}},
-        {"_id": 0, "created_at": 1, "event_type": 1, "plan": 1},
-    ).to_list(None)
-
-    monthly: Dict[str, Dict[str, int]] = {}
-
-    def _get_month(dt: Any) -> str:
-        if not dt:
-            return "unknown"
-        dt_aware = dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
-        return dt_aware.strftime("%Y-%m")
-
-    for u in new_users:
-        m = _get_month(u.get("created_at"))
-        if m not in monthly:
-            monthly[m] = {"month": m, "signups": 0, "churns": 0}
-        monthly[m]["signups"] += 1
-
-    for ev in churn_events:
-        m = _get_month(ev.get("created_at"))
-        if m not in monthly:
-            monthly[m] = {"month": m, "signups": 0, "churns": 0}
-        monthly[m]["churns"] += 1
+    monthly = platform_metrics.monthly_counters(await platform_metrics.daily_documents(db, since))
 
     # Fill missing months in range with zeros
     result = []
     for i in range(months):
         target = now - timedelta(days=(months - 1 - i) * 31)
         m = target.strftime("%Y-%m")
-        entry = monthly.get(m, {"month": m, "signups": 0, "churns": 0})
+        counters = monthly.get(m, {})
+        entry = {
+            "month": m,
+            "signups": int(counters.get("signups", {}).get("by_role", {}).get("shopkeeper", 0)),
+            "churns": int(counters.get("churn", {}).get("count", 0)),
+        }
         entry["net"] = entry["signups"] - entry["churns"]
         result.append(entry)
 
-    # Total active shopkeepers today
-    total_active = await db.users.count_documents({"role": "shopkeeper", "is_active": {"$ne": False}})
-
-    return {"monthly": result, "total_active_today": total_active}
-
+    current = await platform_metrics.get_current(db, _platform_account_profile)
+    return {"monthly": result, "total_active_today": current.get("active_users", 0)}
 
 @admin_router.get("/subscriptions/events")
 async def admin_subscription_events(
@@ -9824,148 +9738,45 @@ async def admin_verification_events(
 
 @admin_router.get("/stores")
 async def admin_list_stores(skip: int = 0, limit: int = 50):
-    """List all stores with owner info and product counts (Optimized)"""
-    pipeline = [
-        {"$sort": {"created_at": -1}},
-        {"$skip": skip},
-        {"$limit": limit},
-        # Join Owner
-        {"$lookup": {
-            "from": "users",
-            "localField": "user_id",
-            "foreignField": "user_id",
-            "as": "owner"
-        }},
-        {"$unwind": {"path": "$owner", "preserveNullAndEmptyArrays": True}},
-        # Lookup products count
-        {"$lookup": {
-            "from": "products",
-            "localField": "store_id",
-            "foreignField": "store_id",
-            "pipeline": [{"$count": "count"}],
-            "as": "products_agg"
-        }},
-        # Lookup sales stats
-        {"$lookup": {
-            "from": "sales",
-            "localField": "store_id",
-            "foreignField": "store_id",
-            "pipeline": [
-                {"$group": {"_id": None, "total": {"$sum": "$total_amount"}, "count": {"$sum": 1}}}
-            ],
-            "as": "sales_agg"
-        }},
-        # Projection
-        {"$project": {
-            "_id": 0,
-            "store_id": 1, "user_id": 1, "name": 1, "address": 1, "created_at": 1,
-            "country_code": "$owner.country_code",
-            "currency": "$owner.currency",
-            "business_type": "$owner.business_type",
-            "owner_name": {"$ifNull": ["$owner.name", "Inconnu"]},
-            "owner_email": {"$ifNull": ["$owner.email", ""]},
-            "product_count": {"$ifNull": [{"$arrayElemAt": ["$products_agg.count", 0]}, 0]},
-            "total_revenue": {"$ifNull": [{"$arrayElemAt": ["$sales_agg.total", 0]}, 0]},
-            "sales_count": {"$ifNull": [{"$arrayElemAt": ["$sales_agg.count", 0]}, 0]}
-        }}
-    ]
-
-    stores = await db.stores.aggregate(pipeline).to_list(limit)
-    store_ids = [store.get("store_id") for store in stores if store.get("store_id")]
-    if store_ids:
-        product_rows = await db.products.find(
-            {"store_id": {"$in": store_ids}, "is_active": {"$ne": False}},
-            {"_id": 0, "store_id": 1, "quantity": 1, "min_stock": 1, "max_stock": 1, "purchase_price": 1, "expiry_date": 1},
-        ).to_list(None)
-        batches = await db.batches.find(
-            {"store_id": {"$in": store_ids}, "quantity": {"$gt": 0}},
-            {"_id": 0, "store_id": 1, "quantity": 1, "expiry_date": 1},
-        ).to_list(None)
-        active_alerts = await db.alerts.find(
-            {"store_id": {"$in": store_ids}, "is_dismissed": False},
-            {"_id": 0, "store_id": 1, "severity": 1},
-        ).to_list(None)
-        customer_counts = await db.customers.aggregate([
-            {"$match": {"store_id": {"$in": store_ids}}},
-            {"$group": {"_id": "$store_id", "count": {"$sum": 1}}},
-        ]).to_list(len(store_ids))
-        supplier_counts = await db.suppliers.aggregate([
-            {"$match": {"store_id": {"$in": store_ids}, "is_active": {"$ne": False}}},
-            {"$group": {"_id": "$store_id", "count": {"$sum": 1}}},
-        ]).to_list(len(store_ids))
-        last_movements = await db.stock_movements.aggregate([
-            {"$match": {"store_id": {"$in": store_ids}}},
-            {"$sort": {"created_at": -1}},
-            {"$group": {"_id": "$store_id", "created_at": {"$first": "$created_at"}}},
-        ]).to_list(len(store_ids))
-
-        now = datetime.now(timezone.utc)
-        expiry_cutoff = now + timedelta(days=30)
-        customer_count_map = {row.get("_id"): int(row.get("count") or 0) for row in customer_counts}
-        supplier_count_map = {row.get("_id"): int(row.get("count") or 0) for row in supplier_counts}
-        last_movement_map = {row.get("_id"): row.get("created_at") for row in last_movements}
-        metrics: Dict[str, Dict[str, Any]] = {
-            store_id: {
-                "low_stock_count": 0,
-                "out_of_stock_count": 0,
-                "overstock_count": 0,
-                "stock_value": 0.0,
-                "expiring_soon_count": 0,
-                "expired_count": 0,
-                "active_alerts_count": 0,
-                "critical_alerts_count": 0,
-                "customer_count": customer_count_map.get(store_id, 0),
-                "supplier_count": supplier_count_map.get(store_id, 0),
-                "last_movement_at": last_movement_map.get(store_id),
-            }
-            for store_id in store_ids
-        }
-
-        for product in product_rows:
-            store_id = product.get("store_id")
-            bucket = metrics.get(store_id)
-            if not bucket:
-                continue
-            quantity = float(product.get("quantity") or 0)
-            min_stock = float(product.get("min_stock") or 0)
-            max_stock = float(product.get("max_stock") or 0)
-            purchase_price = float(product.get("purchase_price") or 0)
-            bucket["stock_value"] += max(quantity, 0) * max(purchase_price, 0)
-            if quantity <= 0:
-                bucket["out_of_stock_count"] += 1
-            elif min_stock > 0 and quantity <= min_stock:
-                bucket["low_stock_count"] += 1
-            if max_stock > 0 and quantity >= max_stock:
-                bucket["overstock_count"] += 1
-            expiry_date = parse_datetime_value(product.get("expiry_date"))
-            if expiry_date and quantity > 0:
-                if expiry_date <= now:
-                    bucket["expired_count"] += 1
-                elif expiry_date <= expiry_cutoff:
-                    bucket["expiring_soon_count"] += 1
-
-        for batch in batches:
-            store_id = batch.get("store_id")
-            bucket = metrics.get(store_id)
-            expiry_date = parse_datetime_value(batch.get("expiry_date"))
-            if not bucket or not expiry_date:
-                continue
-            if expiry_date <= now:
-                bucket["expired_count"] += 1
-            elif expiry_date <= expiry_cutoff:
-                bucket["expiring_soon_count"] += 1
-
-        for alert in active_alerts:
-            store_id = alert.get("store_id")
-            bucket = metrics.get(store_id)
-            if not bucket:
-                continue
-            bucket["active_alerts_count"] += 1
-            if alert.get("severity") == "critical":
-                bucket["critical_alerts_count"] += 1
+    """List all stores with owner info and the metrics of their platform snapshot"""
+    stores = await db.stores.find(
+        {}, {"_id": 0, "store_id": 1, "user_id": 1, "name": 1, "address": 1, "created_at": 1},
+    ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    owner_ids = list({store.get("user_id") for store in stores if store.get("user_id")})
+    owners = {
+        owner["user_id"]: owner
+        for owner in await db.users.find(
+            {"user_id": {"$in": owner_ids}},
+            {"_id": 0, "user_id": 1, "name": 1, "email": 1, "country_code": 1, "currency": 1, "business_type": 1},
+        ).to_list(len(owner_ids))
+    }
+    snapshots = await platform_metrics.store_snapshots(db, [store["store_id"] for store in stores if store.get("store_id")])
 
-        for store in stores:
-            store.update(metrics.get(store.get("store_id"), {}))
+    for store in stores:
+        owner = owners.get(store.get("user_id"), {})
+        snapshot = snapshots.get(store.get("store_id"), {})
+        store.update({
+            "country_code": owner.get("country_code"),
+            "currency": owner.get("currency"),
+            "business_type": owner.get("business_type"),
+            "owner_name": owner.get("name") or "Inconnu",
+            "owner_email": owner.get("email") or "",
+            "product_count": snapshot.get("product_count", 0),
+            "total_revenue": snapshot.get("revenue", 0),
+            "sales_count": snapshot.get("sales_count", 0),
+            "low_stock_count": snapshot.get("low_stock_count", 0),
+            "out_of_stock_count": snapshot.get("out_of_stock_count", 0),
+            "overstock_count": snapshot.get("overstock_count", 0),
+            "stock_value": snapshot.get("stock_value", 0.0),
+            "expiring_soon_count": snapshot.get("expiring_soon_count", 0),
+            "expired_count": snapshot.get("expired_count", 0),
+            "active_alerts_count": snapshot.get("active_alerts_count", 0),
+            "critical_alerts_count": snapshot.get("critical_alerts_count", 0),
+            "customer_count": snapshot.get("customer_count", 0),
+            "supplier_count": snapshot.get("supplier_count", 0),
+            "last_movement_at": snapshot.get("last_movement_at"),
+            "metrics_refreshed_at": snapshot.get("refreshed_at"),
+        })
     total = await db.stores.count_documents({})
     return {"items": stores, "total": total}
 
@@ -10459,54 +10270,48 @@ class BroadcastMessage(BaseModel):
     message: str
 
 
-async def _resolve_admin_message_recipients(target: str, recipient_user_ids: Optional[List[str]] = None) -> List[dict]:
+def _admin_recipient_query(target: str, recipient_user_ids: Optional[List[str]] = None) -> Dict[str, Any]:
     selected_user_ids = [str(user_id).strip() for user_id in (recipient_user_ids or []) if str(user_id).strip()]
     target_value = (target or "all").strip()
     base_query: Dict[str, Any] = {"is_active": {"$ne": False}}
     if selected_user_ids:
-        query = {**base_query, "user_id": {"$in": list(dict.fromkeys(selected_user_ids))}}
-    elif target_value == "all":
-        query = base_query
-    elif target_value in {"shopkeeper", "supplier", "staff", "admin", "superadmin"}:
-        query = {**base_query, "role": target_value}
-    else:
-        query = {**base_query, "user_id": target_value}
-    return await db.users.find(
-        query,
-        {"_id": 0, "user_id": 1, "email": 1, "push_tokens": 1}
-    ).to_list(length=5000)
+        return {**base_query, "user_id": {"$in": list(dict.fromkeys(selected_user_ids))}}
+    if target_value == "all":
+        return base_query
+    if target_value in {"shopkeeper", "supplier", "staff", "admin", "superadmin"}:
+        return {**base_query, "role": target_value}
+    return {**base_query, "user_id": target_value}
 
 
 def is_anonymous_installation_target(target: str) -> bool:
     return (target or "").strip() in {"anonymous_installations", "anonymous"}
 
 
-async def _resolve_admin_push_installations(
-    target: str,
+def _admin_installation_filters(
     language: Optional[str] = None,
     country_code: Optional[str] = None,
     platform: Optional[str] = None,
-) -> List[dict]:
-    if not is_anonymous_installation_target(target):
-        return []
-    query: Dict[str, Any] = {
-        "is_active": True,
-        "expo_push_token": {"$exists": True, "$ne": ""},
-        "$or": [{"last_user_id": {"$exists": False}}, {"last_user_id": None}],
-    }
+) -> Dict[str, str]:
+    filters: Dict[str, str] = {}
     normalized_language = normalize_push_language(language, None) if language else None
     normalized_country = normalize_push_country_code(country_code, None) if country_code else None
     normalized_platform = (platform or "").strip().lower()
     if normalized_language:
-        query["language"] = normalized_language
+        filters["language"] = normalized_language
     if normalized_country:
-        query["country_code"] = normalized_country
+        filters["country_code"] = normalized_country
     if normalized_platform and normalized_platform != "all":
-        query["platform"] = normalized_platform
-    return await db.push_installations.find(
-        query,
-        {"_id": 0, "installation_id": 1, "expo_push_token": 1, "language": 1, "country_code": 1, "platform": 1}
-    ).to_list(length=10000)
+        filters["platform"] = normalized_platform
+    return filters
+
+
+def _admin_installation_query(filters: Dict[str, str]) -> Dict[str, Any]:
+    return {
+        "is_active": True,
+        "expo_push_token": {"$exists": True, "$ne": ""},
+        "$or": [{"last_user_id": {"$exists": False}}, {"last_user_id": None}],
+        **filters,
+    }
 
 
 def build_admin_message_action_url(deeplink: Optional[Dict[str, Any]]) -> Optional[str]:
@@ -10526,91 +10331,179 @@ def build_admin_message_action_url(deeplink: Optional[Dict[str, Any]]) -> Option
     return build_signed_app_open_link(raw_url, purpose="admin_message")
 
 
-async def _deliver_admin_message(message: AdminMessage, recipients: List[dict]) -> Dict[str, Any]:
-    channels = set(message.channels or ["in_app"])
-    delivery: Dict[str, Any] = {
-        "target_users": len(recipients),
-        "channels": sorted(channels),
-        "push": None,
-        "email": None,
-    }
-    if "push" in channels:
-        tokens: List[str] = []
-        for recipient in recipients:
-            tokens.extend(recipient.get("push_tokens") or [])
-        unique_tokens = list(dict.fromkeys(tokens))
-        delivery["push"] = await notification_service.send_push_notification(
-            unique_tokens,
-            message.title,
-            message.content,
-            {
-                "type": "admin_message",
-                "message_id": message.message_id,
-                "target": message.target,
-                **(message.deeplink or {}),
-            },
-        )
-    if "email" in channels:
-        emails = [recipient.get("email") for recipient in recipients if recipient.get("email")]
-        action_url = build_admin_message_action_url(message.deeplink)
-        action_html = ""
-        action_text = ""
-        if action_url:
-            action_html = f"""
+def _admin_message_email(message: AdminMessage) -> Tuple[str, str]:
+    action_url = build_admin_message_action_url(message.deeplink)
+    action_html = ""
+    action_text = ""
+    if action_url:
+        action_html = f"""
         <p style="margin:20px 0;">
             <a href="{escape(action_url)}" style="display:inline-block;background:#2563eb;color:#ffffff;text-decoration:none;padding:12px 18px;border-radius:10px;font-weight:700;">Ouvrir dans Stockman</a>
         </p>
             """
-            action_text = f"\n\nOuvrir dans Stockman : {action_url}"
-        html_body = f"""
+        action_text = f"\n\nOuvrir dans Stockman : {action_url}"
+    html_body = f"""
         <p>{escape(message.content).replace(chr(10), '<br>')}</p>
         {action_html}
         <p style="color:#64748b;font-size:12px;">Message envoyÃ© par Stockman.</p>
         """
-        delivery["email"] = await notification_service.send_email_notification(
-            emails,
-            message.title,
-            html_body,
-            text_body=f"{message.content}{action_text}",
-            from_email=notification_service.communication_email_from,
-        )
-        delivery["email_recipients"] = len(list(dict.fromkeys([str(email).strip().lower() for email in emails if email])))
-    return delivery
+    return html_body, f"{message.content}{action_text}"
 
 
-async def _deliver_admin_message_to_installations(message: AdminMessage, installations: List[dict]) -> Dict[str, Any]:
-    tokens = list(dict.fromkeys([
-        str(item.get("expo_push_token") or "").strip()
-        for item in installations
-        if str(item.get("expo_push_token") or "").strip()
-    ]))
-    result = await notification_service.send_push_notification(
-        tokens,
-        message.title,
-        message.content,
-        {
+async def _plan_admin_message(message: AdminMessage, segment: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """Delivery summary of an admin message and, for push/email, the broadcast campaign that fans it out."""
+    channels = set(message.channels or ["in_app"])
+    if segment["type"] == "installations":
+        channels = {"push"}
+        delivery: Dict[str, Any] = {
+            "target_installations": await db.push_installations.count_documents(_admin_installation_query(segment["filters"])),
+            "channels": ["push"],
+            "filters": segment["filters"],
+        }
+    else:
+        delivery = {
+            "target_users": await db.users.count_documents(_admin_recipient_query(segment["target"], segment.get("user_ids"))),
+            "channels": sorted(channels),
+        }
+    fan_out = sorted(channels & {"push", "email"})
+    if not fan_out:
+        return {**delivery, "status": "completed"}, None
+    payload: Dict[str, Any] = {
+        "title": message.title,
+        "content": message.content,
+        "channels": fan_out,
+        "data": {
             "type": "admin_message",
             "message_id": message.message_id,
             "target": message.target,
             **(message.deeplink or {}),
         },
-    )
+    }
+    if "email" in channels:
+        payload["email_html"], payload["email_text"] = _admin_message_email(message)
+    campaign = broadcast_campaigns.new_campaign("admin_message", segment, payload, datetime.now(timezone.utc))
+    campaign["message_id"] = message.message_id
+    return {**delivery, "status": "queued", "campaign_id": campaign["campaign_id"]}, campaign
+
+
+_broadcast_runner: Optional[asyncio.Task] = None
+
+
+async def _queue_admin_broadcast(campaign: Optional[Dict[str, Any]]) -> None:
+    """Save the campaign of an already inserted admin message and run it now rather than at the next poll."""
+    global _broadcast_runner
+    if campaign is None:
+        return
+    await broadcast_campaigns.create_campaign(db, campaign)
+    if _broadcast_runner is None or _broadcast_runner.done():
+        _broadcast_runner = asyncio.create_task(run_broadcast_campaigns_loop())
+
+
+def _broadcast_segment(campaign: Dict[str, Any]) -> Dict[str, Any]:
+    segment = campaign.get("segment") or {}
+    if segment.get("type") == "installations":
+        return {
+            "collection": "push_installations",
+            "key": "installation_id",
+            "query": _admin_installation_query(segment.get("filters") or {}),
+            "projection": {"_id": 0, "installation_id": 1, "expo_push_token": 1},
+        }
+    if segment.get("type") == "activation_owners":
+        return {
+            "collection": "users",
+            "key": "user_id",
+            "query": {
+                "is_demo": {"$ne": True},
+                "is_active": {"$ne": False},
+                "role": {"$nin": ["supplier", "staff", "admin", "superadmin"]},
+                "$or": [{"parent_user_id": {"$exists": False}}, {"parent_user_id": None}],
+            },
+            "projection": {"_id": 0, "hashed_password": 0},
+        }
     return {
-        "target_installations": len(installations),
-        "channels": ["push"],
-        "push": result,
-        "filters": {
-            "languages": sorted({item.get("language") for item in installations if item.get("language")}),
-            "country_codes": sorted({item.get("country_code") for item in installations if item.get("country_code")}),
-            "platforms": sorted({item.get("platform") for item in installations if item.get("platform")}),
-        },
+        "collection": "users",
+        "key": "user_id",
+        "query": _admin_recipient_query(segment.get("target") or "all", segment.get("user_ids")),
+        "projection": {"_id": 0, "user_id": 1, "email": 1, "push_tokens": 1},
     }
 
 
+async def _send_admin_message_chunk(campaign: Dict[str, Any], recipients: List[dict]) -> Dict[str, int]:
+    payload = campaign["payload"]
+    counts: Dict[str, int] = {}
+    if "push" in payload["channels"]:
+        tokens = list(dict.fromkeys(
+            str(token or "").strip()
+            for recipient in recipients
+            for token in (recipient.get("push_tokens") or [recipient.get("expo_push_token")])
+            if is_expo_push_token(str(token or "").strip())
+        ))
+        messages = [
+            {"to": token, "title": payload["title"], "body": payload["content"], "sound": "default", "data": payload["data"]}
+            for token in tokens
+        ]
+        tickets = await notification_service.send_push_messages(messages)
+        dead_tokens = [
+            message["to"]
+            for message, ticket in zip(messages, tickets)
+            if (ticket.get("details") or {}).get("error") == "DeviceNotRegistered"
+        ]
+        await notification_service.prune_tokens(db, dead_tokens)
+        counts["push_sent"] = sum(1 for ticket in tickets if ticket.get("status") == "ok")
+        counts["push_failed"] = len(tickets) - counts["push_sent"]
+    if "email" in payload["channels"]:
+        emails = [
+            {
+                "to": [email],
+                "subject": payload["title"],
+                "html": payload["email_html"],
+                "text": payload["email_text"],
+                "from": notification_service.communication_email_from,
+            }
+            for email in dict.fromkeys(
+                str(recipient.get("email") or "").strip().lower() for recipient in recipients
+            )
+            if email
+        ]
+        counts["emails_sent"] = await notification_service.send_email_batch(emails)
+        counts["emails_failed"] = len(emails) - counts["emails_sent"]
+    return counts
+
+
+async def _send_broadcast_chunk(campaign: Dict[str, Any], recipients: List[dict]) -> Dict[str, int]:
+    if campaign["kind"] == "activation":
+        return await send_activation_campaign_chunk(recipients, datetime.now(timezone.utc))
+    return await _send_admin_message_chunk(campaign, recipients)
+
+
+async def run_broadcast_campaigns_loop():
+    """Runs queued broadcast campaigns one after the other, resuming interrupted ones."""
+    while True:
+        campaign = await broadcast_campaigns.claim_campaign(db, datetime.now(timezone.utc))
+        if not campaign:
+            return
+        result = await broadcast_campaigns.run_campaign(
+            db,
+            campaign,
+            _broadcast_segment(campaign),
+            lambda chunk: _send_broadcast_chunk(campaign, chunk),
+            lambda: datetime.now(timezone.utc),
+        )
+        if result["status"] != "completed":
+            continue
+        final = await db.broadcast_campaigns.find_one({"campaign_id": campaign["campaign_id"]}, {"_id": 0, "counters": 1})
+        counters = (final or {}).get("counters") or {}
+        logger.info("Broadcast %s completed: %s", campaign["campaign_id"], counters)
+        if campaign.get("message_id"):
+            await db.admin_messages.update_one(
+                {"message_id": campaign["message_id"]},
+                {"$set": {"delivery.status": "completed", "delivery.counters": counters}},
+            )
+
+
 @admin_router.post("/broadcast")
 async def admin_broadcast(data: BroadcastMessage):
     """Send broadcast message to all users"""
-    recipients = await _resolve_admin_message_recipients("all")
     msg = AdminMessage(
         type="broadcast",
         title=data.title,
@@ -10619,9 +10512,10 @@ async def admin_broadcast(data: BroadcastMessage):
         channels=["in_app", "push"],
         sent_by="Admin"
     )
-    delivery = await _deliver_admin_message(msg, recipients)
+    delivery, campaign = await _plan_admin_message(msg, {"type": "users", "target": "all"})
     msg.delivery = delivery
     await db.admin_messages.insert_one(msg.model_dump())
+    await _queue_admin_broadcast(campaign)
 
 
     # Log the broadcast
@@ -10632,11 +10526,30 @@ async def admin_broadcast(data: BroadcastMessage):
         "module": "broadcast",
         "action": "broadcast_sent",
         "description": f"Diffusion: {data.title} - {data.message}",
-        "created_at": datetime.now(timezone.utc)
+        "created_at": datetime.now(timezone.utc),
+        "expires_at": retention.expires_at("activity_logs"),
     })
 
-    sent_to = (delivery.get("push") or {}).get("valid_tokens", 0)
-    return {"status": "sent", "count": sent_to, "sent_to": sent_to, "delivery": delivery}
+    sent_to = delivery["target_users"]
+    return {
+        "status": delivery["status"],
+        "count": sent_to,
+        "sent_to": sent_to,
+        "campaign_id": delivery.get("campaign_id"),
+        "delivery": delivery,
+    }
+
+
+@admin_router.get("/broadcasts/{campaign_id}")
+async def admin_get_broadcast(campaign_id: str):
+    """Progress of a broadcast campaign"""
+    campaign = await db.broadcast_campaigns.find_one(
+        {"campaign_id": campaign_id},
+        {"_id": 0, "payload": 0, "lease": 0},
+    )
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Diffusion introuvable")
+    return campaign
 
 # ===================== INVENTORY MANAGEMENT =====================
 
@@ -10665,15 +10578,21 @@ async def batch_product_action(data: BatchActionRequest, user: User = Depends(re
     }
 
     if data.action == "delete":
+        doomed = await db.products.find(
+            query, {"_id": 0, "product_id": 1, "user_id": 1, "store_id": 1, "inventory_class": 1}
+        ).to_list(None)
         result = await db.products.delete_many(query)
+        await _retire_from_inventory_summary(doomed)
         message = f"{result.deleted_count} produits supprimÃ©s"
 
     elif data.action == "activate":
         result = await db.products.update_many(query, {"$set": {"is_active": True}})
+        await _sync_inventory_summary(data.product_ids, catalog_changed=True)
         message = f"{result.modified_count} produits activÃ©s"
 
     elif data.action == "deactivate":
         result = await db.products.update_many(query, {"$set": {"is_active": False}})
+        await _sync_inventory_summary(data.product_ids, catalog_changed=True)
         message = f"{result.modified_count} produits dÃ©sactivÃ©s"
 
     elif data.action == "set_category":
@@ -10693,7 +10612,8 @@ async def batch_product_action(data: BatchActionRequest, user: User = Depends(re
         "module": "inventory",
         "action": f"batch_{data.action}",
         "description": message,
-        "created_at": datetime.now(timezone.utc)
+        "created_at": datetime.now(timezone.utc),
+        "expires_at": retention.expires_at("activity_logs", normalize_plan(user.effective_plan)),
     })
 
     return {"message": message, "count": result.modified_count if hasattr(result, 'modified_count') else result.deleted_count}
@@ -11569,19 +11489,6 @@ async def detect_anomalies_internal(user_id: str, store_id: Optional[str] = None
         low_revenue_days = len([value for value in daily_rev.values() if value <= (avg_daily_rev * 0.4)])
         active_days_14 = len(daily_rev)
 
-        # Hard guards to reduce noisy alerts:
-        # each anomaly type must be supported by concrete metrics.
-        signal_map: Dict[str, bool] = {
-            "revenue": active_days_14 >= 10 and avg_daily_rev > 0 and low_revenue_days >= 4,
-            "volume": len(volume_changes) >= 2,
-            "margin": len(margin_issues) >= 3,
-            "stock": out_of_stock_count >= 5 or out_of_stock_ratio >= 0.25,
-        }
-
-        # If there is no strong signal, skip AI generation entirely.
-        if not any(signal_map.values()):
-            return []
-
         revenue_data = [f"{d}: {r:.0f} {currency} ({c} ventes)" for d, r, c in
                         sorted([(d, daily_rev[d], daily_count[d]) for d in daily_rev], key=lambda x: x[0])[-14:]]
 
@@ -11606,6 +11513,19 @@ async def detect_anomalies_internal(user_id: str, store_id: Optional[str] = None
             elif s_prev_daily > 1 and s7_daily < s_prev_daily * 0.3:
                 volume_changes.append(f"- {p['name']}: chute x{s_prev_daily/max(s7_daily,0.1):.1f}")
 
+        # Hard guards to reduce noisy alerts:
+        # each anomaly type must be supported by concrete metrics.
+        signal_map: Dict[str, bool] = {
+            "revenue": active_days_14 >= 10 and avg_daily_rev > 0 and low_revenue_days >= 4,
+            "volume": len(volume_changes) >= 2,
+            "margin": len(margin_issues) >= 3,
+            "stock": out_of_stock_count >= 5 or out_of_stock_ratio >= 0.25,
+        }
+
+        # If there is no strong signal, skip AI generation entirely.
+        if not any(signal_map.values()):
+            return []
+
         lang_instr = get_language_instruction(lang)
         prompt = f"""Tu es un analyste business expert. Analyse ces donnÃ©es d'un commerce et dÃ©tecte les ANOMALIES.
 CA quotidien (14 derniers jours) : {chr(10).join(revenue_data) if revenue_data else "Aucune"}
@@ -11627,7 +11547,8 @@ Contraintes importantes:
 
         genai.configure(api_key=api_key)
         model = build_gemini_model()
-        response = model.generate_content(prompt)
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, model.generate_content, prompt)
         text = response.text.strip()
         if text.startswith("```"):
             text = text.split("\n", 1)[1].rsplit("```", 1)[0].strip()
@@ -12111,56 +12032,56 @@ async def ai_churn_prediction(request: Request, lang: str = "fr", user: User = D
         store_id = user.active_store_id
         query = apply_accessible_store_scope({"user_id": owner_id}, user, store_id)
 
-        customers = await db.customers.find(query, {"_id": 0, "customer_id": 1, "name": 1, "last_purchase_date": 1, "total_spent": 1, "visits": 1, "loyalty_tier": 1}).to_list(500)
-        if not customers:
+        if not await db.customers.count_documents(query, limit=1):
             return {"at_risk": [], "summary": "Aucun client trouvÃ©."}
 
+        # Inactive customers straight from the stored stats, best historical spenders first.
+        await customer_stats.ensure_customer_stats(db, owner_id)
         now = datetime.now(timezone.utc)
-        at_risk = []
-        for c in customers:
-            lpd = c.get("last_purchase_date")
-            if not lpd:
-                continue
-
-            try:
-                # Handle both datetime and string formats
-                d = lpd if isinstance(lpd, datetime) else datetime.fromisoformat(str(lpd).replace("Z", "+00:00"))
-                if d.tzinfo is None:
-                    d = d.replace(tzinfo=timezone.utc)
-
-                days_inactive = (now - d).days
-                if days_inactive >= 30:
-                    # Anonymize name (I13)
-                    raw_name = c.get("name", "N/A")
-                    initials = "".join([n[0] for n in str(raw_name).split() if n]) if raw_name else "XX"
-                    anon_name = f"Client {initials}***"
-
-                    at_risk.append({
-                        "customer_id": c.get("customer_id"),
-                        "name": anon_name,
-                        "days_inactive": days_inactive,
-                        "total_spent": c.get("total_spent", 0),
-                        "tier": c.get("loyalty_tier", "bronze"),
-                        "visits": c.get("visits", 0)
-                    })
-            except Exception as e:
-                logger.warning(f"Error processing customer {c.get('customer_id')} for churn: {e}")
-                continue
-
-        at_risk.sort(key=lambda x: (-x["total_spent"], x["days_inactive"]))
-        top_at_risk = at_risk[:10]
+        churn_query = {**query, "stats.last_purchase_at": {"$lte": now - timedelta(days=30)}}
+        churn_totals = (await db.customers.aggregate([
+            {"$match": churn_query},
+            {"$group": {
+                "_id": None,
+                "count": {"$sum": 1},
+                "total_spent": {"$sum": "$stats.lifetime_spend"},
+                "premium": {"$sum": {"$cond": [{"$in": ["$loyalty_tier", ["gold", "platinum", "silver"]]}, 1, 0]}},
+            }},
+        ]).to_list(1) or [{}])[0]
+        top_docs = await db.customers.find(
+            churn_query,
+            {"_id": 0, "customer_id": 1, "name": 1, "stats": 1, "loyalty_tier": 1},
+        ).sort([("stats.lifetime_spend", -1), ("stats.last_purchase_at", -1)]).limit(10).to_list(10)
+
+        top_at_risk = []
+        for c in top_docs:
+            stats = c.get("stats") or {}
+            last_purchase = _parse_crm_datetime(stats.get("last_purchase_at"))
+            # Anonymize name (I13)
+            raw_name = c.get("name", "N/A")
+            initials = "".join([n[0] for n in str(raw_name).split() if n]) if raw_name else "XX"
+            top_at_risk.append({
+                "customer_id": c.get("customer_id"),
+                "name": f"Client {initials}***",
+                "days_inactive": (now - last_purchase).days if last_purchase else None,
+                "total_spent": stats.get("lifetime_spend", 0),
+                "tier": c.get("loyalty_tier", "bronze"),
+                "visits": stats.get("visit_count", 0),
+                "rfm": customer_stats.rfm_scores(stats, now),
+            })
+        total_at_risk = int(churn_totals.get("count") or 0)
 
         lang_map = {"fr": "franÃ§ais", "en": "English", "ar": "Ø§Ù„Ø¹Ø±Ø¨ÙŠØ©", "es": "espaÃ±ol"}
         lang_instr = f"RÃ©ponds en {lang_map.get(lang, 'franÃ§ais')}."
 
-        total_spent_at_risk = sum(c['total_spent'] for c in at_risk)
-        top_tier_at_risk = [c for c in at_risk if c['tier'] in ('gold', 'platinum', 'silver')]
+        total_spent_at_risk = float(churn_totals.get("total_spent") or 0)
+        premium_at_risk = int(churn_totals.get("premium") or 0)
 
         summary_prompt = f"""{lang_instr}
 Tu es un expert CRM et fidÃ©lisation client. Analyse ces donnÃ©es de churn et fournis une stratÃ©gie de rÃ©tention.
 
-SITUATION : {len(at_risk)} clients inactifs depuis 30j+, reprÃ©sentant {total_spent_at_risk:.0f} de CA historique.
-Clients premium Ã  risque (silver/gold/platinum) : {len(top_tier_at_risk)}
+SITUATION : {total_at_risk} clients inactifs depuis 30j+, reprÃ©sentant {total_spent_at_risk:.0f} de CA historique.
+Clients premium Ã  risque (silver/gold/platinum) : {premium_at_risk}
 
 TOP 5 CLIENTS Ã€ RISQUE :
 {chr(10).join([f"- {c['name']}: {c['days_inactive']}j inactif, {c['total_spent']:.0f} dÃ©pensÃ©, {c['visits']} visites, tier {c['tier']}" for c in top_at_risk[:5]])}
@@ -12177,7 +12098,7 @@ Sois direct et opÃ©rationnel. Utilise les chiffres fournis."""
         model = build_gemini_model()
         response = model.generate_content(summary_prompt)
 
-        return {"at_risk": top_at_risk, "total_at_risk": len(at_risk), "summary": response.text.strip()}
+        return {"at_risk": top_at_risk, "total_at_risk": total_at_risk, "summary": response.text.strip()}
     except Exception as e:
         logger.error(f"AI churn-prediction error: {e}")
         raise HTTPException(status_code=500, detail="Erreur prÃ©diction churn")
@@ -14098,92 +14019,43 @@ async def get_contextual_tips(user: User = Depends(require_operational_access)):
 @api_router.get("/ai/product-correlations")
 async def get_product_correlations(
     min_support: int = 3,
+    product_id: Optional[str] = None,
+    store_id: Optional[str] = None,
     user: User = Depends(require_operational_access)
 ):
     """
     Find product pairs frequently bought together (market basket analysis).
-    Uses co-occurrence in sales with â‰¥2 items. Computes lift score.
-    Enterprise only.
+    Served from precomputed co-occurrence counters over the full sales history,
+    with exponential decay so recent baskets weigh more. Enterprise only.
     """
     owner_id = get_owner_id(user)
     plan = _resolve_ai_plan(user)
     _check_ai_gate(owner_id, "product_correlations", plan)
+    if store_id:
+        ensure_user_store_access(user, store_id)
 
-    cache_key = f"product_correlations:{owner_id}"
-    cached = _ai_cache.get(cache_key)
-    if cached and (datetime.now(timezone.utc).timestamp() - _ai_cache_ts.get(cache_key, 0)) < 86400:
-        return cached
-
-    ninety_days_ago = datetime.now(timezone.utc) - timedelta(days=90)
-
-    # Fetch multi-item sales
-    sales = await db.sales.find(
-        {"user_id": owner_id, "created_at": {"$gte": ninety_days_ago}, f"items.1": {"$exists": True}},
-        {"items.product_id": 1, "items.name": 1}
-    ).to_list(2000)
-
-    if not sales:
-        return {"pairs": [], "total_baskets": 0}
-
-    # Build co-occurrence matrix
-    from itertools import combinations
-    co_occurrence: Dict[tuple, int] = {}
-    product_freq: Dict[str, int] = {}
-    total_baskets = len(sales)
-
-    product_names: Dict[str, str] = {}
-
-    for sale in sales:
-        items = sale.get("items", [])
-        pids = []
-        for item in items:
-            pid = item.get("product_id")
-            if pid:
-                pids.append(pid)
-                product_freq[pid] = product_freq.get(pid, 0) + 1
-                if pid not in product_names and item.get("name"):
-                    product_names[pid] = item["name"]
-
-        pids = list(set(pids))  # deduplicate within basket
-        for pair in combinations(sorted(pids), 2):
-            co_occurrence[pair] = co_occurrence.get(pair, 0) + 1
-
-    # Filter by min_support and compute lift
-    pairs = []
-    for (pid_a, pid_b), count in co_occurrence.items():
-        if count < min_support:
-            continue
-        freq_a = product_freq.get(pid_a, 1)
-        freq_b = product_freq.get(pid_b, 1)
-        support = count / total_baskets
-        expected = (freq_a / total_baskets) * (freq_b / total_baskets)
-        lift = support / expected if expected > 0 else 0
-        if lift >= 1.5:
-            pairs.append({
-                "product_a_id": pid_a,
-                "product_a_name": product_names.get(pid_a, pid_a),
-                "product_b_id": pid_b,
-                "product_b_name": product_names.get(pid_b, pid_b),
-                "co_occurrence": count,
-                "lift": round(lift, 2),
-                "support": round(support * 100, 1),
-            })
-
-    pairs.sort(key=lambda x: x["lift"], reverse=True)
-    pairs = pairs[:20]
+    insights = await basket_analysis.get_basket_insights(db, owner_id, store_id, min_support=max(1, min_support))
+    if product_id:
+        pairs = basket_analysis.pairs_for_product(insights, product_id)
+    else:
+        pairs = (insights.get("pairs") or [])[:20]
 
     _track_ai_usage_lite(owner_id, "product_correlations", plan)
 
-    result = {
+    return {
         "pairs": pairs,
-        "total_baskets": total_baskets,
-        "analysis_window_days": 90,
-        "min_lift": 1.5,
+        "total_baskets": insights.get("total_baskets", 0),
+        "half_life_days": insights.get("half_life_days"),
+        "min_lift": insights.get("min_lift", basket_analysis.DEFAULT_MIN_LIFT),
+        "computed_at": insights.get("computed_at"),
+        "pending": bool(insights.get("pending")),
     }
 
-    _ai_cache[cache_key] = result
-    _ai_cache_ts[cache_key] = datetime.now(timezone.utc).timestamp()
-    return result
+
+async def refresh_basket_insights_loop():
+    refreshed = await basket_analysis.refresh_dirty_basket_insights(db)
+    if refreshed:
+        logger.info("Refreshed basket insights for %s owner(s)", refreshed)
 
 
 # ===================== END VAGUE 5 =====================
@@ -14999,66 +14871,6 @@ Reply with JSON only, exactly: {{"intent": "...", "period_days": N}}"""
 
 # ===================== VAGUE 7 â€” voice to cart =====================
 
-def _match_products_from_text(text: str, products: list) -> list:
-    """Match product names from transcribed text. Returns list of {product, qty}."""
-    text_lower = text.lower()
-    results = []
-    # Sort by name length descending (longest match first to avoid partial collisions)
-    sorted_products = sorted(products, key=lambda p: len(p.get("name", "")), reverse=True)
-
-    import re as _re
-    for product in sorted_products:
-        name = (product.get("name") or "").lower().strip()
-        if not name or len(name) < 2:
-            continue
-
-        # Look for the product name in the text
-        # Also look for common quantity patterns before/after the name
-        # e.g. "2 coca", "coca fois 3", "trois bouteilles de coca"
-        pattern = _re.escape(name)
-        match = _re.search(pattern, text_lower)
-        if not match:
-            continue
-
-        # Try to extract quantity near the match
-        qty = 1
-        start = match.start()
-        end = match.end()
-        context_before = text_lower[max(0, start - 20):start]
-        context_after = text_lower[end:min(len(text_lower), end + 20)]
-
-        # Number words
-        word_to_num = {
-            "un": 1, "une": 1, "one": 1, "uno": 1,
-            "deux": 2, "two": 2, "dos": 2, "deux": 2,
-            "trois": 3, "three": 3, "tres": 3,
-            "quatre": 4, "four": 4, "cuatro": 4,
-            "cinq": 5, "five": 5, "cinco": 5,
-            "six": 6, "sept": 7, "huit": 8, "neuf": 9, "dix": 10,
-        }
-
-        # Numeric digit before name
-        num_before = _re.search(r'(\d+)\s*$', context_before)
-        num_after = _re.search(r'^\s*(?:fois|x|Ã—)\s*(\d+)', context_after)
-        word_before = None
-        for word, val in word_to_num.items():
-            if _re.search(r'\b' + word + r'\s*$', context_before):
-                word_before = val
-                break
-
-        if num_before:
-            qty = int(num_before.group(1))
-        elif num_after:
-            qty = int(num_after.group(1))
-        elif word_before:
-            qty = word_before
-
-        qty = max(1, min(qty, 999))
-        results.append({"product": product, "qty": qty})
-
-    return results
-
-
 @api_router.post("/ai/voice-to-cart")
 async def voice_to_cart(body: dict = Body(...), user: User = Depends(require_operational_access)):
     """Transcribe voice audio and match products to build a cart."""
@@ -15091,7 +14903,8 @@ async def voice_to_cart(body: dict = Body(...), user: User = Depends(require_ope
         audio_bytes = _b64.b64decode(audio_base64)
         audio_part = {"inline_data": {"mime_type": "audio/m4a", "data": audio_base64}}
         transcription_prompt = f"Transcribe exactly what is said in this audio in {lang_name}. Output only the transcription, no comments."
-        response = model.generate_content([transcription_prompt, audio_part])
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, model.generate_content, [transcription_prompt, audio_part])
         transcription = (response.text or "").strip() if response else ""
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
@@ -15099,25 +14912,31 @@ async def voice_to_cart(body: dict = Body(...), user: User = Depends(require_ope
     if not transcription:
         return {"transcription": "", "items": [], "unmatched": True}
 
-    # Fetch products catalogue
-    store_filter = {"store_id": store_id} if store_id else {}
-    products = await db.products.find(
-        {"owner_id": owner_id, **store_filter, "quantity": {"$gt": 0}}
-    ).limit(500).to_list(None)
+    # Match products in one pass over the transcription (cached per-store automaton)
+    matcher = await voice_matcher.get_store_matcher(db, owner_id, store_id)
+    matched = matcher.match(transcription)
 
-    # Match products in transcription
-    matched = _match_products_from_text(transcription, products)
+    # Prices and stock change with every sale, so they are read fresh for the matched ids only
+    live_products = {}
+    if matched:
+        live_docs = await db.products.find(
+            {"user_id": owner_id, "product_id": {"$in": [m["product"]["product_id"] for m in matched]}, "quantity": {"$gt": 0}},
+            {"_id": 0, "product_id": 1, "name": 1, "selling_price": 1, "quantity": 1, "sku": 1},
+        ).to_list(None)
+        live_products = {doc["product_id"]: doc for doc in live_docs}
 
     items = []
     for m in matched:
-        p = m["product"]
+        p = live_products.get(m["product"]["product_id"])
+        if not p:
+            continue
         items.append({
             "product_id": p.get("product_id"),
             "name": p.get("name"),
             "quantity": m["qty"],
-            "unit_price": p.get("price", 0),
+            "unit_price": p.get("selling_price", 0),
             "stock_available": p.get("quantity", 0),
-            "barcode": p.get("barcode"),
+            "barcode": p.get("sku"),
         })
 
     _track_ai_usage_lite(owner_id, "voice_to_cart", plan)
@@ -15235,18 +15054,20 @@ async def admin_send_message(data: AdminMessageCreate, user: User = Depends(requ
         deeplink={str(key): value for key, value in (data.deeplink or {}).items() if value is not None and str(value).strip()}
     )
     if is_anonymous_installation_target(data.target):
-        installations = await _resolve_admin_push_installations(
-            data.target,
-            language=data.installation_language,
-            country_code=data.installation_country_code,
-            platform=data.installation_platform,
-        )
-        delivery = await _deliver_admin_message_to_installations(msg, installations)
+        segment = {
+            "type": "installations",
+            "filters": _admin_installation_filters(
+                language=data.installation_language,
+                country_code=data.installation_country_code,
+                platform=data.installation_platform,
+            ),
+        }
     else:
-        recipients = await _resolve_admin_message_recipients(data.target, msg.target_user_ids)
-        delivery = await _deliver_admin_message(msg, recipients)
+        segment = {"type": "users", "target": data.target, "user_ids": msg.target_user_ids}
+    delivery, campaign = await _plan_admin_message(msg, segment)
     msg.delivery = delivery
     await db.admin_messages.insert_one(msg.model_dump())
+    await _queue_admin_broadcast(campaign)
 
     # Log
     await db.activity_logs.insert_one({
@@ -15256,7 +15077,8 @@ async def admin_send_message(data: AdminMessageCreate, user: User = Depends(requ
         "module": "communication",
         "action": "message_sent",
         "description": f"Message ({data.type}): {data.title} â†’ {data.target}",
-        "created_at": datetime.now(timezone.utc)
+        "created_at": datetime.now(timezone.utc),
+        "expires_at": retention.expires_at("activity_logs"),
     })
 
     return {"message_id": msg.message_id, "sent": True, "delivery": delivery}
@@ -15658,6 +15480,9 @@ TEXTE Ã€ PARSER :
             })
             await db.products.insert_one(product_doc)
             created += 1
+        if created:
+            _invalidate_catalog_caches(owner_id, user.active_store_id)
+            await _reconcile_owner_inventory_summaries(owner_id)
 
         # Contribute to global catalog
         sector = user.business_type or "autre"
@@ -15822,9 +15647,16 @@ async def start_production_order(order_id: str, user: User = Depends(require_wri
     if not user.active_store_id:
         raise HTTPException(status_code=400, detail="No active store")
     try:
-        return await production_service.start_production(db, order_id, user.active_store_id)
+        order = await production_service.start_production(db, order_id, user.active_store_id)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    consumed_ids = [ing.get("product_id") for ing in order.get("ingredients_consumed") or []]
+    await db.products.update_many(
+        {"product_id": {"$in": consumed_ids}, "store_id": user.active_store_id},
+        {"$max": {"last_movement_out_at": order["started_at"]}},
+    )
+    await _sync_inventory_summary(consumed_ids)
+    return order
 
 
 @api_router.put("/production/orders/{order_id}/complete")
@@ -15833,11 +15665,13 @@ async def complete_production_order(order_id: str, data: ProductionCompleteReque
     if not user.active_store_id:
         raise HTTPException(status_code=400, detail="No active store")
     try:
-        return await production_service.complete_production(
+        order = await production_service.complete_production(
             db, order_id, user.active_store_id, data.actual_output, data.waste_quantity
         )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    await _sync_inventory_summary([order.get("output_product_id")])
+    return order
 
 
 @api_router.put("/production/orders/{order_id}/cancel")
@@ -15846,9 +15680,11 @@ async def cancel_production_order(order_id: str, user: User = Depends(require_wr
     if not user.active_store_id:
         raise HTTPException(status_code=400, detail="No active store")
     try:
-        return await production_service.cancel_production(db, order_id, user.active_store_id)
+        order = await production_service.cancel_production(db, order_id, user.active_store_id)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    await _sync_inventory_summary([ing.get("product_id") for ing in order.get("ingredients_consumed") or []])
+    return order
 
 
 @api_router.get("/production/dashboard")
@@ -16195,260 +16031,294 @@ async def admin_catalog_delete(catalog_id: str, user: User = Depends(require_sup
     return {"status": "deleted", "catalog_id": catalog_id}
 
 
-async def check_ai_anomalies_loop():
-    """Logic for AI anomaly detection check (called by supervised_loop) (I8)"""
-    logger.info("Starting global AI anomaly detection check...")
-    now = datetime.now(timezone.utc)
-    ai_cooldown_since = now - timedelta(hours=24)
-    # Run for all shopkeepers with active stores
-    users = await db.users.find({"role": "shopkeeper", "active_store_id": {"$ne": None}}).to_list(None)
-    for u in users:
-        user_id = u["user_id"]
-        store_id = u["active_store_id"]
-        account_id = u.get("account_id")
-        anomalies = await detect_anomalies_internal(user_id, store_id)
-
-        for anomaly in anomalies:
-            alert_type = f"ai_{anomaly['type']}"
+async def _check_tenant_anomalies(user_doc: Dict[str, Any], store_id: str, ai_cooldown_since: datetime) -> None:
+    """Detect anomalies for one owner's store and raise the resulting alerts."""
+    user_id = user_doc["user_id"]
+    account_id = user_doc.get("account_id")
+    stock_summary = await db.inventory_summaries.find_one(
+        {"user_id": user_id, "store_id": store_id}, {"_id": 0, "total_products": 1}
+    )
+    if stock_summary is not None and not stock_summary.get("total_products"):
+        # Stores without products only produce false positives.
+        await db.alerts.update_many(
+            {"user_id": user_id, "store_id": store_id, "type": {"$regex": "^ai_"}, "is_dismissed": False},
+            {"$set": {"is_dismissed": True}},
+        )
+        return
+    anomalies = await detect_anomalies_internal(user_id, store_id)
 
-            # Nettoyage prÃ©ventif des doublons actifs dÃ©jÃ  existants:
-            # on conserve la plus rÃ©cente, les autres sont marquÃ©es ignorÃ©es.
-            active_same_type = await db.alerts.find(
-                {
-                    "user_id": user_id,
-                    "store_id": store_id,
-                    "type": alert_type,
-                    "is_dismissed": False,
-                },
-                {"_id": 0, "alert_id": 1},
-            ).sort("created_at", -1).to_list(50)
-            if len(active_same_type) > 1:
-                duplicate_ids = [doc.get("alert_id") for doc in active_same_type[1:] if doc.get("alert_id")]
-                if duplicate_ids:
-                    await db.alerts.update_many(
-                        {"user_id": user_id, "alert_id": {"$in": duplicate_ids}},
-                        {"$set": {"is_dismissed": True}},
-                    )
+    for anomaly in anomalies:
+        alert_type = f"ai_{anomaly['type']}"
 
-            # DÃ©duplication stricte:
-            # 1) ne pas recrÃ©er si une alerte active du mÃªme type existe dÃ©jÃ  pour la boutique,
-            # 2) ne pas recrÃ©er si une alerte du mÃªme type a dÃ©jÃ  Ã©tÃ© Ã©mise rÃ©cemment (cooldown),
-            #    mÃªme si elle a Ã©tÃ© ignorÃ©e.
-            existing_active = await db.alerts.find_one({
+        # Nettoyage prÃ©ventif des doublons actifs dÃ©jÃ  existants:
+        # on conserve la plus rÃ©cente, les autres sont marquÃ©es ignorÃ©es.
+        active_same_type = await db.alerts.find(
+            {
                 "user_id": user_id,
                 "store_id": store_id,
                 "type": alert_type,
                 "is_dismissed": False,
-            })
-            recent_same_type = await db.alerts.find_one({
-                "user_id": user_id,
-                "store_id": store_id,
-                "type": alert_type,
-                "created_at": {"$gte": ai_cooldown_since},
-            })
-
-            if not existing_active and not recent_same_type:
-                alert = Alert(
-                    user_id=user_id,
-                    store_id=store_id,
-                    type=alert_type,
-                    title=anomaly["title"],
-                    message=anomaly["description"],
-                    severity=anomaly["severity"]
-                )
-                await db.alerts.insert_one(alert.model_dump())
-                await dispatch_alert_channels(
-                    user_id,
-                    account_id,
-                    store_id,
-                    alert,
-                    data={"screen": "alerts", "filter": "anomalies"},
+            },
+            {"_id": 0, "alert_id": 1},
+        ).sort("created_at", -1).to_list(50)
+        if len(active_same_type) > 1:
+            duplicate_ids = [doc.get("alert_id") for doc in active_same_type[1:] if doc.get("alert_id")]
+            if duplicate_ids:
+                await db.alerts.update_many(
+                    {"user_id": user_id, "alert_id": {"$in": duplicate_ids}},
+                    {"$set": {"is_dismissed": True}},
                 )
 
-    logger.info("Global AI anomaly detection check completed")
-
-async def check_alerts_loop():
-    """Logic for stock and expiry alerts (called by supervised_loop)"""
-    logger.info("Checking for stock and expiry alerts...")
-    now = datetime.now(timezone.utc)
-    since_24h = now - timedelta(hours=24)
-
-    # 1. Low stock alerts â€” Pro + Enterprise only, dedup on active (non-dismissed) alerts
-    async for product in db.products.find({
-        "min_stock": {"$gt": 0},
-        "quantity": {"$gt": 0},
-        "$expr": {"$lte": ["$quantity", "$min_stock"]}
-    }):
-        owner_id = product.get("user_id")
-        if not owner_id:
-            continue
-
-        owner = await db.users.find_one(
-            {"user_id": owner_id},
-            {"plan": 1, "effective_plan": 1, "subscription_plan": 1, "push_notifications": 1, "account_id": 1}
-        )
-        owner_plan = normalize_plan(owner.get("effective_plan") or owner.get("subscription_plan") or owner.get("plan")) if owner else "starter"
-        if owner_plan not in ("pro", "enterprise"):
-            continue
-
-        product_id = product.get("product_id")
-
-        # Dedup: skip if an active (non-dismissed) alert already exists for this product
-        existing = await db.alerts.find_one({
-            "user_id": owner_id,
-            "product_id": product_id,
-            "type": "low_stock",
+        # DÃ©duplication stricte:
+        # 1) ne pas recrÃ©er si une alerte active du mÃªme type existe dÃ©jÃ  pour la boutique,
+        # 2) ne pas recrÃ©er si une alerte du mÃªme type a dÃ©jÃ  Ã©tÃ© Ã©mise rÃ©cemment (cooldown),
+        #    mÃªme si elle a Ã©tÃ© ignorÃ©e.
+        existing_active = await db.alerts.find_one({
+            "user_id": user_id,
+            "store_id": store_id,
+            "type": alert_type,
             "is_dismissed": False,
         })
-        if existing:
-            continue
-
-        # Create alert record
-        alert = Alert(
-            user_id=owner_id,
-            store_id=product.get("store_id"),
-            product_id=product_id,
-            type="low_stock",
-            title="Stock bas",
-            message=f"Le produit {product['name']} est presque Ã©puisÃ© ({product['quantity']} restant(s)).",
-            severity="warning" if product["quantity"] > 0 else "critical",
-        )
-        await db.alerts.insert_one(alert.model_dump())
-        await dispatch_alert_channels(
-            owner_id,
-            owner.get("account_id"),
-            product.get("store_id"),
-            alert,
-            data={"screen": "products", "filter": "low_stock"},
-        )
+        recent_same_type = await db.alerts.find_one({
+            "user_id": user_id,
+            "store_id": store_id,
+            "type": alert_type,
+            "created_at": {"$gte": ai_cooldown_since},
+        })
 
-    # 2. Expiry alerts (within 7 days) â€” dedup on active alerts
-    seven_days_later = now + timedelta(days=7)
-    async for batch in db.batches.find({"expiry_date": {"$lte": seven_days_later.isoformat()}, "quantity": {"$gt": 0}}):
-        owner_id = batch.get("user_id")
-        if not owner_id:
-            continue
+        if not existing_active and not recent_same_type:
+            alert = Alert(
+                user_id=user_id,
+                store_id=store_id,
+                type=alert_type,
+                title=anomaly["title"],
+                message=anomaly["description"],
+                severity=anomaly["severity"]
+            )
+            await db.alerts.insert_one(alert.model_dump())
+            await dispatch_alert_channels(
+                user_id,
+                account_id,
+                store_id,
+                alert,
+                data={"screen": "alerts", "filter": "anomalies"},
+            )
 
-        owner = await db.users.find_one(
-            {"user_id": owner_id},
-            {"plan": 1, "effective_plan": 1, "subscription_plan": 1, "account_id": 1}
-        )
-        owner_plan = normalize_plan(owner.get("effective_plan") or owner.get("subscription_plan") or owner.get("plan")) if owner else "starter"
-        if owner_plan not in ("pro", "enterprise"):
-            continue
 
-        batch_id = batch.get("batch_id") or batch.get("batch_number")
+async def check_ai_anomalies_loop():
+    """Logic for AI anomaly detection check (called by supervised_loop) (I8)"""
+    now = datetime.now(timezone.utc)
+    ai_cooldown_since = now - timedelta(hours=24)
+    cycle = await anomaly_scheduler.start_or_resume_cycle(db, now)
+    activity = await anomaly_scheduler.tenant_activity(db, cycle["since"])
+    owner_ids = list({owner_id for owner_id, _ in activity})
+    users = {
+        user_doc["user_id"]: user_doc
+        for user_doc in await db.users.find(
+            {"user_id": {"$in": owner_ids}, "role": "shopkeeper", "active_store_id": {"$ne": None}},
+            {"_id": 0, "user_id": 1, "active_store_id": 1, "account_id": 1},
+        ).to_list(None)
+    }
+    account_ids = list({user_doc.get("account_id") for user_doc in users.values() if user_doc.get("account_id")})
+    paying_accounts = {
+        account["account_id"]
+        for account in await db.business_accounts.find(
+            {"account_id": {"$in": account_ids}, "subscription_status": "active"},
+            {"_id": 0, "account_id": 1, "subscription_provider": 1, "subscription_end": 1},
+        ).to_list(None)
+        if _is_paying_account(account)
+    }
+    paying_owner_ids = {user_id for user_id, user_doc in users.items() if user_doc.get("account_id") in paying_accounts}
+    tenants = [(user_id, user_doc["active_store_id"]) for user_id, user_doc in users.items()]
+    due = await anomaly_scheduler.due_tenants(db, cycle["cycle_id"], activity, tenants, paying_owner_ids)
+    logger.info("AI anomaly cycle %s: %s tenant(s) with new activity", cycle["cycle_id"], len(due))
 
-        # Dedup: skip if an active expiry alert already exists for this batch
-        existing = await db.alerts.find_one({
-            "user_id": owner_id,
-            "type": "expiry",
-            "message": {"$regex": batch.get("batch_number", "")},
-            "is_dismissed": False,
-        })
-        if existing:
-            continue
+    async def run(tenant: anomaly_scheduler.Tenant) -> None:
+        await _check_tenant_anomalies(users[tenant[0]], tenant[1], ai_cooldown_since)
+        await anomaly_scheduler.mark_checked(db, cycle["cycle_id"], tenant, activity[tenant], datetime.now(timezone.utc))
 
-        alert = Alert(
-            user_id=owner_id,
-            store_id=batch.get("store_id"),
-            product_id=batch.get("product_id"),
-            type="expiry",
-            title="Expiration proche",
-            message=f"Le lot {batch['batch_number']} de {batch.get('product_name', 'produit')} expire le {batch['expiry_date']}.",
-            severity="warning",
-        )
-        await db.alerts.insert_one(alert.model_dump())
-        await dispatch_alert_channels(
-            owner_id,
-            owner.get("account_id"),
-            batch.get("store_id"),
-            alert,
-            data={"screen": "products", "filter": "expiry"},
-        )
+    async def failed(tenant: anomaly_scheduler.Tenant) -> None:
+        await anomaly_scheduler.mark_failed(db, tenant, activity[tenant], datetime.now(timezone.utc))
 
+    processed = await anomaly_scheduler.run_pool(due, run, on_error=failed)
+    await anomaly_scheduler.complete_cycle(db, cycle["cycle_id"], datetime.now(timezone.utc), processed)
+    logger.info("Global AI anomaly detection check completed (%s tenant(s))", processed)
 
-async def check_planner_reminders_loop():
-    """Envoie les rappels Notes / Calendrier dus aux utilisateurs Enterprise."""
-    now = datetime.now(timezone.utc)
-    due_items = await db.user_planner_items.find(
-        {
-            "is_completed": False,
-            "reminder_at": {"$lte": now},
-            "last_notified_at": None,
-        },
-        {"_id": 0},
-    ).limit(50).to_list(50)
+def _owner_has_scanner_alerts(owner: Dict[str, Any]) -> bool:
+    if not owner:
+        return False
+    return normalize_plan(owner.get("effective_plan") or owner.get("subscription_plan") or owner.get("plan")) in ("pro", "enterprise")
 
-    if not due_items:
-        return
 
-    for item in due_items:
+async def _raise_scanner_alerts(
+    rule: str,
+    owners: Dict[str, Dict[str, Any]],
+    candidates: List[Tuple[Alert, alert_scanner.DedupeKey]],
+    data: Dict[str, Any],
+) -> None:
+    covered = await alert_scanner.active_keys(db, rule, [key for _, key in candidates])
+    pending = [(alert, key) for alert, key in candidates if key not in covered]
+    created = await alert_scanner.upsert_alerts(db, [(alert.model_dump(), key) for alert, key in pending])
+    for index in created:
+        alert, _ = pending[index]
+        owner = owners.get(alert.user_id) or {}
         try:
-            user_id = item.get("user_id")
-            if not user_id:
-                continue
-
-            user_doc = await db.users.find_one(
-                {"user_id": user_id},
-                {"email": 1, "plan": 1, "effective_plan": 1, "subscription_plan": 1, "account_id": 1},
+            await dispatch_alert_channels(
+                alert.user_id,
+                owner.get("account_id"),
+                alert.store_id,
+                alert,
+                data=data,
+                settings_doc=owner.get("settings"),
             )
-            if not user_doc:
-                continue
+        except Exception as exc:
+            logger.warning("Alert dispatch failed for %s: %s", alert.alert_id, exc)
+
 
-            effective_plan = normalize_plan(
-                user_doc.get("effective_plan") or user_doc.get("subscription_plan") or user_doc.get("plan")
+async def check_alerts_loop():
+    """Logic for stock and expiry alerts (called by supervised_loop)"""
+    logger.info("Checking for stock and expiry alerts...")
+    now = datetime.now(timezone.utc)
+    owners: Dict[str, Dict[str, Any]] = {}
+
+    # 1. Low stock alerts â€” Pro + Enterprise only, one active alert per product
+    cursor = db.products.aggregate(alert_scanner.low_stock_pipeline(), batchSize=alert_scanner.SCAN_CHUNK)
+    async for chunk in alert_scanner.chunks(cursor):
+        await alert_scanner.load_owners(db, owners, (product["user_id"] for product in chunk))
+        candidates = [
+            (
+                Alert(
+                    user_id=product["user_id"],
+                    store_id=product.get("store_id"),
+                    product_id=product.get("product_id"),
+                    type="low_stock",
+                    title="Stock bas",
+                    message=f"Le produit {product.get('name')} est presque épuisé ({product.get('quantity')} restant(s)).",
+                    severity="warning",
+                ),
+                alert_scanner.dedupe_key(alert_scanner.LOW_STOCK_RULE, product["user_id"], product.get("product_id")),
             )
-            if effective_plan != "enterprise":
-                await db.user_planner_items.update_one(
-                    {"item_id": item["item_id"]},
-                    {"$set": {"last_notified_at": now}},
-                )
+            for product in chunk
+            if _owner_has_scanner_alerts(owners.get(product["user_id"]))
+        ]
+        await _raise_scanner_alerts(alert_scanner.LOW_STOCK_RULE, owners, candidates, {"screen": "products", "filter": "low_stock"})
+
+    # 2. Expiry alerts (within 7 days) â€” one active alert per batch
+    cursor = db.batches.aggregate(
+        alert_scanner.expiring_batches_pipeline(now + timedelta(days=7)), batchSize=alert_scanner.SCAN_CHUNK,
+    )
+    async for chunk in alert_scanner.chunks(cursor):
+        await alert_scanner.load_owners(db, owners, (batch["user_id"] for batch in chunk))
+        candidates = []
+        for batch in chunk:
+            if not _owner_has_scanner_alerts(owners.get(batch["user_id"])):
                 continue
+            expiry_date = parse_datetime_value(batch.get("expiry_date"))
+            candidates.append((
+                Alert(
+                    user_id=batch["user_id"],
+                    store_id=batch.get("store_id"),
+                    product_id=batch.get("product_id"),
+                    type="expiry",
+                    title="Expiration proche",
+                    message=f"Le lot {batch.get('batch_number')} de {batch.get('product_name')} expire le {expiry_date.date().isoformat()}.",
+                    severity="warning",
+                ),
+                alert_scanner.dedupe_key(
+                    alert_scanner.EXPIRY_RULE,
+                    batch["user_id"],
+                    batch.get("product_id"),
+                    batch.get("batch_id") or batch.get("batch_number"),
+                ),
+            ))
+        await _raise_scanner_alerts(alert_scanner.EXPIRY_RULE, owners, candidates, {"screen": "products", "filter": "expiry"})
+
+
+async def _deliver_planner_reminders(token: str, items: List[Dict[str, Any]], now: datetime) -> None:
+    """Deliver a claimed batch of reminders: one user query, then batched sends per channel."""
+    user_ids = list({item.get("user_id") for item in items if item.get("user_id")})
+    users = {
+        user_doc["user_id"]: user_doc
+        for user_doc in await db.users.find(
+            {"user_id": {"$in": user_ids}},
+            {"_id": 0, "user_id": 1, "email": 1, "plan": 1, "effective_plan": 1, "subscription_plan": 1},
+        ).to_list(len(user_ids))
+    }
 
-            channels = normalize_planner_channels(item.get("channels"))
-            reminder_title = item.get("title") or "Rappel"
-            reminder_content = (item.get("content") or "").strip()
-            push_body = reminder_content or "Vous avez un rappel prevu dans Stockman."
-
-            if "in_app" in channels:
-                message = AdminMessage(
-                    type="individual",
-                    title=f"Rappel : {reminder_title}",
-                    content=push_body,
-                    target=user_id,
-                    sent_by="Stockman",
-                )
-                await db.admin_messages.insert_one(message.model_dump())
+    in_app_messages: List[Dict[str, Any]] = []
+    pushes: List[Dict[str, Any]] = []
+    emails: List[Dict[str, Any]] = []
+    handled: List[str] = []
+    for item in items:
+        handled.append(item["item_id"])
+        user_doc = users.get(item.get("user_id"))
+        if not user_doc:
+            continue
+        effective_plan = normalize_plan(
+            user_doc.get("effective_plan") or user_doc.get("subscription_plan") or user_doc.get("plan")
+        )
+        if effective_plan != "enterprise":
+            continue
 
-            if "push" in channels:
-                await notification_service.notify_user(
-                    db,
-                    user_id,
-                    f"Rappel : {reminder_title}",
-                    push_body,
-                    {"type": "planner_reminder", "item_id": item.get("item_id")},
-                    caller_owner_id=user_doc.get("account_id"),
-                )
+        channels = normalize_planner_channels(item.get("channels"))
+        reminder_title = item.get("title") or "Rappel"
+        reminder_content = (item.get("content") or "").strip()
+        push_body = reminder_content or "Vous avez un rappel prevu dans Stockman."
+
+        if "in_app" in channels:
+            in_app_messages.append(AdminMessage(
+                type="individual",
+                title=f"Rappel : {reminder_title}",
+                content=push_body,
+                target=user_doc["user_id"],
+                sent_by="Stockman",
+            ).model_dump())
 
-            if "email" in channels and user_doc.get("email"):
-                subject = f"Rappel Stockman : {reminder_title}"
-                html_body = (
+        if "push" in channels:
+            pushes.append({
+                "user_id": user_doc["user_id"],
+                "title": f"Rappel : {reminder_title}",
+                "body": push_body,
+                "data": {"type": "planner_reminder", "item_id": item.get("item_id")},
+            })
+
+        if "email" in channels and user_doc.get("email"):
+            emails.append({
+                "to": [user_doc["email"]],
+                "subject": f"Rappel Stockman : {reminder_title}",
+                "html": (
                     f"<p>Bonjour,</p><p>Votre rappel <strong>{reminder_title}</strong> est arrive a echeance.</p>"
                     f"<p>{reminder_content or 'Ouvrez Stockman pour le consulter et le marquer comme termine.'}</p>"
-                )
-                text_body = (
+                ),
+                "text": (
                     f"Votre rappel Stockman \"{reminder_title}\" est arrive a echeance.\n\n"
                     f"{reminder_content or 'Ouvrez Stockman pour le consulter et le marquer comme termine.'}"
-                )
-                await notification_service.send_email_notification([user_doc["email"]], subject, html_body, text_body=text_body)
+                ),
+            })
 
-            await db.user_planner_items.update_one(
-                {"item_id": item["item_id"]},
-                {"$set": {"last_notified_at": now}},
-            )
+    if in_app_messages:
+        await db.admin_messages.insert_many(in_app_messages)
+    if pushes:
+        await notification_service.notify_users(db, pushes)
+    if emails:
+        await notification_service.send_email_batch(emails)
+    await reminder_queue.complete(db, token, handled, now)
+
+
+async def check_planner_reminders_loop():
+    """Envoie les rappels Notes / Calendrier dus aux utilisateurs Enterprise."""
+    for _ in range(reminder_queue.MAX_BATCHES_PER_RUN):
+        now = datetime.now(timezone.utc)
+        token, items = await reminder_queue.claim_batch(db, now)
+        if not items:
+            return
+        try:
+            await _deliver_planner_reminders(token, items, now)
         except Exception as exc:
-            logger.warning(f"Planner reminder notification failed for {item.get('item_id')}: {exc}")
+            # The lease expires on its own and the batch is retried then.
+            logger.warning("Planner reminder batch failed (%s item(s)): %s", len(items), exc)
+        if len(items) < reminder_queue.CLAIM_BATCH:
+            return
 
 
 
@@ -16470,26 +16340,15 @@ async def get_background_tasks_health(user: User = Depends(require_superadmin)):
     return background_tasks_status
 
 async def cleanup_logs_loop():
-    """Removes security logs older than 90 days (I11)"""
-    retention_days = 90
-    threshold = datetime.now(timezone.utc) - timedelta(days=retention_days)
-
-    # 1. Cleanup security events
-    result = await db.security_events.delete_many({"created_at": {"$lt": threshold}})
-    if result.deleted_count:
-        logger.info(f"Cleanup: Removed {result.deleted_count} security logs older than {retention_days} days")
-
-    # 2. Cleanup activity logs
-    result_act = await db.activity_logs.delete_many({"created_at": {"$lt": threshold}})
-    if result_act.deleted_count:
-        logger.info(f"Cleanup: Removed {result_act.deleted_count} activity logs older than {retention_days} days")
-
-    # 3. Cleanup inactive sessions (I10)
-    # Session is considered stale if last_active > 24 hours
-    session_threshold = datetime.now(timezone.utc) - timedelta(hours=24)
-    result_sessions = await db.user_sessions.delete_many({"last_active": {"$lt": session_threshold}})
-    if result_sessions.deleted_count:
-        logger.info(f"Cleanup: Expired {result_sessions.deleted_count} inactive sessions (24h rule)")
+    """Archives log records about to expire (I11).
+
+    Deletion itself is done by the TTL indexes of services.retention; this
+    only copies what is about to go to the monthly archive files, when
+    RETENTION_ARCHIVE_DIR is configured.
+    """
+    archived = await retention.archive_expiring(db)
+    if archived:
+        logger.info(f"Retention: archived {archived} record(s) before expiry")
 
 # ===================== POS ENDPOINTS =====================
 
@@ -17171,6 +17030,7 @@ async def register(request: Request, user_data: UserCreate, response: Response):
         }
 
         await db.users.insert_one(user_doc)
+        await _record_platform_signup(user_doc)
 
         # Log registration activity
         log_user = await build_user_from_doc(user_doc)
@@ -17489,6 +17349,7 @@ async def verify_social_login(request: Request, data: SocialLoginRequest, respon
         }
 
         await db.users.insert_one(user_doc)
+        await _record_platform_signup(user_doc)
 
         log_user = await build_user_from_doc(user_doc)
         await log_activity(
@@ -17598,6 +17459,7 @@ async def verify_phone(request: Request, data: VerifyPhoneRequest, current_user:
         "provider": "firebase",
         "firebase_uid": verified_phone.get("firebase_uid"),
         "created_at": datetime.now(timezone.utc).isoformat(),
+        "expires_at": retention.expires_at("security_events"),
     })
     await log_verification_event(
         "otp_verified",
@@ -17681,6 +17543,7 @@ async def verify_email(request: Request, response: Response, data: VerifyEmailRe
             "user_id": current_user.user_id,
             "email": user_doc.get("email"),
             "created_at": datetime.now(timezone.utc).isoformat(),
+            "expires_at": retention.expires_at("security_events"),
         })
         await log_verification_event(
             "otp_verified",
@@ -18300,6 +18163,7 @@ async def update_store(data: StoreUpdate, store_id: str = Path(..., pattern="^[a
     if not update:
         raise HTTPException(status_code=400, detail="Aucun champ Ã  mettre Ã  jour")
     await db.stores.update_one({"store_id": store_id, "user_id": owner_id}, {"$set": update})
+    await storefront_cache.bump_version(db, [owner_id])
     doc = await db.stores.find_one({"store_id": store_id, "user_id": owner_id}, {"_id": 0})
     if not doc:
         raise HTTPException(status_code=404, detail="Boutique non trouvÃ©e")
@@ -18361,6 +18225,7 @@ async def update_ecommerce_site(data: EcommerceSiteUpdate, user: User = Depends(
             updates["ecommerce_domain_mode"] = "connect"
             updates["ecommerce_domain_status"] = "pending_verification"
             updates["ecommerce_domain_verified_at"] = None
+            updates["ecommerce_domain_check_requested_at"] = updates["updated_at"]
         else:
             updates["ecommerce_custom_domain"] = None
             updates["ecommerce_domain_status"] = "not_configured"
@@ -18395,7 +18260,13 @@ async def update_ecommerce_site(data: EcommerceSiteUpdate, user: User = Depends(
     if data.show_out_of_stock_products is not None:
         updates["ecommerce_show_out_of_stock_products"] = bool(data.show_out_of_stock_products)
     if len(updates) > 1 and account_doc:
-        await db.business_accounts.update_one({"account_id": account_doc["account_id"]}, {"$set": updates})
+        await db.business_accounts.update_one(
+            {"account_id": account_doc["account_id"]},
+            {"$set": updates, "$inc": {storefront_cache.VERSION_FIELD: 1}},
+        )
+        storefront_domains.forget(account_doc.get("ecommerce_custom_domain"), updates.get("ecommerce_custom_domain"))
+        if updates.get("ecommerce_domain_check_requested_at"):
+            start_custom_domain_checks()
     return EcommerceSiteInfo(**await ensure_ecommerce_site_for_owner(owner_id, user.active_store_id))
 
 
@@ -18411,16 +18282,9 @@ async def verify_ecommerce_site_domain(user: User = Depends(require_auth)):
     domain = account_doc.get("ecommerce_custom_domain")
     if not domain:
         raise HTTPException(status_code=400, detail="Ajoutez d'abord un nom de domaine")
-    verified = await verify_ecommerce_domain_resolution(domain)
-    now = datetime.now(timezone.utc)
-    await db.business_accounts.update_one(
-        {"account_id": account_doc["account_id"]},
-        {"$set": {
-            "ecommerce_domain_status": "verified" if verified else "pending_verification",
-            "ecommerce_domain_verified_at": now if verified else None,
-            "updated_at": now,
-        }},
-    )
+    # The DNS lookups run in the background; the client polls GET /ecommerce/site for the result.
+    await storefront_domains.request_check(db, account_doc["account_id"], datetime.now(timezone.utc))
+    start_custom_domain_checks()
     return EcommerceSiteInfo(**await ensure_ecommerce_site_for_owner(owner_id, user.active_store_id))
 
 
@@ -18432,25 +18296,18 @@ async def get_ecommerce_stats(user: User = Depends(require_permission("stock", "
     slug = site.get("slug")
     now = datetime.now(timezone.utc)
     start_30d = now - timedelta(days=30)
-    start_today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    base_event_query = {"user_id": owner_id, "site_slug": slug}
-    if store_id:
-        base_event_query["store_id"] = store_id
     base_order_query = {"user_id": owner_id}
     if store_id:
         base_order_query["store_id"] = store_id
-
-    visits_30d_query = {**base_event_query, "event_type": "site_view", "created_at": {"$gte": start_30d}}
-    visits_today_query = {**base_event_query, "event_type": "site_view", "created_at": {"$gte": start_today}}
-    cart_30d_query = {**base_event_query, "event_type": "add_to_cart", "created_at": {"$gte": start_30d}}
     orders_30d_query = {**base_order_query, "created_at": {"$gte": start_30d}}
 
-    visits_total = await db.ecommerce_events.count_documents({**base_event_query, "event_type": "site_view"})
-    visits_30d = await db.ecommerce_events.count_documents(visits_30d_query)
-    visits_today = await db.ecommerce_events.count_documents(visits_today_query)
-    unique_visitors_30d = len(await db.ecommerce_events.distinct("visitor_key", visits_30d_query))
-    add_to_cart_30d = await db.ecommerce_events.count_documents(cart_30d_query)
-    products_in_cart_30d = await db.ecommerce_events.distinct("product_id", {**cart_30d_query, "product_id": {"$ne": None}})
+    traffic = await storefront_events.read_stats(db, owner_id, slug, store_id, now, days=30)
+    visits_total = traffic["visits_total"]
+    visits_30d = traffic["visits_window"]
+    visits_today = traffic["visits_today"]
+    unique_visitors_30d = traffic["unique_visitors_window"]
+    add_to_cart_30d = traffic["add_to_cart_window"]
+    top_cart_products = traffic["top_cart_products"]
     orders_total = await db.ecommerce_orders.count_documents(base_order_query)
     orders_30d = await db.ecommerce_orders.count_documents(orders_30d_query)
     pending_orders = await db.ecommerce_orders.count_documents({**base_order_query, "status": "pending"})
@@ -18473,12 +18330,6 @@ async def get_ecommerce_stats(user: User = Depends(require_permission("stock", "
     revenue_docs = await db.ecommerce_orders.aggregate(revenue_pipeline).to_list(1)
     revenue_doc = revenue_docs[0] if revenue_docs else {}
 
-    top_cart_products = await db.ecommerce_events.aggregate([
-        {"$match": {**cart_30d_query, "product_id": {"$ne": None}}},
-        {"$group": {"_id": "$product_id", "name": {"$first": "$product_name"}, "quantity": {"$sum": {"$ifNull": ["$quantity", 1]}}, "events": {"$sum": 1}}},
-        {"$sort": {"quantity": -1, "events": -1}},
-        {"$limit": 5},
-    ]).to_list(5)
     top_ordered_products = await db.ecommerce_orders.aggregate([
         {"$match": orders_30d_query},
         {"$unwind": "$items"},
@@ -18498,7 +18349,7 @@ async def get_ecommerce_stats(user: User = Depends(require_permission("stock", "
         "visits_today": visits_today,
         "unique_visitors_30d": unique_visitors_30d,
         "add_to_cart_30d": add_to_cart_30d,
-        "products_in_cart_30d": len(products_in_cart_30d),
+        "products_in_cart_30d": traffic["products_in_cart_window"],
         "orders_total": orders_total,
         "orders_30d": orders_30d,
         "pending_orders": pending_orders,
@@ -18577,10 +18428,15 @@ async def convert_ecommerce_order_to_sale(order: Dict[str, Any], user: User) ->
             raise HTTPException(status_code=400, detail=f"Stock insuffisant pour {product.get('name')}")
         update_result = await db.products.update_one(
             {"product_id": product_id, "user_id": owner_id, "store_id": store_id, "quantity": {"$gte": quantity}},
-            {"$inc": {"quantity": -quantity}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            {
+                "$inc": {"quantity": -quantity},
+                "$set": {"updated_at": datetime.now(timezone.utc)},
+                "$max": {"last_movement_out_at": datetime.now(timezone.utc)},
+            },
         )
         if update_result.modified_count == 0:
             raise HTTPException(status_code=400, detail=f"Stock insuffisant pour {product.get('name')}")
+        await _sync_inventory_summary([product_id])
         new_quantity = current_quantity - quantity
         movement = StockMovement(
             product_id=product_id,
@@ -18636,6 +18492,7 @@ async def convert_ecommerce_order_to_sale(order: Dict[str, Any], user: User) ->
         current_amount=total_amount,
     )
     await db.sales.insert_one(sale.model_dump())
+    asyncio.create_task(_after_sale_completed(sale.model_dump()))
     await _apply_sale_customer_effects(owner_id, order.get("customer_id"), customer_effects, customer_channel="ecommerce")
     await db.ecommerce_orders.update_one(
         {"order_id": order["order_id"], "user_id": owner_id},
@@ -18646,6 +18503,8 @@ async def convert_ecommerce_order_to_sale(order: Dict[str, Any], user: User) ->
             "updated_at": datetime.now(timezone.utc),
         }},
     )
+    if not order.get("sale_id"):
+        await customer_stats.record_order_converted(db, order)
     _invalidate_dashboard_ai_caches(owner_id, store_id)
     updated = await db.ecommerce_orders.find_one({"order_id": order["order_id"], "user_id": owner_id}, {"_id": 0})
     return updated or order
@@ -18697,6 +18556,8 @@ async def update_ecommerce_order_status(
         {"order_id": order_id, "user_id": owner_id},
         {"$set": {"status": payload.status, "updated_at": datetime.now(timezone.utc)}},
     )
+    if payload.status in {"cancelled", "rejected"}:
+        await customer_stats.refresh_customer(db, owner_id, order.get("customer_id"))
     updated = await db.ecommerce_orders.find_one({"order_id": order_id, "user_id": owner_id}, {"_id": 0})
     customer_email = str((updated or {}).get("customer_email") or "").strip().lower()
     if customer_email:
@@ -18778,7 +18639,7 @@ async def transfer_stock(data: StockTransfer, user: User = Depends(require_permi
     # Atomic deduct from source â€” prevents race condition / negative stock
     from_product = await db.products.find_one_and_update(
         {"product_id": data.product_id, "user_id": owner_id, "store_id": data.from_store_id, "quantity": {"$gte": data.quantity}},
-        {"$inc": {"quantity": -data.quantity}},
+        {"$inc": {"quantity": -data.quantity}, "$max": {"last_movement_out_at": datetime.now(timezone.utc)}},
         return_document=False,
     )
     if not from_product:
@@ -18798,7 +18659,7 @@ async def transfer_stock(data: StockTransfer, user: User = Depends(require_permi
         dest_query = {"user_id": owner_id, "store_id": data.to_store_id, "barcode": barcode}
 
     now = datetime.now(timezone.utc)
-    new_product = {k: v for k, v in from_product.items() if k not in {"_id", "quantity"}}
+    new_product = {k: v for k, v in from_product.items() if k not in {"_id", "quantity", "inventory_class", "last_sold_at", "last_movement_out_at", "last_counted_at"}}
     new_product["product_id"] = f"prod_{uuid.uuid4().hex[:12]}"
     new_product["store_id"] = data.to_store_id
     new_product["created_at"] = now
@@ -18855,6 +18716,7 @@ async def transfer_stock(data: StockTransfer, user: User = Depends(require_permi
         "created_at": now,
     }
     await db.stock_transfers.insert_one(transfer_record)
+    await _sync_inventory_summary([data.product_id, (dest_existing or {}).get("product_id") or new_product["product_id"]])
 
     await log_activity(user, "stock_transfer", "stock",
         f"Transfert {data.quantity}x '{from_product['name']}' : {from_store['name']} â†’ {to_store['name']}",
@@ -18940,6 +18802,7 @@ async def create_category(cat_data: CategoryCreate, user: User = Depends(require
         store_id=user.active_store_id
     )
     await db.categories.insert_one(category.model_dump())
+    await storefront_cache.bump_version(db, [owner_id])
     return category
 
 @api_router.put("/categories/{category_id}", response_model=Category)
@@ -18966,6 +18829,7 @@ async def update_category(category_id: str, cat_data: CategoryCreate, user: User
     )
     if not result:
         raise HTTPException(status_code=404, detail="CatÃ©gorie non trouvÃ©e")
+    await storefront_cache.bump_version(db, [owner_id])
     result.pop("_id", None)
     return Category(**result)
 
@@ -18984,6 +18848,7 @@ async def delete_category(category_id: str, user: User = Depends(require_permiss
         {"category_id": category_id, "user_id": owner_id},
         {"$set": {"category_id": None}}
     )
+    await storefront_cache.bump_version(db, [owner_id])
     return {"message": "CatÃ©gorie supprimÃ©e"}
 
 # ===================== PRODUCT ROUTES =====================
@@ -19231,6 +19096,8 @@ async def create_product(prod_data: ProductCreate, user: User = Depends(require_
         store_id=user.active_store_id
     )
     await db.products.insert_one(product.model_dump())
+    _invalidate_catalog_caches(owner_id, user.active_store_id)
+    await _sync_inventory_summary([product.product_id], catalog_changed=True)
 
     await log_activity(user, "product_created", "stock", f"Produit '{product.name}' crÃ©Ã©", {"product_id": product.product_id})
 
@@ -19330,6 +19197,8 @@ async def update_product(product_id: str, prod_data: ProductUpdate, user: User =
         raise HTTPException(status_code=404, detail="Produit non trouvÃ©")
 
     result.pop("_id", None)
+    _invalidate_catalog_caches(owner_id, result.get("store_id"))
+    await _sync_inventory_summary([product_id], catalog_changed=True)
     product = _product_response_for_user(user, result)
 
     await log_activity(user, "product_updated", "stock", f"Produit '{product.name}' modifiÃ©", {"product_id": product_id})
@@ -19408,6 +19277,7 @@ async def bulk_update_product_prices(
 
         updated += 1
         _invalidate_dashboard_ai_caches(owner_id, current_product.get("store_id") or user.active_store_id)
+        await _sync_inventory_summary([item.product_id], catalog_changed=True)
 
     if updated > 0:
         await log_activity(
@@ -19507,10 +19377,11 @@ async def adjust_product_stock(product_id: str, adj_data: StockAdjustmentRequest
 
     # Physical inventory adjustments do not modify the weighted average cost.
     # Update product quantity
-    await db.products.update_one(
-        {"product_id": product_id, "user_id": owner_id},
-        {"$set": {"quantity": actual_quantity, "updated_at": datetime.now(timezone.utc)}}
-    )
+    stock_update = {"$set": {"quantity": actual_quantity, "updated_at": datetime.now(timezone.utc)}}
+    if diff < 0:
+        stock_update["$max"] = {"last_movement_out_at": datetime.now(timezone.utc)}
+    await db.products.update_one({"product_id": product_id, "user_id": owner_id}, stock_update)
+    await _sync_inventory_summary([product_id])
 
     # Record movement
     movement = StockMovement(
@@ -19565,6 +19436,8 @@ async def delete_product(product_id: str, user: User = Depends(require_permissio
         raise HTTPException(status_code=404, detail="Produit non trouve")
 
     _invalidate_dashboard_ai_caches(owner_id, product.get("store_id") or user.active_store_id)
+    _invalidate_catalog_caches(owner_id, product.get("store_id") or user.active_store_id)
+    await _sync_inventory_summary([product_id], catalog_changed=True)
     await log_activity(
         user,
         "product_deleted",
@@ -19695,6 +19568,8 @@ async def restore_product(product_id: str, user: User = Depends(require_permissi
         raise HTTPException(status_code=404, detail="Produit non trouve")
 
     _invalidate_dashboard_ai_caches(owner_id, restored.get("store_id") or user.active_store_id)
+    _invalidate_catalog_caches(owner_id, restored.get("store_id") or user.active_store_id)
+    await _sync_inventory_summary([product_id], catalog_changed=True)
     await log_activity(
         user,
         "product_restored",
@@ -19710,7 +19585,7 @@ async def permanently_delete_product(product_id: str, user: User = Depends(requi
     owner_id = get_owner_id(user)
     product = await db.products.find_one(
         {"product_id": product_id, "user_id": owner_id},
-        {"_id": 0, "name": 1, "store_id": 1, "is_active": 1},
+        {"_id": 0, "name": 1, "store_id": 1, "is_active": 1, "inventory_class": 1},
     )
     ensure_scoped_document_access(user, product, detail="Acces refuse pour ce produit")
     if not product:
@@ -19723,6 +19598,8 @@ async def permanently_delete_product(product_id: str, user: User = Depends(requi
         raise HTTPException(status_code=404, detail="Produit non trouve")
 
     _invalidate_dashboard_ai_caches(owner_id, product.get("store_id") or user.active_store_id)
+    _invalidate_catalog_caches(owner_id, product.get("store_id") or user.active_store_id)
+    await _retire_from_inventory_summary([{**product, "product_id": product_id, "user_id": owner_id}])
     await log_activity(
         user,
         "product_deleted_permanently",
@@ -19808,7 +19685,11 @@ async def create_stock_movement(mov_data: StockMovementCreate, user: User = Depe
                 "store_id": product.get("store_id"),
                 "quantity": {"$gte": mov_data.quantity},
             },
-            {"$inc": {"quantity": -mov_data.quantity}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            {
+                "$inc": {"quantity": -mov_data.quantity},
+                "$set": {"updated_at": datetime.now(timezone.utc)},
+                "$max": {"last_movement_out_at": datetime.now(timezone.utc)},
+            },
             return_document=True,
         )
         if not updated_product:
@@ -19860,6 +19741,7 @@ async def create_stock_movement(mov_data: StockMovementCreate, user: User = Depe
     )
     await db.stock_movements.insert_one(movement.model_dump())
     _invalidate_dashboard_ai_caches(owner_id, product.get("store_id") or user.active_store_id)
+    await _sync_inventory_summary([mov_data.product_id])
 
     # Log activity
     await log_activity(
@@ -20137,10 +20019,27 @@ async def delete_location(location_id: str, user: User = Depends(require_permiss
 
 # Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬ TABLES (Restaurant) Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬
 
+_STREAM_SALE_FIELDS = (
+    "sale_id", "table_id", "status", "items", "total_amount", "current_amount", "covers",
+    "kitchen_sent", "kitchen_sent_at", "all_items_ready", "served_at", "created_at",
+)
+
+
+def _stream_sale(sale: Dict[str, Any]) -> Dict[str, Any]:
+    """Fields of a sale that kitchen screens and floor plans need, for restaurant stream events."""
+    return {field: sale.get(field) for field in _STREAM_SALE_FIELDS if field in sale}
+
+
+def _stream_table(table: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in table.items() if key != "_id"}
+
+
 @api_router.get("/tables")
-async def list_tables(user: User = Depends(get_current_user)):
+async def list_tables(response: Response, user: User = Depends(get_current_user)):
     owner_id = get_owner_id(user)
     store_id = user.active_store_id
+    if store_id:
+        response.headers["X-Stream-Cursor"] = restaurant_stream.current_cursor(store_id)
     tables = await db.tables.find({"user_id": owner_id, "store_id": store_id}).to_list(None)
     for t in tables:
         t.pop("_id", None)
@@ -20167,6 +20066,7 @@ async def update_table(table_id: str, data: Any = Body(...), user: User = Depend
         await db.tables.update_one({"table_id": table_id, "user_id": owner_id, "store_id": store_id}, {"$set": updates})
     updated = await db.tables.find_one({"table_id": table_id, "user_id": owner_id, "store_id": store_id})
     updated.pop("_id", None)
+    await restaurant_stream.publish(store_id, "table_updated", table=_stream_table(updated))
     return updated
 
 @api_router.post("/tables/{table_id}/actions/{action}")
@@ -20248,6 +20148,7 @@ async def table_action(table_id: str, action: str, data: dict = Body(default={})
 
     updated = await db.tables.find_one({"table_id": table_id, "user_id": owner_id, "store_id": store_id})
     updated.pop("_id", None)
+    await restaurant_stream.publish(store_id, "table_freed" if action == "free" else "table_updated", table=_stream_table(updated))
     return updated
 
 @api_router.delete("/tables/{table_id}")
@@ -20322,22 +20223,31 @@ async def send_to_kitchen(sale_id: str, user: User = Depends(get_current_user)):
         raise HTTPException(status_code=404, detail="Vente non trouvÃ©e")
     items = sale.get("items", [])
     all_ready = all(it.get("ready", False) for it in items) if items else False
-    await db.sales.update_one(
+    kitchen_updates = {
+        "kitchen_sent": True,
+        "kitchen_sent_at": datetime.now(timezone.utc),
+        "all_items_ready": all_ready,
+        "served_at": None if not all_ready else sale.get("served_at"),
+    }
+    result = await db.sales.update_one(
         {"sale_id": sale_id, "user_id": owner_id, "store_id": store_id, "status": "open"},
-        {"$set": {
-            "kitchen_sent": True,
-            "kitchen_sent_at": datetime.now(timezone.utc),
-            "all_items_ready": all_ready,
-            "served_at": None if not all_ready else sale.get("served_at"),
-        }}
+        {"$set": kitchen_updates}
     )
+    if result.matched_count:
+        await restaurant_stream.publish(store_id, "status_changed", status="sent", sale=_stream_sale({**sale, **kitchen_updates}))
     return {"message": "Commande envoyÃ©e en cuisine", "sale_id": sale_id}
 
 @api_router.get("/kitchen/pending")
-async def get_kitchen_pending(station: Optional[str] = None, user: User = Depends(get_current_user)):
-    """Commandes en attente cuisine. Filtre optionnel: station=entree|plat|dessert|boisson"""
+async def get_kitchen_pending(response: Response, station: Optional[str] = None, user: User = Depends(get_current_user)):
+    """Commandes en attente cuisine. Filtre optionnel: station=entree|plat|dessert|boisson
+
+    L'en-tete X-Stream-Cursor permet de reprendre /restaurant/stream juste apres cet instantane.
+    """
     owner_id = get_owner_id(user)
     store_id = user.active_store_id
+    if store_id:
+        # Taken before the query: events published meanwhile are replayed, at worst twice.
+        response.headers["X-Stream-Cursor"] = restaurant_stream.current_cursor(store_id)
     since = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
     query: dict = {
         "user_id": owner_id,
@@ -20358,6 +20268,22 @@ async def get_kitchen_pending(station: Optional[str] = None, user: User = Depend
         result.append(s)
     return result
 
+
+@api_router.get("/restaurant/stream")
+async def stream_restaurant_events(request: Request, after: Optional[str] = None, user: User = Depends(get_current_user)):
+    """Flux temps reel (Server-Sent Events) des commandes et tables de la boutique active.
+
+    Reprise apres le curseur `after` (ou l'en-tete Last-Event-ID envoye par EventSource).
+    """
+    store_id = user.active_store_id
+    if not store_id:
+        raise HTTPException(status_code=400, detail="Aucune boutique active")
+    return StreamingResponse(
+        restaurant_stream.sse(store_id, after or request.headers.get("last-event-id")),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬ RESTAURANT STATS Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬Ã¢â€Ã¢â€šÂ¬
 
 @api_router.get("/restaurant/stats")
@@ -20558,7 +20484,7 @@ async def add_items_to_order(sale_id: str, data: dict = Body(...), user: User =
             "kitchen_sent": False,
             "kitchen_sent_at": None,
             "served_at": None,
-        }}
+        }, "$inc": {"receipt_version": 1}}
     )
     if sale.get("table_id"):
         await db.tables.update_one(
@@ -20567,6 +20493,7 @@ async def add_items_to_order(sale_id: str, data: dict = Body(...), user: User =
         )
     updated = await db.sales.find_one({"sale_id": sale_id, "user_id": owner_id, "store_id": store_id, "status": "open"})
     updated.pop("_id", None)
+    await restaurant_stream.publish(store_id, "items_added", sale=_stream_sale(updated))
     return updated
 
 @api_router.delete("/sales/{sale_id}/items/{item_idx}")
@@ -20606,7 +20533,7 @@ async def remove_item_from_order(sale_id: str, item_idx: int, user: User = Depen
             "tax_total": totals["tax_total"],
             "subtotal_ht": totals["subtotal_ht"],
             "tax_mode": totals["tax_mode"],
-        }}
+        }, "$inc": {"receipt_version": 1}}
     )
     if sale.get("table_id"):
         await db.tables.update_one(
@@ -20615,6 +20542,7 @@ async def remove_item_from_order(sale_id: str, item_idx: int, user: User = Depen
         )
     updated = await db.sales.find_one({"sale_id": sale_id, "user_id": owner_id, "store_id": store_id, "status": "open"})
     updated.pop("_id", None)
+    await restaurant_stream.publish(store_id, "items_removed", sale=_stream_sale(updated))
     return updated
 
 
@@ -20686,42 +20614,69 @@ async def finalize_order(sale_id: str, data: dict = Body(...), user: User = Depe
         )
         raise
 
+    completion = {
+        "status": "completed",
+        "items": totals["items"],
+        "total_amount": actual_total,
+        "current_amount": actual_total,
+        "discount_amount": discount,
+        "tip_amount": tip,
+        "service_charge_percent": service_pct,
+        "tax_total": totals["tax_total"],
+        "tax_mode": totals["tax_mode"],
+        "subtotal_ht": totals["subtotal_ht"],
+        "payment_method": primary_method,
+        "payments": payments,
+        "covers": data.get("covers", sale.get("covers")),
+        "loyalty_points_earned": customer_effects["loyalty_points_earned"],
+        "customer_total_spent_increment": customer_effects["customer_total_spent_increment"],
+        "credit_debt_applied": customer_effects["credit_debt_applied"],
+    }
+
+    async def write_completion(session):
+        result = await db.sales.update_one(
+            {"sale_id": sale_id, "user_id": owner_id, "store_id": store_id, "status": "finalizing"},
+            {"$set": completion, "$unset": {"finalizing_at": ""}, "$inc": {"receipt_version": 1}},
+            session=session,
+        )
+        if result.matched_count and not sale.get("receipt_number"):
+            # Numbered only once the completion won, in its transaction: a 409 never consumes a number.
+            await db.sales.update_one(
+                {"sale_id": sale_id, "user_id": owner_id},
+                {"$set": {"receipt_number": await _next_receipt_number(owner_id, session=session)}},
+                session=session,
+            )
+        return result, []
+
+    result = await domain_events.commit(db, write_completion)
+    if result.matched_count == 0:
+        raise HTTPException(status_code=409, detail="La commande a change d'etat pendant la finalisation")
+    # Stock leaves only once the completion is committed: a 409 or an aborted transaction deducts nothing.
     for it in items:
         product_doc = await db.products.find_one({"product_id": it["product_id"], "user_id": owner_id})
         if product_doc:
             await _apply_sale_item_inventory(product_doc, it["quantity"], user, suppress_errors=True)
+    # Accounting counts the order on the day it was opened, which may already be summarized.
+    await accounting_periods.invalidate_periods(db, owner_id, sale.get("created_at"))
+    # Counters date the sale by its stored created_at, like the reconciliations that rebuild them.
+    asyncio.create_task(_after_sale_completed({**sale, **completion}))
 
-    result = await db.sales.update_one(
-        {"sale_id": sale_id, "user_id": owner_id, "store_id": store_id, "status": "finalizing"},
-        {"$set": {
-            "status": "completed",
-            "items": totals["items"],
-            "total_amount": actual_total,
-            "current_amount": actual_total,
-            "discount_amount": discount,
-            "tip_amount": tip,
-            "service_charge_percent": service_pct,
-            "tax_total": totals["tax_total"],
-            "tax_mode": totals["tax_mode"],
-            "subtotal_ht": totals["subtotal_ht"],
-            "payment_method": primary_method,
-            "payments": payments,
-            "covers": data.get("covers", sale.get("covers")),
-            "loyalty_points_earned": customer_effects["loyalty_points_earned"],
-            "customer_total_spent_increment": customer_effects["customer_total_spent_increment"],
-            "credit_debt_applied": customer_effects["credit_debt_applied"],
-        }, "$unset": {"finalizing_at": ""}},
+    await _apply_sale_customer_effects(owner_id, sale.get("customer_id"), customer_effects)
+
+    await restaurant_stream.publish(
+        store_id, "status_changed", status="completed",
+        sale=_stream_sale({**sale, "status": "completed", "items": totals["items"], "total_amount": actual_total}),
     )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=409, detail="La commande a change d'etat pendant la finalisation")
-
-    await _apply_sale_customer_effects(owner_id, sale.get("customer_id"), customer_effects)
-
     if sale.get("table_id"):
-        await db.tables.update_one(
+        table_result = await db.tables.update_one(
             {"table_id": sale["table_id"], "user_id": owner_id, "store_id": store_id, "current_sale_id": sale_id},
             {"$set": {"status": "free", "current_sale_id": None, "current_amount": 0, "occupied_since": None, "covers": 0}}
         )
+        if table_result.modified_count:
+            await restaurant_stream.publish(store_id, "table_freed", table={
+                "table_id": sale["table_id"], "status": "free", "current_sale_id": None,
+                "current_amount": 0, "occupied_since": None, "covers": 0,
+            })
 
     await log_activity(
         user=user, action="sale", module="pos",
@@ -20834,11 +20789,13 @@ async def cancel_sale(
             "cancelled_at": now,
             "cancelled_by_user_id": user.user_id,
             "cancellation_reason": cancel_data.reason,
-        }, "$unset": {"cancelling_at": ""}},
+        }, "$unset": {"cancelling_at": ""}, "$inc": {"receipt_version": 1}},
         return_document=True,
     )
     if not updated_sale:
         raise HTTPException(status_code=409, detail="La vente a change d'etat pendant l'annulation")
+    asyncio.create_task(_after_sale_cancelled(updated_sale))
+    await restaurant_stream.publish(updated_sale.get("store_id"), "status_changed", status="cancelled", sale=_stream_sale(updated_sale))
 
     await log_activity(
         user=user,
@@ -20860,10 +20817,12 @@ async def serve_order(sale_id: str, user: User = Depends(get_current_user)):
     sale = await db.sales.find_one({"sale_id": sale_id, "user_id": owner_id, "store_id": store_id})
     if not sale:
         raise HTTPException(status_code=404, detail="Commande non trouvÃ©e")
+    served = {"all_items_ready": True, "served_at": datetime.now(timezone.utc)}
     await db.sales.update_one(
         {"sale_id": sale_id, "user_id": owner_id, "store_id": store_id},
-        {"$set": {"all_items_ready": True, "served_at": datetime.now(timezone.utc)}}
+        {"$set": served}
     )
+    await restaurant_stream.publish(store_id, "status_changed", status="served", sale=_stream_sale({**sale, **served}))
     return {"message": "Commande servie"}
 
 
@@ -20887,6 +20846,9 @@ async def mark_kitchen_item_ready(sale_id: str, item_idx: int, user: User = Depe
     )
     updated = await db.sales.find_one({"sale_id": sale_id, "user_id": owner_id, "store_id": store_id})
     updated.pop("_id", None)
+    await restaurant_stream.publish(
+        store_id, "status_changed", status="ready" if all_ready else "item_ready", item_index=item_idx, sale=_stream_sale(updated),
+    )
     return updated
 
 
@@ -21021,6 +20983,10 @@ async def submit_inventory_result(
         }},
         return_document=True
     )
+    await db.products.update_one(
+        {"product_id": task["product_id"], "user_id": get_owner_id(user)},
+        {"$max": {"last_counted_at": updated_at}},
+    )
 
     # If discrepancy, we should probably record a stock movement to adjust!
     if discrepancy != 0:
@@ -21044,10 +21010,14 @@ async def submit_inventory_result(
         _invalidate_dashboard_ai_caches(get_owner_id(user), task.get("store_id") or user.active_store_id)
 
         # Update product
+        stock_update = {"$set": {"quantity": actual, "updated_at": updated_at}}
+        if mov_type == "out":
+            stock_update["$max"] = {"last_movement_out_at": updated_at}
         await db.products.update_one(
             {"product_id": task["product_id"], "user_id": get_owner_id(user)},
-            {"$set": {"quantity": actual, "updated_at": updated_at}}
+            stock_update
         )
+        await _sync_inventory_summary([task["product_id"]])
 
         # Also need to check alerts for the new quantity
         # ... logic skipped for brevity but ideally called here
@@ -21128,19 +21098,7 @@ def _parse_crm_datetime(value: Any) -> Optional[datetime]:
 
 
 def _days_until_birthday(birthday: Optional[str], now: datetime) -> Optional[int]:
-    if not birthday or len(birthday) != 5:
-        return None
-    try:
-        month = int(birthday[:2])
-        day = int(birthday[3:5])
-        birthday_this_year = now.replace(month=month, day=day, hour=0, minute=0, second=0, microsecond=0)
-        diff = (birthday_this_year - now).days
-        if diff < 0:
-            next_year = birthday_this_year.replace(year=birthday_this_year.year + 1)
-            diff = (next_year - now).days
-        return diff
-    except Exception:
-        return None
+    return birthday_calendar.days_until_birthday(birthday, now.date())
 
 
 def _classify_crm_segment(
@@ -21176,130 +21134,61 @@ async def _get_customer_sales_and_ecommerce_stats(
     if not customer_ids:
         return {}
 
-    sales_pipeline = [
-        {"$match": apply_store_scope({"user_id": owner_id, "customer_id": {"$in": customer_ids}}, user)},
-        {"$group": {
-            "_id": "$customer_id",
-            "visit_count": {"$sum": 1},
-            "total_sales": {"$sum": "$total_amount"},
-            "last_purchase_date": {"$max": "$created_at"},
-        }},
-    ]
-    open_order_expression = {
-        "$or": [
-            {"$eq": ["$sale_id", None]},
-            {"$eq": ["$sale_id", ""]},
-        ]
-    }
-    ecommerce_pipeline = [
-        {"$match": apply_store_scope(
-            {
-                "user_id": owner_id,
-                "customer_id": {"$in": customer_ids},
-                "status": {"$nin": ["cancelled", "rejected"]},
-            },
-            user,
-        )},
-        {"$group": {
-            "_id": "$customer_id",
-            "order_count": {"$sum": 1},
-            "open_order_count": {"$sum": {"$cond": [open_order_expression, 1, 0]}},
-            "open_total_amount": {"$sum": {"$cond": [open_order_expression, "$total_amount", 0]}},
-            "last_order_date": {"$max": "$created_at"},
-        }},
-    ]
-
-    sales_stats = await db.sales.aggregate(sales_pipeline).to_list(1000)
-    ecommerce_stats = await db.ecommerce_orders.aggregate(ecommerce_pipeline).to_list(1000)
-    sales_map = {row["_id"]: row for row in sales_stats}
-    ecommerce_map = {row["_id"]: row for row in ecommerce_stats}
+    await customer_stats.ensure_customer_stats(db, owner_id)
+    docs = await db.customers.find(
+        {"user_id": owner_id, "customer_id": {"$in": customer_ids}},
+        {"_id": 0, "customer_id": 1, "stats": 1},
+    ).to_list(len(customer_ids))
+    stats_docs = {doc["customer_id"]: doc.get("stats") or {} for doc in docs}
 
     stats_by_customer: Dict[str, Dict[str, Any]] = {}
     for customer_id in customer_ids:
-        sales = sales_map.get(customer_id, {})
-        ecommerce = ecommerce_map.get(customer_id, {})
-        physical_sale_count = int(sales.get("visit_count") or 0)
-        open_ecommerce_order_count = int(ecommerce.get("open_order_count") or 0)
-        last_sale_date = sales.get("last_purchase_date")
-        last_order_date = ecommerce.get("last_order_date")
-        last_purchase_date = max(
-            [value for value in [last_sale_date, last_order_date] if isinstance(value, datetime)],
-            default=last_sale_date or last_order_date,
-        )
+        stats = stats_docs.get(customer_id, {})
         stats_by_customer[customer_id] = {
-            "physical_sale_count": physical_sale_count,
-            "ecommerce_order_count": int(ecommerce.get("order_count") or 0),
-            "open_ecommerce_order_count": open_ecommerce_order_count,
-            "visit_count": physical_sale_count + open_ecommerce_order_count,
-            "total_spent": round(float(sales.get("total_sales") or 0) + float(ecommerce.get("open_total_amount") or 0), 2),
-            "last_purchase_date": last_purchase_date,
+            "physical_sale_count": int(stats.get("sale_count") or 0),
+            "ecommerce_order_count": int(stats.get("ecommerce_order_count") or 0),
+            "open_ecommerce_order_count": int(stats.get("open_order_count") or 0),
+            "visit_count": int(stats.get("visit_count") or 0),
+            "total_spent": round(float(stats.get("lifetime_spend") or 0), 2),
+            "last_purchase_date": stats.get("last_purchase_at"),
         }
     return stats_by_customer
 
 
 async def _build_crm_customer_rows(owner_id: str, start_date: datetime, end_date: datetime, store_id: Optional[str] = None) -> List[Dict[str, Any]]:
     now = datetime.now(timezone.utc)
+    await customer_stats.ensure_customer_stats(db, owner_id)
     cust_query: dict = {"user_id": owner_id}
     if store_id:
         cust_query["store_id"] = store_id
-    customers_raw = await db.customers.find(cust_query, {"_id": 0}).to_list(5000)
-    customer_ids = [customer.get("customer_id") for customer in customers_raw if customer.get("customer_id")]
-    stats_map: Dict[str, Dict[str, Any]] = {}
+    customers_raw = await db.customers.find(cust_query, {"_id": 0, "note_history": 0}).to_list(5000)
 
-    if customer_ids:
-        sales_match: dict = {
-            "user_id": owner_id,
-            "customer_id": {"$in": customer_ids},
-            "$or": [{"status": {"$exists": False}}, {"status": "completed"}],
-        }
-        if store_id:
-            sales_match["store_id"] = store_id
-        sales_pipeline = [
-            {"$match": sales_match},
-            {"$group": {
-                "_id": "$customer_id",
-                "visit_count": {"$sum": 1},
-                "lifetime_revenue": {"$sum": "$total_amount"},
-                "last_purchase_date": {"$max": "$created_at"},
-                "period_visit_count": {
-                    "$sum": {
-                        "$cond": [
-                            {"$and": [
-                                {"$gte": ["$created_at", start_date]},
-                                {"$lte": ["$created_at", end_date]},
-                            ]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "period_revenue": {
-                    "$sum": {
-                        "$cond": [
-                            {"$and": [
-                                {"$gte": ["$created_at", start_date]},
-                                {"$lte": ["$created_at", end_date]},
-                            ]},
-                            "$total_amount",
-                            0,
-                        ]
-                    }
-                },
-            }},
-        ]
-        stats_rows = await db.sales.aggregate(sales_pipeline).to_list(len(customer_ids))
-        stats_map = {row["_id"]: row for row in stats_rows if row.get("_id")}
+    # Lifetime figures live on the customer; only the selected period is aggregated.
+    sales_match: dict = {
+        "user_id": owner_id,
+        "created_at": {"$gte": start_date, "$lte": end_date},
+        "customer_id": {"$nin": [None, ""]},
+        "$or": [{"status": {"$exists": False}}, {"status": "completed"}],
+    }
+    if store_id:
+        sales_match["store_id"] = store_id
+    period_rows = await db.sales.aggregate([
+        {"$match": sales_match},
+        {"$group": {"_id": "$customer_id", "period_visit_count": {"$sum": 1}, "period_revenue": {"$sum": "$total_amount"}}},
+    ]).to_list(None)
+    period_map = {row["_id"]: row for row in period_rows}
 
     rows: List[Dict[str, Any]] = []
     for customer in customers_raw:
         customer_id = customer.get("customer_id")
-        stats = stats_map.get(customer_id, {})
-        visit_count = int(stats.get("visit_count") or 0)
-        period_visit_count = int(stats.get("period_visit_count") or 0)
-        period_revenue = float(stats.get("period_revenue") or 0.0)
-        last_purchase_date = _parse_crm_datetime(stats.get("last_purchase_date"))
+        stats = customer.get("stats") or {}
+        period = period_map.get(customer_id, {})
+        visit_count = int(stats.get("sale_count") or 0)
+        period_visit_count = int(period.get("period_visit_count") or 0)
+        period_revenue = float(period.get("period_revenue") or 0.0)
+        last_purchase_date = _parse_crm_datetime(stats.get("last_sale_at"))
         created_at = _parse_crm_datetime(customer.get("created_at"))
-        total_spent = float(customer.get("total_spent") or stats.get("lifetime_revenue") or 0.0)
+        total_spent = float(customer.get("total_spent") or stats.get("sales_amount") or 0.0)
         current_debt = float(customer.get("current_debt") or 0.0)
         average_basket = round(total_spent / visit_count, 2) if visit_count > 0 else 0.0
         period_average_basket = round(period_revenue / period_visit_count, 2) if period_visit_count > 0 else 0.0
@@ -21357,7 +21246,8 @@ def _build_crm_recommendations(
     return recommendations[:4]
 
 
-def _build_crm_segments(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def _build_crm_segments(segment_rows: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """``segment_rows`` maps a segment id to ``{"count", "examples"}`` (examples by spend, descending)."""
     configs = [
         ("vip", "VIP", "Clients a forte valeur et a forte depense.", "amber"),
         ("loyal", "Fideles", "Clients recurrents a entretenir regulierement.", "emerald"),
@@ -21368,15 +21258,14 @@ def _build_crm_segments(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     ]
     segments: List[Dict[str, Any]] = []
     for segment_id, label, description, accent in configs:
-        matching = [row for row in rows if row.get("segment") == segment_id]
-        matching.sort(key=lambda row: row.get("total_spent", 0), reverse=True)
+        matching = segment_rows.get(segment_id) or {}
         segments.append({
             "id": segment_id,
             "label": label,
             "description": description,
             "accent": accent,
-            "count": len(matching),
-            "examples": [row.get("name") for row in matching[:3] if row.get("name")],
+            "count": int(matching.get("count") or 0),
+            "examples": [name for name in (matching.get("examples") or [])[:3] if name],
         })
     return segments
 
@@ -21391,7 +21280,12 @@ async def get_customers(
     await backfill_inferred_legacy_store_scope(db.customers, owner_id, user, "customer_id")
     cust_query = apply_store_scope_with_legacy({"user_id": owner_id}, user)
     total = await db.customers.count_documents(cust_query)
-    customers_raw = await db.customers.find(cust_query).skip(skip).limit(limit).to_list(limit)
+    customers_cursor = db.customers.find(cust_query)
+    stats_sort = {"total_spent": "stats.lifetime_spend", "last_purchase": "stats.last_purchase_at", "visits": "stats.visit_count"}
+    if sort_by in stats_sort:
+        await customer_stats.ensure_customer_stats(db, owner_id)
+        customers_cursor = customers_cursor.sort([(stats_sort[sort_by], -1), ("customer_id", 1)])
+    customers_raw = await customers_cursor.skip(skip).limit(limit).to_list(limit)
     customer_ids = [c["customer_id"] for c in customers_raw if "customer_id" in c]
     stats_map = await _get_customer_sales_and_ecommerce_stats(owner_id, customer_ids, user)
 
@@ -21440,26 +21334,98 @@ async def get_crm_analytics_overview(
 ):
     owner_id = get_owner_id(user)
     date_range = _parse_optional_range(days=days, start_date=start_date, end_date=end_date)
-    rows = await _build_crm_customer_rows(owner_id, date_range["start"], date_range["end"], store_id=user.active_store_id)
+    now = datetime.now(timezone.utc)
+    await customer_stats.ensure_customer_stats(db, owner_id)
+    cust_query: Dict[str, Any] = {"user_id": owner_id}
+    if user.active_store_id:
+        cust_query["store_id"] = user.active_store_id
 
-    total_customers = len(rows)
-    active_customers = len([row for row in rows if row.get("period_visit_count", 0) > 0])
-    new_customers = len([
-        row for row in rows
-        if (created_at := _parse_crm_datetime(row.get("created_at")))
-        and date_range["start"] <= created_at <= date_range["end"]
-    ])
-    inactive_customers = len([row for row in rows if (row.get("inactive_days") or 9999) > 30])
-    at_risk_customers = len([row for row in rows if row.get("segment") == "at_risk"])
-    vip_customers = len([row for row in rows if row.get("segment") == "vip"])
-    debt_customers = len([row for row in rows if row.get("current_debt", 0) > 0])
-    debt_balance = sum(float(row.get("current_debt") or 0) for row in rows)
-    period_revenue = sum(float(row.get("period_revenue") or 0) for row in rows)
-    period_sales_count = sum(int(row.get("period_visit_count") or 0) for row in rows)
+    # Customer-level KPIs and segments from the stored stats in one pass.
+    spent = {"$cond": [{"$gt": [{"$ifNull": ["$total_spent", 0]}, 0]}, "$total_spent", {"$ifNull": ["$stats.sales_amount", 0]}]}
+    facets = (await db.customers.aggregate([
+        {"$match": cust_query},
+        {"$project": {
+            "_id": 0,
+            "name": {"$ifNull": ["$name", "Client"]},
+            "birthday_doy": 1,
+            "debt": {"$ifNull": ["$current_debt", 0]},
+            "created_at": 1,
+            "last_sale_at": "$stats.last_sale_at",
+            "spent": spent,
+            "segment": customer_stats.segment_expression(now),
+        }},
+        {"$facet": {
+            "totals": [{"$group": {
+                "_id": None,
+                "total": {"$sum": 1},
+                "new": {"$sum": {"$cond": [{"$and": [
+                    {"$gte": ["$created_at", date_range["start"]]},
+                    {"$lte": ["$created_at", date_range["end"]]},
+                ]}, 1, 0]}},
+                "inactive": {"$sum": {"$cond": [{"$or": [
+                    {"$eq": [{"$ifNull": ["$last_sale_at", None]}, None]},
+                    {"$lte": ["$last_sale_at", now - timedelta(days=31)]},
+                ]}, 1, 0]}},
+                "debt_customers": {"$sum": {"$cond": [{"$gt": ["$debt", 0]}, 1, 0]}},
+                "debt_balance": {"$sum": "$debt"},
+            }}],
+            "segments": [
+                {"$group": {
+                    "_id": "$segment",
+                    "count": {"$sum": 1},
+                    "examples": {"$topN": {"n": 3, "sortBy": {"spent": -1}, "output": "$name"}},
+                }},
+            ],
+            "birthdays": [
+                {"$match": birthday_calendar.window_query(now.date(), 7)},
+                {"$count": "count"},
+            ],
+        }},
+    ]).to_list(1))[0]
+    totals = (facets["totals"] or [{}])[0]
+    segment_rows = {row["_id"]: row for row in facets["segments"]}
+
+    # Period activity: sales of the window only, restricted to the listed customers.
+    sales_match: Dict[str, Any] = {
+        "user_id": owner_id,
+        "created_at": {"$gte": date_range["start"], "$lte": date_range["end"]},
+        "customer_id": {"$nin": [None, ""]},
+        "$or": [{"status": {"$exists": False}}, {"status": "completed"}],
+    }
+    if user.active_store_id:
+        sales_match["store_id"] = user.active_store_id
+    customer_match: Dict[str, Any] = {"customer.user_id": owner_id}
+    if user.active_store_id:
+        customer_match["customer.store_id"] = user.active_store_id
+    period = (await db.sales.aggregate([
+        {"$match": sales_match},
+        {"$group": {"_id": "$customer_id", "visits": {"$sum": 1}, "revenue": {"$sum": "$total_amount"}}},
+        {"$lookup": {"from": "customers", "localField": "_id", "foreignField": "customer_id", "as": "customer"}},
+        {"$unwind": "$customer"},
+        {"$match": customer_match},
+        {"$group": {
+            "_id": None,
+            "active": {"$sum": 1},
+            "repeat": {"$sum": {"$cond": [{"$gte": ["$visits", 2]}, 1, 0]}},
+            "visits": {"$sum": "$visits"},
+            "revenue": {"$sum": "$revenue"},
+        }},
+    ]).to_list(1) or [{}])[0]
+
+    total_customers = int(totals.get("total") or 0)
+    active_customers = int(period.get("active") or 0)
+    new_customers = int(totals.get("new") or 0)
+    inactive_customers = int(totals.get("inactive") or 0)
+    at_risk_customers = int((segment_rows.get("at_risk") or {}).get("count") or 0)
+    vip_customers = int((segment_rows.get("vip") or {}).get("count") or 0)
+    debt_customers = int(totals.get("debt_customers") or 0)
+    debt_balance = float(totals.get("debt_balance") or 0)
+    period_revenue = float(period.get("revenue") or 0)
+    period_sales_count = int(period.get("visits") or 0)
     average_basket = round(period_revenue / period_sales_count, 2) if period_sales_count > 0 else 0.0
-    repeat_customers = len([row for row in rows if row.get("period_visit_count", 0) >= 2])
+    repeat_customers = int(period.get("repeat") or 0)
     repeat_rate = round((repeat_customers / active_customers) * 100, 2) if active_customers > 0 else 0.0
-    birthdays_soon = len([row for row in rows if row.get("birthday_in_days") is not None and row.get("birthday_in_days") <= 7])
+    birthdays_soon = int((facets["birthdays"] or [{}])[0].get("count") or 0)
 
     summary = (
         f"{active_customers} clients actifs sur {total_customers}, "
@@ -21492,7 +21458,7 @@ async def get_crm_analytics_overview(
             "debt_balance": round(debt_balance, 2),
             "birthdays_soon": birthdays_soon,
         },
-        "segments": _build_crm_segments(rows),
+        "segments": _build_crm_segments(segment_rows),
     }
 
 
@@ -21646,28 +21612,15 @@ class CampaignCreate(BaseModel):
 async def get_customer_birthdays(user: User = Depends(require_permission("crm", "read")), days: int = Query(7, ge=1, le=90)):
     """Get customers with birthdays in the next N days"""
     await backfill_inferred_legacy_store_scope(db.customers, get_owner_id(user), user, "customer_id")
+    today = datetime.now(timezone.utc).date()
     customers_raw = await db.customers.find(
-        apply_store_scope_with_legacy({"user_id": get_owner_id(user), "birthday": {"$ne": None}}, user)
+        apply_store_scope_with_legacy(
+            {"user_id": get_owner_id(user), **birthday_calendar.window_query(today, days)}, user
+        ),
+        {"_id": 0},
     ).to_list(1000)
-
-    today = datetime.now(timezone.utc)
-    upcoming = []
-    for c in customers_raw:
-        bday = c.get("birthday")
-        if not bday or len(bday) != 5:
-            continue
-        try:
-            month, day_num = int(bday[:2]), int(bday[3:5])
-            bday_this_year = today.replace(month=month, day=day_num)
-            diff = (bday_this_year - today).days
-            if diff < 0:
-                diff += 365
-            if diff <= days:
-                c.pop("_id", None)
-                upcoming.append(c)
-        except (ValueError, TypeError):
-            continue
-    return upcoming
+    customers_raw.sort(key=lambda c: birthday_calendar.days_until(c.get("birthday_doy"), today) or 0)
+    return customers_raw
 
 @api_router.post("/customers/campaign")
 async def create_campaign(data: CampaignCreate, user: User = Depends(require_permission("crm", "write"))):
@@ -21795,7 +21748,7 @@ async def create_customer(customer_data: CustomerCreate, user: User = Depends(re
         store_id=user.active_store_id,
         **customer_data.model_dump(exclude_none=True)
     )
-    await db.customers.insert_one(customer.model_dump())
+    await db.customers.insert_one({**customer.model_dump(), **birthday_calendar.birthday_fields(customer.birthday)})
 
     await log_activity(
         user=user,
@@ -21854,6 +21807,8 @@ async def update_customer(customer_id: str, customer_data: CustomerCreate, user:
     )
     ensure_scoped_document_access(user, existing, detail="Acces refuse pour ce client")
     update_dict = customer_data.model_dump(exclude_none=True)
+    if "birthday" in update_dict:
+        update_dict.update(birthday_calendar.birthday_fields(update_dict["birthday"]))
     customer_query = {"customer_id": customer_id, "user_id": owner_id}
     if existing and existing.get("store_id"):
         customer_query["store_id"] = existing["store_id"]
@@ -22303,6 +22258,45 @@ async def _enrich_sale_items_with_product_tax(
     return enriched
 
 
+RECEIPT_NUMBER_SERIES = "receipt"
+RECEIPT_NUMBER_PREFIX = "TK"
+
+
+async def _next_receipt_number(owner_id: str, at: Optional[datetime] = None, session=None) -> str:
+    return await sequences.next_number(db, owner_id, RECEIPT_NUMBER_SERIES, RECEIPT_NUMBER_PREFIX, at, width=6, session=session)
+
+
+async def _check_offline_receipt_number(owner_id: str, receipt_number: str) -> str:
+    """A receipt number chosen offline must come from a block reserved by this account and not be used yet."""
+    receipt_number = receipt_number.strip().upper()
+    if not await sequences.reserved_block(db, owner_id, RECEIPT_NUMBER_SERIES, receipt_number):
+        raise HTTPException(status_code=400, detail="Numero de ticket hors des plages reservees")
+    if await db.sales.find_one({"user_id": owner_id, "receipt_number": receipt_number}, {"_id": 1}):
+        raise HTTPException(status_code=409, detail="Ce numero de ticket est deja utilise")
+    return receipt_number
+
+
+class ReceiptNumberBlockRequest(BaseModel):
+    count: int = Field(50, ge=1, le=sequences.MAX_BLOCK_SIZE)
+    terminal_id: Optional[str] = None
+
+
+@api_router.post("/sales/receipt-numbers/reserve")
+async def reserve_receipt_numbers(data: ReceiptNumberBlockRequest, user: User = Depends(require_permission("pos", "write"))):
+    """Reserver une plage de numeros de ticket pour les ventes enregistrees hors ligne."""
+    ensure_subscription_write_allowed(user)
+    block = await sequences.reserve_block(
+        db,
+        get_owner_id(user),
+        RECEIPT_NUMBER_SERIES,
+        RECEIPT_NUMBER_PREFIX,
+        data.count,
+        reserved_by=data.terminal_id or user.user_id,
+        width=6,
+    )
+    return {key: block[key] for key in ("block_id", "year", "prefix", "first", "last", "first_number", "last_number")}
+
+
 @api_router.post("/sales", response_model=Sale)
 async def create_sale(sale_data: SaleCreate, user: User = Depends(require_permission("pos", "write"))):
     ensure_subscription_write_allowed(user)
@@ -22312,6 +22306,9 @@ async def create_sale(sale_data: SaleCreate, user: User = Depends(require_permis
 
     sale_items = []
     is_open_order = (sale_data.status == "open")
+    offline_receipt_number = None
+    if sale_data.receipt_number and not is_open_order:
+        offline_receipt_number = await _check_offline_receipt_number(owner_id, sale_data.receipt_number)
 
     # 0. Load tax settings
     tax_settings = await _load_tax_settings_for_user(user)
@@ -22386,13 +22383,6 @@ async def create_sale(sale_data: SaleCreate, user: User = Depends(require_permis
     )
     sale_items = [SaleItem(**item) for item in totals["items"]]
 
-    # 2. Stock deduction â€” uniquement pour les ventes complÃ¨tes
-    if not is_open_order:
-        for si in sale_items:
-            product_doc = await db.products.find_one({"product_id": si.product_id, "user_id": owner_id})
-            if product_doc:
-                await _apply_sale_item_inventory(product_doc, si.quantity, user, suppress_errors=True)
-
     # 3. Totaux
     discount = totals["discount_amount"]
     tax_total_amount = totals["tax_total"]
@@ -22462,8 +22452,29 @@ async def create_sale(sale_data: SaleCreate, user: User = Depends(require_permis
         customer_total_spent_increment=customer_effects["customer_total_spent_increment"],
         credit_debt_applied=customer_effects["credit_debt_applied"],
     )
-    await db.sales.insert_one(sale.model_dump())
+    async def write_sale(session):
+        if not is_open_order:
+            sale.receipt_number = offline_receipt_number or await _next_receipt_number(owner_id, sale.created_at, session=session)
+        await db.sales.insert_one(sale.model_dump(), session=session)
+        return sale, []
+
+    try:
+        await domain_events.commit(db, write_sale)
+    except DuplicateKeyError:
+        if not offline_receipt_number:
+            raise
+        # Another sale took the same offline number after the check above; the unique index refused this one.
+        raise HTTPException(status_code=409, detail="Ce numero de ticket est deja utilise")
+
+    # 2. Stock deduction â€” uniquement pour les ventes complÃ¨tes, une fois la vente enregistrÃ©e
+    if not is_open_order:
+        for si in sale_items:
+            product_doc = await db.products.find_one({"product_id": si.product_id, "user_id": owner_id})
+            if product_doc:
+                await _apply_sale_item_inventory(product_doc, si.quantity, user, suppress_errors=True)
     _invalidate_dashboard_ai_caches(owner_id, store_id)
+    if not is_open_order:
+        asyncio.create_task(_after_sale_completed(sale.model_dump()))
 
     # 6. If this is an open order tied to a table, claim the table atomically.
     if is_open_order and sale_data.table_id:
@@ -22485,6 +22496,11 @@ async def create_sale(sale_data: SaleCreate, user: User = Depends(require_permis
         if claim_result.matched_count == 0:
             await db.sales.delete_one({"sale_id": sale.sale_id, "user_id": owner_id})
             raise HTTPException(status_code=409, detail="Cette table est deja liee a une commande ouverte")
+        table = await db.tables.find_one({"table_id": sale_data.table_id, "user_id": owner_id, "store_id": store_id})
+        if table:
+            await restaurant_stream.publish(store_id, "table_updated", table=_stream_table(table))
+    if is_open_order or sale.kitchen_sent:
+        await restaurant_stream.publish(store_id, "order_created", sale=_stream_sale(sale.model_dump()))
 
     if not is_open_order:
         await log_activity(
@@ -22515,6 +22531,7 @@ async def create_expense(expense_data: ExpenseCreate, user: User = Depends(requi
 
     await db.expenses.insert_one(expense.model_dump())
     _invalidate_dashboard_ai_caches(owner_id, expense.store_id or user.active_store_id)
+    await accounting_periods.invalidate_periods(db, owner_id, expense.created_at)
 
     # Log activity
     await log_activity(
@@ -22568,19 +22585,25 @@ async def update_expense(expense_id: str, expense_data: ExpenseCreate, user: Use
     update = {k: v for k, v in expense_data.model_dump().items() if v is not None}
     if "date" in update:
         update["created_at"] = update.pop("date")
+    previous = await db.expenses.find_one({"expense_id": expense_id, "user_id": owner_id}, {"_id": 0, "created_at": 1})
     await db.expenses.update_one({"expense_id": expense_id, "user_id": owner_id}, {"$set": update})
     doc = await db.expenses.find_one({"expense_id": expense_id, "user_id": owner_id}, {"_id": 0})
     if not doc:
         raise HTTPException(404, "DÃ©pense non trouvÃ©e")
+    for touched_at in {(previous or {}).get("created_at"), doc.get("created_at")}:
+        await accounting_periods.invalidate_periods(db, owner_id, touched_at)
     ensure_scoped_document_access(user, doc, detail="Acces refuse pour cette depense")
     return Expense(**doc)
 
 @api_router.delete("/expenses/{expense_id}")
 async def delete_expense(expense_id: str, user: User = Depends(require_permission("accounting", "write"))):
     ensure_subscription_advanced_allowed(user, detail="Les ecritures comptables manuelles sont indisponibles tant que le compte n'est pas regularise.")
-    result = await db.expenses.delete_one({"expense_id": expense_id, "user_id": get_owner_id(user)})
-    if result.deleted_count == 0:
+    expense = await db.expenses.find_one_and_delete(
+        {"expense_id": expense_id, "user_id": get_owner_id(user)}, {"_id": 0, "created_at": 1}
+    )
+    if not expense:
         raise HTTPException(status_code=404, detail=i18n.t("accounting.expense_not_found", user.language))
+    await accounting_periods.invalidate_periods(db, get_owner_id(user), expense.get("created_at"))
     return {"message": i18n.t("accounting.expense_deleted", user.language)}
 
 
@@ -22672,153 +22695,45 @@ async def get_accounting_stats(
         end_date = datetime.now(timezone.utc)
         period_label = f"Derniers {days or 30} jours"
 
-    def parse_date_safe(d):
-        """Parse date handling both string and datetime, always returns tz-aware or None"""
-        if isinstance(d, str):
-            try:
-                return datetime.fromisoformat(d.replace('Z', '+00:00'))
-            except:
-                return None
-        if isinstance(d, datetime):
-            if d.tzinfo is None:
-                return d.replace(tzinfo=timezone.utc)
-            return d
-        return None
-
-    # 1. Sales Data
-    sales_query: dict = {"user_id": user_id}
-    sales_query = apply_accessible_store_scope(sales_query, user, store_id)
-    sales_query = apply_completed_sales_scope(sales_query)
-
-    # Apply date filters directly to the query
-    sales_query["created_at"] = {"$gte": start_date, "$lte": end_date}
-
-    sales = await db.sales.find(sales_query, {"_id": 0}).sort("created_at", -1).to_list(5000)
-
-    revenue = 0.0
-    cogs = 0.0
-    total_items_sold = 0
-    payment_breakdown: Dict[str, float] = {}
-    daily_map: Dict[str, dict] = {}
-
-    # Track performance per product
-    perf_map: Dict[str, dict] = {} # product_id -> {name, qty_sold, revenue, cogs, loss}
-
-    for s in sales:
-        sale_amount = s.get("total_amount", 0.0)
-        revenue += sale_amount
-
-        # Payment breakdown
-        pm = s.get("payment_method", "cash")
-        payment_breakdown[pm] = payment_breakdown.get(pm, 0.0) + sale_amount
-
-        # Daily aggregation
-        sale_date = parse_date_safe(s.get("created_at"))
-        if sale_date:
-            day_key = sale_date.strftime("%Y-%m-%d")
-            if day_key not in daily_map:
-                daily_map[day_key] = {"date": day_key, "revenue": 0.0, "profit": 0.0}
-            daily_map[day_key]["revenue"] += sale_amount
-
-            sale_cogs = 0.0
-            for item in s.get("items", []):
-                p_id = item.get("product_id")
-                qty = item.get("quantity", 0)
-                item_revenue = item.get("total", 0.0) or (qty * item.get("selling_price", 0.0))
-                item_cost = item.get("purchase_price", 0.0) * qty
-
-                cogs += item_cost
-                sale_cogs += item_cost
-                total_items_sold += qty
-
-                if p_id:
-                    if p_id not in perf_map:
-                        perf_map[p_id] = {"id": p_id, "name": item.get("product_name", "Inconnu"), "qty_sold": 0, "revenue": 0.0, "cogs": 0.0, "loss": 0.0}
-                    perf_map[p_id]["qty_sold"] += qty
-                    perf_map[p_id]["revenue"] += item_revenue
-                    perf_map[p_id]["cogs"] += item_cost
-
-            daily_map[day_key]["profit"] += sale_amount - sale_cogs
+    # Closed days/months come from stored summaries; only the open part is computed live.
+    store_filter = apply_accessible_store_scope({}, user, store_id)
+    period_stats = await accounting_periods.get_range_stats(
+        db, user_id, store_filter, start_date, end_date, is_loss_stock_movement,
+    )
 
+    revenue = period_stats["revenue"]
+    cogs = period_stats["cogs"]
+    sales_count = int(period_stats["sales_count"])
+    total_items_sold = period_stats["total_items_sold"]
+    payment_breakdown = {row["key"]: row["amount"] for row in period_stats["payment"]}
+    daily_revenue = period_stats["daily"]
+    perf_map = {row["id"]: row for row in period_stats["products"]}
     gross_profit = revenue - cogs
-    daily_revenue = sorted(daily_map.values(), key=lambda d: d["date"])
-    # TVA collectÃ©e
-    tax_collected = sum(s.get("tax_total", 0) for s in sales)
-
-    # 2. Losses Data
-    mv_query: dict = {"user_id": user_id, "type": "out"}
-    mv_query = apply_accessible_store_scope(mv_query, user, store_id)
-
-    # Apply date filters directly to the query
-    mv_query["created_at"] = {"$gte": start_date, "$lte": end_date}
-
-    all_movements = await db.stock_movements.find(mv_query, {"_id": 0}).sort("created_at", -1).to_list(10000)
-
-    movements = [m for m in all_movements if is_loss_stock_movement(m)]
-
-    total_losses = 0.0
-    loss_breakdown: Dict[str, float] = {}
-
-    prod_ids = list(set([m["product_id"] for m in movements]))
-    products_db = await db.products.find(
-        {"product_id": {"$in": prod_ids}, "user_id": user_id},
-        {"_id": 0}
-    ).to_list(len(prod_ids)) if prod_ids else []
-    prod_map = {p["product_id"]: p for p in products_db}
-
-    for m in movements:
-        p_id = m.get("product_id")
-        p = prod_map.get(p_id)
-        price = p.get("purchase_price", 0.0) if p else 0.0
-        qty = m.get("quantity", 0)
-        loss_val = price * qty
-        total_losses += loss_val
-        reason = m.get("reason") or "Autre"
-        loss_breakdown[reason] = loss_breakdown.get(reason, 0.0) + loss_val
-
-        if p_id:
-            if p_id not in perf_map:
-                perf_map[p_id] = {"id": p_id, "name": p.get("name", "Inconnu") if p else "Inconnu", "qty_sold": 0, "revenue": 0.0, "cogs": 0.0, "loss": 0.0}
-            perf_map[p_id]["loss"] += loss_val
-
-    # 3. Expenses Data (NEW)
-    exp_query: dict = {"user_id": user_id}
-    exp_query = apply_accessible_store_scope(exp_query, user, store_id)
-    all_expenses_docs = await db.expenses.find(exp_query, {"_id": 0}).to_list(2000)
-
-    total_expenses = 0.0
-    expenses_breakdown: Dict[str, float] = {}
-    for e in all_expenses_docs:
-        e_date = parse_date_safe(e.get("created_at"))
-        if e_date and start_date <= e_date <= end_date:
-            amount = e.get("amount", 0.0)
-            total_expenses += amount
-            cat = e.get("category", "Autre")
-            expenses_breakdown[cat] = expenses_breakdown.get(cat, 0.0) + amount
-
-    # 4. Purchase Orders
-    purchase_query: dict = {"user_id": user_id, "status": "delivered"}
-    purchase_query = apply_accessible_store_scope(purchase_query, user, store_id)
-    purchase_orders = await db.orders.find(purchase_query, {"_id": 0}).to_list(2000)
-    delivered_orders = []
-    for o in purchase_orders:
-        o_date = parse_date_safe(o.get("updated_at") or o.get("created_at"))
-        if o_date and start_date <= o_date <= end_date:
-            delivered_orders.append(o)
-    total_purchases = sum(o.get("total_amount", 0) for o in delivered_orders)
-
-    # 5. Stock value (current)
-    stock_query: dict = {"user_id": user_id}
-    stock_query = apply_accessible_store_scope(stock_query, user, store_id)
-    active_products = await db.products.find({**stock_query, "is_active": {"$ne": False}}, {"_id": 0}).to_list(2000)
-    stock_value = sum(p.get("quantity", 0) * p.get("purchase_price", 0) for p in active_products)
-    stock_selling_value = sum(p.get("quantity", 0) * p.get("selling_price", 0) for p in active_products)
+    tax_collected = period_stats["tax_collected"]
+    total_losses = period_stats["total_losses"]
+    loss_breakdown = {row["key"]: row["amount"] for row in period_stats["losses_by_reason"]}
+    total_expenses = period_stats["expenses"]
+    expenses_breakdown = {row["key"]: row["amount"] for row in period_stats["expenses_by_category"]}
+    total_purchases = period_stats["total_purchases"]
+    purchases_count = int(period_stats["purchases_count"])
+
+    # Stock value (current)
+    stock_rows = await db.products.aggregate([
+        {"$match": {"user_id": user_id, **store_filter, "is_active": {"$ne": False}}},
+        {"$group": {
+            "_id": None,
+            "cost": {"$sum": {"$multiply": [{"$ifNull": ["$quantity", 0]}, {"$ifNull": ["$purchase_price", 0]}]}},
+            "retail": {"$sum": {"$multiply": [{"$ifNull": ["$quantity", 0]}, {"$ifNull": ["$selling_price", 0]}]}},
+        }},
+    ]).to_list(1)
+    stock_value = float((stock_rows[0] if stock_rows else {}).get("cost") or 0)
+    stock_selling_value = float((stock_rows[0] if stock_rows else {}).get("retail") or 0)
 
     # PROFIT DIFFERENTIATION
     # 1. Gross Profit (Stock/Sales) = already calculated as gross_profit
     # 2. Net Profit (Sales/Expenses) = Revenue - COGS - Losses - Expenses
     net_profit = gross_profit - total_losses - total_expenses
-    avg_sale = revenue / len(sales) if sales else 0.0
+    avg_sale = revenue / sales_count if sales_count else 0.0
     gross_margin_pct = ((gross_profit / revenue) * 100) if revenue > 0 else 0.0
     net_margin_pct = ((net_profit / revenue) * 100) if revenue > 0 else 0.0
     expense_ratio = ((total_expenses / revenue) * 100) if revenue > 0 else 0.0
@@ -22871,10 +22786,10 @@ async def get_accounting_stats(
         expenses=total_expenses,
         expenses_breakdown=expenses_breakdown,
         loss_breakdown=loss_breakdown,
-        sales_count=len(sales),
+        sales_count=sales_count,
         period_label=period_label,
         total_purchases=total_purchases,
-        purchases_count=len(delivered_orders),
+        purchases_count=purchases_count,
         daily_revenue=daily_revenue,
         payment_breakdown=payment_breakdown,
         avg_sale=round(avg_sale, 0),
@@ -22974,9 +22889,20 @@ async def _build_customer_name_map(owner_id: str, customer_ids: List[str]) -> Di
     return {customer["customer_id"]: customer.get("name", "") for customer in customers}
 
 
-def _build_invoice_number(prefix: Optional[str], sale_id: str, issued_at: datetime) -> str:
-    clean_prefix = "".join(ch for ch in (prefix or "FAC").upper() if ch.isalnum()) or "FAC"
-    return f"{clean_prefix}-{issued_at.strftime('%Y%m%d')}-{sale_id[-6:].upper()}"
+async def _allocate_invoice_number(owner_id: str, prefix: Optional[str], issued_at: datetime, session=None) -> str:
+    """Next number of the owner's invoice series for ``prefix``; gap-free when ``session`` is the insert's transaction."""
+    clean_prefix = sequences.clean_prefix(prefix, "FAC")
+    return await sequences.next_number(db, owner_id, f"invoice:{clean_prefix}", clean_prefix, issued_at, session=session)
+
+
+async def _insert_numbered_invoice(invoice: CustomerInvoice, prefix: Optional[str]) -> None:
+    """Number and insert ``invoice`` in one transaction, so a failed insert does not consume a number."""
+    async def write_invoice(session):
+        invoice.invoice_number = await _allocate_invoice_number(invoice.user_id, prefix, invoice.issued_at, session=session)
+        await db.customer_invoices.insert_one(invoice.model_dump(), session=session)
+        return invoice, []
+
+    await domain_events.commit(db, write_invoice)
 
 
 async def _create_or_get_invoice_from_sale_doc(sale_doc: dict, user: User) -> CustomerInvoice:
@@ -23028,7 +22954,7 @@ async def _create_or_get_invoice_from_sale_doc(sale_doc: dict, user: User) -> Cu
     ]
 
     invoice = CustomerInvoice(
-        invoice_number=_build_invoice_number(document_profile.get("invoice_prefix"), sale_doc["sale_id"], issued_at),
+        invoice_number="",
         invoice_label=document_profile.get("invoice_label") or "Facture",
         invoice_prefix=document_profile.get("invoice_prefix") or "FAC",
         user_id=owner_id,
@@ -23052,7 +22978,14 @@ async def _create_or_get_invoice_from_sale_doc(sale_doc: dict, user: User) -> Cu
         sale_created_at=sale_doc.get("created_at"),
         issued_at=issued_at,
     )
-    await db.customer_invoices.insert_one(invoice.model_dump())
+    try:
+        await _insert_numbered_invoice(invoice, document_profile.get("invoice_prefix"))
+    except DuplicateKeyError:
+        # Another request invoiced this sale first.
+        existing = await db.customer_invoices.find_one({"sale_id": sale_doc["sale_id"], "user_id": owner_id}, {"_id": 0})
+        if not existing:
+            raise
+        return CustomerInvoice(**existing)
     await log_activity(
         user=user,
         action="invoice_created",
@@ -23223,15 +23156,11 @@ async def create_free_invoice(
 
     total_amount = round(subtotal_ht + tax_total - data.discount_amount, 2)
 
-    # Auto invoice number
-    count = await db.customer_invoices.count_documents({"user_id": owner_id})
-    invoice_number = f"{prefix}-{count + 1:05d}"
-
     store_id = getattr(user, "active_store_id", None) or ""
     currency = getattr(user, "currency", None) or "XOF"
 
     invoice = CustomerInvoice(
-        invoice_number=invoice_number,
+        invoice_number="",
         invoice_label=label,
         invoice_prefix=prefix,
         user_id=owner_id,
@@ -23252,7 +23181,7 @@ async def create_free_invoice(
         business_address=business_address,
         footer=footer,
     )
-    await db.customer_invoices.insert_one(invoice.model_dump())
+    await _insert_numbered_invoice(invoice, prefix)
     return invoice
 
 
@@ -23787,11 +23716,12 @@ def resolve_notification_recipients(
     return recipients
 
 
-async def user_allows_push_notifications(user_id: str, severity: str) -> bool:
-    settings_doc = await db.user_settings.find_one(
-        {"user_id": user_id},
-        {"_id": 0, "push_notifications": 1, "notification_preferences": 1},
-    ) or {}
+async def user_allows_push_notifications(user_id: str, severity: str, settings_doc: Optional[Dict[str, Any]] = None) -> bool:
+    if settings_doc is None:
+        settings_doc = await db.user_settings.find_one(
+            {"user_id": user_id},
+            {"_id": 0, "push_notifications": 1, "notification_preferences": 1},
+        ) or {}
     preferences = normalize_notification_preferences(
         settings_doc.get("notification_preferences"),
         push_enabled=settings_doc.get("push_notifications", True),
@@ -23865,12 +23795,13 @@ async def dispatch_alert_channels(
     store_id: Optional[str],
     alert: Alert,
     data: Optional[Dict[str, Any]] = None,
+    settings_doc: Optional[Dict[str, Any]] = None,
 ):
     rule = await resolve_alert_dispatch_rule(owner_id, account_id, store_id, alert.type, alert.severity)
     channels = resolve_alert_channels_for_dispatch(alert, rule.get("notification_channels") or ["in_app"])
     notification_data = build_alert_navigation_data(alert, data)
 
-    if "push" in channels and await user_allows_push_notifications(owner_id, alert.severity):
+    if "push" in channels and await user_allows_push_notifications(owner_id, alert.severity, settings_doc):
         await notification_service.notify_user(
             db,
             owner_id,
@@ -23881,7 +23812,7 @@ async def dispatch_alert_channels(
         )
 
     if "email" in channels:
-        user_settings = await db.user_settings.find_one(
+        user_settings = settings_doc if settings_doc is not None else await db.user_settings.find_one(
             {"user_id": owner_id},
             {"_id": 0, "notification_preferences": 1},
         ) or {}
@@ -24039,43 +23970,50 @@ async def check_slow_moving(user_id: str):
     if not rules:
         return
 
+    await product_activity.ensure_product_activity(db, user_id)
     thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
-    products = await db.products.find({"user_id": user_id, "is_active": True, "quantity": {"$gt": 0}}, {"_id": 0}).to_list(1000)
+    # No "out" movement in the last 30 days (or never), straight from the product index.
+    products = await db.products.find(
+        {
+            "user_id": user_id,
+            "is_active": True,
+            "quantity": {"$gt": 0},
+            "$or": [
+                {"last_movement_out_at": {"$lt": thirty_days_ago}},
+                {"last_movement_out_at": None},
+            ],
+        },
+        {"_id": 0, "product_id": 1, "name": 1, "store_id": 1},
+    ).to_list(1000)
+    if not products:
+        return
+
+    already_alerted = set(await db.alerts.distinct("product_id", {
+        "user_id": user_id,
+        "product_id": {"$in": [p["product_id"] for p in products]},
+        "type": "slow_moving",
+        "is_dismissed": False,
+    }))
 
     for product in products:
-        # Check if there's been any "out" movement in the last 30 days
-        recent_out = await db.stock_movements.find_one({
-            "product_id": product["product_id"],
-            "user_id": user_id,
-            "type": "out",
-            "created_at": {"$gte": thirty_days_ago}
-        })
-        if not recent_out:
-            # Check if alert already exists
-            existing = await db.alerts.find_one({
-                "user_id": user_id,
-                "product_id": product["product_id"],
-                "type": "slow_moving",
-                "is_dismissed": False
-            })
-            if not existing:
-                alert = Alert(
-                    user_id=user_id,
-                    store_id=product.get("store_id"),
-                    product_id=product["product_id"],
-                    type="slow_moving",
-                    title="reminders.dormant_products_label",
-                    message=f"{product['name']} n'a eu aucune sortie depuis 30 jours",
-                    severity="info"
-                )
-                await db.alerts.insert_one(alert.model_dump())
-                await dispatch_alert_channels(
-                    user_id,
-                    account_id,
-                    product.get("store_id"),
-                    alert,
-                    data={"screen": "products", "filter": "slow_moving"},
-                )
+        if product["product_id"] not in already_alerted:
+            alert = Alert(
+                user_id=user_id,
+                store_id=product.get("store_id"),
+                product_id=product["product_id"],
+                type="slow_moving",
+                title="reminders.dormant_products_label",
+                message=f"{product['name']} n'a eu aucune sortie depuis 30 jours",
+                severity="info"
+            )
+            await db.alerts.insert_one(alert.model_dump())
+            await dispatch_alert_channels(
+                user_id,
+                account_id,
+                product.get("store_id"),
+                alert,
+                data={"screen": "products", "filter": "slow_moving"},
+            )
 
 @api_router.get("/alerts")
 async def get_alerts(
@@ -24553,16 +24491,21 @@ def build_store_name_map(stores: List[dict]) -> Dict[str, str]:
     }
 
 
-def build_current_sales_rows(snapshot: Dict[str, Any]) -> List[Dict[str, Any]]:
+CURRENT_SALES_ROW_PROJECTION = {
+    "_id": 0, "sale_id": 1, "store_id": 1, "created_at": 1, "customer_name": 1, "payment_method": 1,
+    "items.product_id": 1, "items.product_name": 1, "items.quantity": 1, "items.total": 1,
+    "items.selling_price": 1, "items.purchase_price": 1, "items.discount_amount": 1,
+}
+
+
+async def build_current_sales_rows(snapshot: Dict[str, Any]) -> List[Dict[str, Any]]:
     current_start = snapshot["current_start"]
     product_map = snapshot["product_map"]
     store_name_map = build_store_name_map(snapshot["stores"])
     rows: List[Dict[str, Any]] = []
 
-    for sale in snapshot["sales_docs"]:
-        sale_date = parse_analytics_datetime(sale.get("created_at"))
-        if not sale_date or sale_date < current_start:
-            continue
+    match = {**snapshot["sales_match"], "created_at": {"$gte": current_start, "$lt": snapshot["now"]}}
+    async for sale in db.sales.find(match, CURRENT_SALES_ROW_PROJECTION):
 
         revenue = 0.0
         gross_profit = 0.0
@@ -24746,11 +24689,19 @@ async def load_supplier_product_ids(owner_id: str, supplier_id: Optional[str]) -
     return [link.get("product_id") for link in supplier_links if link.get("product_id")]
 
 
+ANALYTICS_PRODUCT_PROJECTION = {
+    "_id": 0, "product_id": 1, "name": 1, "store_id": 1, "category_id": 1, "unit": 1,
+    "quantity": 1, "min_stock": 1, "max_stock": 1, "purchase_price": 1, "selling_price": 1,
+    "expiry_date": 1, "is_active": 1,
+}
+
+
 async def load_analytics_products(
     user: User,
     store_id: Optional[str] = None,
     category_id: Optional[str] = None,
     supplier_id: Optional[str] = None,
+    projection: Optional[Dict[str, Any]] = None,
 ) -> List[dict]:
     owner_id = get_owner_id(user)
     query: Dict[str, Any] = {"user_id": owner_id}
@@ -24765,7 +24716,7 @@ async def load_analytics_products(
             return []
         query["product_id"] = {"$in": product_ids}
 
-    products = await db.products.find(query, {"_id": 0}).to_list(5000)
+    products = await db.products.find(query, projection or {"_id": 0}).to_list(5000)
     return [product for product in products if product.get("is_active", True)]
 
 
@@ -24792,11 +24743,19 @@ async def build_analytics_snapshot(
     visible_store_ids = build_visible_store_ids(stores)
     allow_legacy_unassigned = len(visible_store_ids) == 1
 
+    cache_key = analytics_snapshot.snapshot_cache_key(
+        owner_id, visible_store_ids, store_id, category_id, supplier_id, normalized_days, user.currency,
+    )
+    cached = analytics_snapshot.get_cached_snapshot(cache_key)
+    if cached is not None:
+        return cached
+
     products = await load_analytics_products(
         user,
         store_id=effective_store_id,
         category_id=category_id,
         supplier_id=supplier_id,
+        projection=ANALYTICS_PRODUCT_PROJECTION,
     )
     if visible_store_ids:
         products = [
@@ -24825,26 +24784,18 @@ async def build_analytics_snapshot(
     filter_on_product_set = bool(category_id or supplier_id)
     allowed_product_ids = set(product_map.keys()) if filter_on_product_set else None
 
-    sales_query: Dict[str, Any] = {
-        "user_id": owner_id,
-        "created_at": {"$gte": sales_window_start, "$lt": now},
-        "$or": [{"status": {"$exists": False}}, {"status": "completed"}],
-    }
-    sales_query = apply_accessible_store_scope(sales_query, user, effective_store_id)
-    sales_docs = await db.sales.find(sales_query, {"_id": 0}).to_list(10000)
-    if visible_store_ids:
-        sales_docs = [
-            sale
-            for sale in sales_docs
-            if sale.get("store_id") in visible_store_ids
-            or (
-                allow_legacy_unassigned
-                and sale.get("store_id") in (None, "")
-            )
-        ]
+    # Sales side is aggregated server-side: one row per (period bucket, store, product).
+    sales_match = analytics_snapshot.build_sales_match(
+        owner_id, sales_window_start, now, visible_store_ids, allow_legacy_unassigned,
+    )
+    sales_match = apply_accessible_store_scope(sales_match, user, effective_store_id)
+    facets = (await db.sales.aggregate(
+        analytics_snapshot.build_sales_facet_pipeline(
+            sales_match, current_start, previous_start, dormant_start, allowed_product_ids,
+        ),
+        allowDiskUse=True,
+    ).to_list(1) or [{}])[0]
 
-    current_sale_ids = set()
-    previous_sale_ids = set()
     sold_product_ids_30d = set()
     top_products: Dict[str, Dict[str, Any]] = {}
     top_categories: Dict[str, Dict[str, Any]] = {}
@@ -24860,99 +24811,77 @@ async def build_analytics_snapshot(
     current_gross_profit = 0.0
     previous_gross_profit = 0.0
     current_cogs = 0.0
+    current_sales_count = 0
+    previous_sales_count = 0
+
+    for row in facets.get("sales") or []:
+        bucket = row["_id"].get("bucket")
+        sale_store_id = row["_id"].get("store_id")
+        count = int(row.get("count") or 0)
+        if bucket == "current":
+            current_sales_count += count
+            if sale_store_id:
+                per_store_metrics[sale_store_id]["sales_count"] = per_store_metrics[sale_store_id].get("sales_count", 0) + count
+        elif bucket == "previous":
+            previous_sales_count += count
+            if sale_store_id:
+                per_store_metrics[sale_store_id]["previous_sales_count"] = per_store_metrics[sale_store_id].get("previous_sales_count", 0) + count
+
+    for group in facets.get("lines") or []:
+        bucket = group["_id"].get("bucket")
+        sale_store_id = group["_id"].get("store_id")
+        product_id = group["_id"].get("product_id")
+        product_doc = product_map.get(product_id, {})
+        quantity, line_revenue, line_cogs = analytics_snapshot.line_totals(group, product_doc)
+        line_gross_profit = line_revenue - line_cogs
+
+        if group.get("recent") and product_id:
+            sold_product_ids_30d.add(product_id)
+
+        if bucket == "current":
+            current_revenue += line_revenue
+            current_gross_profit += line_gross_profit
+            current_cogs += line_cogs
+            if sale_store_id:
+                per_store_metrics[sale_store_id]["revenue"] += line_revenue
+                per_store_metrics[sale_store_id]["gross_profit"] += line_gross_profit
+                per_store_metrics[sale_store_id]["cogs"] += line_cogs
 
-    for sale in sales_docs:
-        sale_date = parse_analytics_datetime(sale.get("created_at"))
-        if not sale_date:
-            continue
-
-        bucket = None
-        if sale_date >= current_start:
-            bucket = "current"
-        elif sale_date >= previous_start:
-            bucket = "previous"
-
-        sale_id = sale.get("sale_id")
-        sale_store_id = sale.get("store_id")
-        sale_has_line_in_bucket = False
-        sale_has_line_in_previous = False
-
-        for item in sale.get("items") or []:
-            product_id = item.get("product_id")
-            if allowed_product_ids is not None and product_id not in allowed_product_ids:
-                continue
-
-            product_doc = product_map.get(product_id, {})
-            quantity = float(item.get("quantity") or 0)
-            line_revenue = float(item.get("total") or 0)
-            if not line_revenue:
-                line_revenue = max(
-                    0.0,
-                    (float(item.get("selling_price") or product_doc.get("selling_price") or 0) * quantity)
-                    - float(item.get("discount_amount") or 0),
-                )
-            purchase_price = float(item.get("purchase_price") or product_doc.get("purchase_price") or 0)
-            line_cogs = purchase_price * quantity
-            line_gross_profit = line_revenue - (purchase_price * quantity)
-
-            if sale_date >= dormant_start and product_id:
-                sold_product_ids_30d.add(product_id)
-
-            if bucket == "current":
-                sale_has_line_in_bucket = True
-                current_revenue += line_revenue
-                current_gross_profit += line_gross_profit
-                current_cogs += line_cogs
-                if sale_store_id:
-                    per_store_metrics[sale_store_id]["revenue"] += line_revenue
-                    per_store_metrics[sale_store_id]["gross_profit"] += line_gross_profit
-                    per_store_metrics[sale_store_id]["cogs"] += line_cogs
-
-                if product_id:
-                    product_entry = top_products.setdefault(
-                        product_id,
-                        {
-                            "product_id": product_id,
-                            "name": item.get("product_name") or product_doc.get("name") or "Produit",
-                            "revenue": 0.0,
-                            "quantity": 0.0,
-                            "gross_profit": 0.0,
-                        },
-                    )
-                    product_entry["revenue"] += line_revenue
-                    product_entry["quantity"] += quantity
-                    product_entry["gross_profit"] += line_gross_profit
-
-                category_key = product_doc.get("category_id") or item.get("category_id") or "uncategorized"
-                category_entry = top_categories.setdefault(
-                    category_key,
+            if product_id:
+                product_entry = top_products.setdefault(
+                    product_id,
                     {
-                        "category_id": None if category_key == "uncategorized" else category_key,
-                        "name": category_name_map.get(category_key, "Sans categorie"),
+                        "product_id": product_id,
+                        "name": group.get("name") or product_doc.get("name") or "Produit",
                         "revenue": 0.0,
                         "quantity": 0.0,
                         "gross_profit": 0.0,
                     },
                 )
-                category_entry["revenue"] += line_revenue
-                category_entry["quantity"] += quantity
-                category_entry["gross_profit"] += line_gross_profit
-
-            elif bucket == "previous":
-                sale_has_line_in_previous = True
-                previous_revenue += line_revenue
-                previous_gross_profit += line_gross_profit
-                if sale_store_id:
-                    per_store_metrics[sale_store_id]["previous_revenue"] += line_revenue
-
-        if sale_has_line_in_bucket and sale_id:
-            current_sale_ids.add(sale_id)
-            if sale_store_id:
-                per_store_metrics[sale_store_id]["sale_ids"].add(sale_id)
-        if sale_has_line_in_previous and sale_id:
-            previous_sale_ids.add(sale_id)
+                product_entry["revenue"] += line_revenue
+                product_entry["quantity"] += quantity
+                product_entry["gross_profit"] += line_gross_profit
+
+            category_key = product_doc.get("category_id") or group.get("category_id") or "uncategorized"
+            category_entry = top_categories.setdefault(
+                category_key,
+                {
+                    "category_id": None if category_key == "uncategorized" else category_key,
+                    "name": category_name_map.get(category_key, "Sans categorie"),
+                    "revenue": 0.0,
+                    "quantity": 0.0,
+                    "gross_profit": 0.0,
+                },
+            )
+            category_entry["revenue"] += line_revenue
+            category_entry["quantity"] += quantity
+            category_entry["gross_profit"] += line_gross_profit
+
+        elif bucket == "previous":
+            previous_revenue += line_revenue
+            previous_gross_profit += line_gross_profit
             if sale_store_id:
-                per_store_metrics[sale_store_id]["previous_sale_ids"].add(sale_id)
+                per_store_metrics[sale_store_id]["previous_revenue"] += line_revenue
 
     summary_metrics = {
         "stock_value": 0.0,
@@ -24993,14 +24922,12 @@ async def build_analytics_snapshot(
                 bucket["dormant_products_count"] += 1
 
     for metric in per_store_metrics.values():
-        metric["sales_count"] = len(metric["sale_ids"])
-        metric["previous_sales_count"] = len(metric["previous_sale_ids"])
+        metric["sales_count"] = metric.get("sales_count", 0)
+        metric["previous_sales_count"] = metric.get("previous_sales_count", 0)
         metric["average_ticket"] = round(metric["revenue"] / metric["sales_count"], 2) if metric["sales_count"] else 0.0
         metric["revenue_delta"] = compute_delta_ratio(metric["revenue"], metric["previous_revenue"])
         metric["stock_turnover_ratio"] = round(metric["cogs"] / metric["stock_value"], 2) if metric["stock_value"] > 0 else 0.0
 
-    current_sales_count = len(current_sale_ids)
-    previous_sales_count = len(previous_sale_ids)
     average_ticket = round(current_revenue / current_sales_count, 2) if current_sales_count else 0.0
     previous_average_ticket = round(previous_revenue / previous_sales_count, 2) if previous_sales_count else 0.0
     summary_metrics["stock_turnover_ratio"] = round(current_cogs / summary_metrics["stock_value"], 2) if summary_metrics["stock_value"] > 0 else 0.0
@@ -25013,7 +24940,7 @@ async def build_analytics_snapshot(
         supplier_name_map=supplier_name_map,
     )
 
-    return {
+    snapshot = {
         "days": normalized_days,
         "currency": user.currency or "XOF",
         "scope_label": scope_label,
@@ -25025,7 +24952,10 @@ async def build_analytics_snapshot(
         "product_map": product_map,
         "category_name_map": category_name_map,
         "sold_product_ids_30d": sold_product_ids_30d,
-        "sales_docs": sales_docs,
+        "sales_match": sales_match,
+        "daily_revenue": analytics_snapshot.distribution_rows(facets.get("daily") or [], "date"),
+        "hourly_revenue": analytics_snapshot.distribution_rows(facets.get("hourly") or [], "hour"),
+        "payment_methods": analytics_snapshot.distribution_rows(facets.get("payment_methods") or [], "payment_method"),
         "current_revenue": round(current_revenue, 2),
         "previous_revenue": round(previous_revenue, 2),
         "current_gross_profit": round(current_gross_profit, 2),
@@ -25039,6 +24969,8 @@ async def build_analytics_snapshot(
         "top_categories": top_categories,
         "per_store_metrics": per_store_metrics,
     }
+    analytics_snapshot.set_cached_snapshot(cache_key, snapshot)
+    return snapshot
 
 
 @api_router.get("/analytics/filters/meta")
@@ -25414,11 +25346,11 @@ async def get_analytics_kpi_details(
     )
     scope_label = snapshot.get("scope_label") or "selection courante"
     product_rows = build_product_metric_rows(snapshot)
-    sales_rows = build_current_sales_rows(snapshot)
     stock_health_lists = build_stock_health_lists(snapshot)
 
     if context == "executive":
         if metric in {"revenue", "gross_profit", "sales_count", "average_ticket"}:
+            sales_rows = await build_current_sales_rows(snapshot)
             return build_kpi_detail_response(
                 title="Details des ventes",
                 description=f"Ventes sur {scope_label} pendant {snapshot['days']} jours.",
@@ -25578,99 +25510,83 @@ async def get_analytics_kpi_details(
 
     raise HTTPException(status_code=404, detail="KPI non supporte")
 
+async def backfill_product_activity_loop():
+    backfilled = await product_activity.backfill_pending_owners(db)
+    if backfilled:
+        logger.info("Backfilled product activity timestamps for %s owner(s)", backfilled)
+
+
+async def rebuild_customer_stats_loop():
+    rebuilt = await customer_stats.rebuild_stale_owners(db)
+    if rebuilt:
+        logger.info("Rebuilt customer stats for %s owner(s)", rebuilt)
+
+
+async def reconcile_platform_metrics_loop():
+    result = await platform_metrics.reconcile(db, _platform_account_profile)
+    if result["stores"]:
+        logger.info("Platform metrics: %s period(s), %s store(s) reconciled", result["periods"], result["stores"])
+
+
+async def reconcile_inventory_summaries_loop():
+    reconciled = await inventory_summary.reconcile_stale_summaries(db)
+    if reconciled:
+        logger.info("Reconciled %s inventory summaries", reconciled)
+
+
+async def _fetch_products_in_order(product_ids: List[str]) -> List[Dict[str, Any]]:
+    if not product_ids:
+        return []
+    docs = await db.products.find({"product_id": {"$in": product_ids}}, {"_id": 0, "inventory_class": 0}).to_list(len(product_ids))
+    by_id = {doc["product_id"]: doc for doc in docs}
+    return [by_id[pid] for pid in product_ids if pid in by_id]
+
+
 @api_router.get("/dashboard")
 async def get_dashboard(user: User = Depends(require_operational_access)):
     owner_id = get_owner_id(user)
     # Run slow checks in background (fire-and-forget, don't block dashboard response)
     asyncio.ensure_future(_safe_background_checks(owner_id))
 
-    # Fetch ALL user products (no is_active filter at DB level â€” handle in memory)
-    product_query: dict = {"user_id": owner_id}
+    # Stock figures come from the materialized per-store summary kept up to date by stock writes.
     if user.active_store_id:
-        product_query["store_id"] = user.active_store_id
-
-    products = await db.products.find(product_query, {"_id": 0}).to_list(1000)
+        summary = await inventory_summary.get_summary(db, owner_id, user.active_store_id)
+    else:
+        owner_stores = await db.stores.find({"user_id": owner_id}, {"_id": 0, "store_id": 1}).to_list(None)
+        summary = await inventory_summary.get_owner_summary(
+            db, owner_id, [store["store_id"] for store in owner_stores if store.get("store_id")],
+        )
 
     # Legacy safety net: only backfill unassigned products automatically for true single-store accounts.
-    if not products and user.active_store_id:
+    if not summary.get("total_products") and user.active_store_id:
         accessible_store_ids = list(dict.fromkeys((user.store_ids or []) + [user.active_store_id]))
         if len(accessible_store_ids) <= 1:
             fallback_query = {
                 "user_id": owner_id,
                 "$or": [{"store_id": None}, {"store_id": {"$exists": False}}],
             }
-            products = await db.products.find(fallback_query, {"_id": 0}).to_list(1000)
-            if products:
-                logger.info(f"Dashboard legacy backfill: assigning {len(products)} unscoped products to active store {user.active_store_id}")
-                product_ids = [p["product_id"] for p in products if p.get("product_id")]
-                if product_ids:
-                    await db.products.update_many(
-                        {"product_id": {"$in": product_ids}},
-                        {"$set": {"store_id": user.active_store_id, "is_active": True}},
-                    )
-                for p in products:
-                    p["store_id"] = user.active_store_id
-                    p["is_active"] = True
-
-    # Filter active products in memory (handles missing is_active field)
-    products = [p for p in products if p.get("is_active", True)]
-
-    # Auto-dismiss AI anomaly alerts for accounts with no products (false positives)
-    if not products:
-        ai_dismiss_query: dict = {"user_id": owner_id, "type": {"$regex": "^ai_"}, "is_dismissed": False}
-        if user.active_store_id:
-            ai_dismiss_query["store_id"] = user.active_store_id
-        await db.alerts.update_many(
-            ai_dismiss_query,
-            {"$set": {"is_dismissed": True}}
-        )
-
-    # Calculate stats
-    total_products = len(products)
-    total_value = sum(p.get("quantity", 0) * p.get("purchase_price", 0) for p in products)
-    selling_value = sum(p.get("quantity", 0) * p.get("selling_price", 0) for p in products)
-
-    # Out of stock products
-    out_of_stock_products = [p for p in products if p.get("quantity", 0) == 0]
-
-    # Critical products (out of stock or below min)
-    critical_products = [p for p in products if p.get("quantity", 0) == 0 or (p.get("min_stock", 0) > 0 and p.get("quantity", 0) <= p.get("min_stock", 0))]
-
-    # Overstock products
-    overstock_products = [p for p in products if p.get("max_stock", 0) > 0 and p.get("quantity", 0) >= p.get("max_stock", 0)]
+            legacy_ids = [
+                p["product_id"]
+                for p in await db.products.find(fallback_query, {"_id": 0, "product_id": 1}).to_list(1000)
+                if p.get("product_id")
+            ]
+            if legacy_ids:
+                logger.info(f"Dashboard legacy backfill: assigning {len(legacy_ids)} unscoped products to active store {user.active_store_id}")
+                await db.products.update_many(
+                    {"product_id": {"$in": legacy_ids}},
+                    {"$set": {"store_id": user.active_store_id, "is_active": True}},
+                )
+                summary = await inventory_summary.reconcile_store(db, owner_id, user.active_store_id)
 
-    # Low stock products (above 0 but below min)
-    low_stock_products = [p for p in products if p.get("quantity", 0) > 0 and p.get("min_stock", 0) > 0 and p.get("quantity", 0) <= p.get("min_stock", 0)]
+    critical_products = await _fetch_products_in_order((summary.get("critical_product_ids") or [])[:5])
+    overstock_products = await _fetch_products_in_order((summary.get("overstock_product_ids") or [])[:5])
 
-    # Safety net: ensure alerts exist for critical products (catches missed alerts)
-    for p in critical_products[:10]:  # Limit to avoid slow dashboard
-        try:
-            await check_and_create_alerts(Product(**p), owner_id, store_id=user.active_store_id)
-        except Exception:
-            pass  # Don't break dashboard if alert creation fails
-
-    # Auto-resolve: dismiss out_of_stock/low_stock alerts for products that are back to normal
-    normal_product_ids = [p["product_id"] for p in products if p.get("quantity", 0) > 0 and not (p.get("min_stock", 0) > 0 and p.get("quantity", 0) <= p.get("min_stock", 0))]
-    if normal_product_ids:
-        resolve_query: dict = {
-            "user_id": owner_id,
-            "product_id": {"$in": normal_product_ids},
-            "type": {"$in": ["out_of_stock", "low_stock"]},
-            "is_dismissed": False,
-        }
-        if user.active_store_id:
-            resolve_query["store_id"] = user.active_store_id
-        await db.alerts.update_many(
-            resolve_query,
-            {"$set": {"is_dismissed": True}}
-        )
-
-    # Now fetch alerts (after safety net has run)
     alert_query = {"user_id": owner_id, "is_dismissed": False}
     if user.active_store_id:
         alert_query["store_id"] = user.active_store_id
 
-    alerts = await db.alerts.find(alert_query, {"_id": 0}).to_list(100)
+    unread_alerts = await db.alerts.count_documents(alert_query)
+    recent_alerts = await db.alerts.find(alert_query, {"_id": 0}).sort("created_at", -1).to_list(5)
 
     # Recent sales (last 5)
     sales_query = {"user_id": owner_id}
@@ -25757,19 +25673,19 @@ async def get_dashboard(user: User = Depends(require_operational_access)):
         result["month_revenue"] = round(month_revenue, 0)
 
     if has_stock:
-        result["total_products"] = total_products
-        result["total_stock_value"] = round(total_value, 2)
-        result["potential_revenue"] = round(selling_value, 2)
-        result["critical_count"] = len(critical_products)
-        result["overstock_count"] = len(overstock_products)
-        result["low_stock_count"] = len(low_stock_products)
-        result["out_of_stock_count"] = len(out_of_stock_products)
-        result["critical_products"] = critical_products[:5]
-        result["overstock_products"] = overstock_products[:5]
+        result["total_products"] = int(summary.get("total_products") or 0)
+        result["total_stock_value"] = round(float(summary.get("total_stock_value") or 0), 2)
+        result["potential_revenue"] = round(float(summary.get("potential_revenue") or 0), 2)
+        result["critical_count"] = int(summary.get("critical_count") or 0)
+        result["overstock_count"] = int(summary.get("overstock_count") or 0)
+        result["low_stock_count"] = int(summary.get("low_stock_count") or 0)
+        result["out_of_stock_count"] = int(summary.get("out_of_stock_count") or 0)
+        result["critical_products"] = critical_products
+        result["overstock_products"] = overstock_products
 
     if has_stock or has_accounting:
-        result["unread_alerts"] = len(alerts)
-        result["recent_alerts"] = alerts[:5]
+        result["unread_alerts"] = unread_alerts
+        result["recent_alerts"] = recent_alerts
 
     if has_accounting:
         result["today_tax"] = round(today_tax, 0)
@@ -27002,12 +26918,15 @@ async def update_order_status(order_id: str, status_data: OrderStatusUpdate, use
         order_query["store_id"] = current_order["store_id"]
     result = await db.orders.find_one_and_update(
         order_query,
-        {"$set": {"status": status_data.status, "updated_at": datetime.now(timezone.utc)}},
+        accounting_periods.purchase_status_update(status_data.status, datetime.now(timezone.utc)),
         return_document=True
     )
 
     if not result:
         raise HTTPException(status_code=404, detail="Commande non trouvÃ©e")
+    if (current_order or {}).get("status") == "delivered" and status_data.status != "delivered":
+        # Purchases are counted on their delivery day; this one leaves that day's totals.
+        await accounting_periods.invalidate_periods(db, owner_id, accounting_periods.purchased_at(current_order))
 
     # If delivered, update stock (only for manual orders â€” marketplace uses confirm-delivery)
     if status_data.status == "delivered" and not result.get("is_connected"):
@@ -27020,6 +26939,7 @@ async def update_order_status(order_id: str, status_data: OrderStatusUpdate, use
                     {"product_id": item["product_id"]},
                     {"$set": {"quantity": new_quantity, "updated_at": datetime.now(timezone.utc)}}
                 )
+                await _sync_inventory_summary([item["product_id"]])
 
                 # Create stock movement
                 movement = StockMovement(
@@ -27040,6 +26960,16 @@ async def update_order_status(order_id: str, status_data: OrderStatusUpdate, use
 
     return {"message": f"Statut mis Ã  jour: {status_data.status}"}
 
+def _delivery_alert_events(order_id: str, owner_id: str, store_id: Optional[str], product_ids: List[str]) -> List[Dict[str, Any]]:
+    if not product_ids:
+        return []
+    return [domain_events.new_event(
+        "order.delivery_alerts",
+        {"owner_id": owner_id, "store_id": store_id, "product_ids": list(dict.fromkeys(product_ids))},
+        order_id,
+    )]
+
+
 class PartialDeliveryItem(BaseModel):
     item_id: str
     received_quantity: int
@@ -27136,6 +27066,7 @@ async def receive_partial_delivery(
     items_map = {i["item_id"]: i for i in order_items}
 
     received_so_far = order.get("received_items", {})
+    alert_product_ids: List[str] = []
 
     for delivery_item in data.items:
         item = items_map.get(delivery_item.item_id)
@@ -27184,6 +27115,7 @@ async def receive_partial_delivery(
                 {"product_id": item["product_id"]},
                 {"$set": update_set}
             )
+            await _sync_inventory_summary([item["product_id"]])
 
             if new_wac is not None:
                 await db.price_history.insert_one(PriceHistory(
@@ -27208,9 +27140,7 @@ async def receive_partial_delivery(
             )
             await db.stock_movements.insert_one(movement.model_dump())
 
-            # Check alerts
-            product["quantity"] = new_qty
-            await check_and_create_alerts(Product(**product), owner_id, store_id=order.get("store_id") or user.active_store_id)
+            alert_product_ids.append(item["product_id"])
 
     # Determine if fully delivered
     all_fully_received = True
@@ -27224,14 +27154,20 @@ async def receive_partial_delivery(
     order_update_query = {"order_id": order_id, "user_id": owner_id}
     if order.get("store_id"):
         order_update_query["store_id"] = order["store_id"]
-    await db.orders.update_one(
-        order_update_query,
-        {"$set": {
-            "received_items": received_so_far,
-            "status": new_status,
-            "updated_at": datetime.now(timezone.utc)
-        }}
-    )
+    async def write_reception(session):
+        await db.orders.update_one(
+            order_update_query,
+            {"$set": {
+                "received_items": received_so_far,
+                "status": new_status,
+                "updated_at": datetime.now(timezone.utc),
+                **({"delivered_at": datetime.now(timezone.utc)} if new_status == "delivered" else {}),
+            }},
+            session=session,
+        )
+        return None, _delivery_alert_events(order_id, owner_id, order.get("store_id") or user.active_store_id, alert_product_ids)
+
+    await commit_with_events(write_reception)
 
     await log_activity(user, "partial_delivery", "orders", f"RÃ©ception {'complÃ¨te' if all_fully_received else 'partielle'} - Commande {order_id}")
 
@@ -27257,23 +27193,27 @@ async def update_supplier_order_status(order_id: str, status_data: OrderStatusUp
     if status_data.status not in valid_statuses:
         raise HTTPException(status_code=400, detail="Statut invalide")
 
-    result = await db.orders.find_one_and_update(
-        {"order_id": order_id, "supplier_user_id": user.user_id, "is_connected": True},
-        {"$set": {"status": status_data.status, "updated_at": datetime.now(timezone.utc)}},
-        return_document=True
-    )
-
+    async def write_status(session):
+        order = await db.orders.find_one_and_update(
+            {"order_id": order_id, "supplier_user_id": user.user_id, "is_connected": True},
+            accounting_periods.purchase_status_update(status_data.status, datetime.now(timezone.utc)),
+            session=session,
+        )
+        if not order:
+            return None, []
+        # Notify shopkeeper of status change
+        return order, [domain_events.new_event("push.notify_user", {
+            "user_id": order["user_id"],
+            "title": "Mise Ã  jour Marketplace",
+            "body": f"Votre commande {order_id} est passÃ©e au statut: {status_data.status}",
+            "caller_owner_id": get_owner_id(user),
+        }, order_id)]
+
+    result = await commit_with_events(write_status)
     if not result:
         raise HTTPException(status_code=404, detail="Commande non trouvÃ©e")
-
-    # Notify shopkeeper of status change
-    await notification_service.notify_user(
-        db,
-        result["user_id"],
-        "Mise Ã  jour Marketplace",
-        f"Votre commande {order_id} est passÃ©e au statut: {status_data.status}",
-        caller_owner_id=get_owner_id(user)
-    )
+    if result.get("status") == "delivered" and status_data.status != "delivered":
+        await accounting_periods.invalidate_periods(db, result["user_id"], accounting_periods.purchased_at(result))
 
     return {"message": "Statut mis Ã  jour"}
 
@@ -27644,22 +27584,9 @@ async def get_statistics(user: User = Depends(require_permission("stock", "read"
 
 # ===================== GRAND LIVRE (GENERAL LEDGER) =====================
 
-@api_router.get("/grand-livre")
-async def get_grand_livre(
-    days: Optional[int] = 30,
-    start_date_str: Optional[str] = Query(None, alias="start_date"),
-    end_date_str: Optional[str] = Query(None, alias="end_date"),
-    user: User = Depends(require_permission("accounting", "read"))
-):
-    """
-    Returns a unified chronological ledger of all financial transactions:
-    sales (income), expenses (outflow), stock losses, and delivered supplier orders.
-    Each entry includes: date, type, reference, description, amount_in, amount_out, running_balance.
-    """
-    user_id = get_owner_id(user)
-    store_id = user.active_store_id
-
-    # Resolve date range
+def _resolve_grand_livre_range(
+    days: Optional[int], start_date_str: Optional[str], end_date_str: Optional[str]
+) -> Tuple[datetime, datetime]:
     now = datetime.now(timezone.utc)
     if start_date_str or end_date_str:
         try:
@@ -27686,116 +27613,96 @@ async def get_grand_livre(
         start_date = now - timedelta(days=days or 30)
         end_date = now
 
-    date_filter = {"$gte": start_date, "$lte": end_date}
-    base_q = {"user_id": user_id}
-    if store_id:
-        base_q["store_id"] = store_id
-
-    entries = []
+    return start_date, end_date
 
-    # 1. SALES â†’ income
-    sales = await db.sales.find({**base_q, "created_at": date_filter}).to_list(5000)
-    for s in sales:
-        amount = s.get("total_amount", 0) or 0
-        items_desc = ", ".join(
-            f"{i.get('product_name','?')} x{i.get('quantity',0)}"
-            for i in s.get("items", [])[:3]
-        )
-        if len(s.get("items", [])) > 3:
-            items_desc += f" (+{len(s['items'])-3})"
-        entries.append({
-            "date": s.get("created_at", now).isoformat() if hasattr(s.get("created_at", now), "isoformat") else str(s.get("created_at", "")),
-            "type": "Vente",
-            "type_code": "sale",
-            "reference": ("VNT-" + s.get("sale_id", "")[-6:].upper()) if s.get("sale_id") else "VNT-???",
-            "description": items_desc or "Vente POS",
-            "payment_method": s.get("payment_method", ""),
-            "amount_in": round(amount, 2),
-            "amount_out": 0,
-        })
 
-    # 2. EXPENSES â†’ outflow
-    expenses = await db.expenses.find({**base_q, "created_at": date_filter}).to_list(5000)
-    for e in expenses:
-        amount = e.get("amount", 0) or 0
-        entries.append({
-            "date": e.get("created_at", now).isoformat() if hasattr(e.get("created_at", now), "isoformat") else str(e.get("created_at", "")),
-            "type": "DÃ©pense",
-            "type_code": "expense",
-            "reference": ("DEP-" + e.get("expense_id", "")[-6:].upper()) if e.get("expense_id") else "DEP-???",
-            "description": f"{e.get('category','').capitalize()} â€” {e.get('description','') or ''}".strip(" â€”"),
-            "payment_method": "",
-            "amount_in": 0,
-            "amount_out": round(amount, 2),
-        })
-
-    # 3. STOCK LOSSES (movements that are not POS sales) â†’ outflow (stock value lost)
-    products = await db.products.find({"user_id": user_id}, {"_id": 0, "product_id": 1, "name": 1, "purchase_price": 1}).to_list(2000)
-    prod_map = {p["product_id"]: p for p in products}
-    loss_candidates = await db.stock_movements.find({
-        **base_q,
-        "type": "out",
-        "created_at": date_filter,
-    }).to_list(5000)
-    losses = [movement for movement in loss_candidates if is_loss_stock_movement(movement)]
-    for m in losses:
-        p = prod_map.get(m.get("product_id", ""), {})
-        unit_price = p.get("purchase_price", 0) or 0
-        qty = m.get("quantity", 0) or 0
-        loss_val = round(unit_price * qty, 2)
-        entries.append({
-            "date": m.get("created_at", now).isoformat() if hasattr(m.get("created_at", now), "isoformat") else str(m.get("created_at", "")),
-            "type": "Perte / DÃ©marque",
-            "type_code": "loss",
-            "reference": ("MOV-" + m.get("movement_id", "")[-6:].upper()) if m.get("movement_id") else "MOV-???",
-            "description": f"{p.get('name','?')} x{qty} â€” {m.get('reason','?')}",
-            "payment_method": "",
-            "amount_in": 0,
-            "amount_out": loss_val,
-        })
-
-    # 4. DELIVERED SUPPLIER ORDERS â†’ outflow (purchase cost)
-    orders = await db.orders.find({
-        **{k: v for k, v in base_q.items() if k != "store_id"},
-        "status": {"$in": ["delivered", "received", "partially_received", "partial"]},
-        "updated_at": date_filter
-    }).to_list(1000)
-    for o in orders:
-        amount = o.get("total_amount", 0) or 0
-        entries.append({
-            "date": o.get("updated_at", o.get("created_at", now)).isoformat() if hasattr(o.get("updated_at", now), "isoformat") else str(o.get("updated_at", "")),
-            "type": "Achat Fournisseur",
-            "type_code": "purchase",
-            "reference": ("ACH-" + o.get("order_id", "")[-6:].upper()) if o.get("order_id") else "ACH-???",
-            "description": f"Commande â€” {o.get('supplier_name', o.get('notes', 'Fournisseur')[:30] if o.get('notes') else 'Fournisseur')}",
-            "payment_method": "",
-            "amount_in": 0,
-            "amount_out": round(amount, 2),
-        })
+def _grand_livre_sources(user: User, start_date: datetime, end_date: datetime) -> List[Dict[str, Any]]:
+    store_filter = {"store_id": user.active_store_id} if user.active_store_id else {}
+    return general_ledger.build_sources(
+        get_owner_id(user), store_filter, start_date, end_date,
+        loss_stock_movement_query(), is_loss_stock_movement,
+    )
 
-    # Sort all entries chronologically
-    entries.sort(key=lambda x: x["date"])
 
-    # Compute running balance
-    balance = 0.0
-    for e in entries:
-        balance += e["amount_in"] - e["amount_out"]
-        e["balance"] = round(balance, 2)
+@api_router.get("/grand-livre")
+async def get_grand_livre(
+    days: Optional[int] = 30,
+    start_date_str: Optional[str] = Query(None, alias="start_date"),
+    end_date_str: Optional[str] = Query(None, alias="end_date"),
+    limit: int = Query(general_ledger.DEFAULT_PAGE_SIZE, ge=1, le=general_ledger.MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    user: User = Depends(require_permission("accounting", "read"))
+):
+    """
+    Returns a unified chronological ledger of all financial transactions:
+    sales (income), expenses (outflow), stock losses, and delivered supplier orders.
+    Each entry includes: date, type, reference, description, amount_in, amount_out, running_balance.
 
-    # Summary
-    total_in = sum(e["amount_in"] for e in entries)
-    total_out = sum(e["amount_out"] for e in entries)
+    Results are paged: pass back ``next_cursor`` to continue where the previous
+    page stopped (the running balance and period are carried by the cursor).
+    """
+    state: Optional[Dict[str, Any]] = None
+    if cursor:
+        try:
+            state = general_ledger.decode_token(cursor)
+            start_date = datetime.fromisoformat(state["period_start"])
+            end_date = datetime.fromisoformat(state["period_end"])
+        except (general_ledger.InvalidLedgerToken, KeyError, ValueError):
+            raise HTTPException(status_code=400, detail="Curseur du grand livre invalide")
+        if state.get("store_id") != user.active_store_id:
+            raise HTTPException(status_code=400, detail="Curseur du grand livre invalide")
+    else:
+        start_date, end_date = _resolve_grand_livre_range(days, start_date_str, end_date_str)
+
+    sources = _grand_livre_sources(user, start_date, end_date)
+    totals = state["totals"] if state else await general_ledger.period_totals(db, sources)
+    opening_balance = state["balance"] if state else 0.0
+    entries, last_key, balance, has_more = await general_ledger.read_page(
+        db, sources, limit, after=state["after"] if state else None, opening_balance=opening_balance,
+    )
+
+    next_cursor = None
+    if has_more and last_key:
+        next_cursor = general_ledger.encode_token({
+            "after": last_key,
+            "balance": balance,
+            "totals": totals,
+            "period_start": start_date.isoformat(),
+            "period_end": end_date.isoformat(),
+            "store_id": user.active_store_id,
+        })
 
     return {
         "entries": entries,
-        "total_in": round(total_in, 2),
-        "total_out": round(total_out, 2),
-        "net_balance": round(total_in - total_out, 2),
-        "count": len(entries),
+        "total_in": totals["total_in"],
+        "total_out": totals["total_out"],
+        "net_balance": round(totals["total_in"] - totals["total_out"], 2),
+        "count": totals["count"],
+        "opening_balance": round(opening_balance, 2),
+        "has_more": has_more,
+        "next_cursor": next_cursor,
         "period_start": start_date.isoformat(),
         "period_end": end_date.isoformat(),
     }
 
+
+@api_router.get("/grand-livre/export/csv")
+async def export_grand_livre_csv(
+    days: Optional[int] = 30,
+    start_date_str: Optional[str] = Query(None, alias="start_date"),
+    end_date_str: Optional[str] = Query(None, alias="end_date"),
+    user: User = Depends(require_permission("accounting", "read"))
+):
+    """Streams the complete ledger of the period as CSV without loading it in memory."""
+    start_date, end_date = _resolve_grand_livre_range(days, start_date_str, end_date_str)
+    sources = _grand_livre_sources(user, start_date, end_date)
+    filename = f"grand_livre_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.csv"
+    return StreamingResponse(
+        general_ledger.iter_csv(db, sources),
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
 # ===================== SUPPLIER PROFILE ROUTES (CAS 1) =====================
 
 @api_router.get("/supplier/profile")
@@ -28285,19 +28192,21 @@ async def supplier_update_order_status(order_id: str, status_data: OrderStatusUp
     if status_data.status not in allowed:
         raise HTTPException(status_code=400, detail=f"Transition invalide pour le fournisseur: {order['status']} -> {status_data.status}. Le commerÃ§ant doit valider la livraison.")
 
-    await db.orders.update_one(
-        {"order_id": order_id},
-        {"$set": {"status": status_data.status, "updated_at": datetime.now(timezone.utc)}}
-    )
+    async def write_status(session):
+        await db.orders.update_one(
+            {"order_id": order_id},
+            {"$set": {"status": status_data.status, "updated_at": datetime.now(timezone.utc)}},
+            session=session,
+        )
+        # Send push notification to shopkeeper
+        return None, [domain_events.new_event("push.notify_user", {
+            "user_id": order["user_id"],
+            "title": "Commande mise Ã  jour",
+            "body": f"Votre commande {order_id} est maintenant: {status_data.status}",
+            "caller_owner_id": get_owner_id(user),
+        }, order_id)]
 
-    # Send push notification to shopkeeper
-    await notification_service.notify_user(
-        db,
-        order["user_id"],
-        "Commande mise Ã  jour",
-        f"Votre commande {order_id} est maintenant: {status_data.status}",
-        caller_owner_id=get_owner_id(user)
-    )
+    await commit_with_events(write_status)
 
     return {"message": f"Statut mis Ã  jour par le fournisseur: {status_data.status}"}
 
@@ -28341,11 +28250,9 @@ async def get_supplier_invoices_list(user: User = Depends(require_supplier)):
 @api_router.post("/supplier/invoices")
 async def create_supplier_invoice_from_order(data: SupplierInvoiceCreate, user: User = Depends(require_supplier)):
     """Generate an invoice from an order or create a manual supplier invoice"""
-    count = await db.supplier_generated_invoices.count_documents({"supplier_user_id": user.user_id})
     profile = await db.supplier_profiles.find_one({"user_id": user.user_id}, {"_id": 0})
     inv_prefix = (profile or {}).get("invoice_prefix") or "FAC"
     inv_label = (profile or {}).get("invoice_label") or "Facture"
-    inv_number = data.invoice_number or f"{inv_prefix}-{count + 1:04d}"
 
     shopkeeper_name = (data.client_name or "").strip()
     shopkeeper_user_id = ""
@@ -28412,6 +28319,12 @@ async def create_supplier_invoice_from_order(data: SupplierInvoiceCreate, user:
         if not normalized_items:
             raise HTTPException(status_code=400, detail="Ajoutez au moins une ligne valide")
 
+    if data.invoice_number:
+        inv_number = data.invoice_number
+    else:
+        number_prefix = sequences.clean_prefix(inv_prefix, "FAC")
+        inv_number = await sequences.next_number(db, user.user_id, f"supplier_invoice:{number_prefix}", number_prefix)
+
     invoice = {
         "invoice_id": f"sinv_{uuid.uuid4().hex[:12]}",
         "supplier_user_id": user.user_id,
@@ -28720,6 +28633,7 @@ async def register_from_invitation(request: Request, response: Response, user_da
         "created_at": datetime.now(timezone.utc)
     }
     await db.users.insert_one(user_doc)
+    await _record_platform_signup(user_doc)
 
     # Create default settings
     settings = UserSettings(user_id=user_id)
@@ -29138,12 +29052,138 @@ def _build_ai_scope_cache_key(
 
 
 def _invalidate_dashboard_ai_caches(owner_id: str, store_id: Optional[str] = None) -> None:
+    analytics_snapshot.invalidate_snapshots(owner_id)
     target_store = store_id or ""
     for feature in ("business_health_score", "dashboard_prediction"):
         ai_governance.cache_invalidate(owner_id, feature)
         if target_store:
             ai_governance.cache_invalidate(owner_id, feature, target_store)
 
+
+def _invalidate_catalog_caches(owner_id: str, store_id: Optional[str] = None) -> None:
+    """Drop caches derived from product names/variants (not stock levels)."""
+    voice_matcher.invalidate_store_matcher(owner_id)
+    demand_forecast.invalidate_store_forecast(owner_id, store_id)
+
+
+async def _after_sale_completed(sale: Dict[str, Any]) -> None:
+    """Feed derived analytics from a completed sale. Runs off the request path."""
+    owner_id = sale.get("user_id")
+    if not owner_id:
+        return
+    # Storefront versions follow the stock writes of the sale (_sync_inventory_summary).
+    try:
+        await basket_analysis.record_basket(
+            db, owner_id, sale.get("store_id"), sale.get("items") or [], sale.get("created_at"), sale.get("sale_id"),
+        )
+    except Exception as exc:
+        logger.warning("Basket stats update failed for sale %s: %s", sale.get("sale_id"), exc)
+    try:
+        await demand_forecast.record_sale_rollup(db, sale)
+    except Exception as exc:
+        logger.warning("Daily sales rollup update failed for sale %s: %s", sale.get("sale_id"), exc)
+    try:
+        await product_activity.record_sale(db, sale)
+    except Exception as exc:
+        logger.warning("Last-sold timestamps update failed for sale %s: %s", sale.get("sale_id"), exc)
+    try:
+        await customer_stats.record_sale(db, sale)
+    except Exception as exc:
+        logger.warning("Customer stats update failed for sale %s: %s", sale.get("sale_id"), exc)
+    try:
+        await platform_metrics.record_sale(db, sale)
+    except Exception as exc:
+        logger.warning("Platform metrics update failed for sale %s: %s", sale.get("sale_id"), exc)
+    try:
+        receipt_sale = await db.sales.find_one(
+            {"sale_id": sale.get("sale_id"), "public_receipt_token": {"$nin": [None, ""]}},
+            {"_id": 0, "sale_id": 1, "public_receipt_token": 1, "receipt_version": 1},
+        )
+        if receipt_sale:
+            await receipt_renderer.ensure_pdf(db, await render_public_receipt(receipt_sale))
+    except Exception as exc:
+        logger.warning("Receipt pre-render failed for sale %s: %s", sale.get("sale_id"), exc)
+
+
+async def _after_sale_cancelled(sale: Dict[str, Any]) -> None:
+    """Withdraw a cancelled sale from derived analytics. Runs off the request path."""
+    try:
+        await basket_analysis.forget_basket(
+            db, sale.get("user_id"), sale.get("store_id"), sale.get("items") or [], sale.get("created_at"), sale.get("sale_id"),
+        )
+    except Exception as exc:
+        logger.warning("Basket stats reversal failed for sale %s: %s", sale.get("sale_id"), exc)
+    try:
+        await demand_forecast.record_sale_rollup(db, sale, sign=-1)
+    except Exception as exc:
+        logger.warning("Daily sales rollup reversal failed for sale %s: %s", sale.get("sale_id"), exc)
+    try:
+        await accounting_periods.invalidate_periods(db, sale.get("user_id"), sale.get("created_at"))
+    except Exception as exc:
+        logger.warning("Accounting period invalidation failed for sale %s: %s", sale.get("sale_id"), exc)
+    try:
+        await customer_stats.refresh_customer(db, sale.get("user_id"), sale.get("customer_id"))
+    except Exception as exc:
+        logger.warning("Customer stats refresh failed for sale %s: %s", sale.get("sale_id"), exc)
+    try:
+        await platform_metrics.record_sale(db, sale, sign=-1)
+    except Exception as exc:
+        logger.warning("Platform metrics reversal failed for sale %s: %s", sale.get("sale_id"), exc)
+
+
+async def _sync_inventory_summary(product_ids: List[str], catalog_changed: bool = False) -> None:
+    """
+    Apply stock/price changes of the given products to their store summaries and storefronts.
+
+    A stock write only refreshes a storefront when a product goes in or out of
+    stock; ``catalog_changed`` (product edits) always does.
+    """
+    if catalog_changed:
+        try:
+            await storefront_cache.bump_version_for_products(db, product_ids)
+        except Exception as exc:
+            logger.warning("Storefront version bump failed for %s: %s", product_ids, exc)
+    try:
+        transitions = await inventory_summary.sync_products(db, product_ids)
+    except Exception as exc:
+        logger.warning("Inventory summary sync failed for %s: %s", product_ids, exc)
+        return
+    if not catalog_changed:
+        shown = {t["owner_id"] for t in transitions if storefront_cache.changes_listing(t["old"], t["new"])}
+        try:
+            await storefront_cache.bump_version(db, shown)
+        except Exception as exc:
+            logger.warning("Storefront version bump failed for %s: %s", product_ids, exc)
+    # Products back above their minimum no longer need their stock alerts.
+    for transition in transitions:
+        if (transition["old"] or {}).get("critical") and not transition["new"].get("critical"):
+            await db.alerts.update_many(
+                {
+                    "user_id": transition["owner_id"],
+                    "product_id": transition["product_id"],
+                    "type": {"$in": ["out_of_stock", "low_stock"]},
+                    "is_dismissed": False,
+                },
+                {"$set": {"is_dismissed": True}},
+            )
+
+
+async def _retire_from_inventory_summary(products: List[Dict[str, Any]]) -> None:
+    """Withdraw hard-deleted products (fetched with ``inventory_class``) from their summaries."""
+    for product in products:
+        try:
+            await inventory_summary.retire_product(db, product)
+        except Exception as exc:
+            logger.warning("Inventory summary retire failed for %s: %s", product.get("product_id"), exc)
+
+
+async def _reconcile_owner_inventory_summaries(owner_id: str) -> None:
+    try:
+        await storefront_cache.bump_version(db, [owner_id])
+        await inventory_summary.reconcile_owner(db, owner_id)
+    except Exception as exc:
+        logger.warning("Inventory summary reconcile failed for %s: %s", owner_id, exc)
+
 class AiTools:
     def __init__(
         self,
@@ -30889,98 +30929,41 @@ async def _get_ai_data_summary(
         return "(Note: Erreur partielle lors de la recuperation des donnees analytiques.)"
 @api_router.get("/replenishment/suggestions", response_model=List[ReplenishmentSuggestion])
 async def get_replenishment_suggestions(user: User = Depends(require_permission("stock", "read"))):
-    """Analyze sales velocity and stock levels to suggest replenishment"""
+    """Suggest replenishment from the cached store demand forecast"""
     try:
         owner_id = get_owner_id(user)
-        # 1. Get all products
-        query = {"user_id": owner_id}
-        query = apply_store_scope(query, user)
-
-        products = await db.products.find(query).to_list(1000)
-        if not products:
+        store_id = user.active_store_id
+        if store_id:
+            ensure_user_store_access(user, store_id)
+        forecast = await demand_forecast.get_store_forecast(db, owner_id, store_id)
+        candidates = forecast.get("replenishment") or []
+        if not candidates:
             return []
 
-        # 2. Calculate velocity (last 30 days)
-        thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
-        sales_query = {"user_id": owner_id, "created_at": {"$gte": thirty_days_ago}}
-        sales_query = apply_store_scope(sales_query, user)
-
-        sales = await db.sales.find(sales_query).to_list(5000)
-
-        velocity_map = defaultdict(float)
-        for s in sales:
-            for item in s.get("items", []):
-                pid = item.get("product_id")
-                qty = item.get("quantity", 0)
-                velocity_map[pid] += qty / 30.0 # Average per day
-
-        # 3. Get supplier-product mappings
-        supplier_products = await db.supplier_products.find({"user_id": owner_id}).to_list(1000)
+        # Supplier mappings for the suggested products only
+        candidate_ids = [c["product_id"] for c in candidates]
+        supplier_products = await db.supplier_products.find(
+            {"user_id": owner_id, "product_id": {"$in": candidate_ids}},
+            {"_id": 0, "product_id": 1, "supplier_id": 1},
+        ).to_list(None)
         sp_map = {sp.get("product_id"): sp for sp in supplier_products if sp.get("product_id")}
 
-        # Get suppliers names
         supplier_ids = list(set(sp.get("supplier_id") for sp in supplier_products if sp.get("supplier_id")))
-        suppliers = await db.suppliers.find({"supplier_id": {"$in": supplier_ids}, "user_id": owner_id}).to_list(100)
+        suppliers = await db.suppliers.find(
+            {"supplier_id": {"$in": supplier_ids}, "user_id": owner_id},
+            {"_id": 0, "supplier_id": 1, "name": 1},
+        ).to_list(None)
         supplier_names = {s.get("supplier_id"): s.get("name", "Fournisseur") for s in suppliers if s.get("supplier_id")}
 
         suggestions = []
-
-        for p in products:
-            try:
-                pid = p.get("product_id")
-                if not pid: continue
-
-                qty = p.get("quantity", 0)
-                min_stock = p.get("min_stock", 0)
-                max_stock = p.get("max_stock", 100)
-                velocity = velocity_map.get(pid, 0.0)
-                lead_time = p.get("lead_time_days", 3)
-
-                # Logic:
-                # - If qty <= min_stock -> Critical/Warning
-                # - If qty / velocity <= lead_time + 2 days -> Warning
-
-                days_left = qty / velocity if velocity > 0 else 999
-
-                is_needed = False
-                priority = "info"
-
-                if qty <= min_stock:
-                    is_needed = True
-                    priority = "critical" if qty == 0 else "warning"
-                elif days_left <= (lead_time + 2):
-                    is_needed = True
-                    priority = "warning"
-
-                if is_needed:
-                    suggested_qty = max(0, max_stock - qty)
-                    if suggested_qty > 0:
-                        sp = sp_map.get(pid)
-                        supplier_id = sp.get("supplier_id") if sp else None
-                        suggestions.append(ReplenishmentSuggestion(
-                            product_id=pid,
-                            product_name=p.get("name", "Produit inconnu"),
-                            current_quantity=qty,
-                            min_stock=min_stock,
-                            max_stock=max_stock,
-                            daily_velocity=round(velocity, 2),
-                            days_until_stock_out=round(days_left, 1) if velocity > 0 else None,
-                            suggested_quantity=suggested_qty,
-                            priority=priority,
-                            supplier_id=supplier_id,
-                            supplier_name=supplier_names.get(supplier_id) if supplier_id else "Non assignÃ©"
-                        ))
-            except Exception as e:
-                logger.error(f"Error processing replenishment suggestion for product {p.get('product_id')}: {e}")
-                continue
-
-        # Sort suggestions by priority (critical first) and then by days_left
-        priority_order = {"critical": 0, "warning": 1, "info": 2}
-        try:
-            suggestions.sort(key=lambda x: (priority_order.get(x.priority, 3), x.days_until_stock_out if x.days_until_stock_out is not None else 999))
-        except Exception as e:
-            logger.error(f"Error sorting replenishment suggestions: {e}")
-
+        for candidate in candidates:
+            sp = sp_map.get(candidate["product_id"])
+            supplier_id = sp.get("supplier_id") if sp else None
+            suggestions.append(ReplenishmentSuggestion(
+                **candidate,
+                supplier_id=supplier_id,
+                supplier_name=supplier_names.get(supplier_id) if supplier_id else "Non assignÃ©",
+            ))
         return suggestions
     except Exception as e:
         logger.error(f"CRITICAL ERROR in get_replenishment_suggestions: {e}", exc_info=True)
@@ -31433,13 +31416,17 @@ async def batch_stock_update(data: BatchStockUpdate, user: User = Depends(requir
         if target:
             ensure_scoped_document_access(user, target, detail="Acces refuse pour ce produit")
             # Increment quantity
+            stock_update = {
+                "$inc": {"quantity": data.increment},
+                "$set": {"updated_at": datetime.now(timezone.utc)}
+            }
+            if data.increment < 0:
+                stock_update["$max"] = {"last_movement_out_at": datetime.now(timezone.utc)}
             await db.products.update_one(
                 {"product_id": target["product_id"], "user_id": owner_id, "store_id": target.get("store_id")},
-                {
-                    "$inc": {"quantity": data.increment},
-                    "$set": {"updated_at": datetime.now(timezone.utc)}
-                }
+                stock_update
             )
+            await _sync_inventory_summary([target["product_id"]])
 
             # Log movement
             await db.stock_movements.insert_one({
@@ -31735,6 +31722,7 @@ async def confirm_delivery(order_id: str, data: ConfirmDeliveryRequest, user: Us
     catalog_map = {p["catalog_id"]: p for p in catalog_prods}
 
     results = []
+    alert_product_ids: List[str] = []
     for mapping in data.mappings:
         item = items_map.get(mapping.catalog_id)
         if not item:
@@ -31772,6 +31760,7 @@ async def confirm_delivery(order_id: str, data: ConfirmDeliveryRequest, user: Us
             )
             await db.products.insert_one(new_product.model_dump())
             target_product_id = new_product.product_id
+            await _sync_inventory_summary([target_product_id])
 
             # Create stock movement for new product
             movement = StockMovement(
@@ -31797,7 +31786,7 @@ async def confirm_delivery(order_id: str, data: ConfirmDeliveryRequest, user: Us
                         {"product_id": target_product_id},
                         {"$set": {"updated_at": datetime.now(timezone.utc)}}
                     )
-                    await check_and_create_alerts(Product(**product), owner_id, store_id=order.get("store_id") or user.active_store_id)
+                    alert_product_ids.append(target_product_id)
                     results.append({"catalog_id": mapping.catalog_id, "action": "linked_existing_stock", "product_id": target_product_id})
                 else:
                     new_qty = product["quantity"] + item["quantity"]
@@ -31805,6 +31794,7 @@ async def confirm_delivery(order_id: str, data: ConfirmDeliveryRequest, user: Us
                         {"product_id": target_product_id},
                         {"$set": {"quantity": new_qty, "updated_at": datetime.now(timezone.utc)}}
                     )
+                    await _sync_inventory_summary([target_product_id])
 
                     movement = StockMovement(
                         product_id=target_product_id,
@@ -31818,8 +31808,7 @@ async def confirm_delivery(order_id: str, data: ConfirmDeliveryRequest, user: Us
                     )
                     await db.stock_movements.insert_one(movement.model_dump())
 
-                    product["quantity"] = new_qty
-                    await check_and_create_alerts(Product(**product), owner_id, store_id=order.get("store_id") or user.active_store_id)
+                    alert_product_ids.append(target_product_id)
 
                     results.append({"catalog_id": mapping.catalog_id, "action": "linked", "product_id": target_product_id})
 
@@ -31841,10 +31830,15 @@ async def confirm_delivery(order_id: str, data: ConfirmDeliveryRequest, user: Us
     order_update_query = {"order_id": order_id, "user_id": owner_id}
     if order.get("store_id"):
         order_update_query["store_id"] = order["store_id"]
-    await db.orders.update_one(
-        order_update_query,
-        {"$set": {"status": "delivered", "updated_at": datetime.now(timezone.utc)}}
-    )
+    async def write_delivery(session):
+        await db.orders.update_one(
+            order_update_query,
+            {"$set": {"status": "delivered", "updated_at": datetime.now(timezone.utc), "delivered_at": datetime.now(timezone.utc)}},
+            session=session,
+        )
+        return None, _delivery_alert_events(order_id, owner_id, order.get("store_id") or user.active_store_id, alert_product_ids)
+
+    await commit_with_events(write_delivery)
 
     return {"message": "Livraison confirmÃ©e", "results": results}
 
@@ -31913,6 +31907,8 @@ async def add_product_variant(product_id: str, variant: ProductVariant, user: Us
         }}
     )
 
+    _invalidate_catalog_caches(owner_id, product.get("store_id"))
+    await _sync_inventory_summary([product_id], catalog_changed=True)
     await log_activity(user, "create", "stock", f"Variante '{variant.name}' ajoutÃ©e Ã  {product['name']}")
     return {"message": "Variante ajoutÃ©e", "variant": new_variant, "total_quantity": total_qty}
 
@@ -31948,6 +31944,8 @@ async def update_product_variant(product_id: str, variant_id: str, variant: Prod
         }}
     )
 
+    _invalidate_catalog_caches(owner_id, product.get("store_id"))
+    await _sync_inventory_summary([product_id], catalog_changed=True)
     return {"message": "Variante mise Ã  jour", "total_quantity": total_qty}
 
 @api_router.delete("/products/{product_id}/variants/{variant_id}")
@@ -31977,6 +31975,8 @@ async def delete_product_variant(product_id: str, variant_id: str, user: User =
         }}
     )
 
+    _invalidate_catalog_caches(owner_id, product.get("store_id"))
+    await _sync_inventory_summary([product_id], catalog_changed=True)
     await log_activity(user, "delete", "stock", f"Variante supprimÃ©e du produit {product['name']}")
     return {"message": "Variante supprimÃ©e", "total_quantity": total_qty}
 
@@ -32002,273 +32002,123 @@ class SalesForecastResponse(BaseModel):
     generated_at: str = ""
     currency: str = "XOF"
 
-@api_router.get("/sales/forecast")
-async def get_sales_forecast(user: User = Depends(require_permission("stock", "read"))):
-    """Analyze sales trends and predict future sales using velocity data + Gemini AI"""
-    owner_id = get_owner_id(user)
-    store_id = user.active_store_id
-    user_doc = await db.users.find_one({"user_id": owner_id}, {"_id": 0, "currency": 1})
-    currency = user_doc.get("currency", "XOF") if user_doc else "XOF"
-
-    # Get products
-    query = {"user_id": owner_id}
-    if store_id:
-        query["store_id"] = store_id
-    products = await db.products.find(query, {"_id": 0}).to_list(1000)
-    if not products:
-        return SalesForecastResponse(generated_at=datetime.now(timezone.utc).isoformat(), currency=currency).model_dump()
-
-    now = datetime.now(timezone.utc)
-
-    # Sales last 30 days
-    thirty_days_ago = now - timedelta(days=30)
-    sales_query_30 = {"user_id": owner_id, "created_at": {"$gte": thirty_days_ago}}
-    if store_id:
-        sales_query_30["store_id"] = store_id
-    sales_30 = await db.sales.find(sales_query_30).to_list(10000)
-
-    # Sales last 7 days (for trend comparison)
-    seven_days_ago = now - timedelta(days=7)
-
-    # Aggregate by product
-    from collections import defaultdict
-    qty_30d = defaultdict(int)
-    rev_30d = defaultdict(float)
-    qty_7d = defaultdict(int)
-
-    for s in sales_30:
-        sale_date = parse_datetime_value(s.get("created_at"))
-        is_last_7 = sale_date >= seven_days_ago if sale_date else False
-
-        for item in s.get("items", []):
-            pid = item.get("product_id", "")
-            qty = item.get("quantity", 0)
-            price = item.get("selling_price", 0)
-            qty_30d[pid] += qty
-            rev_30d[pid] += qty * price
-            if is_last_7:
-                qty_7d[pid] += qty
-
-    # Build forecast per product
-    forecast_products = []
-    total_rev_7d = 0.0
-    total_rev_30d = 0.0
-
-    for p in products:
-        pid = p["product_id"]
-        stock = p.get("quantity", 0)
-        selling_price = p.get("selling_price", 0)
-
-        vel_30 = qty_30d[pid] / 30.0  # avg per day over 30d
-        vel_7 = qty_7d[pid] / 7.0     # avg per day over 7d
-
-        # Trend detection
-        if vel_30 == 0:
-            trend = "stable"
-        elif vel_7 > vel_30 * 1.2:
-            trend = "up"
-        elif vel_7 < vel_30 * 0.8:
-            trend = "down"
-        else:
-            trend = "stable"
-
-        # Use recent velocity (weighted: 60% last 7d, 40% last 30d) for prediction
-        effective_vel = vel_7 * 0.6 + vel_30 * 0.4 if vel_30 > 0 else vel_7
-
-        predicted_7d = round(effective_vel * 7)
-        predicted_30d = round(effective_vel * 30)
-
-        days_of_stock = stock / effective_vel if effective_vel > 0 else 999
-
-        # Risk level
-        if stock == 0 and effective_vel > 0:
-            risk = "critical"
-        elif days_of_stock < 7:
-            risk = "critical"
-        elif days_of_stock < 14:
-            risk = "warning"
-        else:
-            risk = "ok"
-
-        rev_7d = predicted_7d * selling_price
-        rev_30d = predicted_30d * selling_price
-        total_rev_7d += rev_7d
-        total_rev_30d += rev_30d
-
-        # Only include products that have sales activity or stock
-        if vel_30 > 0 or stock > 0:
-            forecast_products.append(ForecastProduct(
-                product_id=pid,
-                name=p["name"],
-                current_stock=stock,
-                velocity=round(effective_vel, 2),
-                days_of_stock=round(days_of_stock, 1),
-                predicted_sales_7d=predicted_7d,
-                predicted_sales_30d=predicted_30d,
-                trend=trend,
-                risk_level=risk,
-            ))
-
-    # Generate daily_forecast for the AreaChart in the dashboard
-    # We mix actual sales from last 7 days + projected sales for next 14 days
-    daily_forecast = []
-
-    # Past 7 days actual revenue
-    for i in range(7, 0, -1):
-        date = now - timedelta(days=i)
-        d_str = date.strftime("%Y-%m-%d")
-        # Sum revenue for all products on this day from sales_30
-        day_rev = 0
-        for s in sales_30:
-            s_date = s.get("created_at")
-            if isinstance(s_date, str):
-                try:
-                    s_date = datetime.fromisoformat(s_date.replace("Z", "+00:00"))
-                except:
-                    continue
-            if s_date and s_date.strftime("%Y-%m-%d") == d_str:
-                day_rev += s.get("total_amount", 0)
-        daily_forecast.append({"date": d_str, "expected_revenue": day_rev, "is_predicted": False})
-
-    # Future 14 days projected revenue
-    total_daily_velocity_rev = sum(
-        (qty_7d[p["product_id"]] / 7.0 if qty_7d[p["product_id"]] > 0 else qty_30d[p["product_id"]] / 30.0) * p.get("selling_price", 0)
-        for p in products
-    )
-
-    for i in range(14):
-        date = now + timedelta(days=i)
-        d_str = date.strftime("%Y-%m-%d")
-        daily_forecast.append({
-            "date": d_str,
-            "expected_revenue": round(total_daily_velocity_rev, 2),
-            "is_predicted": True
-        })
+def _forecast_product_from_row(row: Dict[str, Any]) -> ForecastProduct:
+    return ForecastProduct(
+        product_id=row["product_id"],
+        name=row["name"],
+        current_stock=row["current_stock"],
+        velocity=round(row["velocity"], 2),
+        days_of_stock=round(row["days_of_stock"], 1),
+        predicted_sales_7d=round(row["predicted_sales_7d"]),
+        predicted_sales_30d=round(row["predicted_sales_30d"]),
+        trend=row["trend"],
+        risk_level=row["risk_level"],
+    )
 
-    # Sort: critical first, then by velocity desc
-    risk_order = {"critical": 0, "warning": 1, "ok": 2}
-    forecast_products.sort(key=lambda x: (risk_order.get(x.risk_level, 2), -x.velocity))
 
-    # Gemini AI summary (optional, only if API key available)
+async def _forecast_ai_summary(forecast: Dict[str, Any], forecast_products: List[ForecastProduct], currency: str) -> str:
+    """Gemini summary, generated once per forecast model (stock changes do not regenerate it)."""
+    if "ai_summary" in forecast["shared"]:
+        return forecast["shared"]["ai_summary"]
     ai_summary = ""
     api_key = resolve_gemini_api_key()
     if api_key and forecast_products:
         try:
             genai.configure(api_key=api_key)
-            top_items = forecast_products[:10]
             items_text = "\n".join([
                 f"- {fp.name}: stock={fp.current_stock}, vitesse={fp.velocity}/j, tendance={fp.trend}, risque={fp.risk_level}, jours_restants={fp.days_of_stock}"
-                for fp in top_items
+                for fp in forecast_products[:10]
             ])
-
             critical_count = len([fp for fp in forecast_products if fp.risk_level == "critical"])
             warning_count = len([fp for fp in forecast_products if fp.risk_level == "warning"])
 
-
             prompt_text = f"""Analyse ces prÃ©visions de ventes et donne un rÃ©sumÃ© en 3-4 phrases concises en franÃ§ais.
 Mentionne les produits critiques, les tendances importantes et une recommandation.
 
-CA prÃ©vu 7 jours: {total_rev_7d:,.0f} {currency}
-CA prÃ©vu 30 jours: {total_rev_30d:,.0f} {currency}
+CA prÃ©vu 7 jours: {forecast["total_predicted_revenue_7d"]:,.0f} {currency}
+CA prÃ©vu 30 jours: {forecast["total_predicted_revenue_30d"]:,.0f} {currency}
 Produits critiques: {critical_count} | Attention: {warning_count}
 
 Top produits:
 {items_text}
 """
             model = build_gemini_model()
-            response = model.generate_content(prompt_text)
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, model.generate_content, prompt_text)
             ai_summary = response.text
         except Exception as e:
             logger.error(f"Gemini forecast summary error: {e}")
             ai_summary = ""
+    forecast["shared"]["ai_summary"] = ai_summary
+    return ai_summary
+
+
+@api_router.get("/sales/forecast")
+async def get_sales_forecast(user: User = Depends(require_permission("stock", "read"))):
+    """Predict future sales from the cached store demand forecast + Gemini AI summary"""
+    owner_id = get_owner_id(user)
+    store_id = user.active_store_id
+    user_doc = await db.users.find_one({"user_id": owner_id}, {"_id": 0, "currency": 1})
+    currency = user_doc.get("currency", "XOF") if user_doc else "XOF"
+
+    forecast = await demand_forecast.get_store_forecast(db, owner_id, store_id)
+    if not forecast["products"]:
+        return SalesForecastResponse(generated_at=forecast["generated_at"], currency=currency).model_dump()
+
+    ranked_rows = [forecast["products"][pid] for pid in forecast["ranked_product_ids"]]
+    forecast_products = [_forecast_product_from_row(row) for row in ranked_rows[:30]]
+
+    # Actual revenue of the last 7 days + seasonal projection of the next 14 days (dashboard AreaChart)
+    daily_forecast = [
+        {"date": day["date"], "expected_revenue": round(day["revenue"], 2), "is_predicted": False}
+        for day in forecast["daily_revenue_history"][-8:-1]
+    ] + [
+        {"date": day["date"], "expected_revenue": round(day["revenue"], 2), "is_predicted": True}
+        for day in forecast["daily_revenue_projection"][:14]
+    ]
+
+    ai_summary = await _forecast_ai_summary(forecast, forecast_products, currency)
 
     return SalesForecastResponse(
-        products=forecast_products[:30],
-        total_predicted_revenue_7d=round(total_rev_7d),
-        total_predicted_revenue_30d=round(total_rev_30d),
+        products=forecast_products,
+        total_predicted_revenue_7d=round(forecast["total_predicted_revenue_7d"]),
+        total_predicted_revenue_30d=round(forecast["total_predicted_revenue_30d"]),
         daily_forecast=daily_forecast,
         ai_summary=ai_summary,
         currency=currency,
-        generated_at=now.isoformat(),
+        generated_at=forecast["generated_at"],
     ).model_dump()
 
 @api_router.get("/sales/forecast/{product_id}")
 async def get_product_sales_forecast(product_id: str, user: User = Depends(require_permission("stock", "read"))):
-    """Analyze sales trends and predict future sales for a specific product"""
+    """Predict future sales for a specific product from its store forecast"""
     owner_id = get_owner_id(user)
-    product = await db.products.find_one({"product_id": product_id, "user_id": owner_id}, {"_id": 0})
+    product = await db.products.find_one(
+        {"product_id": product_id, "user_id": owner_id},
+        {"_id": 0, "product_id": 1, "name": 1, "quantity": 1, "store_id": 1},
+    )
     if not product:
         raise HTTPException(status_code=404, detail="Produit non trouvÃ©")
 
-    now = datetime.now(timezone.utc)
-    thirty_days_ago = now - timedelta(days=30)
-    seven_days_ago = now - timedelta(days=7)
-
     ensure_scoped_document_access(user, product, detail="Acces refuse pour ce produit")
 
-    # Sales last 30 days for this product
-    sales_query = {
-        "user_id": owner_id,
-        "created_at": {"$gte": thirty_days_ago},
-        "items.product_id": product_id
-    }
-    sales_query = apply_store_scope(sales_query, user)
-
-    sales_30 = await db.sales.find(sales_query).to_list(1000)
-
-    qty_30d = 0
-    qty_7d = 0
-
-    for s in sales_30:
-        sale_date = parse_datetime_value(s.get("created_at"))
-        is_last_7 = sale_date >= seven_days_ago if sale_date else False
-
-        for item in s.get("items", []):
-            if item.get("product_id") == product_id:
-                qty = item.get("quantity", 0)
-                qty_30d += qty
-                if is_last_7:
-                    qty_7d += qty
-
-    stock = product.get("quantity", 0)
-
-    vel_30 = qty_30d / 30.0
-    vel_7 = qty_7d / 7.0
-
-    if vel_30 == 0:
-        trend = "stable"
-    elif vel_7 > vel_30 * 1.2:
-        trend = "up"
-    elif vel_7 < vel_30 * 0.8:
-        trend = "down"
-    else:
-        trend = "stable"
-
-    effective_vel = vel_7 * 0.6 + vel_30 * 0.4 if vel_30 > 0 else vel_7
-    days_of_stock = stock / effective_vel if effective_vel > 0 else 999
-
-    if stock == 0 and effective_vel > 0:
-        risk = "critical"
-    elif days_of_stock < 7:
-        risk = "critical"
-    elif days_of_stock < 14:
-        risk = "warning"
-    else:
-        risk = "ok"
-
-    forecast = ForecastProduct(
-        product_id=product_id,
-        name=product["name"],
-        current_stock=stock,
-        velocity=round(effective_vel, 2),
-        days_of_stock=round(days_of_stock, 1),
-        predicted_sales_7d=round(effective_vel * 7),
-        predicted_sales_30d=round(effective_vel * 30),
-        trend=trend,
-        risk_level=risk,
-    )
-
-    return forecast.model_dump()
+    forecast = await demand_forecast.get_store_forecast(db, owner_id, product.get("store_id"))
+    row = forecast["products"].get(product_id)
+    if not row:
+        # Product created after the model was built: no history yet.
+        return ForecastProduct(
+            product_id=product_id,
+            name=product["name"],
+            current_stock=product.get("quantity", 0),
+            velocity=0.0,
+            days_of_stock=demand_forecast.NO_STOCKOUT_DAYS,
+            predicted_sales_7d=0,
+            predicted_sales_30d=0,
+            trend="stable",
+            risk_level="ok",
+        ).model_dump()
+
+    return _forecast_product_from_row(row).model_dump()
 
 # ===================== RETURNS & CREDIT NOTES ENDPOINTS =====================
 
@@ -32389,6 +32239,7 @@ async def complete_return(return_id: str, user: User = Depends(require_procureme
                 {"product_id": item["product_id"], "user_id": owner_id, "store_id": product.get("store_id")},
                 {"$set": {"quantity": new_qty, "updated_at": datetime.now(timezone.utc)}}
             )
+            await _sync_inventory_summary([item["product_id"]])
 
             movement = StockMovement(
                 product_id=item["product_id"],
@@ -32518,8 +32369,18 @@ async def create_or_get_conversation(
     return convo.model_dump()
 
 @api_router.get("/conversations/{conversation_id}/messages")
-async def get_messages(conversation_id: str, skip: int = 0, limit: int = 50, user: User = Depends(require_auth)):
-    """Get messages for a conversation"""
+async def get_messages(
+    conversation_id: str,
+    skip: int = 0,
+    limit: int = Query(chat_inbox.PAGE_SIZE, ge=1),
+    before: Optional[str] = Query(None),
+    user: User = Depends(require_auth),
+):
+    """Get messages for a conversation, newest first.
+
+    Pass back ``next_cursor`` as ``before`` to load older messages; ``skip`` is
+    only kept for older clients.
+    """
     # Verify user is part of the conversation
     convo = await db.conversations.find_one({
         "conversation_id": conversation_id,
@@ -32528,25 +32389,23 @@ async def get_messages(conversation_id: str, skip: int = 0, limit: int = 50, use
     if not convo:
         raise HTTPException(status_code=404, detail="Conversation non trouvÃ©e")
 
-    # Mark messages as read
-    is_supplier = user.user_id == convo.get("supplier_id")
-    await db.chat_messages.update_many(
-        {"conversation_id": conversation_id, "sender_id": {"$ne": user.user_id}, "read": False},
-        {"$set": {"read": True}}
-    )
-    # Reset unread counter
-    unread_field = "unread_supplier" if is_supplier else "unread_shopkeeper"
-    await db.conversations.update_one(
-        {"conversation_id": conversation_id},
-        {"$set": {unread_field: 0}}
-    )
+    await chat_inbox.mark_read(db, convo, user.user_id)
 
-    total = await db.chat_messages.count_documents({"conversation_id": conversation_id})
-    messages = await db.chat_messages.find(
-        {"conversation_id": conversation_id}, {"_id": 0}
-    ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    if skip and not before:
+        total = await db.chat_messages.count_documents({"conversation_id": conversation_id})
+        messages = await db.chat_messages.find(
+            {"conversation_id": conversation_id}, {"_id": 0}
+        ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+        return {"items": messages, "total": total}
 
-    return {"items": messages, "total": total}
+    try:
+        messages, next_cursor = await chat_inbox.read_page(db, conversation_id, limit, before)
+    except chat_inbox.InvalidChatCursor:
+        raise HTTPException(status_code=400, detail="Curseur de messages invalide")
+    result: Dict[str, Any] = {"items": messages, "has_more": next_cursor is not None, "next_cursor": next_cursor}
+    if not before:
+        result["total"] = await db.chat_messages.count_documents({"conversation_id": conversation_id})
+    return result
 
 @api_router.post("/conversations/{conversation_id}/messages")
 async def send_message(conversation_id: str, msg: ChatMessageCreate, user: User = Depends(require_auth)):
@@ -32567,35 +32426,28 @@ async def send_message(conversation_id: str, msg: ChatMessageCreate, user: User
         sender_role="supplier" if is_supplier else "shopkeeper",
         content=msg.content.strip(),
     )
-    await db.chat_messages.insert_one(message.model_dump())
-
-    # Update conversation
-    unread_field = "unread_shopkeeper" if is_supplier else "unread_supplier"
-    await db.conversations.update_one(
-        {"conversation_id": conversation_id},
-        {
-            "$set": {
-                "last_message": msg.content.strip()[:100],
-                "last_message_at": datetime.now(timezone.utc),
-            },
-            "$inc": {unread_field: 1}
-        }
-    )
+    message_doc = message.model_dump()
+    await db.chat_messages.insert_one(dict(message_doc))
+    await chat_inbox.record_message(db, convo, message_doc)
 
-    return message.model_dump()
+    return message_doc
 
 @api_router.get("/conversations/unread-count")
 async def get_unread_count(user: User = Depends(require_auth)):
     """Get total unread message count for the user"""
-    is_supplier = user.role == "supplier"
-    unread_field = "unread_supplier" if is_supplier else "unread_shopkeeper"
+    return {"unread": await chat_inbox.unread_total(db, user.user_id)}
 
-    pipeline = [
-        {"$match": {"$or": [{"shopkeeper_id": user.user_id}, {"supplier_id": user.user_id}]}},
-        {"$group": {"_id": None, "total": {"$sum": f"${unread_field}"}}}
-    ]
-    result = await db.conversations.aggregate(pipeline).to_list(1)
-    return {"unread": result[0]["total"] if result else 0}
+@api_router.get("/conversations/stream")
+async def stream_conversations(request: Request, after: Optional[str] = None, user: User = Depends(require_auth)):
+    """Server-Sent Events: new messages and unread counter changes of the current user.
+
+    Resumes after the cursor ``after`` (or the Last-Event-ID header sent by EventSource).
+    """
+    return StreamingResponse(
+        restaurant_stream.sse_frames(chat_inbox.broker, user.user_id, after or request.headers.get("last-event-id")),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # ===================== SMART REMINDERS =====================
@@ -32633,50 +32485,60 @@ async def get_smart_reminders(user: User = Depends(require_auth)):
 
     # -------- 1. STOCK MANAGEMENT --------
 
+    if rules.inventory_check.enabled or rules.dormant_products.enabled:
+        try:
+            await product_activity.ensure_product_activity(db, user_id)
+        except Exception as e:
+            logger.warning(f"Smart reminders - product activity backfill error: {e}")
+
     # 1a. Inventory verification - products not counted in X+ days
     if rules.inventory_check.enabled:
       try:
         inv_days = rules.inventory_check.threshold or 30
-        all_products = await db.products.find(
-            {**store_filter, "is_active": True}, {"_id": 0, "product_id": 1, "name": 1, "quantity": 1, "created_at": 1}
-        ).to_list(500)
+        cutoff_inv = now - timedelta(days=inv_days)
+        stale_counts = await db.products.find(
+            {**store_filter, "is_active": True, "last_counted_at": {"$lt": cutoff_inv}},
+            {"_id": 0, "product_id": 1, "name": 1, "last_counted_at": 1}
+        ).sort("last_counted_at", 1).to_list(5)
+        for product in stale_counts:
+            completed_at = parse_datetime_value(product.get("last_counted_at"))
+            if not completed_at:
+                continue
+            reminders.append(SmartReminder(
+                category="stock",
+                type="inventory_check",
+                title="VÃ©rification d'inventaire",
+                message=f"'{product['name']}' n'a pas Ã©tÃ© comptÃ© depuis {(now - completed_at).days} jours",
+                severity="info",
+                icon="clipboard-outline",
+                action_label="Lancer un inventaire",
+                action_route="/(tabs)/index",
+            ).model_dump())
 
-        inv_count = 0
-        for product in all_products:
-            if inv_count >= 5:
-                break
-            last_task = await db.inventory_tasks.find_one(
-                {"product_id": product["product_id"], "status": "completed"},
-                sort=[("completed_at", -1)]
-            )
-            if last_task:
-                completed_at = parse_datetime_value(last_task.get("completed_at"))
-                if completed_at and (now - completed_at).days > inv_days:
-                    reminders.append(SmartReminder(
-                        category="stock",
-                        type="inventory_check",
-                        title="VÃ©rification d'inventaire",
-                        message=f"'{product['name']}' n'a pas Ã©tÃ© comptÃ© depuis {(now - completed_at).days} jours",
-                        severity="info",
-                        icon="clipboard-outline",
-                        action_label="Lancer un inventaire",
-                        action_route="/(tabs)/index",
-                    ).model_dump())
-                    inv_count += 1
-            elif product.get("quantity", 0) > 0:
-                created = parse_datetime_value(product.get("created_at"))
-                if created and (now - created).days > inv_days:
-                    reminders.append(SmartReminder(
-                        category="stock",
-                        type="inventory_check",
-                        title="Inventaire jamais rÃ©alisÃ©",
-                        message=f"'{product['name']}' n'a jamais Ã©tÃ© inventoriÃ© physiquement",
-                        severity="warning",
-                        icon="clipboard-outline",
-                        action_label="Lancer un inventaire",
-                        action_route="/(tabs)/index",
-                    ).model_dump())
-                    inv_count += 1
+        remaining = 5 - len(stale_counts)
+        never_counted = []
+        if remaining > 0:
+            never_counted = await db.products.find(
+                {
+                    **store_filter,
+                    "is_active": True,
+                    "last_counted_at": None,
+                    "quantity": {"$gt": 0},
+                    "created_at": {"$lt": cutoff_inv},
+                },
+                {"_id": 0, "product_id": 1, "name": 1}
+            ).to_list(remaining)
+        for product in never_counted:
+            reminders.append(SmartReminder(
+                category="stock",
+                type="inventory_check",
+                title="Inventaire jamais rÃ©alisÃ©",
+                message=f"'{product['name']}' n'a jamais Ã©tÃ© inventoriÃ© physiquement",
+                severity="warning",
+                icon="clipboard-outline",
+                action_label="Lancer un inventaire",
+                action_route="/(tabs)/index",
+            ).model_dump())
       except Exception as e:
         logger.error(f"Smart reminders - inventory check error: {e}")
 
@@ -32685,24 +32547,25 @@ async def get_smart_reminders(user: User = Depends(require_auth)):
       try:
         dorm_days = rules.dormant_products.threshold or 60
         cutoff_dorm = now - timedelta(days=dorm_days)
-        products_with_stock = await db.products.find(
-            {**store_filter, "is_active": True, "quantity": {"$gt": 0}},
-            {"_id": 0, "product_id": 1, "name": 1, "quantity": 1, "selling_price": 1}
-        ).to_list(500)
-
-        dorm_items = []
-        for product in products_with_stock:
-            recent_sale = await db.sales.find_one({
+        dorm_items = await db.products.aggregate([
+            {"$match": {
                 **store_filter,
-                "items.product_id": product["product_id"],
-                "created_at": {"$gte": cutoff_dorm}
-            })
-            if not recent_sale:
-                stock_value = product.get("quantity", 0) * product.get("selling_price", 0)
-                dorm_items.append((product, stock_value))
+                "is_active": True,
+                "quantity": {"$gt": 0},
+                "$or": [{"last_sold_at": {"$lt": cutoff_dorm}}, {"last_sold_at": None}],
+            }},
+            {"$project": {
+                "_id": 0, "product_id": 1, "name": 1, "quantity": 1,
+                "stock_value": {"$multiply": [
+                    {"$ifNull": ["$quantity", 0]}, {"$ifNull": ["$selling_price", 0]},
+                ]},
+            }},
+            {"$sort": {"stock_value": -1}},
+            {"$limit": 8},
+        ]).to_list(8)
 
-        dorm_items.sort(key=lambda x: x[1], reverse=True)
-        for product, stock_value in dorm_items[:8]:
+        for product in dorm_items:
+            stock_value = product.get("stock_value", 0)
             reminders.append(SmartReminder(
                 category="stock",
                 type="dormant_product",
@@ -32935,27 +32798,15 @@ async def get_smart_reminders(user: User = Depends(require_auth)):
         bday_window = rules.birthdays.threshold or 7
         today = now.date()
         customers_with_birthday = await db.customers.find(
-            {"user_id": user_id, "birthday": {"$ne": None, "$exists": True}},
-            {"_id": 0, "customer_id": 1, "name": 1, "birthday": 1}
+            {"user_id": user_id, **birthday_calendar.window_query(today, bday_window)},
+            {"_id": 0, "customer_id": 1, "name": 1, "birthday_doy": 1}
         ).to_list(500)
 
         for customer in customers_with_birthday:
-            bday = customer.get("birthday")
-            if not bday:
-                continue
             try:
-                if isinstance(bday, str):
-                    bday_date = datetime.fromisoformat(bday.replace("Z", "+00:00")).date()
-                elif isinstance(bday, datetime):
-                    bday_date = bday.date()
-                else:
+                days_until = birthday_calendar.days_until(customer.get("birthday_doy"), today)
+                if days_until is None:
                     continue
-
-                bday_this_year = bday_date.replace(year=today.year)
-                if bday_this_year < today:
-                    bday_this_year = bday_date.replace(year=today.year + 1)
-
-                days_until = (bday_this_year - today).days
                 if days_until == 0:
                     reminders.append(SmartReminder(
                         category="crm",
@@ -33876,6 +33727,8 @@ app.add_middleware(
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await storefront_events.flush(db)
+    await notification_service.stop()
     client.close()
 
 
@@ -0,0 +1,356 @@
+"""
+Closed-period summaries for accounting reports.
+
+Accounting figures of a day that is over (UTC) no longer change in normal
+operation, so each closed day and each closed month is computed once and
+stored in ``accounting_period_summaries``.  A report for an arbitrary range is
+split by ``plan_segments`` into stored months, stored days and live segments
+(partial first day, the current open day); only the live segments hit the raw
+collections, always with the date range in the query.
+
+Writes that can reach back into a closed period (cancelled sales, restaurant
+orders finalized after the day they were opened, edited or deleted expenses,
+purchases leaving the delivered status) call ``invalidate_periods`` so the
+affected day and month are recomputed on the next read.
+
+Purchases count on their ``delivered_at``.  ``purchase_status_update`` sets it
+on the first delivery and keeps it when a delivered order is written again, so
+later status writes do not move a purchase out of a closed period; orders
+delivered before the field existed fall back to ``updated_at``.
+"""
+
+from __future__ import annotations
+
+import logging
+from calendar import monthrange
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_COMPLETED_SALE = {"$or": [{"status": {"$exists": False}}, {"status": "completed"}]}
+
+SCALAR_FIELDS = (
+    "revenue", "cogs", "tax_collected", "sales_count", "total_items_sold",
+    "total_losses", "expenses", "total_purchases", "purchases_count",
+)
+KEYED_FIELDS = ("payment", "losses_by_reason", "expenses_by_category")
+
+Segment = Tuple[str, Any, Any]  # ("live", start, end) | ("day", date, None) | ("month", (year, month), None)
+
+
+def _midnight(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _month_end(value: datetime) -> datetime:
+    return value.replace(day=monthrange(value.year, value.month)[1]) + timedelta(days=1)
+
+
+def plan_segments(start: datetime, end: datetime, now: datetime) -> List[Segment]:
+    """Split the inclusive range [start, end] into stored periods and live segments."""
+    end_excl = end + timedelta(microseconds=1)
+    if (end.hour, end.minute, end.second) == (23, 59, 59):
+        # "T23:59:59" end dates mean the whole day; align so the day can be a stored period.
+        end_excl = _midnight(end) + timedelta(days=1)
+    closed_before = _midnight(now)
+    segments: List[Segment] = []
+    cursor = start
+    if cursor >= end_excl:
+        return segments
+    if cursor != _midnight(cursor):
+        head_end = min(_midnight(cursor) + timedelta(days=1), end_excl)
+        segments.append(("live", cursor, head_end))
+        cursor = head_end
+
+    while cursor < end_excl:
+        next_day = cursor + timedelta(days=1)
+        if cursor.day == 1 and _month_end(cursor) <= min(end_excl, closed_before):
+            segments.append(("month", (cursor.year, cursor.month), None))
+            cursor = _month_end(cursor)
+        elif next_day <= min(end_excl, closed_before):
+            segments.append(("day", cursor.date(), None))
+            cursor = next_day
+        else:
+            segments.append(("live", cursor, end_excl))
+            break
+    return segments
+
+
+def segment_bounds(segment: Segment) -> Tuple[datetime, datetime]:
+    kind, value, end = segment
+    if kind == "live":
+        return value, end
+    if kind == "day":
+        day_start = datetime(value.year, value.month, value.day, tzinfo=timezone.utc)
+        return day_start, day_start + timedelta(days=1)
+    month_start = datetime(value[0], value[1], 1, tzinfo=timezone.utc)
+    return month_start, _month_end(month_start)
+
+
+def _period_key(segment: Segment) -> Tuple[str, str]:
+    kind, value, _ = segment
+    if kind == "day":
+        return "day", value.isoformat()
+    return "month", f"{value[0]:04d}-{value[1]:02d}"
+
+
+def scope_key(store_filter: Dict[str, Any]) -> str:
+    store_id = store_filter.get("store_id")
+    if store_id is None:
+        return "all"
+    if isinstance(store_id, dict):
+        return "in:" + ",".join(sorted(str(s) for s in store_id.get("$in", [])))
+    return f"store:{store_id}"
+
+
+def empty_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = {field: 0.0 for field in SCALAR_FIELDS}
+    stats.update({field: [] for field in KEYED_FIELDS})
+    stats.update({"daily": [], "products": []})
+    return stats
+
+
+def _merge_keyed(rows: Iterable[Dict[str, Any]], into: Dict[str, float]) -> None:
+    for row in rows:
+        into[row["key"]] = into.get(row["key"], 0.0) + float(row.get("amount") or 0)
+
+
+def merge_stats(parts: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    totals: Dict[str, float] = {field: 0.0 for field in SCALAR_FIELDS}
+    keyed: Dict[str, Dict[str, float]] = {field: {} for field in KEYED_FIELDS}
+    daily: Dict[str, Dict[str, float]] = {}
+    products: Dict[str, Dict[str, Any]] = {}
+    for part in parts:
+        for field in SCALAR_FIELDS:
+            totals[field] += float(part.get(field) or 0)
+        for field in KEYED_FIELDS:
+            _merge_keyed(part.get(field) or [], keyed[field])
+        for row in part.get("daily") or []:
+            day = daily.setdefault(row["date"], {"date": row["date"], "revenue": 0.0, "profit": 0.0})
+            day["revenue"] += float(row.get("revenue") or 0)
+            day["profit"] += float(row.get("profit") or 0)
+        for row in part.get("products") or []:
+            entry = products.setdefault(
+                row["id"], {"id": row["id"], "name": row.get("name") or "Inconnu", "qty_sold": 0, "revenue": 0.0, "cogs": 0.0, "loss": 0.0}
+            )
+            for field in ("qty_sold", "revenue", "cogs", "loss"):
+                entry[field] += row.get(field) or 0
+    merged: Dict[str, Any] = dict(totals)
+    merged.update({field: [{"key": k, "amount": v} for k, v in values.items()] for field, values in keyed.items()})
+    merged["daily"] = sorted(daily.values(), key=lambda row: row["date"])
+    merged["products"] = list(products.values())
+    return merged
+
+
+async def compute_stats(
+    db,
+    owner_id: str,
+    store_filter: Dict[str, Any],
+    start: datetime,
+    end: datetime,
+    is_loss: Callable[[Dict[str, Any]], bool],
+) -> Dict[str, Any]:
+    """Accounting figures of [start, end) straight from the raw collections."""
+    window = {"$gte": start, "$lt": end}
+    base = {"user_id": owner_id, **store_filter}
+
+    qty = {"$ifNull": ["$items.quantity", 0]}
+    item_cost = {"$multiply": [{"$ifNull": ["$items.purchase_price", 0]}, qty]}
+    item_revenue = {"$cond": [
+        {"$ne": [{"$ifNull": ["$items.total", 0]}, 0]},
+        "$items.total",
+        {"$multiply": [qty, {"$ifNull": ["$items.selling_price", 0]}]},
+    ]}
+    facets = (await db.sales.aggregate([
+        {"$match": {**base, "created_at": window, **_COMPLETED_SALE}},
+        {"$project": {
+            "_id": 0, "created_at": 1, "items": 1,
+            "amount": {"$ifNull": ["$total_amount", 0]},
+            "tax": {"$ifNull": ["$tax_total", 0]},
+            "payment_method": {"$ifNull": ["$payment_method", "cash"]},
+        }},
+        {"$facet": {
+            "totals": [{"$group": {"_id": None, "revenue": {"$sum": "$amount"}, "tax": {"$sum": "$tax"}, "count": {"$sum": 1}}}],
+            "payment": [{"$group": {"_id": "$payment_method", "amount": {"$sum": "$amount"}}}],
+            "daily": [
+                {"$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                    "revenue": {"$sum": "$amount"},
+                    "cogs": {"$sum": {"$sum": {"$map": {
+                        "input": {"$ifNull": ["$items", []]},
+                        "as": "it",
+                        "in": {"$multiply": [{"$ifNull": ["$$it.purchase_price", 0]}, {"$ifNull": ["$$it.quantity", 0]}]},
+                    }}}},
+                }},
+            ],
+            "products": [
+                {"$unwind": "$items"},
+                {"$group": {
+                    "_id": "$items.product_id",
+                    "name": {"$first": "$items.product_name"},
+                    "qty_sold": {"$sum": qty},
+                    "revenue": {"$sum": item_revenue},
+                    "cogs": {"$sum": item_cost},
+                }},
+            ],
+        }},
+    ]).to_list(1) or [{}])[0]
+
+    stats = empty_stats()
+    totals = (facets.get("totals") or [{}])[0]
+    stats["revenue"] = float(totals.get("revenue") or 0)
+    stats["tax_collected"] = float(totals.get("tax") or 0)
+    stats["sales_count"] = int(totals.get("count") or 0)
+    stats["payment"] = [{"key": row["_id"], "amount": float(row.get("amount") or 0)} for row in facets.get("payment") or []]
+    stats["daily"] = [
+        {"date": row["_id"], "revenue": float(row.get("revenue") or 0), "profit": float(row.get("revenue") or 0) - float(row.get("cogs") or 0)}
+        for row in facets.get("daily") or [] if row.get("_id")
+    ]
+    products: Dict[str, Dict[str, Any]] = {}
+    for row in facets.get("products") or []:
+        stats["cogs"] += float(row.get("cogs") or 0)
+        stats["total_items_sold"] += row.get("qty_sold") or 0
+        if row.get("_id"):
+            products[row["_id"]] = {
+                "id": row["_id"], "name": row.get("name") or "Inconnu",
+                "qty_sold": row.get("qty_sold") or 0, "revenue": float(row.get("revenue") or 0),
+                "cogs": float(row.get("cogs") or 0), "loss": 0.0,
+            }
+
+    movements = await db.stock_movements.find(
+        {**base, "type": "out", "created_at": window},
+        {"_id": 0, "product_id": 1, "quantity": 1, "reason": 1, "type": 1, "source_type": 1},
+    ).to_list(None)
+    movements = [m for m in movements if is_loss(m)]
+    loss_ids = list({m["product_id"] for m in movements if m.get("product_id")})
+    loss_products = {
+        p["product_id"]: p
+        for p in await db.products.find(
+            {"product_id": {"$in": loss_ids}, "user_id": owner_id}, {"_id": 0, "product_id": 1, "name": 1, "purchase_price": 1}
+        ).to_list(len(loss_ids))
+    } if loss_ids else {}
+    losses_by_reason: Dict[str, float] = {}
+    for movement in movements:
+        product_id = movement.get("product_id")
+        product = loss_products.get(product_id) or {}
+        loss_value = float(product.get("purchase_price") or 0) * float(movement.get("quantity") or 0)
+        stats["total_losses"] += loss_value
+        reason = movement.get("reason") or "Autre"
+        losses_by_reason[reason] = losses_by_reason.get(reason, 0.0) + loss_value
+        if product_id:
+            entry = products.setdefault(product_id, {
+                "id": product_id, "name": product.get("name") or "Inconnu", "qty_sold": 0, "revenue": 0.0, "cogs": 0.0, "loss": 0.0,
+            })
+            entry["loss"] += loss_value
+    stats["losses_by_reason"] = [{"key": k, "amount": v} for k, v in losses_by_reason.items()]
+    stats["products"] = list(products.values())
+
+    expense_rows = await db.expenses.aggregate([
+        {"$match": {**base, "created_at": window}},
+        {"$group": {"_id": {"$ifNull": ["$category", "Autre"]}, "amount": {"$sum": {"$ifNull": ["$amount", 0]}}}},
+    ]).to_list(None)
+    stats["expenses_by_category"] = [{"key": row["_id"], "amount": float(row.get("amount") or 0)} for row in expense_rows]
+    stats["expenses"] = sum(row["amount"] for row in stats["expenses_by_category"])
+
+    purchase_rows = await db.orders.aggregate([
+        {"$match": {
+            **base,
+            "status": "delivered",
+            "$or": [
+                {"delivered_at": window},
+                {"delivered_at": None, "updated_at": window},
+                {"delivered_at": None, "updated_at": None, "created_at": window},
+            ],
+        }},
+        {"$group": {"_id": None, "amount": {"$sum": {"$ifNull": ["$total_amount", 0]}}, "count": {"$sum": 1}}},
+    ]).to_list(1)
+    if purchase_rows:
+        stats["total_purchases"] = float(purchase_rows[0].get("amount") or 0)
+        stats["purchases_count"] = int(purchase_rows[0].get("count") or 0)
+    return stats
+
+
+async def get_range_stats(
+    db,
+    owner_id: str,
+    store_filter: Dict[str, Any],
+    start: datetime,
+    end: datetime,
+    is_loss: Callable[[Dict[str, Any]], bool],
+    now: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    """Accounting figures of the inclusive range [start, end] from stored and live segments."""
+    now = now or datetime.now(timezone.utc)
+    start, end = start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+    scope = scope_key(store_filter)
+    segments = plan_segments(start, end, now)
+    stored_keys = [_period_key(seg) for seg in segments if seg[0] != "live"]
+    stored: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    if stored_keys:
+        docs = await db.accounting_period_summaries.find(
+            {"user_id": owner_id, "scope": scope, "period": {"$in": [key[1] for key in stored_keys]}},
+            {"_id": 0},
+        ).to_list(len(stored_keys))
+        stored = {(doc["period_type"], doc["period"]): doc["stats"] for doc in docs}
+
+    parts: List[Dict[str, Any]] = []
+    for segment in segments:
+        seg_start, seg_end = segment_bounds(segment)
+        if segment[0] == "live":
+            parts.append(await compute_stats(db, owner_id, store_filter, seg_start, seg_end, is_loss))
+            continue
+        key = _period_key(segment)
+        stats = stored.get(key)
+        if stats is None:
+            stats = await compute_stats(db, owner_id, store_filter, seg_start, seg_end, is_loss)
+            await db.accounting_period_summaries.update_one(
+                {"user_id": owner_id, "scope": scope, "period_type": key[0], "period": key[1]},
+                {"$set": {"stats": stats, "computed_at": now}},
+                upsert=True,
+            )
+        parts.append(stats)
+    return merge_stats(parts)
+
+
+def purchased_at(order: Dict[str, Any]) -> Any:
+    """The instant a delivered order's purchase is counted on."""
+    return order.get("delivered_at") or order.get("updated_at") or order.get("created_at")
+
+
+def purchase_status_update(status: str, now: datetime) -> List[Dict[str, Any]]:
+    """Update pipeline setting an order's status without moving an existing delivery date."""
+    if status != "delivered":
+        delivered_at: Any = "$$REMOVE"
+    else:
+        delivered_at = {"$cond": [
+            {"$eq": ["$status", "delivered"]},
+            {"$ifNull": ["$delivered_at", {"$ifNull": ["$updated_at", "$created_at"]}]},
+            now,
+        ]}
+    return [{"$set": {"status": status, "updated_at": now, "delivered_at": delivered_at}}]
+
+
+async def invalidate_periods(db, owner_id: str, at: Any) -> None:
+    """Forget the stored day and month containing ``at`` (every scope of the owner)."""
+    if isinstance(at, str):
+        try:
+            at = datetime.fromisoformat(at.replace("Z", "+00:00"))
+        except ValueError:
+            return
+    if not isinstance(at, (datetime, date)):
+        return
+    await db.accounting_period_summaries.delete_many({
+        "user_id": owner_id,
+        "$or": [
+            {"period_type": "day", "period": at.strftime("%Y-%m-%d")},
+            {"period_type": "month", "period": at.strftime("%Y-%m")},
+        ],
+    })
+
+
+async def ensure_accounting_period_indexes(db) -> None:
+    await db.accounting_period_summaries.create_index(
+        [("user_id", 1), ("scope", 1), ("period_type", 1), ("period", 1)], unique=True
+    )
+    await db.expenses.create_index([("user_id", 1), ("created_at", -1)])
@@ -17,6 +17,8 @@ from typing import Any, Dict, List, Optional
 
 from fastapi import HTTPException
 
+from services import retention
+
 try:
     import redis
 except Exception:  # pragma: no cover - optional dependency at runtime
@@ -530,6 +532,7 @@ async def track_ai_usage(
         "cost_estimated": cost_estimated if success else 0.0,
         "created_at": datetime.now(timezone.utc),
     }
+    doc["expires_at"] = retention.expires_at("ai_usage", plan, doc["created_at"])
     await db.ai_usage.insert_one(doc)
 
 
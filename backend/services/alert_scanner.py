@@ -0,0 +1,177 @@
+"""
+Set-based scanner for the periodic stock and expiry alerts.
+
+Each cycle runs one aggregation per rule that only emits the products (or
+batches) crossing their threshold, loads the owners concerned and their
+notification settings once, and writes alerts with unordered ``bulk_write``
+upserts.  Scanner alerts carry a structured dedupe key - ``dedupe_rule``,
+``product_id`` and ``batch_id`` - backed by a partial unique index over the
+active (non-dismissed) alerts, so concurrent workers cannot emit the same
+alert twice and a dismissed alert can be raised again later.
+"""
+
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+LOW_STOCK_RULE = "low_stock"
+EXPIRY_RULE = "expiry"
+SCAN_CHUNK = 500
+
+DedupeKey = Tuple[str, str, Optional[str], Optional[str]]
+
+
+def low_stock_pipeline() -> List[Dict[str, Any]]:
+    return [
+        {"$match": {
+            "min_stock": {"$gt": 0},
+            "quantity": {"$gt": 0},
+            "$expr": {"$lte": ["$quantity", "$min_stock"]},
+            "user_id": {"$nin": [None, ""]},
+        }},
+        {"$project": {"_id": 0, "user_id": 1, "store_id": 1, "product_id": 1, "name": 1, "quantity": 1}},
+    ]
+
+
+def expiring_batches_pipeline(until: datetime) -> List[Dict[str, Any]]:
+    return [
+        {"$match": {
+            "expiry_date": {"$type": "date", "$lte": until},
+            "quantity": {"$gt": 0},
+            "user_id": {"$nin": [None, ""]},
+        }},
+        {"$lookup": {
+            "from": "products",
+            "localField": "product_id",
+            "foreignField": "product_id",
+            "pipeline": [{"$project": {"_id": 0, "name": 1}}],
+            "as": "product",
+        }},
+        {"$project": {
+            "_id": 0, "user_id": 1, "store_id": 1, "product_id": 1, "batch_id": 1,
+            "batch_number": 1, "expiry_date": 1,
+            "product_name": {"$ifNull": [{"$arrayElemAt": ["$product.name", 0]}, "produit"]},
+        }},
+    ]
+
+
+async def chunks(cursor, size: int = SCAN_CHUNK) -> AsyncIterator[List[Dict[str, Any]]]:
+    chunk: List[Dict[str, Any]] = []
+    async for doc in cursor:
+        chunk.append(doc)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def load_owners(db, owners: Dict[str, Dict[str, Any]], owner_ids: Iterable[str]) -> None:
+    """Add the missing owners of ``owner_ids`` (user doc + ``settings``) to the per-cycle map."""
+    missing = list({owner_id for owner_id in owner_ids if owner_id and owner_id not in owners})
+    if not missing:
+        return
+    async for user in db.users.find(
+        {"user_id": {"$in": missing}},
+        {"_id": 0, "user_id": 1, "plan": 1, "effective_plan": 1, "subscription_plan": 1, "account_id": 1},
+    ):
+        owners[user["user_id"]] = {**user, "settings": {}}
+    async for settings in db.user_settings.find(
+        {"user_id": {"$in": missing}},
+        {"_id": 0, "user_id": 1, "push_notifications": 1, "notification_preferences": 1},
+    ):
+        if settings["user_id"] in owners:
+            owners[settings["user_id"]]["settings"] = settings
+    for owner_id in missing:
+        owners.setdefault(owner_id, {})
+
+
+def dedupe_key(rule: str, owner_id: str, product_id: Optional[str], batch_id: Optional[str] = None) -> DedupeKey:
+    return rule, owner_id, product_id, batch_id
+
+
+async def active_keys(db, rule: str, candidates: List[DedupeKey]) -> Set[DedupeKey]:
+    """Keys of ``candidates`` already covered by an active alert.
+
+    Alerts raised before dedupe keys existed (or by the product-level rules)
+    have no ``dedupe_rule``; they still cover their product.
+    """
+    owner_ids = list({key[1] for key in candidates})
+    product_ids = list({key[2] for key in candidates if key[2]})
+    covered: Set[DedupeKey] = set()
+    legacy: Set[Tuple[str, Optional[str]]] = set()
+    async for alert in db.alerts.find(
+        {"user_id": {"$in": owner_ids}, "type": rule, "is_dismissed": False, "product_id": {"$in": product_ids}},
+        {"_id": 0, "user_id": 1, "product_id": 1, "dedupe_rule": 1, "batch_id": 1},
+    ):
+        if alert.get("dedupe_rule"):
+            covered.add(dedupe_key(alert["dedupe_rule"], alert["user_id"], alert.get("product_id"), alert.get("batch_id")))
+        else:
+            legacy.add((alert["user_id"], alert.get("product_id")))
+    return {key for key in candidates if key in covered or (key[1], key[2]) in legacy}
+
+
+def upsert_op(alert_doc: Dict[str, Any], key: DedupeKey) -> UpdateOne:
+    rule, owner_id, product_id, batch_id = key
+    selector = {
+        "user_id": owner_id, "dedupe_rule": rule, "product_id": product_id,
+        "batch_id": batch_id, "is_dismissed": False,
+    }
+    return UpdateOne(selector, {"$setOnInsert": {**alert_doc, **selector}}, upsert=True)
+
+
+async def upsert_alerts(db, pending: List[Tuple[Dict[str, Any], DedupeKey]]) -> List[int]:
+    """Upsert alerts, returning the indexes of ``pending`` that were actually created."""
+    if not pending:
+        return []
+    ops = [upsert_op(doc, key) for doc, key in pending]
+    try:
+        result = await db.alerts.bulk_write(ops, ordered=False)
+        return sorted(result.upserted_ids)
+    except BulkWriteError as exc:
+        # Duplicate keys mean another worker raised the same alert first.
+        details = exc.details or {}
+        unexpected = [err for err in details.get("writeErrors", []) if err.get("code") != 11000]
+        if unexpected:
+            logger.warning("Alert upsert errors: %s", unexpected[:3])
+        return sorted(item["index"] for item in details.get("upserted", []))
+
+
+async def normalize_batch_expiry_dates(db) -> int:
+    """Convert legacy ISO-string ``expiry_date`` values of batches to dates."""
+    converted = 0
+    ops: List[UpdateOne] = []
+    async for batch in db.batches.find({"expiry_date": {"$type": "string"}}, {"_id": 1, "expiry_date": 1}):
+        try:
+            parsed = datetime.fromisoformat(batch["expiry_date"].replace("Z", "+00:00"))
+        except ValueError:
+            continue
+        if not parsed.tzinfo:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        ops.append(UpdateOne({"_id": batch["_id"]}, {"$set": {"expiry_date": parsed}}))
+        if len(ops) >= SCAN_CHUNK:
+            await db.batches.bulk_write(ops, ordered=False)
+            converted += len(ops)
+            ops = []
+    if ops:
+        await db.batches.bulk_write(ops, ordered=False)
+        converted += len(ops)
+    return converted
+
+
+async def ensure_alert_indexes(db) -> None:
+    await db.alerts.create_index(
+        [("user_id", 1), ("dedupe_rule", 1), ("product_id", 1), ("batch_id", 1)],
+        unique=True,
+        partialFilterExpression={"dedupe_rule": {"$exists": True}, "is_dismissed": False},
+        name="alerts_active_dedupe",
+    )
+    await db.alerts.create_index([("user_id", 1), ("type", 1), ("product_id", 1), ("is_dismissed", 1)])
+    await db.batches.create_index([("expiry_date", 1), ("quantity", 1)])
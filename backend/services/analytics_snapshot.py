@@ -0,0 +1,210 @@
+"""
+Server-side building blocks for the analytics snapshot.
+
+The executive overview, store comparison, stock health, ABC and KPI detail
+endpoints share one snapshot.  Instead of loading every sale of the window
+into the app, the sales side is computed by a single ``$facet`` aggregation
+that returns one row per (period bucket, store, product) plus sale counts and
+day / hour / payment-method distributions.
+
+Line revenue and cost fall back to the catalog price when a legacy sale line
+has no total or purchase price.  The pipeline sums what the line knows and
+reports the quantities that still need a catalog price; ``line_totals`` applies
+the fallback with the product document.
+
+Snapshots are cached per (owner, store set, filters, period) and dropped by
+``invalidate_snapshots`` from ``_invalidate_dashboard_ai_caches``.
+"""
+
+from __future__ import annotations
+
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+SNAPSHOT_TTL_S = 300
+SNAPSHOT_CACHE_MAX = 500
+
+_COMPLETED_SALE = {"$or": [{"status": {"$exists": False}}, {"status": "completed"}]}
+
+
+def _num(expr: Any) -> Dict[str, Any]:
+    return {"$convert": {"input": expr, "to": "double", "onError": 0.0, "onNull": 0.0}}
+
+
+def build_sales_match(
+    owner_id: str,
+    window_start: datetime,
+    now: datetime,
+    store_ids: Iterable[str],
+    allow_legacy_unassigned: bool,
+) -> Dict[str, Any]:
+    clauses: List[Dict[str, Any]] = [_COMPLETED_SALE]
+    store_ids = [store_id for store_id in store_ids if store_id]
+    if store_ids:
+        allowed: List[Any] = list(store_ids)
+        if allow_legacy_unassigned:
+            allowed += [None, ""]
+        clauses.append({"store_id": {"$in": allowed}})
+    return {"user_id": owner_id, "created_at": {"$gte": window_start, "$lt": now}, "$and": clauses}
+
+
+def build_sales_facet_pipeline(
+    match: Dict[str, Any],
+    current_start: datetime,
+    previous_start: datetime,
+    recent_start: datetime,
+    allowed_product_ids: Optional[Iterable[str]] = None,
+    timezone_name: str = "UTC",
+) -> List[Dict[str, Any]]:
+    items: Any = {"$ifNull": ["$items", []]}
+    if allowed_product_ids is not None:
+        items = {"$filter": {"input": items, "as": "it", "cond": {"$in": ["$$it.product_id", list(allowed_product_ids)]}}}
+
+    qty = _num("$$it.quantity")
+    total = _num("$$it.total")
+    unit_price = _num("$$it.selling_price")
+    discount = _num("$$it.discount_amount")
+    cost = _num("$$it.purchase_price")
+    has_total = {"$ne": [total, 0]}
+    has_price = {"$ne": [unit_price, 0]}
+    needs_catalog_price = {"$and": [{"$not": [has_total]}, {"$not": [has_price]}]}
+
+    line = {
+        "product_id": "$$it.product_id",
+        "product_name": "$$it.product_name",
+        "category_id": "$$it.category_id",
+        "quantity": qty,
+        "revenue": {"$cond": [
+            has_total, total,
+            {"$cond": [has_price, {"$max": [0, {"$subtract": [{"$multiply": [unit_price, qty]}, discount]}]}, 0]},
+        ]},
+        "missing_price_qty": {"$cond": [needs_catalog_price, qty, 0]},
+        "missing_price_discount": {"$cond": [needs_catalog_price, discount, 0]},
+        "cost": {"$cond": [{"$ne": [cost, 0]}, {"$multiply": [cost, qty]}, 0]},
+        "missing_cost_qty": {"$cond": [{"$ne": [cost, 0]}, 0, qty]},
+    }
+    current_lines = {"$match": {"bucket": "current"}}
+
+    return [
+        {"$match": match},
+        {"$project": {
+            "_id": 0,
+            "store_id": 1,
+            "created_at": 1,
+            "payment_method": {"$ifNull": ["$payment_method", "-"]},
+            "lines": {"$map": {"input": items, "as": "it", "in": line}},
+        }},
+        {"$match": {"lines.0": {"$exists": True}}},
+        {"$addFields": {
+            "bucket": {"$switch": {
+                "branches": [
+                    {"case": {"$gte": ["$created_at", current_start]}, "then": "current"},
+                    {"case": {"$gte": ["$created_at", previous_start]}, "then": "previous"},
+                ],
+                "default": None,
+            }},
+            "recent": {"$gte": ["$created_at", recent_start]},
+            "revenue": {"$sum": "$lines.revenue"},
+        }},
+        {"$facet": {
+            "sales": [
+                {"$match": {"bucket": {"$ne": None}}},
+                {"$group": {"_id": {"bucket": "$bucket", "store_id": "$store_id"}, "count": {"$sum": 1}}},
+            ],
+            "lines": [
+                {"$match": {"$or": [{"bucket": {"$ne": None}}, {"recent": True}]}},
+                {"$unwind": "$lines"},
+                {"$group": {
+                    "_id": {"bucket": "$bucket", "store_id": "$store_id", "product_id": "$lines.product_id"},
+                    "name": {"$first": "$lines.product_name"},
+                    "category_id": {"$first": "$lines.category_id"},
+                    "quantity": {"$sum": "$lines.quantity"},
+                    "revenue": {"$sum": "$lines.revenue"},
+                    "missing_price_qty": {"$sum": "$lines.missing_price_qty"},
+                    "missing_price_discount": {"$sum": "$lines.missing_price_discount"},
+                    "cost": {"$sum": "$lines.cost"},
+                    "missing_cost_qty": {"$sum": "$lines.missing_cost_qty"},
+                    "recent": {"$max": "$recent"},
+                }},
+            ],
+            "daily": [
+                current_lines,
+                {"$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at", "timezone": timezone_name}},
+                    "revenue": {"$sum": "$revenue"},
+                    "sales_count": {"$sum": 1},
+                }},
+                {"$sort": {"_id": 1}},
+            ],
+            "hourly": [
+                current_lines,
+                {"$group": {
+                    "_id": {"$hour": {"date": "$created_at", "timezone": timezone_name}},
+                    "revenue": {"$sum": "$revenue"},
+                    "sales_count": {"$sum": 1},
+                }},
+                {"$sort": {"_id": 1}},
+            ],
+            "payment_methods": [
+                current_lines,
+                {"$group": {"_id": "$payment_method", "revenue": {"$sum": "$revenue"}, "sales_count": {"$sum": 1}}},
+                {"$sort": {"revenue": -1}},
+            ],
+        }},
+    ]
+
+
+def line_totals(group: Dict[str, Any], product_doc: Dict[str, Any]) -> Tuple[float, float, float]:
+    """(quantity, revenue, cogs) of a line group, using catalog prices where the lines had none."""
+    quantity = float(group.get("quantity") or 0)
+    revenue = float(group.get("revenue") or 0)
+    missing_price_qty = float(group.get("missing_price_qty") or 0)
+    if missing_price_qty:
+        revenue += max(
+            0.0,
+            float(product_doc.get("selling_price") or 0) * missing_price_qty
+            - float(group.get("missing_price_discount") or 0),
+        )
+    cogs = float(group.get("cost") or 0) + float(product_doc.get("purchase_price") or 0) * float(group.get("missing_cost_qty") or 0)
+    return quantity, revenue, cogs
+
+
+def distribution_rows(rows: List[Dict[str, Any]], key: str) -> List[Dict[str, Any]]:
+    return [
+        {key: row["_id"], "revenue": round(float(row.get("revenue") or 0), 2), "sales_count": int(row.get("sales_count") or 0)}
+        for row in rows
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Cache
+# ---------------------------------------------------------------------------
+_snapshot_cache: Dict[Tuple[Any, ...], Tuple[Dict[str, Any], float]] = {}
+
+
+def snapshot_cache_key(owner_id: str, store_ids: Iterable[str], *parts: Any) -> Tuple[Any, ...]:
+    return (owner_id, tuple(sorted(store_id for store_id in store_ids if store_id)), *parts)
+
+
+def get_cached_snapshot(key: Tuple[Any, ...]) -> Optional[Dict[str, Any]]:
+    entry = _snapshot_cache.get(key)
+    if entry and time.monotonic() < entry[1]:
+        return entry[0]
+    _snapshot_cache.pop(key, None)
+    return None
+
+
+def set_cached_snapshot(key: Tuple[Any, ...], snapshot: Dict[str, Any]) -> None:
+    if len(_snapshot_cache) >= SNAPSHOT_CACHE_MAX:
+        now = time.monotonic()
+        for stale in [k for k, (_, expires) in _snapshot_cache.items() if expires <= now]:
+            _snapshot_cache.pop(stale, None)
+        if len(_snapshot_cache) >= SNAPSHOT_CACHE_MAX:
+            _snapshot_cache.pop(next(iter(_snapshot_cache)), None)
+    _snapshot_cache[key] = (snapshot, time.monotonic() + SNAPSHOT_TTL_S)
+
+
+def invalidate_snapshots(owner_id: str) -> None:
+    for key in [k for k in _snapshot_cache if k[0] == owner_id]:
+        _snapshot_cache.pop(key, None)
@@ -0,0 +1,171 @@
+"""
+Scheduling of the periodic AI anomaly detection.
+
+A tenant is an owner's active store.  Its data watermark is the timestamp of
+its latest sale or stock movement; detection only runs again for a tenant
+whose watermark advanced since its last check, so LLM spend follows activity
+rather than the number of accounts.
+
+A cycle scans activity since the previous cycle started (one grouped
+aggregation on ``sales`` and one on ``stock_movements``), orders the tenants
+due (paying accounts first, most recent activity first) and feeds them to a
+bounded pool of workers.  Each finished tenant is written to
+``ai_anomaly_state`` with the cycle id, so a cycle interrupted by a restart
+resumes with the same window and skips the tenants already done.  A tenant
+whose check fails keeps its activity as ``pending`` on that state document and
+is folded back into the next cycle's activity, so it is retried even though
+the next window starts after its last sale.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 4
+FIRST_CYCLE_LOOKBACK = timedelta(hours=24)
+
+Tenant = Tuple[str, str]
+
+_SCHEDULER_ID = "scheduler"
+
+
+def _utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+async def start_or_resume_cycle(db, now: datetime) -> Dict[str, Any]:
+    """The unfinished cycle if there is one, else a new cycle covering activity since the last one began."""
+    state = await db.ai_anomaly_cycles.find_one({"_id": _SCHEDULER_ID}) or {}
+    if state.get("cycle_id") and not state.get("completed_at"):
+        return state
+    since = _utc(state.get("started_at")) or now - FIRST_CYCLE_LOOKBACK
+    cycle = {"_id": _SCHEDULER_ID, "cycle_id": uuid.uuid4().hex[:12], "since": since, "started_at": now,
+             "completed_at": None, "processed": 0}
+    await db.ai_anomaly_cycles.replace_one({"_id": _SCHEDULER_ID}, cycle, upsert=True)
+    return cycle
+
+
+async def complete_cycle(db, cycle_id: str, now: datetime, processed: int) -> None:
+    await db.ai_anomaly_cycles.update_one(
+        {"_id": _SCHEDULER_ID, "cycle_id": cycle_id},
+        {"$set": {"completed_at": now}, "$inc": {"processed": processed}},
+    )
+
+
+async def tenant_activity(db, since: datetime) -> Dict[Tenant, datetime]:
+    """Latest sale or stock movement per (owner, store) since ``since``, plus tenants left pending by a failed check."""
+    activity: Dict[Tenant, datetime] = {}
+    for collection in ("sales", "stock_movements"):
+        async for row in db[collection].aggregate([
+            {"$match": {"created_at": {"$gt": since}, "store_id": {"$nin": [None, ""]}}},
+            {"$group": {"_id": {"user_id": "$user_id", "store_id": "$store_id"}, "at": {"$max": "$created_at"}}},
+        ]):
+            key = (row["_id"].get("user_id"), row["_id"].get("store_id"))
+            at = _utc(row["at"])
+            if key[0] and (key not in activity or at > activity[key]):
+                activity[key] = at
+    async for state in db.ai_anomaly_state.find(
+        {"pending": {"$exists": True}}, {"_id": 0, "user_id": 1, "store_id": 1, "pending": 1},
+    ):
+        key = (state["user_id"], state["store_id"])
+        at = _utc(state["pending"])
+        if key not in activity or at > activity[key]:
+            activity[key] = at
+    return activity
+
+
+async def due_tenants(
+    db,
+    cycle_id: str,
+    activity: Dict[Tenant, datetime],
+    tenants: Iterable[Tenant],
+    paying_owner_ids: Set[str],
+) -> List[Tenant]:
+    """Tenants whose watermark advanced and that this cycle has not handled yet, in priority order."""
+    candidates = [tenant for tenant in tenants if tenant in activity]
+    if not candidates:
+        return []
+    handled: Dict[Tenant, Dict[str, Any]] = {}
+    async for state in db.ai_anomaly_state.find(
+        {"user_id": {"$in": list({owner for owner, _ in candidates})}},
+        {"_id": 0, "user_id": 1, "store_id": 1, "watermark": 1, "cycle_id": 1},
+    ):
+        handled[(state["user_id"], state["store_id"])] = state
+
+    due = []
+    for tenant in candidates:
+        state = handled.get(tenant) or {}
+        if state.get("cycle_id") == cycle_id:
+            continue
+        watermark = _utc(state.get("watermark"))
+        if watermark and activity[tenant] <= watermark:
+            continue
+        due.append(tenant)
+    return sorted(due, key=lambda tenant: (tenant[0] not in paying_owner_ids, -activity[tenant].timestamp()))
+
+
+async def mark_checked(db, cycle_id: str, tenant: Tenant, watermark: datetime, now: datetime) -> None:
+    await db.ai_anomaly_state.update_one(
+        {"user_id": tenant[0], "store_id": tenant[1]},
+        {"$set": {"watermark": watermark, "cycle_id": cycle_id, "checked_at": now}, "$unset": {"pending": ""}},
+        upsert=True,
+    )
+
+
+async def mark_failed(db, tenant: Tenant, watermark: datetime, now: datetime) -> None:
+    """Keep the tenant's activity pending so the next cycle retries it."""
+    await db.ai_anomaly_state.update_one(
+        {"user_id": tenant[0], "store_id": tenant[1]},
+        {"$max": {"pending": watermark}, "$set": {"failed_at": now}},
+        upsert=True,
+    )
+
+
+async def run_pool(
+    items: List[Any],
+    worker: Callable[[Any], Awaitable[None]],
+    concurrency: int = WORKERS,
+    on_error: Optional[Callable[[Any], Awaitable[None]]] = None,
+) -> int:
+    """Run ``worker`` over ``items`` with at most ``concurrency`` in flight; returns the number processed.
+
+    ``on_error`` is awaited with each item whose worker raised.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    processed = 0
+
+    async def consume() -> None:
+        nonlocal processed
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await worker(item)
+                processed += 1
+            except Exception as exc:
+                logger.warning("Anomaly detection failed for %s: %s", item, exc)
+                if on_error is not None:
+                    try:
+                        await on_error(item)
+                    except Exception as error_exc:
+                        logger.warning("Could not record anomaly failure for %s: %s", item, error_exc)
+
+    await asyncio.gather(*(consume() for _ in range(max(1, min(concurrency, len(items) or 1)))))
+    return processed
+
+
+async def ensure_anomaly_scheduler_indexes(db) -> None:
+    await db.ai_anomaly_state.create_index([("user_id", 1), ("store_id", 1)], unique=True)
+    await db.ai_anomaly_state.create_index("pending", sparse=True)
@@ -0,0 +1,501 @@
+"""
+Market basket analysis — incremental co-occurrence counts.
+
+Every completed sale feeds three small collections through ``record_basket``:
+
+    basket_product_stats  (user_id, store_id, product_id) -> count, weight
+    basket_pair_stats     (user_id, store_id, a, b)       -> count, weight
+    basket_totals         (user_id, store_id)             -> baskets, weight
+
+``count`` is the raw number of baskets; ``weight`` is the same count with
+forward exponential decay: a basket sold at time t adds 2 ** ((t - epoch) /
+half_life), so old baskets fade without ever rewriting stored documents.
+Dividing by the weight of "now" gives the decayed count.  ``forget_basket``
+subtracts a cancelled sale the same way.
+
+History from before the counters existed is loaded once per owner by
+``rebuild_basket_stats``; ``basket_state`` records that it ran, so later sales
+never hide an owner whose history was not loaded yet.  The first read of an
+owner starts that rebuild in the background (``start_rebuild``) and answers
+with an empty, ``pending`` result until it is done.  A rebuild holds a lease
+on that state document: while it is held, incremental updates are appended to
+its ``pending`` list instead of touching the counters, and the rebuild takes
+them back atomically with the lease release and applies them on top of the
+fresh counters.
+
+``refresh_basket_insights`` turns the sparse pair matrix into support,
+confidence and lift for all pairs in a single NumPy pass and stores the
+result in ``basket_insights`` so cross-sell endpoints only read it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+BASKET_HALF_LIFE_DAYS = 45.0
+BASKET_DECAY_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+MAX_BASKET_PRODUCTS = 40  # caps pairs per sale at 780
+INSIGHTS_MAX_PAIRS = 300
+INSIGHTS_MAX_AGE_S = 6 * 3600
+DEFAULT_MIN_LIFT = 1.5
+ALL_STORES_SCOPE = "all"
+REBUILD_LEASE = timedelta(minutes=10)
+STATE_READY = "ready"
+STATE_REBUILDING = "rebuilding"
+
+
+def _as_utc(value: Optional[datetime]) -> datetime:
+    if value is None:
+        return datetime.now(timezone.utc)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def decay_weight(at: Optional[datetime]) -> float:
+    elapsed_days = (_as_utc(at) - BASKET_DECAY_EPOCH).total_seconds() / 86400.0
+    return float(2.0 ** (elapsed_days / BASKET_HALF_LIFE_DAYS))
+
+
+def basket_products(items: Iterable[Dict[str, Any]]) -> Dict[str, str]:
+    """Distinct ``product_id -> name`` of a sale, capped to MAX_BASKET_PRODUCTS."""
+    products: Dict[str, str] = {}
+    for item in items or []:
+        product_id = (item or {}).get("product_id")
+        if not product_id or product_id in products:
+            continue
+        products[product_id] = item.get("product_name") or item.get("name") or product_id
+        if len(products) >= MAX_BASKET_PRODUCTS:
+            break
+    return products
+
+
+def basket_pairs(product_ids: Iterable[str]) -> List[Tuple[str, str]]:
+    ordered = sorted(product_ids)
+    return [(a, b) for i, a in enumerate(ordered) for b in ordered[i + 1:]]
+
+
+async def _apply_basket(
+    db,
+    owner_id: str,
+    store_id: Optional[str],
+    products: Dict[str, str],
+    created_at: datetime,
+    sign: int,
+) -> None:
+    weight = decay_weight(created_at)
+    scope = {"user_id": owner_id, "store_id": store_id}
+    inc = {"count": sign, "weight": sign * weight}
+    # A withdrawal never creates counters: it only undoes what was added.
+    upsert = sign > 0
+
+    await db.basket_product_stats.bulk_write([
+        UpdateOne(
+            {**scope, "product_id": product_id},
+            {"$inc": inc, "$set": {"name": name, "last_seen_at": created_at}} if upsert else {"$inc": inc},
+            upsert=upsert,
+        )
+        for product_id, name in products.items()
+    ], ordered=False)
+
+    pairs = basket_pairs(products)
+    if pairs:
+        await db.basket_pair_stats.bulk_write([
+            UpdateOne(
+                {**scope, "a": a, "b": b},
+                {"$inc": inc, "$set": {"last_seen_at": created_at}} if upsert else {"$inc": inc},
+                upsert=upsert,
+            )
+            for a, b in pairs
+        ], ordered=False)
+
+    totals_update: Dict[str, Any] = {"$inc": {"baskets": sign, "weight": sign * weight}, "$set": {"dirty": True}}
+    if upsert:
+        totals_update["$set"]["last_basket_at"] = created_at
+    await db.basket_totals.update_one(scope, totals_update, upsert=upsert)
+
+
+async def _record(
+    db,
+    owner_id: str,
+    store_id: Optional[str],
+    items: Iterable[Dict[str, Any]],
+    created_at: Optional[datetime],
+    sale_id: Optional[str],
+    sign: int,
+) -> None:
+    products = basket_products(items)
+    if not products:
+        return
+    created_at = _as_utc(created_at)
+    now = datetime.now(timezone.utc)
+    held = await db.basket_state.update_one(
+        {"user_id": owner_id, "status": STATE_REBUILDING, "lease_until": {"$gt": now}},
+        {"$push": {"pending": {
+            "sale_id": sale_id,
+            "store_id": store_id,
+            "created_at": created_at,
+            "products": [[product_id, name] for product_id, name in products.items()],
+            "sign": sign,
+        }}},
+    )
+    if held.modified_count:
+        return
+    await _apply_basket(db, owner_id, store_id, products, created_at, sign)
+
+
+async def record_basket(
+    db,
+    owner_id: str,
+    store_id: Optional[str],
+    items: Iterable[Dict[str, Any]],
+    created_at: Optional[datetime] = None,
+    sale_id: Optional[str] = None,
+) -> None:
+    """Add one completed sale to the co-occurrence counters."""
+    await _record(db, owner_id, store_id, items, created_at, sale_id, 1)
+
+
+async def forget_basket(
+    db,
+    owner_id: str,
+    store_id: Optional[str],
+    items: Iterable[Dict[str, Any]],
+    created_at: Optional[datetime] = None,
+    sale_id: Optional[str] = None,
+) -> None:
+    """Withdraw a cancelled sale from the co-occurrence counters."""
+    await _record(db, owner_id, store_id, items, created_at, sale_id, -1)
+
+
+async def _acquire_rebuild_lease(db, owner_id: str, now: datetime) -> Optional[str]:
+    lease_id = uuid.uuid4().hex
+    try:
+        await db.basket_state.find_one_and_update(
+            {"user_id": owner_id, "$or": [{"status": {"$ne": STATE_REBUILDING}}, {"lease_until": {"$lte": now}}]},
+            {"$set": {
+                "status": STATE_REBUILDING,
+                "lease_id": lease_id,
+                "lease_until": now + REBUILD_LEASE,
+                "pending": [],
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Another rebuild of this owner holds the lease.
+        return None
+    return lease_id
+
+
+async def _replay_pending(db, owner_id: str, pending: List[Dict[str, Any]], counted: Set[str]) -> None:
+    """Apply updates queued during a rebuild that the history scan did not already reflect."""
+    for entry in pending:
+        sale_id = entry.get("sale_id")
+        sign = int(entry.get("sign") or 1)
+        if sale_id:
+            if sign > 0 and sale_id in counted:
+                continue
+            if sign < 0 and sale_id not in counted:
+                continue
+            if sign > 0:
+                counted.add(sale_id)
+            else:
+                counted.discard(sale_id)
+        products = {product_id: name for product_id, name in entry.get("products") or []}
+        if products:
+            await _apply_basket(db, owner_id, entry.get("store_id"), products, _as_utc(entry.get("created_at")), sign)
+
+
+async def rebuild_basket_stats(db, owner_id: str) -> Optional[Dict[str, int]]:
+    """Recompute every counter of an owner from the full sales history.
+
+    Returns None without touching anything when another rebuild of the owner
+    holds the lease.
+    """
+    now = datetime.now(timezone.utc)
+    lease_id = await _acquire_rebuild_lease(db, owner_id, now)
+    if lease_id is None:
+        return None
+    product_acc: Dict[Tuple[Optional[str], str], List[Any]] = {}
+    pair_acc: Dict[Tuple[Optional[str], str, str], List[float]] = defaultdict(lambda: [0, 0.0])
+    total_acc: Dict[Optional[str], List[Any]] = {}
+    counted: Set[str] = set()
+
+    cursor = db.sales.find(
+        {"user_id": owner_id, "$or": [{"status": {"$exists": False}}, {"status": "completed"}]},
+        {"_id": 0, "sale_id": 1, "store_id": 1, "created_at": 1, "items.product_id": 1, "items.product_name": 1},
+    )
+    async for sale in cursor:
+        products = basket_products(sale.get("items") or [])
+        if not products:
+            continue
+        if sale.get("sale_id"):
+            counted.add(sale["sale_id"])
+        store_id = sale.get("store_id")
+        created_at = _as_utc(sale.get("created_at"))
+        weight = decay_weight(created_at)
+        for product_id, name in products.items():
+            entry = product_acc.setdefault((store_id, product_id), [0, 0.0, name, created_at])
+            entry[0] += 1
+            entry[1] += weight
+            entry[3] = max(entry[3], created_at)
+        for a, b in basket_pairs(products):
+            entry = pair_acc[(store_id, a, b)]
+            entry[0] += 1
+            entry[1] += weight
+        total = total_acc.setdefault(store_id, [0, 0.0, created_at])
+        total[0] += 1
+        total[1] += weight
+        total[2] = max(total[2], created_at)
+
+    # The lease keeps incremental updates out of the counters while they are replaced.
+    for collection in (db.basket_product_stats, db.basket_pair_stats, db.basket_totals):
+        await collection.delete_many({"user_id": owner_id})
+    if product_acc:
+        await db.basket_product_stats.insert_many([
+            {"user_id": owner_id, "store_id": store_id, "product_id": product_id,
+             "count": count, "weight": weight, "name": name, "last_seen_at": last_seen}
+            for (store_id, product_id), (count, weight, name, last_seen) in product_acc.items()
+        ], ordered=False)
+    if pair_acc:
+        await db.basket_pair_stats.insert_many([
+            {"user_id": owner_id, "store_id": store_id, "a": a, "b": b, "count": count, "weight": weight}
+            for (store_id, a, b), (count, weight) in pair_acc.items()
+        ], ordered=False)
+    if total_acc:
+        await db.basket_totals.insert_many([
+            {"user_id": owner_id, "store_id": store_id, "baskets": baskets, "weight": weight,
+             "last_basket_at": last_basket, "dirty": True, "rebuilt_at": now}
+            for store_id, (baskets, weight, last_basket) in total_acc.items()
+        ], ordered=False)
+
+    released = await db.basket_state.find_one_and_update(
+        {"user_id": owner_id, "lease_id": lease_id},
+        {"$set": {"status": STATE_READY, "rebuilt_at": now}, "$unset": {"pending": "", "lease_id": "", "lease_until": ""}},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if released is None:
+        logger.warning("Basket rebuild lease of %s expired before the rebuild finished", owner_id)
+    else:
+        await _replay_pending(db, owner_id, released.get("pending") or [], counted)
+    return {"baskets": sum(t[0] for t in total_acc.values()), "pairs": len(pair_acc)}
+
+
+def compute_associations(
+    product_rows: List[Dict[str, Any]],
+    pair_rows: List[Dict[str, Any]],
+    total_weight: float,
+    now_weight: float,
+    min_support: float = 3,
+    min_lift: float = DEFAULT_MIN_LIFT,
+    limit: int = INSIGHTS_MAX_PAIRS,
+) -> List[Dict[str, Any]]:
+    """Score all pairs at once.
+
+    ``min_support`` is expressed in (decayed) baskets, like the legacy endpoint.
+    """
+    if not pair_rows or total_weight <= 0:
+        return []
+
+    index = {row["_id"]: i for i, row in enumerate(product_rows)}
+    names = [row.get("name") or row["_id"] for row in product_rows]
+    freq = np.array([float(row.get("weight") or 0.0) for row in product_rows])
+
+    usable = [row for row in pair_rows if row["_id"]["a"] in index and row["_id"]["b"] in index]
+    if not usable:
+        return []
+    a_idx = np.fromiter((index[row["_id"]["a"]] for row in usable), dtype=np.int64, count=len(usable))
+    b_idx = np.fromiter((index[row["_id"]["b"]] for row in usable), dtype=np.int64, count=len(usable))
+    pair_w = np.fromiter((float(row.get("weight") or 0.0) for row in usable), dtype=np.float64, count=len(usable))
+    raw_count = np.fromiter((int(row.get("count") or 0) for row in usable), dtype=np.int64, count=len(usable))
+
+    freq_a = freq[a_idx]
+    freq_b = freq[b_idx]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        support = pair_w / total_weight
+        confidence_ab = np.where(freq_a > 0, pair_w / freq_a, 0.0)
+        confidence_ba = np.where(freq_b > 0, pair_w / freq_b, 0.0)
+        lift = np.where((freq_a > 0) & (freq_b > 0), pair_w * total_weight / (freq_a * freq_b), 0.0)
+    decayed_count = pair_w / now_weight if now_weight > 0 else pair_w
+
+    keep = np.nonzero((decayed_count >= min_support) & (lift >= min_lift))[0]
+    if keep.size == 0:
+        return []
+    order = keep[np.lexsort((-support[keep], -lift[keep]))][:limit]
+
+    return [
+        {
+            "product_a_id": product_rows[a_idx[i]]["_id"],
+            "product_a_name": names[a_idx[i]],
+            "product_b_id": product_rows[b_idx[i]]["_id"],
+            "product_b_name": names[b_idx[i]],
+            "co_occurrence": int(raw_count[i]),
+            "weighted_co_occurrence": round(float(decayed_count[i]), 2),
+            "lift": round(float(lift[i]), 2),
+            "support": round(float(support[i]) * 100, 2),
+            "confidence_a_to_b": round(float(confidence_ab[i]) * 100, 1),
+            "confidence_b_to_a": round(float(confidence_ba[i]) * 100, 1),
+        }
+        for i in order
+    ]
+
+
+def _scope_filter(owner_id: str, store_id: Optional[str]) -> Dict[str, Any]:
+    query: Dict[str, Any] = {"user_id": owner_id}
+    if store_id:
+        query["store_id"] = store_id
+    return query
+
+
+async def refresh_basket_insights(
+    db,
+    owner_id: str,
+    store_id: Optional[str] = None,
+    min_support: float = 3,
+    min_lift: float = DEFAULT_MIN_LIFT,
+) -> Dict[str, Any]:
+    query = _scope_filter(owner_id, store_id)
+    totals = await db.basket_totals.aggregate([
+        {"$match": query},
+        {"$group": {"_id": None, "baskets": {"$sum": "$baskets"}, "weight": {"$sum": "$weight"}}},
+    ]).to_list(1)
+    product_rows = await db.basket_product_stats.aggregate([
+        {"$match": query},
+        {"$group": {"_id": "$product_id", "weight": {"$sum": "$weight"}, "name": {"$last": "$name"}}},
+    ]).to_list(None)
+    pair_rows = await db.basket_pair_stats.aggregate([
+        {"$match": query},
+        {"$group": {"_id": {"a": "$a", "b": "$b"}, "weight": {"$sum": "$weight"}, "count": {"$sum": "$count"}}},
+    ]).to_list(None)
+
+    total_baskets = int(totals[0]["baskets"]) if totals else 0
+    total_weight = float(totals[0]["weight"]) if totals else 0.0
+    now = datetime.now(timezone.utc)
+    pairs = compute_associations(
+        product_rows,
+        pair_rows,
+        total_weight,
+        decay_weight(now),
+        min_support=min_support,
+        min_lift=min_lift,
+    )
+    insights = {
+        "user_id": owner_id,
+        "scope": store_id or ALL_STORES_SCOPE,
+        "pairs": pairs,
+        "total_baskets": total_baskets,
+        "half_life_days": BASKET_HALF_LIFE_DAYS,
+        "min_support": min_support,
+        "min_lift": min_lift,
+        "computed_at": now,
+    }
+    await db.basket_insights.update_one(
+        {"user_id": owner_id, "scope": insights["scope"]},
+        {"$set": insights},
+        upsert=True,
+    )
+    if not store_id:
+        await db.basket_totals.update_many(query, {"$set": {"dirty": False}})
+    return insights
+
+
+_rebuild_tasks: Dict[str, "asyncio.Task[None]"] = {}
+
+
+async def _rebuild_in_background(db, owner_id: str) -> None:
+    try:
+        stats = await rebuild_basket_stats(db, owner_id)
+    except Exception as exc:
+        logger.warning("Basket stats rebuild failed for %s: %s", owner_id, exc)
+        return
+    if stats is not None:
+        logger.info("Basket stats rebuilt for %s: %s", owner_id, stats)
+
+
+def start_rebuild(db, owner_id: str) -> "asyncio.Task[None]":
+    """Load the owner's sales history off the request path; one task per owner and process."""
+    task = _rebuild_tasks.get(owner_id)
+    if task is None or task.done():
+        task = asyncio.create_task(_rebuild_in_background(db, owner_id))
+        _rebuild_tasks[owner_id] = task
+        task.add_done_callback(lambda done: _rebuild_tasks.pop(owner_id) if _rebuild_tasks.get(owner_id) is done else None)
+    return task
+
+
+def pending_insights(owner_id: str, store_id: Optional[str], min_support: float) -> Dict[str, Any]:
+    """Empty result served while the owner's history is being loaded."""
+    return {
+        "user_id": owner_id,
+        "scope": store_id or ALL_STORES_SCOPE,
+        "pairs": [],
+        "total_baskets": 0,
+        "half_life_days": BASKET_HALF_LIFE_DAYS,
+        "min_support": min_support,
+        "min_lift": DEFAULT_MIN_LIFT,
+        "computed_at": None,
+        "pending": True,
+    }
+
+
+async def get_basket_insights(
+    db,
+    owner_id: str,
+    store_id: Optional[str] = None,
+    min_support: float = 3,
+) -> Dict[str, Any]:
+    """Serve precomputed insights; load the history in the background on first use, refresh when stale."""
+    scope = store_id or ALL_STORES_SCOPE
+    insights = await db.basket_insights.find_one({"user_id": owner_id, "scope": scope}, {"_id": 0})
+    if insights and insights.get("min_support") == min_support:
+        computed_at = _as_utc(insights.get("computed_at"))
+        if (datetime.now(timezone.utc) - computed_at).total_seconds() < INSIGHTS_MAX_AGE_S:
+            return insights
+
+    state = await db.basket_state.find_one({"user_id": owner_id}, {"_id": 0, "status": 1})
+    if not state or state.get("status") != STATE_READY:
+        start_rebuild(db, owner_id)
+        return pending_insights(owner_id, store_id, min_support)
+    insights = await refresh_basket_insights(db, owner_id, store_id, min_support=min_support)
+    insights.pop("_id", None)
+    return insights
+
+
+def pairs_for_product(insights: Dict[str, Any], product_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+    return [
+        pair for pair in insights.get("pairs") or []
+        if pair["product_a_id"] == product_id or pair["product_b_id"] == product_id
+    ][:limit]
+
+
+async def refresh_dirty_basket_insights(db, limit: int = 200) -> int:
+    """Background pass: recompute owner-wide insights touched by new sales."""
+    owner_ids = await db.basket_totals.distinct("user_id", {"dirty": True})
+    refreshed = 0
+    for owner_id in owner_ids[:limit]:
+        try:
+            await refresh_basket_insights(db, owner_id)
+            refreshed += 1
+        except Exception as exc:
+            logger.warning("Basket insights refresh failed for %s: %s", owner_id, exc)
+    return refreshed
+
+
+async def ensure_basket_indexes(db) -> None:
+    await db.basket_product_stats.create_index([("user_id", 1), ("store_id", 1), ("product_id", 1)], unique=True)
+    await db.basket_pair_stats.create_index([("user_id", 1), ("store_id", 1), ("a", 1), ("b", 1)], unique=True)
+    await db.basket_totals.create_index([("user_id", 1), ("store_id", 1)], unique=True)
+    await db.basket_totals.create_index("dirty")
+    await db.basket_insights.create_index([("user_id", 1), ("scope", 1)], unique=True)
+    await db.basket_state.create_index("user_id", unique=True)
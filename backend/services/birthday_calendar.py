@@ -0,0 +1,132 @@
+"""
+Customer birthday calendar.
+
+Birthdays are stored as typed (``"MM-DD"`` from the CRM, sometimes a full ISO
+date).  ``birthday_doy`` normalizes them to a day of year in a leap-year
+calendar (Feb 29 = 60, Mar 1 = 61 every year) and is written next to
+``birthday`` on every customer write.  With ``(user_id, birthday_doy)`` and
+``(birthday_doy, user_id)`` indexes, "birthdays in the next N days" is a range
+scan (two ranges when the window crosses Dec 31) and "birthdays today across
+all accounts" is a single indexed query.
+"""
+
+from __future__ import annotations
+
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+_CALENDAR_YEAR = 2000  # leap year: every (month, day) has a stable day of year
+BACKFILL_BATCH = 500
+
+
+def parse_birthday(value: Any) -> Optional[Tuple[int, int]]:
+    """(month, day) of a stored birthday, or None when it cannot be read."""
+    if isinstance(value, (datetime, date)):
+        return value.month, value.day
+    if not isinstance(value, str):
+        return None
+    text = value.strip()
+    try:
+        if len(text) == 5 and text[2] in "-/":
+            month, day = int(text[:2]), int(text[3:5])
+        else:
+            parsed = datetime.fromisoformat(text.replace("Z", "+00:00"))
+            month, day = parsed.month, parsed.day
+        date(_CALENDAR_YEAR, month, day)
+    except (ValueError, TypeError):
+        return None
+    return month, day
+
+
+def doy_for(month: int, day: int) -> int:
+    return date(_CALENDAR_YEAR, month, day).timetuple().tm_yday
+
+
+def birthday_doy(value: Any) -> Optional[int]:
+    parsed = parse_birthday(value)
+    return doy_for(*parsed) if parsed else None
+
+
+def birthday_fields(value: Any) -> Dict[str, Any]:
+    """Fields to write with a customer's ``birthday``."""
+    return {"birthday_doy": birthday_doy(value)}
+
+
+def _is_leap(year: int) -> bool:
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def _start_doy(day: date) -> int:
+    # Feb 29 birthdays are celebrated on Mar 1 in common years.
+    if day.month == 3 and day.day == 1 and not _is_leap(day.year):
+        return doy_for(2, 29)
+    return doy_for(day.month, day.day)
+
+
+def window_query(today: date, days: int) -> Dict[str, Any]:
+    """Query on ``birthday_doy`` for birthdays from ``today`` to ``today + days`` included."""
+    days = max(0, int(days))
+    if days >= 365:
+        return {"birthday_doy": {"$ne": None}}
+    start = _start_doy(today)
+    last = today + timedelta(days=days)
+    end = doy_for(last.month, last.day)
+    if start <= end:
+        return {"birthday_doy": {"$gte": start, "$lte": end}}
+    return {"$or": [{"birthday_doy": {"$gte": start}}, {"birthday_doy": {"$gte": 1, "$lte": end}}]}
+
+
+def days_until(doy: Optional[int], today: date) -> Optional[int]:
+    """Days from ``today`` to the next occurrence of a birthday day of year."""
+    if not doy:
+        return None
+    anchor = date(_CALENDAR_YEAR, 1, 1) + timedelta(days=int(doy) - 1)
+    for year in (today.year, today.year + 1):
+        try:
+            occurrence = date(year, anchor.month, anchor.day)
+        except ValueError:  # Feb 29 in a common year
+            occurrence = date(year, 3, 1)
+        if occurrence >= today:
+            return (occurrence - today).days
+    return None
+
+
+def days_until_birthday(value: Any, today: date) -> Optional[int]:
+    return days_until(birthday_doy(value), today)
+
+
+async def todays_birthdays(db, today: date, projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Customers of every account whose birthday is today (one indexed query)."""
+    query = window_query(today, 0)
+    fields = projection or {"_id": 0, "user_id": 1, "store_id": 1, "customer_id": 1, "name": 1}
+    return await db.customers.find(query, fields).to_list(None)
+
+
+async def backfill_birthday_doy(db) -> int:
+    """Normalize birthdays written before ``birthday_doy`` existed."""
+    cursor = db.customers.find(
+        {"birthday": {"$nin": [None, ""]}, "birthday_doy": {"$exists": False}},
+        {"_id": 1, "birthday": 1},
+    )
+    ops: List[UpdateOne] = []
+    written = 0
+    async for doc in cursor:
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": birthday_fields(doc.get("birthday"))}))
+        if len(ops) >= BACKFILL_BATCH:
+            await db.customers.bulk_write(ops, ordered=False)
+            written += len(ops)
+            ops = []
+    if ops:
+        await db.customers.bulk_write(ops, ordered=False)
+        written += len(ops)
+    return written
+
+
+async def ensure_birthday_indexes(db) -> None:
+    await db.customers.create_index([("user_id", 1), ("birthday_doy", 1)])
+    await db.customers.create_index([("birthday_doy", 1), ("user_id", 1)])
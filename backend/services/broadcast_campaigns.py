@@ -0,0 +1,194 @@
+"""
+Fan-out of broadcasts to large recipient populations.
+
+A broadcast is saved as a ``broadcast_campaigns`` record describing its
+segment (resolved to a query by the caller) and payload, and runs as a
+background job instead of inside the request that created it.  The runner
+claims a campaign with a lease, reads the segment one page at a time sorted
+on a unique key (``cursor`` holds the last key sent), splits each page into
+chunks and hands them to a small pool of senders.  After every page the
+cursor and the ``counters`` (recipients, sent, failed...) are written back
+with the lease renewed, so a campaign interrupted by a restart resumes from
+its last page once the lease expires.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 500
+CHUNK_SIZE = 100
+SENDERS = 4
+LEASE_DURATION = timedelta(minutes=5)
+
+ACTIVE_STATUSES = ["queued", "running"]
+
+WORKER_ID = uuid.uuid4().hex[:8]
+
+SendChunk = Callable[[List[Dict[str, Any]]], Awaitable[Dict[str, int]]]
+
+
+def new_campaign(
+    kind: str,
+    segment: Dict[str, Any],
+    payload: Dict[str, Any],
+    now: datetime,
+    campaign_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    return {
+        "campaign_id": campaign_id or f"bcast_{uuid.uuid4().hex[:12]}",
+        "kind": kind,
+        "segment": segment,
+        "payload": payload,
+        "status": "queued",
+        "cursor": None,
+        "counters": {},
+        "lease": None,
+        "lease_until": None,
+        "created_at": now,
+        "updated_at": now,
+        "started_at": None,
+        "completed_at": None,
+    }
+
+
+async def create_campaign(db, campaign: Dict[str, Any]) -> Dict[str, Any]:
+    """Save a campaign; saving the same campaign_id again is a no-op."""
+    await db.broadcast_campaigns.update_one(
+        {"campaign_id": campaign["campaign_id"]},
+        {"$setOnInsert": campaign},
+        upsert=True,
+    )
+    return campaign
+
+
+async def claim_campaign(db, now: datetime) -> Optional[Dict[str, Any]]:
+    """Lease the oldest queued campaign, or a running one whose worker stopped renewing its lease."""
+    campaign = await db.broadcast_campaigns.find_one_and_update(
+        {
+            "status": {"$in": ACTIVE_STATUSES},
+            "$or": [{"lease_until": None}, {"lease_until": {"$lte": now}}],
+        },
+        {"$set": {
+            "status": "running",
+            "lease": f"{WORKER_ID}:{uuid.uuid4().hex[:12]}",
+            "lease_until": now + LEASE_DURATION,
+            "updated_at": now,
+        }},
+        sort=[("created_at", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    if campaign and not campaign.get("started_at"):
+        campaign["started_at"] = now
+        await db.broadcast_campaigns.update_one({"campaign_id": campaign["campaign_id"]}, {"$set": {"started_at": now}})
+    return campaign
+
+
+async def record_progress(db, campaign: Dict[str, Any], cursor: Any, counts: Dict[str, int], now: datetime) -> bool:
+    """Persist the page just sent; False when the lease was lost to another worker."""
+    update: Dict[str, Any] = {"$set": {"cursor": cursor, "lease_until": now + LEASE_DURATION, "updated_at": now}}
+    if counts:
+        update["$inc"] = {f"counters.{name}": value for name, value in counts.items()}
+    result = await db.broadcast_campaigns.update_one(
+        {"campaign_id": campaign["campaign_id"], "lease": campaign["lease"]},
+        update,
+    )
+    return result.matched_count > 0
+
+
+async def finish_campaign(db, campaign: Dict[str, Any], now: datetime, status: str = "completed") -> None:
+    await db.broadcast_campaigns.update_one(
+        {"campaign_id": campaign["campaign_id"], "lease": campaign["lease"]},
+        {"$set": {"status": status, "completed_at": now, "updated_at": now, "lease": None, "lease_until": None}},
+    )
+
+
+async def send_page(
+    page: List[Dict[str, Any]],
+    send_chunk: SendChunk,
+    senders: int = SENDERS,
+    chunk_size: int = CHUNK_SIZE,
+) -> Dict[str, int]:
+    """Send one page through ``senders`` concurrent chunk senders and add up their counts."""
+    queue: asyncio.Queue = asyncio.Queue()
+    for start in range(0, len(page), chunk_size):
+        queue.put_nowait(page[start:start + chunk_size])
+    totals: Counter = Counter(recipients=len(page), chunks=queue.qsize())
+
+    async def sender() -> None:
+        while True:
+            try:
+                chunk = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                totals.update(await send_chunk(chunk) or {})
+            except Exception as exc:
+                logger.warning("Broadcast chunk of %s recipient(s) failed: %s", len(chunk), exc)
+                totals.update(failed=len(chunk), failed_chunks=1)
+
+    await asyncio.gather(*(sender() for _ in range(max(1, min(senders, queue.qsize())))))
+    return dict(totals)
+
+
+async def run_campaign(
+    db,
+    campaign: Dict[str, Any],
+    segment: Dict[str, Any],
+    send_chunk: SendChunk,
+    now_fn: Callable[[], datetime],
+    page_size: int = PAGE_SIZE,
+    senders: int = SENDERS,
+    chunk_size: int = CHUNK_SIZE,
+) -> Dict[str, Any]:
+    """
+    Send a claimed campaign from its cursor to the end of its segment.
+
+    ``segment`` gives the ``collection``, its ``query``, the unique ``key``
+    the pages are sorted on and the ``projection`` of the recipient docs.
+    Returns the final status and the counters accumulated by this run.
+    """
+    key = segment["key"]
+    cursor = campaign.get("cursor")
+    totals: Counter = Counter()
+    while True:
+        query = segment["query"]
+        if cursor is not None:
+            query = {"$and": [query, {key: {"$gt": cursor}}]}
+        page = await db[segment["collection"]].find(query, segment.get("projection")).sort(key, 1).limit(
+            page_size
+        ).to_list(page_size)
+        if not page:
+            break
+        counts = await send_page(page, send_chunk, senders=senders, chunk_size=chunk_size)
+        totals.update(counts)
+        cursor = page[-1][key]
+        if not await record_progress(db, campaign, cursor, counts, now_fn()):
+            logger.warning("Broadcast %s was taken over by another worker", campaign["campaign_id"])
+            return {"status": "lease_lost", "counters": dict(totals)}
+        if len(page) < page_size:
+            break
+    await finish_campaign(db, campaign, now_fn())
+    return {"status": "completed", "counters": dict(totals)}
+
+
+async def active_campaign(db, kind: str) -> Optional[Dict[str, Any]]:
+    return await db.broadcast_campaigns.find_one(
+        {"kind": kind, "status": {"$in": ACTIVE_STATUSES}}, {"_id": 0, "campaign_id": 1},
+    )
+
+
+async def ensure_broadcast_indexes(db) -> None:
+    await db.broadcast_campaigns.create_index("campaign_id", unique=True)
+    await db.broadcast_campaigns.create_index([("status", 1), ("created_at", 1)])
+    await db.broadcast_campaigns.create_index([("kind", 1), ("status", 1)])
@@ -0,0 +1,233 @@
+"""
+Unread counters, cursor pages and live events for supplier/shopkeeper chat.
+
+Each conversation keeps one unread counter per participant
+(``unread_shopkeeper`` / ``unread_supplier``) and each user has one
+``chat_inbox`` document whose ``unread`` is the sum of their counters, so the
+unread badge is a single field read.  ``record_message`` increments both for
+the recipient; ``mark_read`` swaps the reader's conversation counter to 0 and
+subtracts exactly what it cleared from the inbox.  ``rebuild_unread``
+recomputes the total from the conversation counters the first time a badge is
+read, when the total drops below zero, and after a change reached a user
+without an inbox (which leaves a ``stale`` stub).
+
+Each of these runs in one transaction (``domain_events.commit``): a message
+or a read committed while a rebuild runs makes one of the two inbox writes
+conflict and retry, so a rebuild neither drops a change nor counts it twice.
+
+New messages and counter changes are also published per user on ``broker``
+(an ``InProcessBroker`` from ``restaurant_stream``, swappable with
+``set_broker``), so open apps follow ``/conversations/stream`` instead of
+polling.
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+from services import domain_events
+from services.restaurant_stream import InProcessBroker
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+broker: Any = InProcessBroker()
+
+
+class InvalidChatCursor(ValueError):
+    pass
+
+
+def set_broker(new_broker: Any) -> None:
+    global broker
+    broker = new_broker
+
+
+def participant_field(conversation: Dict[str, Any], user_id: str) -> str:
+    """Unread counter of ``user_id`` in ``conversation``."""
+    return "unread_supplier" if conversation.get("supplier_id") == user_id else "unread_shopkeeper"
+
+
+def other_participant(conversation: Dict[str, Any], user_id: str) -> Optional[str]:
+    if conversation.get("supplier_id") == user_id:
+        return conversation.get("shopkeeper_id")
+    return conversation.get("supplier_id")
+
+
+async def _publish(user_id: Optional[str], event_type: str, **payload: Any) -> None:
+    if not user_id:
+        return
+    try:
+        await broker.publish(user_id, event_type, payload)
+    except Exception as exc:
+        logger.warning("Chat stream publish %s failed for user %s: %s", event_type, user_id, exc)
+
+
+async def rebuild_unread(db, user_id: str) -> int:
+    """Recompute the inbox total of ``user_id`` from the conversation counters."""
+    pipeline = [
+        {"$match": {"$or": [{"shopkeeper_id": user_id}, {"supplier_id": user_id}]}},
+        {"$group": {"_id": None, "total": {"$sum": {
+            "$cond": [{"$eq": ["$supplier_id", user_id]}, {"$ifNull": ["$unread_supplier", 0]}, {"$ifNull": ["$unread_shopkeeper", 0]}],
+        }}}},
+    ]
+
+    async def write(session):
+        result = await db.conversations.aggregate(pipeline, session=session).to_list(1)
+        total = int(result[0]["total"]) if result else 0
+        await db.chat_inbox.update_one(
+            {"user_id": user_id},
+            {"$set": {"unread": total, "updated_at": datetime.now(timezone.utc)}, "$unset": {"stale": ""}},
+            upsert=True,
+            session=session,
+        )
+        return total, []
+
+    return await domain_events.commit(db, write)
+
+
+async def unread_total(db, user_id: str) -> int:
+    inbox = await db.chat_inbox.find_one({"user_id": user_id}, {"_id": 0, "unread": 1, "stale": 1})
+    if inbox is None or inbox.get("stale") or int(inbox.get("unread") or 0) < 0:
+        return await rebuild_unread(db, user_id)
+    return int(inbox.get("unread") or 0)
+
+
+async def _add_to_inbox(db, user_id: str, delta: int, session=None) -> Dict[str, Any]:
+    # A missing inbox gets a stale stub: the write still conflicts with a running rebuild.
+    return await db.chat_inbox.find_one_and_update(
+        {"user_id": user_id},
+        {
+            "$inc": {"unread": delta},
+            "$set": {"updated_at": datetime.now(timezone.utc)},
+            "$setOnInsert": {"stale": True},
+        },
+        projection={"_id": 0, "unread": 1, "stale": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+
+
+async def _inbox_total(db, user_id: str, inbox: Dict[str, Any]) -> Optional[int]:
+    """Badge after an inbox update; None while the inbox waits for its first rebuild."""
+    if inbox.get("stale"):
+        return None
+    if int(inbox.get("unread") or 0) < 0:
+        return await rebuild_unread(db, user_id)
+    return int(inbox["unread"])
+
+
+async def record_message(db, conversation: Dict[str, Any], message: Dict[str, Any]) -> None:
+    """Count ``message`` as unread for the recipient and push it to both participants."""
+    sender_id = message["sender_id"]
+    recipient_id = other_participant(conversation, sender_id)
+    unread_field = participant_field(conversation, recipient_id) if recipient_id else None
+    update: Dict[str, Any] = {"$set": {
+        "last_message": message["content"][:100],
+        "last_message_at": message["created_at"],
+    }}
+    if unread_field:
+        update["$inc"] = {unread_field: 1}
+
+    async def write(session):
+        updated = await db.conversations.find_one_and_update(
+            {"conversation_id": conversation["conversation_id"]},
+            update,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        inbox = await _add_to_inbox(db, recipient_id, 1, session=session) if recipient_id else None
+        return (updated, inbox), []
+
+    updated, inbox = await domain_events.commit(db, write)
+    if not recipient_id:
+        return
+    total = await _inbox_total(db, recipient_id, inbox)
+    for user_id in (recipient_id, sender_id):
+        await _publish(user_id, "message", conversation_id=conversation["conversation_id"], message=message)
+    await _publish(
+        recipient_id, "unread",
+        conversation_id=conversation["conversation_id"],
+        conversation_unread=int((updated or {}).get(unread_field) or 0),
+        unread_total=total,
+    )
+
+
+async def mark_read(db, conversation: Dict[str, Any], user_id: str) -> int:
+    """Clear the unread counter of ``user_id`` in ``conversation``; returns how many were cleared."""
+    unread_field = participant_field(conversation, user_id)
+
+    async def write(session):
+        before = await db.conversations.find_one_and_update(
+            {"conversation_id": conversation["conversation_id"], unread_field: {"$gt": 0}},
+            {"$set": {unread_field: 0}},
+            projection={"_id": 0, unread_field: 1},
+            return_document=ReturnDocument.BEFORE,
+            session=session,
+        )
+        cleared = int((before or {}).get(unread_field) or 0)
+        inbox = await _add_to_inbox(db, user_id, -cleared, session=session) if cleared else None
+        return (cleared, inbox), []
+
+    cleared, inbox = await domain_events.commit(db, write)
+    if not cleared:
+        return 0
+    await db.chat_messages.update_many(
+        {"conversation_id": conversation["conversation_id"], "sender_id": {"$ne": user_id}, "read": False},
+        {"$set": {"read": True}},
+    )
+    total = await _inbox_total(db, user_id, inbox)
+    await _publish(user_id, "unread", conversation_id=conversation["conversation_id"], conversation_unread=0, unread_total=total)
+    return cleared
+
+
+def encode_cursor(message: Dict[str, Any]) -> str:
+    payload = [message["created_at"].isoformat(), message["message_id"]]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        at, message_id = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        return datetime.fromisoformat(at), str(message_id)
+    except Exception as exc:
+        raise InvalidChatCursor(str(exc)) from exc
+
+
+async def read_page(
+    db,
+    conversation_id: str,
+    limit: int = PAGE_SIZE,
+    before: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Messages newest first, strictly older than the cursor ``before``; returns the next cursor."""
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    query: Dict[str, Any] = {"conversation_id": conversation_id}
+    if before:
+        at, message_id = decode_cursor(before)
+        query["$or"] = [{"created_at": {"$lt": at}}, {"created_at": at, "message_id": {"$lt": message_id}}]
+    messages = await db.chat_messages.find(query, {"_id": 0}).sort(
+        [("created_at", -1), ("message_id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    return messages, encode_cursor(messages[-1]) if has_more else None
+
+
+async def ensure_chat_indexes(db) -> None:
+    await db.chat_messages.create_index([("conversation_id", 1), ("created_at", -1), ("message_id", -1)])
+    await db.conversations.create_index([("shopkeeper_id", 1), ("last_message_at", -1)])
+    await db.conversations.create_index([("supplier_id", 1), ("last_message_at", -1)])
+    await db.conversations.create_index("conversation_id")
+    await db.chat_inbox.create_index("user_id", unique=True)
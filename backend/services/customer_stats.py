@@ -0,0 +1,309 @@
+"""
+Per-customer purchase statistics kept on the customer document.
+
+``stats`` holds the raw counters (completed sales, open e-commerce orders,
+first / last dates) and the figures derived from them: visit count, lifetime
+spend, average basket, first / last purchase and the time-independent RFM
+scores.  Recency is scored at read time from ``stats.last_purchase_at``.
+
+Counters move with ``$inc`` from the sale, e-commerce order and conversion
+paths; cancellations recompute the customer from ``sales`` and
+``ecommerce_orders``.  ``rebuild_owner`` recomputes a whole account; the
+first CRM read of an account only starts it in the background
+(``ensure_customer_stats``) and the periodic job covers the rest, so the CRM
+screens read and sort customers on indexed fields instead of aggregating
+sales, and serve them without stats until the first build is done.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+REBUILD_MAX_AGE = timedelta(hours=24)
+REBUILD_BATCH = 50
+WRITE_BATCH = 500
+
+_COMPLETED_SALE = {"$or": [{"status": {"$exists": False}}, {"status": "completed"}]}
+_CLOSED_ORDER_STATUSES = ["cancelled", "rejected"]
+
+RAW_FIELDS = (
+    "sale_count", "sales_amount", "first_sale_at", "last_sale_at",
+    "ecommerce_order_count", "open_order_count", "open_order_amount", "first_order_at", "last_order_at",
+)
+
+# (minimum, score) from best to worst
+FREQUENCY_SCORES = ((30, 5), (15, 4), (5, 3), (2, 2), (1, 1))
+MONETARY_SCORES = ((500000, 5), (200000, 4), (50000, 3), (10000, 2), (0.01, 1))
+RECENCY_SCORES = ((7, 5), (30, 4), (60, 3), (90, 2))
+
+
+def _field(name: str) -> str:
+    return f"$stats.{name}"
+
+
+def _zero(name: str) -> Dict[str, Any]:
+    return {"$ifNull": [_field(name), 0]}
+
+
+def _score_expression(value: Dict[str, Any], thresholds) -> Dict[str, Any]:
+    return {"$switch": {
+        "branches": [{"case": {"$gte": [value, minimum]}, "then": score} for minimum, score in thresholds],
+        "default": 0,
+    }}
+
+
+def _derived_stage() -> Dict[str, Any]:
+    """Pipeline stage recomputing the derived figures from the raw counters."""
+    visits = {"$add": [_zero("sale_count"), _zero("open_order_count")]}
+    spend = {"$add": [_zero("sales_amount"), _zero("open_order_amount")]}
+    return {"$set": {
+        "stats.visit_count": visits,
+        "stats.lifetime_spend": {"$round": [spend, 2]},
+        "stats.average_basket": {"$cond": [{"$gt": [visits, 0]}, {"$round": [{"$divide": [spend, visits]}, 2]}, 0]},
+        "stats.first_purchase_at": {"$min": [_field("first_sale_at"), _field("first_order_at")]},
+        "stats.last_purchase_at": {"$max": [_field("last_sale_at"), _field("last_order_at")]},
+        "stats.rfm.frequency_score": _score_expression(visits, FREQUENCY_SCORES),
+        "stats.rfm.monetary_score": _score_expression(spend, MONETARY_SCORES),
+        "stats.updated_at": "$$NOW",
+    }}
+
+
+def _increment_pipeline(
+    inc: Dict[str, float],
+    first_at: Optional[Dict[str, datetime]] = None,
+    last_at: Optional[Dict[str, datetime]] = None,
+) -> List[Dict[str, Any]]:
+    changes: Dict[str, Any] = {f"stats.{name}": {"$add": [_zero(name), amount]} for name, amount in inc.items()}
+    for name, at in (first_at or {}).items():
+        changes[f"stats.{name}"] = {"$min": [_field(name), at]}
+    for name, at in (last_at or {}).items():
+        changes[f"stats.{name}"] = {"$max": [_field(name), at]}
+    return [{"$set": changes}, _derived_stage()]
+
+
+def _as_datetime(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str) and value:
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return None
+
+
+def recency_score(last_purchase_at: Any, now: datetime) -> int:
+    last = _as_datetime(last_purchase_at)
+    if not last:
+        return 0
+    days = (now - last).days
+    for maximum, score in RECENCY_SCORES:
+        if days <= maximum:
+            return score
+    return 1
+
+
+def rfm_scores(stats: Optional[Dict[str, Any]], now: datetime) -> Dict[str, int]:
+    stats = stats or {}
+    rfm = stats.get("rfm") or {}
+    return {
+        "recency": recency_score(stats.get("last_purchase_at"), now),
+        "frequency": int(rfm.get("frequency_score") or 0),
+        "monetary": int(rfm.get("monetary_score") or 0),
+    }
+
+
+async def _apply(db, owner_id: str, customer_id: Optional[str], pipeline: List[Dict[str, Any]]) -> None:
+    if not owner_id or not customer_id:
+        return
+    await db.customers.update_one({"user_id": owner_id, "customer_id": customer_id}, pipeline)
+
+
+async def record_sale(db, sale: Dict[str, Any]) -> None:
+    """Count a completed sale for its customer."""
+    sold_at = _as_datetime(sale.get("created_at")) or datetime.now(timezone.utc)
+    await _apply(db, sale.get("user_id"), sale.get("customer_id"), _increment_pipeline(
+        {"sale_count": 1, "sales_amount": float(sale.get("total_amount") or 0)},
+        first_at={"first_sale_at": sold_at},
+        last_at={"last_sale_at": sold_at},
+    ))
+
+
+async def record_ecommerce_order(db, order: Dict[str, Any]) -> None:
+    """Count a new, still open, e-commerce order for its customer."""
+    ordered_at = _as_datetime(order.get("created_at")) or datetime.now(timezone.utc)
+    await _apply(db, order.get("user_id"), order.get("customer_id"), _increment_pipeline(
+        {"ecommerce_order_count": 1, "open_order_count": 1, "open_order_amount": float(order.get("total_amount") or 0)},
+        first_at={"first_order_at": ordered_at},
+        last_at={"last_order_at": ordered_at},
+    ))
+
+
+async def record_order_converted(db, order: Dict[str, Any]) -> None:
+    """An open order became a sale: the sale itself is counted by ``record_sale``."""
+    await _apply(db, order.get("user_id"), order.get("customer_id"), _increment_pipeline(
+        {"open_order_count": -1, "open_order_amount": -float(order.get("total_amount") or 0)},
+    ))
+
+
+def _sales_pipeline(match: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {"$match": {**match, **_COMPLETED_SALE}},
+        {"$group": {
+            "_id": "$customer_id",
+            "sale_count": {"$sum": 1},
+            "sales_amount": {"$sum": {"$ifNull": ["$total_amount", 0]}},
+            "first_sale_at": {"$min": "$created_at"},
+            "last_sale_at": {"$max": "$created_at"},
+        }},
+    ]
+
+
+def _orders_pipeline(match: Dict[str, Any]) -> List[Dict[str, Any]]:
+    is_open = {"$in": [{"$ifNull": ["$sale_id", ""]}, [""]]}
+    return [
+        {"$match": {**match, "status": {"$nin": _CLOSED_ORDER_STATUSES}}},
+        {"$group": {
+            "_id": "$customer_id",
+            "ecommerce_order_count": {"$sum": 1},
+            "open_order_count": {"$sum": {"$cond": [is_open, 1, 0]}},
+            "open_order_amount": {"$sum": {"$cond": [is_open, {"$ifNull": ["$total_amount", 0]}, 0]}},
+            "first_order_at": {"$min": "$created_at"},
+            "last_order_at": {"$max": "$created_at"},
+        }},
+    ]
+
+
+def _raw_stats(sales_row: Optional[Dict[str, Any]], orders_row: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    merged = {**(sales_row or {}), **(orders_row or {})}
+    return {name: merged.get(name, 0 if not name.endswith("_at") else None) for name in RAW_FIELDS}
+
+
+def _replace_pipeline(raw: Dict[str, Any], marker: Optional[str] = None) -> List[Dict[str, Any]]:
+    values = {f"stats.{name}": {"$literal": value} for name, value in raw.items()}
+    if marker:
+        values["stats.rebuild_id"] = marker
+    return [{"$set": values}, _derived_stage()]
+
+
+async def refresh_customer(db, owner_id: Optional[str], customer_id: Optional[str]) -> None:
+    """Recompute one customer from raw history (after cancellations)."""
+    if not owner_id or not customer_id:
+        return
+    match = {"user_id": owner_id, "customer_id": customer_id}
+    sales = await db.sales.aggregate(_sales_pipeline(match)).to_list(1)
+    orders = await db.ecommerce_orders.aggregate(_orders_pipeline(match)).to_list(1)
+    raw = _raw_stats(sales[0] if sales else None, orders[0] if orders else None)
+    await _apply(db, owner_id, customer_id, _replace_pipeline(raw))
+
+
+async def rebuild_owner(db, owner_id: str) -> int:
+    """Recompute every customer of an account; customers without history get zeroed stats."""
+    match = {"user_id": owner_id, "customer_id": {"$nin": [None, ""]}}
+    sales_map = {row["_id"]: row async for row in db.sales.aggregate(_sales_pipeline(match))}
+    orders_map = {row["_id"]: row async for row in db.ecommerce_orders.aggregate(_orders_pipeline(match))}
+    marker = uuid.uuid4().hex
+
+    ops: List[UpdateOne] = []
+    for customer_id in set(sales_map) | set(orders_map):
+        raw = _raw_stats(sales_map.get(customer_id), orders_map.get(customer_id))
+        ops.append(UpdateOne({"user_id": owner_id, "customer_id": customer_id}, _replace_pipeline(raw, marker)))
+        if len(ops) >= WRITE_BATCH:
+            await db.customers.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.customers.bulk_write(ops, ordered=False)
+    await db.customers.update_many(
+        {"user_id": owner_id, "stats.rebuild_id": {"$ne": marker}},
+        _replace_pipeline(_raw_stats(None, None), marker),
+    )
+
+    await db.customer_stats_state.update_one(
+        {"user_id": owner_id},
+        {"$set": {"rebuilt_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+    return len(sales_map) + len(orders_map)
+
+
+_rebuild_tasks: Dict[str, "asyncio.Task[None]"] = {}
+
+
+async def _rebuild_in_background(db, owner_id: str) -> None:
+    try:
+        await rebuild_owner(db, owner_id)
+    except Exception as e:
+        logger.warning("Customer stats rebuild failed for %s: %s", owner_id, e)
+
+
+async def ensure_customer_stats(db, owner_id: str) -> bool:
+    """Whether the account has stats; if not, start its first build off the request path."""
+    state = await db.customer_stats_state.find_one({"user_id": owner_id}, {"_id": 1})
+    if state:
+        return True
+    task = _rebuild_tasks.get(owner_id)
+    if task is None or task.done():
+        task = asyncio.create_task(_rebuild_in_background(db, owner_id))
+        _rebuild_tasks[owner_id] = task
+        task.add_done_callback(lambda done: _rebuild_tasks.pop(owner_id) if _rebuild_tasks.get(owner_id) is done else None)
+    return False
+
+
+async def rebuild_stale_owners(db, max_age: timedelta = REBUILD_MAX_AGE, limit: int = REBUILD_BATCH) -> int:
+    """Background job: first build for new accounts, then periodic drift correction."""
+    cutoff = datetime.now(timezone.utc) - max_age
+    states = await db.customer_stats_state.find({}, {"_id": 0, "user_id": 1, "rebuilt_at": 1}).to_list(None)
+    fresh = {row["user_id"] for row in states if _as_datetime(row.get("rebuilt_at")) and _as_datetime(row["rebuilt_at"]) >= cutoff}
+    stale = sorted(
+        (row for row in states if row["user_id"] not in fresh),
+        key=lambda row: _as_datetime(row.get("rebuilt_at")) or datetime.min.replace(tzinfo=timezone.utc),
+    )
+    known = {row["user_id"] for row in states}
+    pending = [owner for owner in await db.customers.distinct("user_id") if owner and owner not in known]
+    owners: Iterable[str] = (pending + [row["user_id"] for row in stale])[:limit]
+    done = 0
+    for owner_id in owners:
+        try:
+            await rebuild_owner(db, owner_id)
+            done += 1
+        except Exception as e:
+            logger.warning("Customer stats rebuild failed for %s: %s", owner_id, e)
+    return done
+
+
+def segment_expression(now: datetime) -> Dict[str, Any]:
+    """Aggregation version of ``_classify_crm_segment`` over a customer document."""
+    visits = _zero("sale_count")
+    spent = {"$cond": [{"$gt": [{"$ifNull": ["$total_spent", 0]}, 0]}, "$total_spent", _zero("sales_amount")]}
+    last = _field("last_sale_at")
+    created_recently = {"$gte": [{"$ifNull": ["$created_at", datetime.min]}, now - timedelta(days=30)]}
+    has_last = {"$gt": [{"$ifNull": [last, None]}, None]}
+    return {"$switch": {
+        "branches": [
+            {"case": {"$eq": [visits, 0]}, "then": {"$cond": [created_recently, "new", "inactive"]}},
+            {"case": {"$and": [has_last, {"$lt": [last, now - timedelta(days=90)]}]}, "then": "inactive"},
+            {"case": {"$and": [has_last, {"$lt": [last, now - timedelta(days=30)]}]}, "then": "at_risk"},
+            {"case": {"$or": [{"$gte": [spent, 500000]}, {"$gte": [visits, 15]}]}, "then": "vip"},
+            {"case": {"$gte": [visits, 5]}, "then": "loyal"},
+            {"case": created_recently, "then": "new"},
+        ],
+        "default": "occasional",
+    }}
+
+
+async def ensure_customer_stats_indexes(db) -> None:
+    await db.customer_stats_state.create_index("user_id", unique=True)
+    await db.customers.create_index([("user_id", 1), ("stats.last_purchase_at", -1)])
+    await db.customers.create_index([("user_id", 1), ("stats.lifetime_spend", -1)])
+    await db.customers.create_index([("user_id", 1), ("stats.visit_count", -1)])
+    await db.sales.create_index([("user_id", 1), ("customer_id", 1), ("created_at", -1)])
+    await db.ecommerce_orders.create_index([("user_id", 1), ("customer_id", 1)])
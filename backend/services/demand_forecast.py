@@ -0,0 +1,474 @@
+"""
+Demand forecasting from daily per-product sales rollups.
+
+Completed sales are rolled up into ``product_daily_sales``
+(user_id, store_id, product_id, day) -> qty, revenue.  A store forecast loads
+the last ``HISTORY_DAYS`` of that rollup as a (products x days) matrix and
+computes, for every product at once:
+
+  - exponentially smoothed daily velocity,
+  - day-of-week seasonality factors (shrunk towards 1 when data is thin),
+  - 7/30-day velocities and trend, kept for continuity with the legacy rule,
+  - the projected stock-out date by walking the seasonal forecast forward.
+
+The demand side of a store (velocities, weekday seasonality, projected
+sales) is cached in memory as a model and rebuilt every
+``FORECAST_REFRESH_S`` seconds, with a single build per store however many
+requests miss at once.  Stock is not part of the model: each read overlays the
+live quantities (one projected query) to derive days of stock, risk and
+replenishment, so sales and stock writes never invalidate it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DAYS = 56  # 8 full weeks for weekday seasonality
+PROJECTION_DAYS = 60
+SMOOTHING_ALPHA = 0.3
+SEASONALITY_PRIOR_WEEKS = 4.0  # shrinkage strength of weekday factors
+FORECAST_REFRESH_S = 600
+NO_STOCKOUT_DAYS = 999.0
+
+_DAY_FORMAT = "%Y-%m-%d"
+
+
+def day_key(value: Optional[datetime]) -> str:
+    value = value or datetime.now(timezone.utc)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime(_DAY_FORMAT)
+
+
+# ---------------------------------------------------------------------------
+# Rollup maintenance
+# ---------------------------------------------------------------------------
+async def record_sale_rollup(db, sale: Dict[str, Any], sign: int = 1) -> None:
+    """Add (sign=1) or remove (sign=-1, cancellations) a sale from the daily rollup."""
+    owner_id = sale.get("user_id")
+    if not owner_id:
+        return
+    day = day_key(sale.get("created_at"))
+    per_product: Dict[str, List[float]] = {}
+    for item in sale.get("items") or []:
+        product_id = (item or {}).get("product_id")
+        if not product_id:
+            continue
+        entry = per_product.setdefault(product_id, [0.0, 0.0])
+        entry[0] += float(item.get("quantity") or 0)
+        entry[1] += float(item.get("total") or 0)
+    if not per_product:
+        return
+    await db.product_daily_sales.bulk_write([
+        UpdateOne(
+            {"user_id": owner_id, "store_id": sale.get("store_id"), "product_id": product_id, "day": day},
+            {"$inc": {"qty": sign * qty, "revenue": sign * revenue}},
+            upsert=True,
+        )
+        for product_id, (qty, revenue) in per_product.items()
+    ], ordered=False)
+
+
+async def backfill_daily_rollups(db, owner_id: str, store_id: Optional[str], days: int = HISTORY_DAYS) -> None:
+    """Rebuild the rollup window of a store from raw sales, server-side."""
+    start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    match: Dict[str, Any] = {
+        "user_id": owner_id,
+        "created_at": {"$gte": start},
+        "$or": [{"status": {"$exists": False}}, {"status": "completed"}],
+    }
+    if store_id:
+        match["store_id"] = store_id
+    await db.sales.aggregate([
+        {"$match": match},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {
+                "store_id": "$store_id",
+                "product_id": "$items.product_id",
+                "day": {"$dateToString": {"format": _DAY_FORMAT, "date": "$created_at"}},
+            },
+            "qty": {"$sum": "$items.quantity"},
+            "revenue": {"$sum": "$items.total"},
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": {"$literal": owner_id},
+            "store_id": "$_id.store_id",
+            "product_id": "$_id.product_id",
+            "day": "$_id.day",
+            "qty": 1,
+            "revenue": 1,
+        }},
+        {"$merge": {
+            "into": "product_daily_sales",
+            "on": ["user_id", "store_id", "product_id", "day"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert",
+        }},
+    ]).to_list(None)
+    await db.forecast_rollup_state.update_one(
+        {"user_id": owner_id, "store_id": store_id},
+        {"$set": {"backfilled_at": datetime.now(timezone.utc), "days": days}},
+        upsert=True,
+    )
+
+
+async def _ensure_rollups(db, owner_id: str, store_id: Optional[str]) -> None:
+    state = await db.forecast_rollup_state.find_one({"user_id": owner_id, "store_id": store_id}, {"_id": 1})
+    if not state:
+        await backfill_daily_rollups(db, owner_id, store_id)
+
+
+async def load_daily_matrix(
+    db,
+    owner_id: str,
+    store_id: Optional[str],
+    product_ids: List[str],
+    today: datetime,
+    days: int = HISTORY_DAYS,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (qty matrix [products x days], revenue per day [days]); column -1 is today."""
+    start = today - timedelta(days=days - 1)
+    day_index = {day_key(start + timedelta(days=i)): i for i in range(days)}
+    product_index = {product_id: i for i, product_id in enumerate(product_ids)}
+    qty = np.zeros((len(product_ids), days), dtype=np.float64)
+    revenue = np.zeros(days, dtype=np.float64)
+
+    query: Dict[str, Any] = {"user_id": owner_id, "day": {"$gte": day_key(start)}}
+    if store_id:
+        query["store_id"] = store_id
+    cursor = db.product_daily_sales.find(query, {"_id": 0, "product_id": 1, "day": 1, "qty": 1, "revenue": 1})
+    async for row in cursor:
+        col = day_index.get(row.get("day"))
+        if col is None:
+            continue
+        revenue[col] += float(row.get("revenue") or 0)
+        p = product_index.get(row.get("product_id"))
+        if p is not None:
+            qty[p, col] += float(row.get("qty") or 0)
+    return qty, revenue
+
+
+# ---------------------------------------------------------------------------
+# Vectorized model
+# ---------------------------------------------------------------------------
+def smoothed_velocity(qty: np.ndarray, alpha: float = SMOOTHING_ALPHA) -> np.ndarray:
+    """Exponentially weighted daily mean of every row (latest day weighs most)."""
+    days = qty.shape[1]
+    weights = alpha * (1 - alpha) ** np.arange(days - 1, -1, -1, dtype=np.float64)
+    return qty @ weights / weights.sum()
+
+
+def weekly_rolling_mean(qty: np.ndarray) -> np.ndarray:
+    """Trailing 7-day mean of every row; removes the weekday cycle before smoothing."""
+    cumulative = np.cumsum(np.pad(qty, ((0, 0), (1, 0))), axis=1)
+    window = np.minimum(np.arange(1, qty.shape[1] + 1), 7)
+    starts = np.arange(1, qty.shape[1] + 1) - window
+    return (cumulative[:, 1:] - cumulative[:, starts]) / window
+
+
+def weekday_factors(qty: np.ndarray, first_weekday: int, prior_weeks: float = SEASONALITY_PRIOR_WEEKS) -> np.ndarray:
+    """Per-product multiplicative weekday factors [products x 7], indexed by weekday (Mon=0)."""
+    days = qty.shape[1]
+    weekdays = (first_weekday + np.arange(days)) % 7
+    sums = np.zeros((qty.shape[0], 7), dtype=np.float64)
+    counts = np.bincount(weekdays, minlength=7).astype(np.float64)
+    for weekday in range(7):
+        sums[:, weekday] = qty[:, weekdays == weekday].sum(axis=1)
+    overall = qty.sum(axis=1, keepdims=True) / max(days, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        raw = np.where(overall > 0, (sums / np.maximum(counts, 1)) / overall, 1.0)
+    # Shrink towards 1 in proportion to how much volume supports the estimate.
+    volume = qty.sum(axis=1, keepdims=True)
+    confidence = volume / (volume + prior_weeks * 7)
+    factors = 1.0 + confidence * (raw - 1.0)
+    factors /= np.maximum(factors.mean(axis=1, keepdims=True), 1e-9)
+    return factors
+
+
+def demand_model(qty: np.ndarray, today: datetime, projection_days: int = PROJECTION_DAYS) -> Dict[str, np.ndarray]:
+    """Stock-independent part of the forecast: velocities, projected daily sales and trend."""
+    days = qty.shape[1]
+    first_weekday = (today - timedelta(days=days - 1)).weekday()
+
+    vel_7 = qty[:, -7:].sum(axis=1) / 7.0
+    vel_30 = qty[:, -30:].sum(axis=1) / 30.0
+    factors = weekday_factors(qty, first_weekday)
+    velocity = smoothed_velocity(weekly_rolling_mean(qty))
+
+    future_weekdays = (today.weekday() + 1 + np.arange(projection_days)) % 7
+    daily = velocity[:, None] * factors[:, future_weekdays]  # [products x projection_days]
+    cumulative = np.cumsum(daily, axis=1)
+
+    trend = np.full(qty.shape[0], "stable", dtype=object)
+    trend[(vel_30 > 0) & (vel_7 > vel_30 * 1.2)] = "up"
+    trend[(vel_30 > 0) & (vel_7 < vel_30 * 0.8)] = "down"
+
+    return {
+        "velocity": velocity,
+        "vel_7": vel_7,
+        "vel_30": vel_30,
+        "predicted_7d": cumulative[:, min(6, projection_days - 1)],
+        "predicted_30d": cumulative[:, min(29, projection_days - 1)],
+        "daily": daily,
+        "cumulative": cumulative,
+        "trend": trend,
+    }
+
+
+def stock_cover(model: Dict[str, np.ndarray], stock: np.ndarray) -> np.ndarray:
+    """Days until ``stock`` runs out under the projected daily sales of ``model``."""
+    velocity, daily, cumulative = model["velocity"], model["daily"], model["cumulative"]
+    stock = np.maximum(stock, 0.0)
+    crossed = cumulative >= stock[:, None]
+    has_crossing = crossed.any(axis=1) & (velocity > 0)
+    first_cross = np.argmax(crossed, axis=1)
+    # Interpolate inside the crossing day for a fractional days-of-stock figure.
+    before = np.where(first_cross > 0, cumulative[np.arange(len(stock)), np.maximum(first_cross - 1, 0)], 0.0)
+    on_day = daily[np.arange(len(stock)), first_cross]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(on_day > 0, (stock - before) / on_day, 0.0)
+        linear = np.where(velocity > 0, stock / velocity, NO_STOCKOUT_DAYS)
+    days_of_stock = np.where(has_crossing, first_cross + np.clip(fraction, 0.0, 1.0), linear)
+    return np.where(stock <= 0, 0.0, np.minimum(days_of_stock, NO_STOCKOUT_DAYS))
+
+
+def compute_forecasts(
+    qty: np.ndarray,
+    stock: np.ndarray,
+    today: datetime,
+    projection_days: int = PROJECTION_DAYS,
+) -> Dict[str, np.ndarray]:
+    model = demand_model(qty, today, projection_days)
+    return {**model, "days_of_stock": stock_cover(model, stock)}
+
+
+def risk_level(stock: float, velocity: float, days_of_stock: float) -> str:
+    if stock <= 0 and velocity > 0:
+        return "critical"
+    if days_of_stock < 7:
+        return "critical"
+    if days_of_stock < 14:
+        return "warning"
+    return "ok"
+
+
+def replenishment_candidates(rows: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Products to reorder: at/below min stock, or running out within lead time + 2 days."""
+    priority_order = {"critical": 0, "warning": 1, "info": 2}
+    candidates = []
+    for row in rows:
+        stock = row["current_stock"]
+        velocity = row["velocity"]
+        days_left = row["days_of_stock"] if velocity > 0 else None
+        if stock <= row["min_stock"]:
+            priority = "critical" if stock <= 0 else "warning"
+        elif days_left is not None and days_left <= row["lead_time_days"] + 2:
+            priority = "warning"
+        else:
+            continue
+        suggested = max(0.0, row["max_stock"] - stock)
+        if suggested <= 0:
+            continue
+        candidates.append({
+            "product_id": row["product_id"],
+            "product_name": row["name"] or "Produit inconnu",
+            "current_quantity": stock,
+            "min_stock": row["min_stock"],
+            "max_stock": row["max_stock"],
+            "daily_velocity": round(velocity, 2),
+            "days_until_stock_out": round(days_left, 1) if days_left is not None else None,
+            "suggested_quantity": suggested,
+            "priority": priority,
+        })
+    candidates.sort(key=lambda c: (
+        priority_order.get(c["priority"], 3),
+        c["days_until_stock_out"] if c["days_until_stock_out"] is not None else NO_STOCKOUT_DAYS,
+    ))
+    return candidates
+
+
+# ---------------------------------------------------------------------------
+# Store snapshots
+# ---------------------------------------------------------------------------
+_model_cache: Dict[str, Tuple[Dict[str, Any], float]] = {}
+_model_builds: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+
+FORECAST_PRODUCT_PROJECTION = {
+    "_id": 0,
+    "product_id": 1,
+    "name": 1,
+    "min_stock": 1,
+    "max_stock": 1,
+    "lead_time_days": 1,
+    "selling_price": 1,
+}
+
+
+def _snapshot_key(owner_id: str, store_id: Optional[str]) -> str:
+    return f"{owner_id}:{store_id or ''}"
+
+
+def _product_query(owner_id: str, store_id: Optional[str]) -> Dict[str, Any]:
+    query: Dict[str, Any] = {"user_id": owner_id, "is_active": {"$ne": False}}
+    if store_id:
+        query["store_id"] = store_id
+    return query
+
+
+async def build_store_model(db, owner_id: str, store_id: Optional[str]) -> Dict[str, Any]:
+    """Compute the demand model of a store and cache it for ``FORECAST_REFRESH_S`` seconds."""
+    key = _snapshot_key(owner_id, store_id)
+    build = asyncio.current_task()
+    await _ensure_rollups(db, owner_id, store_id)
+    products = await db.products.find(_product_query(owner_id, store_id), FORECAST_PRODUCT_PROJECTION).to_list(None)
+
+    now = datetime.now(timezone.utc)
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    product_ids = [p["product_id"] for p in products]
+    qty, revenue = await load_daily_matrix(db, owner_id, store_id, product_ids, today)
+    prices = np.array([float(p.get("selling_price") or 0) for p in products], dtype=np.float64)
+    arrays = demand_model(qty, today)
+
+    rows: Dict[str, Dict[str, Any]] = {}
+    for i, product in enumerate(products):
+        rows[product["product_id"]] = {
+            "product_id": product["product_id"],
+            "name": product.get("name") or "",
+            "min_stock": float(product.get("min_stock") or 0),
+            "max_stock": float(product.get("max_stock") if product.get("max_stock") is not None else 100),
+            "lead_time_days": int(product.get("lead_time_days") or 3),
+            "selling_price": float(prices[i]),
+            "velocity": float(arrays["velocity"][i]),
+            "velocity_7d": float(arrays["vel_7"][i]),
+            "velocity_30d": float(arrays["vel_30"][i]),
+            "predicted_sales_7d": float(arrays["predicted_7d"][i]),
+            "predicted_sales_30d": float(arrays["predicted_30d"][i]),
+            "trend": str(arrays["trend"][i]),
+        }
+    projected_revenue = (arrays["daily"] * prices[:, None]).sum(axis=0).tolist() if products else []
+
+    model = {
+        "owner_id": owner_id,
+        "store_id": store_id,
+        "product_ids": product_ids,
+        "products": rows,
+        "arrays": arrays,
+        "total_predicted_revenue_7d": float((arrays["predicted_7d"] * prices).sum()) if products else 0.0,
+        "total_predicted_revenue_30d": float((arrays["predicted_30d"] * prices).sum()) if products else 0.0,
+        "daily_revenue_history": [
+            {"date": day_key(today - timedelta(days=len(revenue) - 1 - i)), "revenue": float(value)}
+            for i, value in enumerate(revenue)
+        ],
+        "daily_revenue_projection": [
+            {"date": day_key(today + timedelta(days=i + 1)), "revenue": float(value)}
+            for i, value in enumerate(projected_revenue)
+        ],
+        "generated_at": now.isoformat(),
+        # Per-model annotations (the AI summary), kept until the model is rebuilt.
+        "shared": {},
+    }
+    # A catalog write during the build dropped this build: serve it, but do not cache it.
+    if build is None or _model_builds.get(key) is build:
+        _model_cache[key] = (model, time.monotonic() + FORECAST_REFRESH_S)
+    return model
+
+
+async def get_store_model(db, owner_id: str, store_id: Optional[str]) -> Dict[str, Any]:
+    key = _snapshot_key(owner_id, store_id)
+    entry = _model_cache.get(key)
+    if entry and time.monotonic() < entry[1]:
+        return entry[0]
+    build = _model_builds.get(key)
+    if build is None:
+        build = asyncio.ensure_future(build_store_model(db, owner_id, store_id))
+        _model_builds[key] = build
+        build.add_done_callback(lambda done: _model_builds.pop(key) if _model_builds.get(key) is done else None)
+    # Shielded: a cancelled request must not cancel the build other requests wait on.
+    return await asyncio.shield(build)
+
+
+def overlay_stock(model: Dict[str, Any], stock_by_product: Dict[str, float], now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Forecast of a store at the given stock levels; products missing from ``stock_by_product`` are left out."""
+    now = now or datetime.now(timezone.utc)
+    product_ids = model["product_ids"]
+    stock = np.array([float(stock_by_product.get(pid) or 0) for pid in product_ids], dtype=np.float64)
+    days_left = stock_cover(model["arrays"], stock) if product_ids else np.zeros(0)
+
+    rows: Dict[str, Dict[str, Any]] = {}
+    for i, product_id in enumerate(product_ids):
+        if product_id not in stock_by_product:
+            continue
+        row = model["products"][product_id]
+        days_of_stock = float(days_left[i])
+        stockout_date = None
+        if row["velocity"] > 0 and days_of_stock < NO_STOCKOUT_DAYS:
+            stockout_date = day_key(now + timedelta(days=days_of_stock))
+        rows[product_id] = {
+            **row,
+            "current_stock": float(stock[i]),
+            "days_of_stock": days_of_stock,
+            "stockout_date": stockout_date,
+            "risk_level": risk_level(float(stock[i]), row["velocity"], days_of_stock),
+        }
+
+    risk_order = {"critical": 0, "warning": 1, "ok": 2}
+    ranked = sorted(
+        (row for row in rows.values() if row["velocity_30d"] > 0 or row["velocity"] > 0 or row["current_stock"] > 0),
+        key=lambda row: (risk_order.get(row["risk_level"], 2), -row["velocity"]),
+    )
+    return {
+        "owner_id": model["owner_id"],
+        "store_id": model["store_id"],
+        "products": rows,
+        "ranked_product_ids": [row["product_id"] for row in ranked],
+        "replenishment": replenishment_candidates(rows.values()),
+        "total_predicted_revenue_7d": model["total_predicted_revenue_7d"],
+        "total_predicted_revenue_30d": model["total_predicted_revenue_30d"],
+        "daily_revenue_history": model["daily_revenue_history"],
+        "daily_revenue_projection": model["daily_revenue_projection"],
+        "generated_at": model["generated_at"],
+        "shared": model["shared"],
+    }
+
+
+async def get_store_forecast(db, owner_id: str, store_id: Optional[str]) -> Dict[str, Any]:
+    """Cached demand model of the store with its live stock levels."""
+    model = await get_store_model(db, owner_id, store_id)
+    stock_by_product = {
+        product["product_id"]: float(product.get("quantity") or 0)
+        async for product in db.products.find(
+            _product_query(owner_id, store_id), {"_id": 0, "product_id": 1, "quantity": 1},
+        )
+    }
+    return overlay_stock(model, stock_by_product)
+
+
+def invalidate_store_forecast(owner_id: str, store_id: Optional[str] = None) -> None:
+    """Drop a store model (or all of an owner's) along with the owner-wide one, after a catalog write."""
+    if store_id:
+        keys = [_snapshot_key(owner_id, store_id), _snapshot_key(owner_id, None)]
+    else:
+        prefix = f"{owner_id}:"
+        keys = [k for k in {*_model_cache, *_model_builds} if k.startswith(prefix)]
+    for key in keys:
+        _model_cache.pop(key, None)
+        _model_builds.pop(key, None)
+
+
+async def ensure_forecast_indexes(db) -> None:
+    await db.product_daily_sales.create_index(
+        [("user_id", 1), ("store_id", 1), ("product_id", 1), ("day", 1)], unique=True
+    )
+    await db.product_daily_sales.create_index([("user_id", 1), ("store_id", 1), ("day", 1)])
+    await db.forecast_rollup_state.create_index([("user_id", 1), ("store_id", 1)], unique=True)
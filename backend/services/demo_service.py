@@ -107,6 +107,31 @@ def build_demo_user_email(contact_email: Optional[str], demo_session_id: str) ->
     return f"demo+{safe_local}.{demo_session_id[-6:]}@stockman.pro"
 
 
+# Collections holding demo records (tagged is_demo / demo_session_id / demo_expires_at).
+DEMO_COLLECTIONS = [
+    "users",
+    "business_accounts",
+    "user_settings",
+    "stores",
+    "categories",
+    "products",
+    "customers",
+    "customer_payments",
+    "sales",
+    "customer_invoices",
+    "suppliers",
+    "supplier_products",
+    "orders",
+    "order_items",
+    "expenses",
+    "stock_movements",
+    "tables",
+    "reservations",
+    "alerts",
+    "activity_logs",
+]
+
+
 def _with_demo_metadata(payload: Dict[str, Any], demo_session_id: str, expires_at: datetime) -> Dict[str, Any]:
     enriched = dict(payload)
     enriched["is_demo"] = True
@@ -1116,30 +1141,8 @@ async def cleanup_demo_session(
     mark_missing: bool = False,
     force_delete_record: bool = False,
 ) -> Dict[str, int]:
-    collection_names = [
-        "users",
-        "business_accounts",
-        "user_settings",
-        "stores",
-        "categories",
-        "products",
-        "customers",
-        "customer_payments",
-        "sales",
-        "customer_invoices",
-        "suppliers",
-        "supplier_products",
-        "orders",
-        "order_items",
-        "expenses",
-        "stock_movements",
-        "tables",
-        "reservations",
-        "alerts",
-        "activity_logs",
-    ]
     deleted_counts: Dict[str, int] = {}
-    for collection_name in collection_names:
+    for collection_name in DEMO_COLLECTIONS:
         result = await db[collection_name].delete_many({"demo_session_id": demo_session_id})
         deleted_counts[collection_name] = result.deleted_count
 
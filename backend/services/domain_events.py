@@ -0,0 +1,202 @@
+"""
+Transactional outbox for the side effects of business writes.
+
+A write that must notify someone returns its domain events along with its
+result; ``commit`` saves them in ``domain_events`` in the same transaction
+as the business document, so the events exist if and only if the write
+committed.  The request then returns without waiting on push or email
+providers.  ``dispatch_due`` leases due events, runs the handler registered
+for each type with bounded concurrency and retries failures with
+exponential backoff; an event still failing after ``MAX_ATTEMPTS`` is kept
+as ``failed`` for inspection.  Each side effect is its own event, so a retry
+never repeats one that already succeeded.
+
+A transaction aborted with the ``TransientTransactionError`` label (write
+conflict, primary step-down) is run again after a jittered exponential
+backoff, for up to ``TRANSACTION_TIMEOUT_S`` seconds: writers contending on
+one counter (receipt numbers of an owner's terminals) spread out instead of
+conflicting again in lockstep.  On a standalone MongoDB without transactions, ``commit`` falls back to
+writing the document and then its events, as the bulk import does.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo.errors import ConfigurationError, OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+CONCURRENCY = 8
+LEASE_DURATION = timedelta(minutes=2)
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = timedelta(seconds=15)
+BACKOFF_MAX = timedelta(hours=1)
+DONE_KEEP_SECONDS = 7 * 24 * 3600
+TRANSACTION_TIMEOUT_S = 15.0
+TRANSACTION_BACKOFF_BASE_S = 0.01
+TRANSACTION_BACKOFF_MAX_S = 1.0
+
+# MongoDB answers IllegalOperation when transactions need a replica set.
+_NO_TRANSACTION_CODES = {20}
+
+WORKER_ID = uuid.uuid4().hex[:8]
+
+Write = Callable[[Any], Awaitable[Tuple[Any, List[Dict[str, Any]]]]]
+Handler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+_transactions_supported: Optional[bool] = None
+
+
+def new_event(event_type: str, payload: Dict[str, Any], aggregate_id: Optional[str] = None,
+              now: Optional[datetime] = None) -> Dict[str, Any]:
+    now = now or datetime.now(timezone.utc)
+    return {
+        "event_id": f"evt_{uuid.uuid4().hex[:16]}",
+        "type": event_type,
+        "aggregate_id": aggregate_id,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "created_at": now,
+        "next_attempt_at": now,
+        "lease": None,
+        "lease_until": None,
+    }
+
+
+def backoff_delay(attempts: int) -> timedelta:
+    return min(BACKOFF_BASE * (2 ** max(attempts - 1, 0)), BACKOFF_MAX)
+
+
+def transaction_backoff(attempts: int) -> float:
+    """Full-jitter delay in seconds before running an aborted transaction again."""
+    return random.uniform(0, min(TRANSACTION_BACKOFF_BASE_S * (2 ** attempts), TRANSACTION_BACKOFF_MAX_S))
+
+
+async def _start_session(db):
+    try:
+        return await db.client.start_session()
+    except (AttributeError, ConfigurationError, NotImplementedError) as exc:
+        logger.warning("Sessions unavailable, domain events are written after their document: %s", exc)
+        return None
+
+
+async def _run_transaction(db, session, write: Write) -> Any:
+    deadline = time.monotonic() + TRANSACTION_TIMEOUT_S
+    attempt = 1
+    while True:
+        try:
+            async with session.start_transaction():
+                result, events = await write(session)
+                if events:
+                    await db.domain_events.insert_many(events, session=session)
+            return result
+        except PyMongoError as exc:
+            if not exc.has_error_label("TransientTransactionError") or time.monotonic() >= deadline:
+                raise
+            logger.info("Transient transaction error on attempt %s, retrying: %s", attempt, exc)
+            await asyncio.sleep(transaction_backoff(attempt))
+            attempt += 1
+
+
+async def commit(db, write: Write) -> Any:
+    """
+    Run ``write(session)``, which returns ``(result, events)``, and save the
+    events in the same transaction; returns ``result``.
+    """
+    global _transactions_supported
+    if _transactions_supported is not False:
+        session = await _start_session(db)
+        if session is not None:
+            try:
+                async with session:
+                    result = await _run_transaction(db, session, write)
+                _transactions_supported = True
+                return result
+            except OperationFailure as exc:
+                if _transactions_supported or exc.code not in _NO_TRANSACTION_CODES:
+                    raise
+                logger.warning("Transactions unavailable, domain events are written after their document: %s", exc)
+        _transactions_supported = False
+    result, events = await write(None)
+    if events:
+        await db.domain_events.insert_many(events)
+    return result
+
+
+async def claim_due(db, now: datetime, limit: int = BATCH_SIZE) -> List[Dict[str, Any]]:
+    due = {
+        "status": "pending",
+        "next_attempt_at": {"$lte": now},
+        "$or": [{"lease_until": None}, {"lease_until": {"$lte": now}}],
+    }
+    candidates = await db.domain_events.find(due, {"_id": 0, "event_id": 1}).sort(
+        "next_attempt_at", 1
+    ).limit(limit).to_list(limit)
+    event_ids = [doc["event_id"] for doc in candidates]
+    if not event_ids:
+        return []
+    lease = f"{WORKER_ID}:{uuid.uuid4().hex[:12]}"
+    await db.domain_events.update_many(
+        {**due, "event_id": {"$in": event_ids}},
+        {"$set": {"lease": lease, "lease_until": now + LEASE_DURATION}},
+    )
+    return await db.domain_events.find({"event_id": {"$in": event_ids}, "lease": lease}, {"_id": 0}).to_list(limit)
+
+
+async def dispatch_due(
+    db,
+    handlers: Dict[str, Handler],
+    now: Optional[datetime] = None,
+    concurrency: int = CONCURRENCY,
+) -> Dict[str, int]:
+    """Run one leased batch of due events; returns counts of done, retry and failed."""
+    now = now or datetime.now(timezone.utc)
+    events = await claim_due(db, now)
+    counts: Counter = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(event: Dict[str, Any]) -> None:
+        attempts = int(event.get("attempts") or 0) + 1
+        fields: Dict[str, Any] = {"attempts": attempts, "lease": None, "lease_until": None}
+        handler = handlers.get(event["type"])
+        async with semaphore:
+            try:
+                if handler is None:
+                    raise LookupError(f"no handler for {event['type']}")
+                await handler(event.get("payload") or {})
+            except Exception as exc:
+                failed = handler is None or attempts >= MAX_ATTEMPTS
+                logger.warning("Domain event %s (%s) failed on attempt %s: %s", event["event_id"], event["type"], attempts, exc)
+                fields["last_error"] = str(exc)[:500]
+                if failed:
+                    fields.update({"status": "failed", "finished_at": now})
+                else:
+                    fields["next_attempt_at"] = now + backoff_delay(attempts)
+                counts["failed" if failed else "retry"] += 1
+            else:
+                fields.update({"status": "done", "finished_at": now})
+                counts["done"] += 1
+        await db.domain_events.update_one({"event_id": event["event_id"], "lease": event["lease"]}, {"$set": fields})
+
+    await asyncio.gather(*(run(event) for event in events))
+    return dict(counts)
+
+
+async def ensure_domain_event_indexes(db) -> None:
+    await db.domain_events.create_index("event_id", unique=True)
+    await db.domain_events.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.domain_events.create_index(
+        "finished_at",
+        expireAfterSeconds=DONE_KEEP_SECONDS,
+        partialFilterExpression={"status": "done"},
+    )
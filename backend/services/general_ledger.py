@@ -0,0 +1,303 @@
+"""
+General ledger (grand livre) engine.
+
+Each source (sales, expenses, stock losses, delivered supplier orders) is read
+through its own cursor sorted by ``(date, _id)``; ``iter_ledger`` merges the
+cursors lazily with a heap, so memory stays bounded by one batch per source
+whatever the length of the period.
+
+A page ends with a continuation token carrying the sort key of its last entry,
+the running balance and the period totals.  The next page re-opens every
+cursor strictly after that key, so a fiscal year can be browsed page by page
+and ``iter_csv`` can stream the whole ledger.
+"""
+
+from __future__ import annotations
+
+import base64
+import csv
+import heapq
+import io
+import json
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 2000
+CURSOR_BATCH = 500
+CSV_CHUNK_ROWS = 200
+
+PURCHASE_STATUSES = ["delivered", "received", "partially_received", "partial"]
+
+CSV_HEADER = ["Date", "Type", "Reference", "Description", "Mode paiement", "Entree", "Sortie", "Solde"]
+
+SortKey = Tuple[datetime, int, str]
+
+
+class InvalidLedgerToken(ValueError):
+    pass
+
+
+def _short_ref(prefix: str, value: Optional[str]) -> str:
+    return f"{prefix}-{value[-6:].upper()}" if value else f"{prefix}-???"
+
+
+def _sale_entry(doc: Dict[str, Any]) -> Dict[str, Any]:
+    items = doc.get("items") or []
+    description = ", ".join(f"{i.get('product_name', '?')} x{i.get('quantity', 0)}" for i in items[:3])
+    if len(items) > 3:
+        description += f" (+{len(items) - 3})"
+    return {
+        "type": "Vente",
+        "type_code": "sale",
+        "reference": _short_ref("VNT", doc.get("sale_id")),
+        "description": description or "Vente POS",
+        "payment_method": doc.get("payment_method", ""),
+        "amount_in": round(doc.get("total_amount", 0) or 0, 2),
+        "amount_out": 0,
+    }
+
+
+def _expense_entry(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "Dépense",
+        "type_code": "expense",
+        "reference": _short_ref("DEP", doc.get("expense_id")),
+        "description": f"{(doc.get('category') or '').capitalize()} — {doc.get('description') or ''}".strip(" —"),
+        "payment_method": "",
+        "amount_in": 0,
+        "amount_out": round(doc.get("amount", 0) or 0, 2),
+    }
+
+
+def _loss_entry(doc: Dict[str, Any]) -> Dict[str, Any]:
+    product = doc.get("product") or {}
+    qty = doc.get("quantity", 0) or 0
+    return {
+        "type": "Perte / Démarque",
+        "type_code": "loss",
+        "reference": _short_ref("MOV", doc.get("movement_id")),
+        "description": f"{product.get('name', '?')} x{qty} — {doc.get('reason', '?')}",
+        "payment_method": "",
+        "amount_in": 0,
+        "amount_out": round((product.get("purchase_price", 0) or 0) * qty, 2),
+    }
+
+
+def _purchase_entry(doc: Dict[str, Any]) -> Dict[str, Any]:
+    supplier = doc.get("supplier_name") or ((doc.get("notes") or "")[:30] or "Fournisseur")
+    return {
+        "type": "Achat Fournisseur",
+        "type_code": "purchase",
+        "reference": _short_ref("ACH", doc.get("order_id")),
+        "description": f"Commande — {supplier}",
+        "payment_method": "",
+        "amount_in": 0,
+        "amount_out": round(doc.get("total_amount", 0) or 0, 2),
+    }
+
+
+_PRODUCT_LOOKUP = [
+    {"$lookup": {"from": "products", "localField": "product_id", "foreignField": "product_id", "as": "product"}},
+    {"$addFields": {"product": {"$arrayElemAt": ["$product", 0]}}},
+    {"$project": {"movement_id": 1, "quantity": 1, "reason": 1, "type": 1, "source_type": 1, "created_at": 1,
+                  "product.name": 1, "product.purchase_price": 1}},
+]
+
+
+def build_sources(
+    owner_id: str,
+    store_filter: Dict[str, Any],
+    start: datetime,
+    end: datetime,
+    loss_query: Dict[str, Any],
+    is_loss: Callable[[Dict[str, Any]], bool],
+) -> List[Dict[str, Any]]:
+    """Ledger sources in tie-break order (entries at the same instant keep this order)."""
+    window = {"$gte": start, "$lte": end}
+    base = {"user_id": owner_id, **store_filter}
+    return [
+        {
+            "collection": "sales", "date_field": "created_at", "build": _sale_entry,
+            "query": {**base, "created_at": window},
+            "projection": {"sale_id": 1, "items.product_name": 1, "items.quantity": 1,
+                           "payment_method": 1, "total_amount": 1, "created_at": 1},
+            "amount": "$total_amount",
+        },
+        {
+            "collection": "expenses", "date_field": "created_at", "build": _expense_entry,
+            "query": {**base, "created_at": window},
+            "projection": {"expense_id": 1, "category": 1, "description": 1, "amount": 1, "created_at": 1},
+            "amount": "$amount",
+        },
+        {
+            "collection": "stock_movements", "date_field": "created_at", "build": _loss_entry,
+            "query": {**base, **loss_query, "created_at": window},
+            "pipeline": _PRODUCT_LOOKUP,
+            "keep": is_loss,
+            "amount": {"$multiply": [
+                {"$ifNull": ["$product.purchase_price", 0]}, {"$ifNull": ["$quantity", 0]},
+            ]},
+        },
+        {
+            # Supplier orders are owner-wide, as in the purchase figures of the accounting stats.
+            "collection": "orders", "date_field": "updated_at", "build": _purchase_entry,
+            "query": {"user_id": owner_id, "status": {"$in": PURCHASE_STATUSES}, "updated_at": window},
+            "projection": {"order_id": 1, "supplier_name": 1, "notes": 1, "total_amount": 1, "updated_at": 1},
+            "amount": "$total_amount",
+        },
+    ]
+
+
+def _after_clause(source: Dict[str, Any], rank: int, after: Optional[SortKey]) -> Dict[str, Any]:
+    """Query restricting a source to documents sorting strictly after ``after``."""
+    if after is None:
+        return {}
+    at, after_rank, after_id = after
+    field = source["date_field"]
+    if rank < after_rank:
+        return {field: {"$gt": at}}
+    if rank > after_rank:
+        return {field: {"$gte": at}}
+    oid: Any = ObjectId(after_id) if ObjectId.is_valid(after_id) else after_id
+    return {"$or": [{field: {"$gt": at}}, {field: at, "_id": {"$gt": oid}}]}
+
+
+def _open_cursor(db, source: Dict[str, Any], rank: int, after: Optional[SortKey]):
+    query = {"$and": [source["query"], _after_clause(source, rank, after)]}
+    sort = [(source["date_field"], 1), ("_id", 1)]
+    collection = db[source["collection"]]
+    if source.get("pipeline"):
+        pipeline = [{"$match": query}, {"$sort": dict(sort)}, *source["pipeline"]]
+        return collection.aggregate(pipeline, batchSize=CURSOR_BATCH)
+    return collection.find(query, source["projection"]).sort(sort).batch_size(CURSOR_BATCH)
+
+
+async def _next_entry(cursor, source: Dict[str, Any], rank: int) -> Optional[Tuple[SortKey, Dict[str, Any]]]:
+    keep = source.get("keep")
+    async for doc in cursor:
+        if keep and not keep(doc):
+            continue
+        at = doc.get(source["date_field"])
+        entry = source["build"](doc)
+        entry["date"] = at.isoformat() if hasattr(at, "isoformat") else str(at or "")
+        return (at, rank, str(doc["_id"])), entry
+    return None
+
+
+async def iter_ledger(
+    db, sources: List[Dict[str, Any]], after: Optional[SortKey] = None,
+) -> AsyncIterator[Tuple[SortKey, Dict[str, Any]]]:
+    """Chronological merge of every source, strictly after ``after``."""
+    cursors = [_open_cursor(db, source, rank, after) for rank, source in enumerate(sources)]
+    heap: List[Tuple[SortKey, Dict[str, Any]]] = []
+    try:
+        for rank, source in enumerate(sources):
+            head = await _next_entry(cursors[rank], source, rank)
+            if head:
+                heap.append(head)
+        heapq.heapify(heap)
+        while heap:
+            key, entry = heap[0]
+            rank = key[1]
+            nxt = await _next_entry(cursors[rank], sources[rank], rank)
+            if nxt:
+                heapq.heapreplace(heap, nxt)
+            else:
+                heapq.heappop(heap)
+            yield key, entry
+    finally:
+        for cursor in cursors:
+            try:
+                await cursor.close()
+            except Exception:
+                pass
+
+
+async def period_totals(db, sources: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Totals of the whole period, computed server-side once for the first page."""
+    total_in = total_out = 0.0
+    count = 0
+    for source in sources:
+        pipeline = [{"$match": source["query"]}, *(source.get("pipeline") or [])]
+        pipeline.append({"$group": {"_id": None, "amount": {"$sum": source["amount"]}, "count": {"$sum": 1}}})
+        rows = await db[source["collection"]].aggregate(pipeline).to_list(1)
+        if not rows:
+            continue
+        if source["collection"] == "sales":
+            total_in += float(rows[0].get("amount") or 0)
+        else:
+            total_out += float(rows[0].get("amount") or 0)
+        count += int(rows[0].get("count") or 0)
+    return {"total_in": round(total_in, 2), "total_out": round(total_out, 2), "count": count}
+
+
+def encode_token(state: Dict[str, Any]) -> str:
+    at, rank, doc_id = state["after"]
+    payload = {**state, "after": [at.isoformat(), rank, doc_id]}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_token(token: str) -> Dict[str, Any]:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        state = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        at, rank, doc_id = state["after"]
+        state["after"] = (datetime.fromisoformat(at), int(rank), str(doc_id))
+        state["balance"] = float(state["balance"])
+        return state
+    except Exception as exc:
+        raise InvalidLedgerToken(str(exc)) from exc
+
+
+async def read_page(
+    db,
+    sources: List[Dict[str, Any]],
+    limit: int,
+    after: Optional[SortKey] = None,
+    opening_balance: float = 0.0,
+) -> Tuple[List[Dict[str, Any]], Optional[SortKey], float, bool]:
+    """(entries, last key, closing balance, has_more) for one page."""
+    entries: List[Dict[str, Any]] = []
+    balance = opening_balance
+    last_key = after
+    has_more = False
+    stream = iter_ledger(db, sources, after)
+    try:
+        async for key, entry in stream:
+            if len(entries) >= limit:
+                has_more = True
+                break
+            balance += entry["amount_in"] - entry["amount_out"]
+            entry["balance"] = round(balance, 2)
+            entries.append(entry)
+            last_key = key
+    finally:
+        await stream.aclose()
+    return entries, last_key, balance, has_more
+
+
+async def iter_csv(db, sources: List[Dict[str, Any]]) -> AsyncIterator[str]:
+    """The full ledger as CSV text chunks, with the running balance."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    writer.writerow(CSV_HEADER)
+    balance = 0.0
+    rows = 0
+    async for _, entry in iter_ledger(db, sources):
+        balance += entry["amount_in"] - entry["amount_out"]
+        writer.writerow([
+            entry["date"], entry["type"], entry["reference"], entry["description"],
+            entry["payment_method"], entry["amount_in"], entry["amount_out"], round(balance, 2),
+        ])
+        rows += 1
+        if rows % CSV_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,285 @@
+"""
+Per-store inventory health summary.
+
+One small document per (owner, store) in ``inventory_summaries`` holds the
+figures the dashboard shows: product count, stock value at cost and retail,
+out-of-stock / low / critical / overstock counts and a short list of critical
+and overstocked product ids.
+
+Every product carries an ``inventory_class`` snapshot of how it is currently
+counted.  Stock-mutating code calls ``sync_products`` after its write; the new
+class is compared with the stored snapshot and only the difference is applied
+to the summary with ``$inc``.  ``reconcile_store`` recomputes a store from the
+product collection and is run on first access and periodically to absorb
+writes made outside the instrumented paths.
+"""
+
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TOP_PRODUCT_IDS = 20
+RECONCILE_MAX_AGE = timedelta(hours=6)
+RECONCILE_BATCH = 200
+_SYNC_RETRIES = 3
+
+# snapshot key -> summary counter
+COUNT_FIELDS = {
+    "active": "total_products",
+    "out": "out_of_stock_count",
+    "low": "low_stock_count",
+    "critical": "critical_count",
+    "over": "overstock_count",
+}
+VALUE_FIELDS = {
+    "stock_value": "total_stock_value",
+    "retail_value": "potential_revenue",
+}
+# summary list -> snapshot flag that keeps a product in it
+ID_LISTS = {
+    "critical_product_ids": "critical",
+    "overstock_product_ids": "over",
+}
+
+EMPTY_CLASS: Dict[str, Any] = {
+    "active": False, "out": False, "low": False, "critical": False, "over": False,
+    "stock_value": 0.0, "retail_value": 0.0,
+}
+
+
+def _num(value: Any) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def classify_product(product: Dict[str, Any]) -> Dict[str, Any]:
+    """How a product counts in its store summary. Keep in sync with ``_class_expression``."""
+    if product.get("is_active") is False:
+        return dict(EMPTY_CLASS)
+    qty = _num(product.get("quantity"))
+    min_stock = _num(product.get("min_stock"))
+    max_stock = _num(product.get("max_stock"))
+    below_min = min_stock > 0 and qty <= min_stock
+    return {
+        "active": True,
+        "out": qty <= 0,
+        "low": qty > 0 and below_min,
+        "critical": qty <= 0 or below_min,
+        "over": max_stock > 0 and qty >= max_stock,
+        "stock_value": qty * _num(product.get("purchase_price")),
+        "retail_value": qty * _num(product.get("selling_price")),
+    }
+
+
+def _class_expression() -> Dict[str, Any]:
+    """Aggregation equivalent of the snapshot ``sync_product`` stores."""
+    def num(field: str) -> Dict[str, Any]:
+        return {"$convert": {"input": f"${field}", "to": "double", "onError": 0.0, "onNull": 0.0}}
+
+    qty, min_stock, max_stock = num("quantity"), num("min_stock"), num("max_stock")
+    active = {"$ne": ["$is_active", False]}
+    below_min = {"$and": [{"$gt": [min_stock, 0]}, {"$lte": [qty, min_stock]}]}
+    return {
+        "active": active,
+        "out": {"$and": [active, {"$lte": [qty, 0]}]},
+        "low": {"$and": [active, {"$gt": [qty, 0]}, below_min]},
+        "critical": {"$and": [active, {"$or": [{"$lte": [qty, 0]}, below_min]}]},
+        "over": {"$and": [active, {"$gt": [max_stock, 0]}, {"$gte": [qty, max_stock]}]},
+        "stock_value": {"$cond": [active, {"$multiply": [qty, num("purchase_price")]}, 0.0]},
+        "retail_value": {"$cond": [active, {"$multiply": [qty, num("selling_price")]}, 0.0]},
+        "store_id": {"$ifNull": ["$store_id", None]},
+    }
+
+
+def summary_delta(old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]) -> Dict[str, float]:
+    """``$inc`` document moving a summary from ``old`` to ``new`` contribution."""
+    old = old or EMPTY_CLASS
+    new = new or EMPTY_CLASS
+    delta: Dict[str, float] = {}
+    for key, field in COUNT_FIELDS.items():
+        diff = int(bool(new.get(key))) - int(bool(old.get(key)))
+        if diff:
+            delta[field] = diff
+    for key, field in VALUE_FIELDS.items():
+        diff = _num(new.get(key)) - _num(old.get(key))
+        if diff:
+            delta[field] = diff
+    return delta
+
+
+def _summary_key(owner_id: str, store_id: Optional[str]) -> Dict[str, Any]:
+    return {"user_id": owner_id, "store_id": store_id}
+
+
+async def _apply_transition(
+    db, owner_id: str, store_id: Optional[str], product_id: str,
+    old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]],
+) -> None:
+    delta = summary_delta(old, new)
+    update: Dict[str, Any] = {"$set": {"updated_at": datetime.now(timezone.utc)}}
+    if delta:
+        update["$inc"] = delta
+    pulls = [name for name, flag in ID_LISTS.items() if (old or {}).get(flag) and not (new or {}).get(flag)]
+    if pulls:
+        update["$pull"] = {name: product_id for name in pulls}
+    if delta or pulls:
+        # Never upsert: a missing summary is rebuilt in full by reconcile_store.
+        await db.inventory_summaries.update_one(_summary_key(owner_id, store_id), update)
+
+    for name, flag in ID_LISTS.items():
+        if (new or {}).get(flag) and not (old or {}).get(flag):
+            # Capped list: only fill free slots, reconcile re-ranks it.
+            await db.inventory_summaries.update_one(
+                {**_summary_key(owner_id, store_id), f"{name}.{TOP_PRODUCT_IDS - 1}": {"$exists": False}},
+                {"$addToSet": {name: product_id}},
+            )
+
+
+async def sync_product(db, product_id: str) -> Optional[Dict[str, Any]]:
+    """Bring one product's summary contribution up to date.
+
+    Returns ``{"owner_id", "store_id", "product_id", "old", "new"}`` when the
+    product changed class, ``None`` otherwise.
+    """
+    for _ in range(_SYNC_RETRIES):
+        product = await db.products.find_one(
+            {"product_id": product_id},
+            {"_id": 0, "product_id": 1, "user_id": 1, "store_id": 1, "quantity": 1,
+             "min_stock": 1, "max_stock": 1, "purchase_price": 1, "selling_price": 1,
+             "is_active": 1, "inventory_class": 1},
+        )
+        if not product:
+            return None
+        old = product.get("inventory_class")
+        new = {**classify_product(product), "store_id": product.get("store_id")}
+        if old == new:
+            return None
+        # Compare-and-set on the snapshot so concurrent syncs never apply the same delta twice.
+        claimed = await db.products.update_one(
+            {"product_id": product_id, "inventory_class": old},
+            {"$set": {"inventory_class": new}},
+        )
+        if claimed.modified_count == 0:
+            continue
+        owner_id, store_id = product.get("user_id"), product.get("store_id")
+        old_store_id = (old or {}).get("store_id", store_id)
+        if old_store_id != store_id:
+            await _apply_transition(db, owner_id, old_store_id, product_id, old, None)
+            await _apply_transition(db, owner_id, store_id, product_id, None, new)
+        else:
+            await _apply_transition(db, owner_id, store_id, product_id, old, new)
+        return {"owner_id": owner_id, "store_id": store_id, "product_id": product_id, "old": old, "new": new}
+    logger.warning("Inventory summary sync gave up on %s after concurrent updates", product_id)
+    return None
+
+
+async def sync_products(db, product_ids: Iterable[str]) -> List[Dict[str, Any]]:
+    transitions = []
+    for product_id in dict.fromkeys(pid for pid in product_ids if pid):
+        transition = await sync_product(db, product_id)
+        if transition:
+            transitions.append(transition)
+    return transitions
+
+
+async def retire_product(db, product: Dict[str, Any]) -> None:
+    """Remove a product that is being deleted for good from its summary."""
+    old = product.get("inventory_class")
+    if not old:
+        return
+    store_id = old.get("store_id", product.get("store_id"))
+    await _apply_transition(db, product.get("user_id"), store_id, product.get("product_id"), old, None)
+
+
+async def reconcile_store(db, owner_id: str, store_id: Optional[str]) -> Dict[str, Any]:
+    """Recompute a store summary from its products and refresh every snapshot."""
+    scope = {"user_id": owner_id, "store_id": store_id}
+    await db.products.update_many(scope, [{"$set": {"inventory_class": _class_expression()}}])
+
+    group: Dict[str, Any] = {"_id": None}
+    for key, field in COUNT_FIELDS.items():
+        group[field] = {"$sum": {"$cond": [f"$inventory_class.{key}", 1, 0]}}
+    for key, field in VALUE_FIELDS.items():
+        group[field] = {"$sum": f"$inventory_class.{key}"}
+    rows = await db.products.aggregate([{"$match": scope}, {"$group": group}]).to_list(1)
+    totals = rows[0] if rows else {}
+
+    summary: Dict[str, Any] = {field: int(totals.get(field) or 0) for field in COUNT_FIELDS.values()}
+    summary.update({field: float(totals.get(field) or 0.0) for field in VALUE_FIELDS.values()})
+    for name, flag in ID_LISTS.items():
+        docs = await db.products.find(
+            {**scope, f"inventory_class.{flag}": True}, {"_id": 0, "product_id": 1}
+        ).sort("quantity", 1 if flag == "critical" else -1).limit(TOP_PRODUCT_IDS).to_list(TOP_PRODUCT_IDS)
+        summary[name] = [d["product_id"] for d in docs]
+
+    now = datetime.now(timezone.utc)
+    summary.update({"updated_at": now, "reconciled_at": now})
+    await db.inventory_summaries.update_one(
+        _summary_key(owner_id, store_id),
+        {"$set": summary, "$setOnInsert": {"created_at": now}},
+        upsert=True,
+    )
+    return {**_summary_key(owner_id, store_id), **summary}
+
+
+async def get_summary(db, owner_id: str, store_id: Optional[str]) -> Dict[str, Any]:
+    summary = await db.inventory_summaries.find_one(_summary_key(owner_id, store_id), {"_id": 0})
+    if summary is None:
+        summary = await reconcile_store(db, owner_id, store_id)
+    return summary
+
+
+def merge_summaries(summaries: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Add store summaries together; id lists interleave so each store's first products lead."""
+    summaries = list(summaries)
+    merged: Dict[str, Any] = {field: 0 for field in COUNT_FIELDS.values()}
+    merged.update({field: 0.0 for field in VALUE_FIELDS.values()})
+    for summary in summaries:
+        for field in COUNT_FIELDS.values():
+            merged[field] += int(summary.get(field) or 0)
+        for field in VALUE_FIELDS.values():
+            merged[field] += _num(summary.get(field))
+    for name in ID_LISTS:
+        lists = [summary.get(name) or [] for summary in summaries]
+        interleaved = [ids[i] for i in range(max(map(len, lists), default=0)) for ids in lists if i < len(ids)]
+        merged[name] = list(dict.fromkeys(interleaved))[:TOP_PRODUCT_IDS]
+    return merged
+
+
+async def get_owner_summary(db, owner_id: str, store_ids: Iterable[Optional[str]]) -> Dict[str, Any]:
+    """Summary of every store of the owner, products without a store included."""
+    summaries = [await get_summary(db, owner_id, store_id) for store_id in dict.fromkeys([*store_ids, None])]
+    return {**_summary_key(owner_id, None), **merge_summaries(summaries)}
+
+
+async def reconcile_owner(db, owner_id: str) -> None:
+    """Rebuild every existing summary of an owner (after bulk imports or deletes)."""
+    rows = await db.inventory_summaries.find({"user_id": owner_id}, {"_id": 0, "store_id": 1}).to_list(None)
+    for row in rows:
+        await reconcile_store(db, owner_id, row.get("store_id"))
+
+
+async def reconcile_stale_summaries(db, max_age: timedelta = RECONCILE_MAX_AGE, limit: int = RECONCILE_BATCH) -> int:
+    """Periodic drift correction for the oldest summaries."""
+    cutoff = datetime.now(timezone.utc) - max_age
+    stale = await db.inventory_summaries.find(
+        {"reconciled_at": {"$lt": cutoff}}, {"_id": 0, "user_id": 1, "store_id": 1}
+    ).sort("reconciled_at", 1).limit(limit).to_list(limit)
+    for row in stale:
+        try:
+            await reconcile_store(db, row["user_id"], row.get("store_id"))
+        except Exception as e:
+            logger.warning("Inventory summary reconcile failed for %s/%s: %s", row.get("user_id"), row.get("store_id"), e)
+    return len(stale)
+
+
+async def ensure_inventory_summary_indexes(db) -> None:
+    await db.inventory_summaries.create_index([("user_id", 1), ("store_id", 1)], unique=True)
+    await db.inventory_summaries.create_index("reconciled_at")
+    await db.products.create_index([("user_id", 1), ("store_id", 1), ("inventory_class.critical", 1), ("quantity", 1)])
@@ -1,5 +1,6 @@
 import logging
 from utils.i18n import i18n
+from services import retention
 from datetime import datetime, timezone
 import uuid
 
@@ -40,7 +41,8 @@ class MarketplaceAutomationService:
                 "module": "marketplace",
                 "action": "send_order",
                 "description": i18n.t("marketplace.order_sent_description", lang, order_id=order_id, count=len(items)),
-                "created_at": datetime.now(timezone.utc)
+                "created_at": datetime.now(timezone.utc),
+                "expires_at": retention.expires_at("activity_logs"),
             })
             
             logger.info(f"Marketplace order {order_id} sent for user {user_id}")
@@ -1,21 +1,87 @@
+"""
+Push and email delivery.
+
+Every request to Expo and Resend goes through one pooled ``httpx.AsyncClient``
+so connections and their TLS sessions are reused from message to message.
+
+User push notifications go through a durable outbox: ``notify_user`` writes a
+``notification_outbox`` document leased to this worker and hands it to an
+in-process queue.  Dispatcher workers drain the queue in bursts, read the push
+tokens of the whole burst with one query and send Expo-sized batches.
+Transport failures and rate-limit tickets are retried with exponential
+backoff; documents whose worker died are reclaimed by ``recover_outbox`` once
+their lease expires.  Delivery receipts are read after ``RECEIPT_DELAY`` and
+tokens Expo reports as ``DeviceNotRegistered`` are removed from users and
+installations.
+
+``EXPO_API_URL`` and ``RESEND_API_URL`` point the service at another host,
+such as ``mock_push_server.py`` for offline throughput runs.
+"""
+
+import asyncio
 import logging
 import os
-from typing import Any, Dict, List, Optional
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
 
 import httpx
+from pymongo import UpdateOne
 
 logger = logging.getLogger(__name__)
 
+EXPO_BATCH_SIZE = 100
+EXPO_RECEIPT_BATCH_SIZE = 1000
+RESEND_BATCH_SIZE = 100
+
+MAX_CONNECTIONS = 20
+DISPATCH_WORKERS = 2
+DISPATCH_LINGER_SECONDS = 0.05
+OUTBOX_LEASE = timedelta(minutes=5)
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = timedelta(seconds=30)
+BACKOFF_MAX = timedelta(hours=1)
+RECEIPT_DELAY = timedelta(minutes=15)
+MAX_RECEIPT_CHECKS = 3
+OUTBOX_KEEP_SECONDS = 7 * 24 * 3600
+
+DEAD_TOKEN_ERRORS = {"DeviceNotRegistered"}
+RETRYABLE_TICKET_ERRORS = {"MessageRateExceeded"}
+
+WORKER_ID = uuid.uuid4().hex[:8]
+
+
+class TransientDeliveryError(Exception):
+    """The provider could not take the request right now; it can be retried."""
+
 
 def is_expo_push_token(token: str) -> bool:
     value = str(token or "")
     return value.startswith("ExponentPushToken") or value.startswith("ExpoPushToken")
 
 
+def backoff_delay(attempts: int) -> timedelta:
+    """Wait before retrying after the ``attempts``-th failed attempt, doubling up to BACKOFF_MAX."""
+    return min(BACKOFF_BASE * (2 ** max(attempts - 1, 0)), BACKOFF_MAX)
+
+
+def _lease_token() -> str:
+    return f"{WORKER_ID}:{uuid.uuid4().hex[:12]}"
+
+
+def _tickets_from(raw_result: Any) -> List[Dict[str, Any]]:
+    ticket_data = raw_result.get("data") if isinstance(raw_result, dict) else None
+    return ticket_data if isinstance(ticket_data, list) else []
+
+
 class NotificationService:
-    def __init__(self):
-        self.expo_push_url = "https://exp.host/--/api/v2/push/send"
-        self.resend_url = "https://api.resend.com/emails"
+    def __init__(self, transport: Optional[httpx.AsyncBaseTransport] = None):
+        expo_api_url = os.environ.get("EXPO_API_URL", "https://exp.host/--/api/v2").rstrip("/")
+        resend_api_url = os.environ.get("RESEND_API_URL", "https://api.resend.com").rstrip("/")
+        self.expo_push_url = f"{expo_api_url}/push/send"
+        self.expo_receipts_url = f"{expo_api_url}/push/getReceipts"
+        self.resend_url = f"{resend_api_url}/emails"
+        self.resend_batch_url = f"{resend_api_url}/emails/batch"
         self.headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
@@ -28,6 +94,52 @@ class NotificationService:
         self.email_from = os.environ.get("RESEND_ALERTS_FROM_EMAIL", os.environ.get("RESEND_FROM_EMAIL", "Stockman <alertes@stockman.pro>"))
         self.communication_email_from = os.environ.get("RESEND_COMMUNICATION_FROM_EMAIL", os.environ.get("RESEND_FROM_EMAIL", "Stockman <contact@stockman.pro>"))
         self.support_email_from = os.environ.get("RESEND_SUPPORT_FROM_EMAIL", os.environ.get("RESEND_FROM_EMAIL", "Stockman Support <support@stockman.pro>"))
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._db = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The pooled client shared by every provider request."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                transport=self._transport,
+                timeout=10.0,
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+            )
+        return self._client
+
+    @property
+    def running(self) -> bool:
+        return any(not task.done() for task in self._workers)
+
+    async def start(self, db, workers: int = DISPATCH_WORKERS) -> None:
+        """Start the dispatcher workers draining the in-process queue."""
+        if self.running:
+            return
+        self._db = db
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._dispatch_worker()) for _ in range(workers)]
+
+    async def stop(self) -> None:
+        """Stop the workers and close the pooled client; queued documents are reclaimed from the outbox."""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post_expo(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        response = await self.client.post(self.expo_push_url, json=messages, headers=self.headers)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise TransientDeliveryError(f"Expo answered {response.status_code}")
+        response.raise_for_status()
+        return _tickets_from(response.json())
 
     async def send_push_notification(
         self,
@@ -88,49 +200,40 @@ class NotificationService:
             }
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.expo_push_url,
-                    json=messages,
-                    headers=self.headers,
-                    timeout=10.0,
-                )
-                response.raise_for_status()
-                raw_result = response.json()
-                ticket_data = raw_result.get("data") if isinstance(raw_result, dict) else None
-                tickets = ticket_data if isinstance(ticket_data, list) else []
-                errors: List[Dict[str, Any]] = []
-                ok_count = 0
-                reason = None
-                message = "Notification push envoyee."
-
-                for item in tickets:
-                    if item.get("status") == "ok":
-                        ok_count += 1
-                        continue
-
-                    logger.warning("Expo push ticket issue: %s", item)
-                    errors.append(item)
-                    details = item.get("details") or {}
-                    if details.get("error") == "InvalidCredentials":
-                        reason = "invalid_credentials"
-                        message = "Expo n'a pas pu envoyer la notification car la configuration FCM est invalide ou manquante."
-                    elif not reason:
-                        reason = "provider_error"
-                        message = item.get("message") or "Le fournisseur push a refuse la notification."
-
-                result = {
-                    "ok": ok_count > 0 and not errors,
-                    "reason": reason,
-                    "message": message,
-                    "attempted_tokens": len(expo_tokens),
-                    "valid_tokens": len(messages),
-                    "invalid_tokens": invalid_tokens,
-                    "tickets": tickets,
-                    "errors": errors,
-                }
-                logger.info("Push notification sent with result: %s", result)
-                return result
+            tickets = await self._post_expo(messages)
+            errors: List[Dict[str, Any]] = []
+            ok_count = 0
+            reason = None
+            message = "Notification push envoyee."
+
+            for item in tickets:
+                if item.get("status") == "ok":
+                    ok_count += 1
+                    continue
+
+                logger.warning("Expo push ticket issue: %s", item)
+                errors.append(item)
+                details = item.get("details") or {}
+                if details.get("error") == "InvalidCredentials":
+                    reason = "invalid_credentials"
+                    message = "Expo n'a pas pu envoyer la notification car la configuration FCM est invalide ou manquante."
+                elif not reason:
+                    reason = "provider_error"
+                    message = item.get("message") or "Le fournisseur push a refuse la notification."
+
+            result = {
+                "ok": ok_count > 0 and not errors,
+                "reason": reason,
+                "message": message,
+                "attempted_tokens": len(expo_tokens),
+                "valid_tokens": len(messages),
+                "sent": ok_count,
+                "invalid_tokens": invalid_tokens,
+                "tickets": tickets,
+                "errors": errors,
+            }
+            logger.info("Push notification sent with result: %s", result)
+            return result
         except Exception as exc:
             logger.error("Error sending push notification: %s", exc)
             return {
@@ -144,6 +247,35 @@ class NotificationService:
                 "errors": [],
             }
 
+    async def send_push_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Send prepared Expo messages (one token each) in chunks of
+        EXPO_BATCH_SIZE and return one ticket per message, in order.
+        """
+        tickets: List[Dict[str, Any]] = []
+        if not messages:
+            return tickets
+        for start in range(0, len(messages), EXPO_BATCH_SIZE):
+            chunk = messages[start:start + EXPO_BATCH_SIZE]
+            try:
+                chunk_tickets = await self._post_expo(chunk)
+            except Exception as exc:
+                logger.error("Error sending push batch: %s", exc)
+                chunk_tickets = []
+            chunk_tickets = chunk_tickets + [
+                {"status": "error", "message": "request_failed"}
+            ] * (len(chunk) - len(chunk_tickets))
+            tickets.extend(chunk_tickets[:len(chunk)])
+        return tickets
+
+    async def notify_users(self, db, notifications: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Queue several notifications (user_id, title, body, optional data and
+        caller_owner_id) in the outbox at once.
+        """
+        docs = await self.enqueue(db, notifications)
+        return {"queued": len(docs)}
+
     async def notify_user(
         self,
         db,
@@ -152,12 +284,31 @@ class NotificationService:
         body: str,
         data: Optional[Dict[str, Any]] = None,
         caller_owner_id: Optional[str] = None,
+        wait: bool = False,
     ) -> Dict[str, Any]:
         """
         Helper to notify a user by user_id.
         If caller_owner_id is provided, verify the target user belongs to the
         same tenant.
+        The notification is queued in the outbox unless ``wait`` is set, in
+        which case it is sent now and the provider result is returned.
         """
+        if not wait:
+            docs = await self.enqueue(db, [{
+                "user_id": user_id,
+                "title": title,
+                "body": body,
+                "data": data,
+                "caller_owner_id": caller_owner_id,
+            }])
+            return {
+                "ok": bool(docs),
+                "reason": "queued" if docs else "user_not_found",
+                "message": "Notification mise en file d'envoi." if docs else "Utilisateur introuvable.",
+                "user_id": user_id,
+                "outbox_id": docs[0]["outbox_id"] if docs else None,
+            }
+
         user_doc = await db.users.find_one({"user_id": user_id}, {"push_tokens": 1, "parent_user_id": 1})
         if not user_doc:
             return {
@@ -195,6 +346,291 @@ class NotificationService:
         result["user_id"] = user_id
         return result
 
+    async def enqueue(self, db, notifications: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Persist notifications in the outbox, leased to this worker, and hand
+        them to the dispatcher; without running workers they are sent inline.
+        """
+        now = datetime.now(timezone.utc)
+        lease = _lease_token()
+        docs = [
+            {
+                "outbox_id": f"ntf_{uuid.uuid4().hex[:12]}",
+                "channel": "push",
+                "user_id": item["user_id"],
+                "title": item["title"],
+                "body": item["body"],
+                "data": item.get("data") or None,
+                "caller_owner_id": item.get("caller_owner_id"),
+                "status": "pending",
+                "attempts": 0,
+                "created_at": now,
+                "next_attempt_at": now,
+                "lease": lease,
+                "lease_until": now + OUTBOX_LEASE,
+            }
+            for item in notifications
+            if item.get("user_id")
+        ]
+        if not docs:
+            return []
+        await db.notification_outbox.insert_many(docs)
+        if self.running:
+            for doc in docs:
+                self._queue.put_nowait(doc)
+        else:
+            await self.dispatch(db, docs, now)
+        return docs
+
+    async def _dispatch_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # Linger briefly so a burst of notify_user calls shares Expo requests.
+            deadline = loop.time() + DISPATCH_LINGER_SECONDS
+            while len(batch) < EXPO_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.dispatch(self._db, batch)
+            except Exception as exc:
+                # The documents keep their lease and recover_outbox retries them.
+                logger.error("Push dispatch failed for %s notification(s): %s", len(batch), exc)
+
+    async def dispatch(self, db, docs: List[Dict[str, Any]], now: Optional[datetime] = None) -> Dict[str, int]:
+        """Send a burst of leased outbox documents and record each outcome; returns counts per outcome."""
+        now = now or datetime.now(timezone.utc)
+        users = {
+            user_doc["user_id"]: user_doc
+            async for user_doc in db.users.find(
+                {"user_id": {"$in": list({doc["user_id"] for doc in docs})}},
+                {"_id": 0, "user_id": 1, "push_tokens": 1, "parent_user_id": 1},
+            )
+        }
+
+        outcomes: Dict[str, Dict[str, Any]] = {}
+        messages: List[Dict[str, Any]] = []
+        recipients: List[tuple] = []
+        for doc in docs:
+            outcome = outcomes[doc["outbox_id"]] = {"tickets": [], "retry": [], "dead": [], "errors": [], "reason": None}
+            user_id = doc["user_id"]
+            user_doc = users.get(user_id)
+            if not user_doc:
+                outcome["reason"] = "user_not_found"
+                continue
+            caller_owner_id = doc.get("caller_owner_id")
+            if caller_owner_id and user_id != caller_owner_id and (user_doc.get("parent_user_id") or user_id) != caller_owner_id:
+                logger.warning("Cross-tenant notification blocked: caller=%s target=%s", caller_owner_id, user_id)
+                outcome["reason"] = "cross_tenant_blocked"
+                continue
+            tokens = doc.get("pending_tokens") or user_doc.get("push_tokens") or []
+            tokens = [token for token in dict.fromkeys(str(t or "").strip() for t in tokens) if is_expo_push_token(token)]
+            if not tokens:
+                outcome["reason"] = "no_tokens_registered"
+                continue
+            for token in tokens:
+                msg: Dict[str, Any] = {"to": token, "title": doc["title"], "body": doc["body"], "sound": "default"}
+                if doc.get("data"):
+                    msg["data"] = doc["data"]
+                messages.append(msg)
+                recipients.append((doc["outbox_id"], token))
+
+        for start in range(0, len(messages), EXPO_BATCH_SIZE):
+            chunk_recipients = recipients[start:start + EXPO_BATCH_SIZE]
+            try:
+                tickets = await self._post_expo(messages[start:start + EXPO_BATCH_SIZE])
+            except httpx.HTTPStatusError as exc:
+                logger.error("Expo rejected a push batch: %s", exc)
+                tickets = [{"status": "error", "message": str(exc)}] * len(chunk_recipients)
+            except Exception as exc:
+                logger.warning("Push batch of %s message(s) will be retried: %s", len(chunk_recipients), exc)
+                for outbox_id, token in chunk_recipients:
+                    outcomes[outbox_id]["retry"].append(token)
+                continue
+            for index, (outbox_id, token) in enumerate(chunk_recipients):
+                outcome = outcomes[outbox_id]
+                ticket = tickets[index] if index < len(tickets) else {"status": "error", "message": "missing_ticket"}
+                error = (ticket.get("details") or {}).get("error")
+                if ticket.get("status") == "ok":
+                    outcome["tickets"].append({"id": ticket.get("id"), "token": token})
+                elif error in DEAD_TOKEN_ERRORS:
+                    outcome["dead"].append(token)
+                elif error in RETRYABLE_TICKET_ERRORS:
+                    outcome["retry"].append(token)
+                else:
+                    outcome["errors"].append(ticket)
+
+        counts = {"sent": 0, "retry": 0, "failed": 0, "skipped": 0}
+        operations = []
+        dead_tokens: List[str] = []
+        for doc in docs:
+            outcome = outcomes[doc["outbox_id"]]
+            dead_tokens.extend(outcome["dead"])
+            attempts = int(doc.get("attempts") or 0) + 1
+            fields: Dict[str, Any] = {"attempts": attempts, "last_attempt_at": now, "lease": None, "lease_until": None}
+            if outcome["errors"]:
+                fields["errors"] = outcome["errors"][:5]
+            if outcome["retry"] and attempts < MAX_ATTEMPTS:
+                status = "retry"
+                fields.update({
+                    "status": "pending",
+                    "pending_tokens": outcome["retry"],
+                    "next_attempt_at": now + backoff_delay(attempts),
+                })
+            else:
+                if outcome["tickets"] or doc.get("tickets"):
+                    status = "sent"
+                    fields["receipts_due_at"] = now + RECEIPT_DELAY
+                elif outcome["retry"] or outcome["errors"] or outcome["dead"]:
+                    status = "failed"
+                else:
+                    status = "skipped"
+                fields.update({"status": status, "reason": outcome["reason"], "finished_at": now})
+            counts[status] += 1
+            update: Dict[str, Any] = {"$set": fields}
+            if outcome["tickets"]:
+                update["$push"] = {"tickets": {"$each": outcome["tickets"]}}
+            operations.append(UpdateOne({"outbox_id": doc["outbox_id"], "lease": doc.get("lease")}, update))
+        if operations:
+            await db.notification_outbox.bulk_write(operations, ordered=False)
+        await self.prune_tokens(db, dead_tokens)
+        return counts
+
+    async def recover_outbox(self, db, now: Optional[datetime] = None, max_batches: int = 20) -> int:
+        """Dispatch outbox documents due for a retry or whose worker lease expired; returns how many."""
+        handled = 0
+        for _ in range(max_batches):
+            current = now or datetime.now(timezone.utc)
+            due = {
+                "status": "pending",
+                "next_attempt_at": {"$lte": current},
+                "$or": [{"lease_until": None}, {"lease_until": {"$lte": current}}],
+            }
+            candidates = await db.notification_outbox.find(due, {"_id": 0, "outbox_id": 1}).sort(
+                "next_attempt_at", 1
+            ).limit(EXPO_BATCH_SIZE).to_list(EXPO_BATCH_SIZE)
+            outbox_ids = [doc["outbox_id"] for doc in candidates]
+            if not outbox_ids:
+                break
+            lease = _lease_token()
+            await db.notification_outbox.update_many(
+                {**due, "outbox_id": {"$in": outbox_ids}},
+                {"$set": {"lease": lease, "lease_until": current + OUTBOX_LEASE}},
+            )
+            docs = await db.notification_outbox.find(
+                {"outbox_id": {"$in": outbox_ids}, "lease": lease}, {"_id": 0},
+            ).to_list(EXPO_BATCH_SIZE)
+            if docs:
+                await self.dispatch(db, docs, current)
+                handled += len(docs)
+            if len(outbox_ids) < EXPO_BATCH_SIZE:
+                break
+        return handled
+
+    async def process_receipts(self, db, now: Optional[datetime] = None) -> int:
+        """Read Expo receipts of sent notifications and prune tokens reported dead; returns receipts read."""
+        now = now or datetime.now(timezone.utc)
+        docs = await db.notification_outbox.find(
+            {"status": "sent", "receipts_due_at": {"$lte": now}},
+            {"_id": 0, "outbox_id": 1, "tickets": 1, "receipt_checks": 1},
+        ).sort("receipts_due_at", 1).limit(EXPO_RECEIPT_BATCH_SIZE).to_list(EXPO_RECEIPT_BATCH_SIZE)
+        ticket_tokens = {
+            ticket["id"]: ticket.get("token")
+            for doc in docs
+            for ticket in doc.get("tickets") or []
+            if ticket.get("id")
+        }
+        ticket_ids = list(ticket_tokens)
+        receipts: Dict[str, Dict[str, Any]] = {}
+        for start in range(0, len(ticket_ids), EXPO_RECEIPT_BATCH_SIZE):
+            response = await self.client.post(
+                self.expo_receipts_url,
+                json={"ids": ticket_ids[start:start + EXPO_RECEIPT_BATCH_SIZE]},
+                headers=self.headers,
+            )
+            response.raise_for_status()
+            data = (response.json() or {}).get("data")
+            if isinstance(data, dict):
+                receipts.update(data)
+
+        dead_tokens = [
+            ticket_tokens[ticket_id]
+            for ticket_id, receipt in receipts.items()
+            if ticket_id in ticket_tokens
+            and receipt.get("status") == "error"
+            and (receipt.get("details") or {}).get("error") in DEAD_TOKEN_ERRORS
+        ]
+        operations = []
+        for doc in docs:
+            tickets = [ticket for ticket in doc.get("tickets") or [] if ticket.get("id")]
+            checks = int(doc.get("receipt_checks") or 0) + 1
+            if any(ticket["id"] not in receipts for ticket in tickets) and checks < MAX_RECEIPT_CHECKS:
+                update = {"$set": {"receipts_due_at": now + RECEIPT_DELAY, "receipt_checks": checks}}
+            else:
+                errors = [receipts[t["id"]] for t in tickets if (receipts.get(t["id"]) or {}).get("status") == "error"]
+                update = {"$set": {
+                    "status": "failed" if tickets and len(errors) == len(tickets) else "delivered",
+                    "receipt_errors": errors[:5],
+                    "receipt_checks": checks,
+                    "receipts_checked_at": now,
+                }}
+            operations.append(UpdateOne({"outbox_id": doc["outbox_id"]}, update))
+        if operations:
+            await db.notification_outbox.bulk_write(operations, ordered=False)
+        await self.prune_tokens(db, dead_tokens)
+        return len(receipts)
+
+    async def prune_tokens(self, db, tokens: Iterable[str]) -> None:
+        """Forget push tokens Expo no longer accepts."""
+        tokens = list(dict.fromkeys(token for token in tokens if token))
+        if not tokens:
+            return
+        await db.users.update_many({"push_tokens": {"$in": tokens}}, {"$pull": {"push_tokens": {"$in": tokens}}})
+        await db.push_installations.update_many({"expo_push_token": {"$in": tokens}}, {"$set": {"is_active": False}})
+        logger.info("Pruned %s unregistered push token(s)", len(tokens))
+
+    async def send_email_batch(self, emails: List[Dict[str, Any]]) -> int:
+        """
+        Send several emails (to, subject, html, optional text) through the
+        Resend batch endpoint; returns how many were accepted.
+        """
+        if not emails:
+            return 0
+        if not self.resend_api_key:
+            logger.warning("RESEND_API_KEY not set - skipping %s email notification(s)", len(emails))
+            return 0
+        payloads = []
+        for email in emails:
+            payload: Dict[str, Any] = {
+                "from": email.get("from") or self.email_from,
+                "to": email["to"],
+                "subject": email["subject"],
+                "html": email["html"],
+            }
+            if email.get("text"):
+                payload["text"] = email["text"]
+            payloads.append(payload)
+        accepted = 0
+        for start in range(0, len(payloads), RESEND_BATCH_SIZE):
+            chunk = payloads[start:start + RESEND_BATCH_SIZE]
+            try:
+                response = await self.client.post(
+                    self.resend_batch_url,
+                    headers={"Authorization": f"Bearer {self.resend_api_key}"},
+                    json=chunk,
+                    timeout=15.0,
+                )
+                response.raise_for_status()
+                accepted += len(chunk)
+            except Exception as exc:
+                logger.error("Error sending email batch: %s", exc)
+        return accepted
+
     async def send_email_notification(
         self,
         to_emails: List[str],
@@ -231,17 +667,23 @@ class NotificationService:
             payload["reply_to"] = str(reply_to).strip()
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.resend_url,
-                    headers={"Authorization": f"Bearer {self.resend_api_key}"},
-                    json=payload,
-                    timeout=10.0,
-                )
-                response.raise_for_status()
-                result = response.json()
-                logger.info("Email notification sent successfully: %s", result)
-                return result
+            response = await self.client.post(
+                self.resend_url,
+                headers={"Authorization": f"Bearer {self.resend_api_key}"},
+                json=payload,
+            )
+            response.raise_for_status()
+            result = response.json()
+            logger.info("Email notification sent successfully: %s", result)
+            return result
         except Exception as exc:
             logger.error("Error sending email notification: %s", exc)
             return None
+
+
+async def ensure_notification_outbox_indexes(db) -> None:
+    await db.notification_outbox.create_index("outbox_id", unique=True)
+    await db.notification_outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.notification_outbox.create_index([("status", 1), ("receipts_due_at", 1)])
+    await db.notification_outbox.create_index("finished_at", expireAfterSeconds=OUTBOX_KEEP_SECONDS)
+    await db.users.create_index("push_tokens")
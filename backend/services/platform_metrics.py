@@ -0,0 +1,576 @@
+"""
+Platform-wide metrics for the super-admin console.
+
+The admin dashboards used to scan every tenant's users, sales and
+subscription events on each load.  They now read three kinds of snapshot:
+
+* ``platform_metrics`` period documents (``hour:YYYY-MM-DDTHH`` and
+  ``day:YYYY-MM-DD``) holding counters for signups, subscription payments,
+  churn events and sales, plus the ``active_users`` / ``mrr`` gauges measured
+  while the period was current.  Counters are ``$inc``-ed as events happen;
+  hourly documents expire after ``HOURLY_RETENTION_DAYS`` and only serve the
+  ragged edges of rolling windows (``window_totals``).
+* the ``current`` document of the same collection: account-state aggregates
+  (plans, providers, MRR, trials, users by role/country...).
+* ``platform_store_metrics``: one document per store with its revenue, sales
+  count, catalogue size and stock health.
+
+``reconcile`` runs on a schedule: it recomputes the closed periods of the last
+days from the source collections (correcting any increment lost to a crash),
+refreshes the ``current`` document and the stale store documents.
+"""
+
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+HOURLY_RETENTION_DAYS = 100
+RECONCILE_LOOKBACK_DAYS = 2
+BACKFILL_DAYS = 760
+STORE_REFRESH_INTERVAL = timedelta(hours=24)
+STORE_BATCH = 200
+LOW_STOCK_THRESHOLD = 5
+
+CHURN_EVENT_TYPES = ("subscription_expired", "subscription_cancelled", "payment_failed")
+COUNTER_FIELDS = ("signups", "payments", "churn", "sales")
+KNOWN_ROLES = ("shopkeeper", "staff", "supplier", "admin", "superadmin")
+
+_COMPLETED_SALE = {"$or": [{"status": {"$exists": False}}, {"status": "completed"}]}
+
+AccountProfile = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+
+# ---------------------------------------------------------------------------
+# Periods
+# ---------------------------------------------------------------------------
+def _utc(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return None
+
+
+def hour_start(at: datetime) -> datetime:
+    return _utc(at).replace(minute=0, second=0, microsecond=0)
+
+
+def day_start(at: datetime) -> datetime:
+    return _utc(at).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def period_id(granularity: str, start: datetime) -> str:
+    return f"{granularity}:{start.strftime('%Y-%m-%dT%H' if granularity == 'hour' else '%Y-%m-%d')}"
+
+
+def _period_fields(granularity: str, start: datetime) -> Dict[str, Any]:
+    fields: Dict[str, Any] = {"granularity": granularity, "period_start": start}
+    if granularity == "hour":
+        fields["expires_at"] = start + timedelta(days=HOURLY_RETENTION_DAYS)
+    return fields
+
+
+def _periods(at: datetime) -> List[Tuple[str, datetime]]:
+    return [("hour", hour_start(at)), ("day", day_start(at))]
+
+
+# ---------------------------------------------------------------------------
+# Counters
+# ---------------------------------------------------------------------------
+def _key(value: Any, default: str = "unknown") -> str:
+    """Counter key safe for a Mongo field path."""
+    text = str(value or default).strip().replace(".", "_").replace("$", "_")
+    return text or default
+
+
+def _role_key(role: Any) -> str:
+    """Role counter key; a missing or unexpected role is counted as ``other``, never as a shopkeeper."""
+    return role if role in KNOWN_ROLES else "other"
+
+
+def _amount(value: Any) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def signup_increments(role: Optional[str], count: int = 1) -> Dict[str, float]:
+    return {"signups.total": count, f"signups.by_role.{_role_key(role)}": count}
+
+
+def event_increments(event: Dict[str, Any], count: int = 1) -> Dict[str, float]:
+    """Counters moved by a subscription event (``amount`` is the summed amount when ``count`` > 1)."""
+    event_type = event.get("event_type")
+    if event_type == "payment_succeeded":
+        currency = _key((event.get("currency") or "XOF").upper())
+        plan = _key((event.get("plan") or "unknown").lower())
+        amount = _amount(event.get("amount"))
+        return {
+            "payments.count": count,
+            f"payments.by_provider.{_key((event.get('provider') or 'unknown').lower())}": count,
+            f"payments.by_source.{_key((event.get('source') or 'unknown').lower())}": count,
+            f"payments.volume.{currency}": amount,
+            f"payments.volume_by_plan.{plan}.{currency}": amount,
+        }
+    if event_type in CHURN_EVENT_TYPES:
+        return {"churn.count": count, f"churn.by_type.{event_type}": count}
+    return {}
+
+
+def sale_increments(revenue: float, count: int = 1) -> Dict[str, float]:
+    return {"sales.count": count, "sales.revenue": revenue}
+
+
+def add_flat(target: Dict[str, Any], increments: Dict[str, float]) -> Dict[str, Any]:
+    """Apply dotted-path increments to a nested counter dict."""
+    for path, value in increments.items():
+        node = target
+        *parents, leaf = path.split(".")
+        for part in parents:
+            node = node.setdefault(part, {})
+        node[leaf] = node.get(leaf, 0) + value
+    return target
+
+
+def merge_counters(target: Dict[str, Any], source: Dict[str, Any]) -> Dict[str, Any]:
+    for key, value in (source or {}).items():
+        if isinstance(value, dict):
+            merge_counters(target.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)):
+            target[key] = target.get(key, 0) + value
+    return target
+
+
+def format_amount(value: float) -> str:
+    text = f"{value:.2f}"
+    return text[:-3] if text.endswith(".00") else text.rstrip("0")
+
+
+async def _apply(db, at: Any, increments: Dict[str, float]) -> None:
+    at = _utc(at) or datetime.now(timezone.utc)
+    if not increments:
+        return
+    now = datetime.now(timezone.utc)
+    ops = [
+        UpdateOne(
+            {"_id": period_id(granularity, start)},
+            {"$inc": increments, "$set": {"updated_at": now}, "$setOnInsert": _period_fields(granularity, start)},
+            upsert=True,
+        )
+        for granularity, start in _periods(at)
+    ]
+    await db.platform_metrics.bulk_write(ops, ordered=False)
+
+
+async def record_signup(db, user_doc: Dict[str, Any]) -> None:
+    await _apply(db, user_doc.get("created_at"), signup_increments(user_doc.get("role")))
+
+
+async def record_subscription_event(db, event: Dict[str, Any]) -> None:
+    await _apply(db, event.get("created_at"), event_increments(event))
+
+
+async def record_sale(db, sale: Dict[str, Any], sign: int = 1) -> None:
+    """Count a completed sale (``sign=-1`` withdraws a cancelled one) platform-wide and for its store."""
+    revenue = _amount(sale.get("total_amount")) * sign
+    await _apply(db, sale.get("created_at"), sale_increments(revenue, sign))
+    store_id = sale.get("store_id")
+    if store_id:
+        await db.platform_store_metrics.update_one(
+            {"store_id": store_id},
+            {"$inc": {"revenue": revenue, "sales_count": sign}, "$setOnInsert": {"user_id": sale.get("user_id")}},
+            upsert=True,
+        )
+
+
+# ---------------------------------------------------------------------------
+# Reads
+# ---------------------------------------------------------------------------
+def window_query(start: datetime, end: datetime) -> Dict[str, Any]:
+    """Documents covering [start, end): whole days from daily docs, ragged edges from hourly docs."""
+    first_day = day_start(start)
+    if first_day < _utc(start):
+        first_day += timedelta(days=1)
+    last_day = day_start(end)
+    start_hour = hour_start(start)
+    if first_day >= last_day:
+        return {"granularity": "hour", "period_start": {"$gte": start_hour, "$lt": end}}
+    return {"$or": [
+        {"granularity": "day", "period_start": {"$gte": first_day, "$lt": last_day}},
+        {"granularity": "hour", "period_start": {"$gte": start_hour, "$lt": first_day}},
+        {"granularity": "hour", "period_start": {"$gte": last_day, "$lt": end}},
+    ]}
+
+
+async def window_totals(db, start: datetime, end: datetime) -> Dict[str, Any]:
+    projection = {field: 1 for field in COUNTER_FIELDS}
+    totals: Dict[str, Any] = {}
+    async for doc in db.platform_metrics.find(window_query(start, end), projection):
+        merge_counters(totals, {field: doc.get(field) or {} for field in COUNTER_FIELDS})
+    return totals
+
+
+async def daily_documents(db, since: datetime) -> List[Dict[str, Any]]:
+    return await db.platform_metrics.find(
+        {"granularity": "day", "period_start": {"$gte": day_start(since)}},
+        {"_id": 0, "period_start": 1, **{field: 1 for field in COUNTER_FIELDS}},
+    ).sort("period_start", 1).to_list(None)
+
+
+def monthly_counters(daily_docs: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Daily documents summed per ``YYYY-MM``."""
+    months: Dict[str, Dict[str, Any]] = {}
+    for doc in daily_docs:
+        month = _utc(doc["period_start"]).strftime("%Y-%m")
+        merge_counters(months.setdefault(month, {}), {field: doc.get(field) or {} for field in COUNTER_FIELDS})
+    return months
+
+
+async def get_current(db, account_profile: AccountProfile) -> Dict[str, Any]:
+    current = await db.platform_metrics.find_one({"_id": "current"})
+    if not current:
+        current = await refresh_current(db, datetime.now(timezone.utc), account_profile)
+    return current
+
+
+async def top_stores(db, limit: int = 5) -> List[Dict[str, Any]]:
+    rows = await db.platform_store_metrics.find(
+        {}, {"_id": 0, "store_id": 1, "name": 1, "revenue": 1, "sales_count": 1},
+    ).sort("revenue", -1).limit(limit).to_list(limit)
+    return [
+        {"store_id": row.get("store_id"), "name": row.get("name") or "Inconnu",
+         "revenue": row.get("revenue") or 0, "sales_count": row.get("sales_count") or 0}
+        for row in rows
+    ]
+
+
+async def store_snapshots(db, store_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    rows = await db.platform_store_metrics.find({"store_id": {"$in": store_ids}}, {"_id": 0}).to_list(len(store_ids))
+    return {row["store_id"]: row for row in rows}
+
+
+# ---------------------------------------------------------------------------
+# Reconciliation
+# ---------------------------------------------------------------------------
+def _hour_bucket(field: str) -> Dict[str, Any]:
+    return {"$dateToString": {"format": "%Y-%m-%dT%H", "date": f"${field}", "timezone": "UTC"}}
+
+
+async def _source_counters(db, since: datetime, until: datetime) -> Dict[datetime, Dict[str, Any]]:
+    """Counters per hour recomputed from users, subscription events and sales."""
+    window = {"$gte": since, "$lt": until}
+    hours: Dict[datetime, Dict[str, Any]] = {}
+
+    def bucket(key: str) -> Dict[str, Any]:
+        start = datetime.strptime(key, "%Y-%m-%dT%H").replace(tzinfo=timezone.utc)
+        return hours.setdefault(start, {})
+
+    async for row in db.users.aggregate([
+        {"$match": {"created_at": window}},
+        {"$group": {"_id": {"h": _hour_bucket("created_at"), "role": "$role"}, "count": {"$sum": 1}}},
+    ]):
+        add_flat(bucket(row["_id"]["h"]), signup_increments(row["_id"].get("role"), row["count"]))
+
+    async for row in db.subscription_events.aggregate([
+        {"$match": {"created_at": window, "event_type": {"$in": ["payment_succeeded", *CHURN_EVENT_TYPES]}}},
+        {"$group": {
+            "_id": {"h": _hour_bucket("created_at"), "event_type": "$event_type", "provider": "$provider",
+                    "source": "$source", "currency": "$currency", "plan": "$plan"},
+            "amount": {"$sum": {"$convert": {"input": "$amount", "to": "double", "onError": 0.0, "onNull": 0.0}}},
+            "count": {"$sum": 1},
+        }},
+    ]):
+        event = {**row["_id"], "amount": row["amount"]}
+        add_flat(bucket(row["_id"]["h"]), event_increments(event, row["count"]))
+
+    async for row in db.sales.aggregate([
+        {"$match": {"created_at": window, **_COMPLETED_SALE}},
+        {"$group": {"_id": _hour_bucket("created_at"), "revenue": {"$sum": "$total_amount"}, "count": {"$sum": 1}}},
+    ]):
+        add_flat(bucket(row["_id"]), sale_increments(float(row["revenue"] or 0), row["count"]))
+    return hours
+
+
+async def rebuild_periods(db, since: datetime, until: datetime, now: datetime) -> int:
+    """Overwrite the counters of the closed hours and days of [since, until) from the sources."""
+    since, until = day_start(since), hour_start(until)
+    hours = await _source_counters(db, since, until)
+    days: Dict[datetime, Dict[str, Any]] = {}
+    for start, counters in hours.items():
+        merge_counters(days.setdefault(day_start(start), {}), counters)
+
+    hourly_floor = now - timedelta(days=HOURLY_RETENTION_DAYS)
+    ops: List[UpdateOne] = []
+
+    def put(granularity: str, start: datetime, counters: Dict[str, Any]) -> None:
+        fields = {field: counters.get(field, {}) for field in COUNTER_FIELDS}
+        ops.append(UpdateOne(
+            {"_id": period_id(granularity, start)},
+            {"$set": {**fields, **_period_fields(granularity, start), "updated_at": now}},
+            upsert=True,
+        ))
+
+    hour = max(since, hour_start(hourly_floor))
+    while hour < until:
+        put("hour", hour, hours.get(hour, {}))
+        hour += timedelta(hours=1)
+    day = since
+    while day + timedelta(days=1) <= until:
+        put("day", day, days.get(day, {}))
+        day += timedelta(days=1)
+
+    for offset in range(0, len(ops), 500):
+        await db.platform_metrics.bulk_write(ops[offset:offset + 500], ordered=False)
+    return len(ops)
+
+
+def _account_state(accounts: Iterable[Tuple[Dict[str, Any], Dict[str, Any]]], now: datetime) -> Dict[str, Any]:
+    """Subscription aggregates of (account, profile) pairs, as of ``now``."""
+    week_ahead = now + timedelta(days=7)
+    three_days_ahead = now + timedelta(days=3)
+    state: Dict[str, Any] = {
+        "total_accounts": 0, "active_paid_accounts": 0, "active_trials": 0,
+        "trials_expiring_3d": 0, "trials_expiring_7d": 0, "trials_expiring_soon": 0,
+        "subscriptions_expiring_soon": 0, "expired_accounts": 0, "cancelled_accounts": 0,
+        "by_plan": {}, "by_provider": {}, "by_currency": {}, "mrr": {}, "mrr_by_plan": {},
+    }
+    for account, profile in accounts:
+        state["total_accounts"] += 1
+        plan = profile["plan"]
+        add_flat(state, {f"by_plan.{_key(plan)}": 1})
+        provider = (account.get("subscription_provider") or "none").lower()
+        add_flat(state, {f"by_provider.{_key(provider)}": 1})
+        if account.get("currency"):
+            add_flat(state, {f"by_currency.{_key(account['currency'].upper())}": 1})
+
+        status = account.get("subscription_status") or "active"
+        sub_end = _utc(account.get("subscription_end"))
+        trial_end = _utc(account.get("trial_ends_at"))
+        currency = _key(profile["currency"])
+        if account.get("subscription_status") == "active":
+            add_flat(state, {f"mrr_by_plan.{_key(plan)}.{currency}": profile["amount"]})
+            if trial_end and now <= trial_end <= week_ahead and provider in ("none", ""):
+                state["trials_expiring_soon"] += 1
+
+        if profile["paying"] and status == "active":
+            state["active_paid_accounts"] += 1
+            add_flat(state, {f"mrr.{currency}": profile["amount"]})
+            if sub_end and now <= sub_end <= week_ahead:
+                state["subscriptions_expiring_soon"] += 1
+        elif trial_end and status == "active" and trial_end >= now:
+            state["active_trials"] += 1
+            if trial_end <= three_days_ahead:
+                state["trials_expiring_3d"] += 1
+            if trial_end <= week_ahead:
+                state["trials_expiring_7d"] += 1
+
+        if status == "expired":
+            state["expired_accounts"] += 1
+        if status == "cancelled":
+            state["cancelled_accounts"] += 1
+    return state
+
+
+async def refresh_current(db, now: datetime, account_profile: AccountProfile) -> Dict[str, Any]:
+    """Recompute the ``current`` document and stamp the gauges on the current hour and day."""
+    cursor = db.business_accounts.find({}, {
+        "_id": 0, "plan": 1, "subscription_status": 1, "subscription_provider": 1, "subscription_end": 1,
+        "trial_ends_at": 1, "country_code": 1, "currency": 1,
+    })
+    accounts = [(account, account_profile(account)) async for account in cursor]
+    state = _account_state(accounts, now)
+
+    role_rows = await db.users.aggregate([{"$group": {"_id": "$role", "count": {"$sum": 1}}}]).to_list(None)
+    country_rows = await db.users.aggregate([{"$group": {"_id": "$country_code", "count": {"$sum": 1}}}]).to_list(None)
+    state.update({
+        "_id": "current",
+        "users_by_role": add_flat({}, {_role_key(row["_id"]): row["count"] for row in role_rows}),
+        "users_by_country": {_key(row["_id"], "Unknown"): row["count"] for row in country_rows},
+        "active_users": await db.users.count_documents({"role": "shopkeeper", "is_active": {"$ne": False}}),
+        "open_tickets": await db.support_tickets.count_documents({"status": "open"}),
+        "low_stock_count": await db.products.count_documents({"quantity": {"$lte": LOW_STOCK_THRESHOLD}}),
+        "refreshed_at": now,
+    })
+    await db.platform_metrics.replace_one({"_id": "current"}, state, upsert=True)
+
+    gauges = {"active_users": state["active_users"], "mrr": state["mrr"], "updated_at": now}
+    await db.platform_metrics.bulk_write([
+        UpdateOne({"_id": period_id(granularity, start)},
+                  {"$set": gauges, "$setOnInsert": _period_fields(granularity, start)}, upsert=True)
+        for granularity, start in _periods(now)
+    ], ordered=False)
+    return state
+
+
+async def store_health(db, store_ids: List[str], now: datetime) -> Dict[str, Dict[str, Any]]:
+    """Stock health, catalogue and relationship counts of a batch of stores."""
+    expiry_cutoff = now + timedelta(days=30)
+    metrics: Dict[str, Dict[str, Any]] = {
+        store_id: {
+            "product_count": 0, "low_stock_count": 0, "out_of_stock_count": 0, "overstock_count": 0,
+            "stock_value": 0.0, "expiring_soon_count": 0, "expired_count": 0,
+            "active_alerts_count": 0, "critical_alerts_count": 0,
+            "customer_count": 0, "supplier_count": 0, "last_movement_at": None,
+        }
+        for store_id in store_ids
+    }
+
+    def count_expiry(bucket: Dict[str, Any], value: Any) -> None:
+        expiry_date = _utc(value)
+        if not expiry_date:
+            return
+        if expiry_date <= now:
+            bucket["expired_count"] += 1
+        elif expiry_date <= expiry_cutoff:
+            bucket["expiring_soon_count"] += 1
+
+    async for row in db.products.aggregate([
+        {"$match": {"store_id": {"$in": store_ids}}},
+        {"$group": {"_id": "$store_id", "count": {"$sum": 1}}},
+    ]):
+        metrics[row["_id"]]["product_count"] = row["count"]
+
+    async for product in db.products.find(
+        {"store_id": {"$in": store_ids}, "is_active": {"$ne": False}},
+        {"_id": 0, "store_id": 1, "quantity": 1, "min_stock": 1, "max_stock": 1, "purchase_price": 1, "expiry_date": 1},
+    ):
+        bucket = metrics.get(product.get("store_id"))
+        if not bucket:
+            continue
+        quantity = float(product.get("quantity") or 0)
+        min_stock = float(product.get("min_stock") or 0)
+        max_stock = float(product.get("max_stock") or 0)
+        bucket["stock_value"] += max(quantity, 0) * max(float(product.get("purchase_price") or 0), 0)
+        if quantity <= 0:
+            bucket["out_of_stock_count"] += 1
+        elif min_stock > 0 and quantity <= min_stock:
+            bucket["low_stock_count"] += 1
+        if max_stock > 0 and quantity >= max_stock:
+            bucket["overstock_count"] += 1
+        if quantity > 0:
+            count_expiry(bucket, product.get("expiry_date"))
+
+    async for batch in db.batches.find(
+        {"store_id": {"$in": store_ids}, "quantity": {"$gt": 0}},
+        {"_id": 0, "store_id": 1, "expiry_date": 1},
+    ):
+        bucket = metrics.get(batch.get("store_id"))
+        if bucket:
+            count_expiry(bucket, batch.get("expiry_date"))
+
+    async for alert in db.alerts.find(
+        {"store_id": {"$in": store_ids}, "is_dismissed": False}, {"_id": 0, "store_id": 1, "severity": 1},
+    ):
+        bucket = metrics.get(alert.get("store_id"))
+        if bucket:
+            bucket["active_alerts_count"] += 1
+            if alert.get("severity") == "critical":
+                bucket["critical_alerts_count"] += 1
+
+    for collection, field, match in (
+        ("customers", "customer_count", {}),
+        ("suppliers", "supplier_count", {"is_active": {"$ne": False}}),
+    ):
+        async for row in db[collection].aggregate([
+            {"$match": {"store_id": {"$in": store_ids}, **match}},
+            {"$group": {"_id": "$store_id", "count": {"$sum": 1}}},
+        ]):
+            metrics[row["_id"]][field] = row["count"]
+
+    async for row in db.stock_movements.aggregate([
+        {"$match": {"store_id": {"$in": store_ids}}},
+        {"$sort": {"created_at": -1}},
+        {"$group": {"_id": "$store_id", "created_at": {"$first": "$created_at"}}},
+    ]):
+        metrics[row["_id"]]["last_movement_at"] = row["created_at"]
+    return metrics
+
+
+async def refresh_stores(db, store_docs: List[Dict[str, Any]], now: datetime) -> None:
+    store_ids = [doc["store_id"] for doc in store_docs]
+    health = await store_health(db, store_ids, now)
+    sales: Dict[str, Dict[str, Any]] = {}
+    async for row in db.sales.aggregate([
+        {"$match": {"store_id": {"$in": store_ids}, **_COMPLETED_SALE}},
+        {"$group": {"_id": "$store_id", "revenue": {"$sum": "$total_amount"}, "count": {"$sum": 1}}},
+    ]):
+        sales[row["_id"]] = row
+    ops = [
+        UpdateOne({"store_id": doc["store_id"]}, {"$set": {
+            **health[doc["store_id"]],
+            "user_id": doc.get("user_id"),
+            "name": doc.get("name"),
+            "revenue": float((sales.get(doc["store_id"]) or {}).get("revenue") or 0),
+            "sales_count": int((sales.get(doc["store_id"]) or {}).get("count") or 0),
+            "refreshed_at": now,
+        }}, upsert=True)
+        for doc in store_docs
+    ]
+    if ops:
+        await db.platform_store_metrics.bulk_write(ops, ordered=False)
+
+
+async def refresh_stale_stores(db, now: datetime, max_stores: Optional[int] = None) -> int:
+    """Refresh store documents that are missing or older than ``STORE_REFRESH_INTERVAL``."""
+    stale_before = now - STORE_REFRESH_INTERVAL
+    refreshed = 0
+    batch: List[Dict[str, Any]] = []
+
+    async def flush() -> None:
+        nonlocal refreshed, batch
+        fresh = {
+            row["store_id"]
+            async for row in db.platform_store_metrics.find(
+                {"store_id": {"$in": [doc["store_id"] for doc in batch]}, "refreshed_at": {"$gte": stale_before}},
+                {"_id": 0, "store_id": 1},
+            )
+        }
+        stale = [doc for doc in batch if doc["store_id"] not in fresh]
+        if stale:
+            await refresh_stores(db, stale, now)
+            refreshed += len(stale)
+        batch = []
+
+    async for doc in db.stores.find({"store_id": {"$nin": [None, ""]}}, {"_id": 0, "store_id": 1, "user_id": 1, "name": 1}):
+        batch.append(doc)
+        if len(batch) >= STORE_BATCH:
+            await flush()
+            if max_stores and refreshed >= max_stores:
+                return refreshed
+    if batch:
+        await flush()
+    return refreshed
+
+
+async def reconcile(db, account_profile: AccountProfile, now: Optional[datetime] = None) -> Dict[str, int]:
+    """Scheduled job: closed periods from the sources, the ``current`` document, stale stores."""
+    now = now or datetime.now(timezone.utc)
+    state = await db.platform_metrics_state.find_one({"_id": "reconcile"}) or {}
+    lookback = RECONCILE_LOOKBACK_DAYS if state.get("backfilled_at") else BACKFILL_DAYS
+    periods = await rebuild_periods(db, now - timedelta(days=lookback), now, now)
+    await refresh_current(db, now, account_profile)
+    stores = await refresh_stale_stores(db, now)
+    await db.platform_metrics_state.update_one(
+        {"_id": "reconcile"},
+        {"$set": {"last_run_at": now, "backfilled_at": state.get("backfilled_at") or now}},
+        upsert=True,
+    )
+    return {"periods": periods, "stores": stores}
+
+
+async def ensure_platform_metrics_indexes(db) -> None:
+    await db.platform_metrics.create_index([("granularity", 1), ("period_start", 1)])
+    await db.platform_metrics.create_index("expires_at", expireAfterSeconds=0)
+    await db.platform_store_metrics.create_index("store_id", unique=True)
+    await db.platform_store_metrics.create_index([("revenue", -1)])
@@ -0,0 +1,141 @@
+"""
+Last-activity timestamps on products.
+
+``last_movement_out_at``, ``last_sold_at`` and ``last_counted_at`` are kept on
+each product by the stock movement, sale and inventory paths so that dormant
+product and inventory reminders are a single indexed range query instead of
+one lookup per product.
+
+Owners whose products predate these fields are backfilled once from
+``stock_movements``, ``sales`` and ``inventory_tasks`` (``ensure_product_activity``).
+Each backfilled owner gets a ``product_activity_state`` document; once a
+background pass finds no owner left, a global marker stops the scans (owners
+created later are covered by the write paths and ``ensure_product_activity``).
+"""
+
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH = 500
+ALL_OWNERS_DONE = "*"
+
+_COMPLETED_SALE = {"$or": [{"status": {"$exists": False}}, {"status": "completed"}]}
+
+
+def _as_datetime(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str) and value:
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return None
+
+
+async def record_sale(db, sale: Dict[str, Any]) -> None:
+    """Stamp ``last_sold_at`` on every product of a completed sale."""
+    sold_at = _as_datetime(sale.get("created_at")) or datetime.now(timezone.utc)
+    product_ids = list(dict.fromkeys(
+        item.get("product_id") for item in sale.get("items") or [] if item.get("product_id")
+    ))
+    if not product_ids:
+        return
+    await db.products.update_many(
+        {"user_id": sale.get("user_id"), "product_id": {"$in": product_ids}},
+        {"$max": {"last_sold_at": sold_at}},
+    )
+
+
+async def _apply_max(db, field: str, rows: Iterable[Dict[str, Any]], owner_id: str) -> int:
+    ops: List[UpdateOne] = []
+    written = 0
+    for row in rows:
+        at = _as_datetime(row.get("at"))
+        if not row.get("_id") or not at:
+            continue
+        ops.append(UpdateOne({"user_id": owner_id, "product_id": row["_id"]}, {"$max": {field: at}}))
+        if len(ops) >= BACKFILL_BATCH:
+            await db.products.bulk_write(ops, ordered=False)
+            written += len(ops)
+            ops = []
+    if ops:
+        await db.products.bulk_write(ops, ordered=False)
+        written += len(ops)
+    return written
+
+
+async def backfill_product_activity(db, owner_id: str) -> None:
+    """Derive the activity timestamps of an owner's products from history."""
+    outs = await db.stock_movements.aggregate([
+        {"$match": {"user_id": owner_id, "type": "out"}},
+        {"$group": {"_id": "$product_id", "at": {"$max": "$created_at"}}},
+    ]).to_list(None)
+    await _apply_max(db, "last_movement_out_at", outs, owner_id)
+
+    sold = await db.sales.aggregate([
+        {"$match": {"user_id": owner_id, **_COMPLETED_SALE}},
+        {"$unwind": "$items"},
+        {"$group": {"_id": "$items.product_id", "at": {"$max": "$created_at"}}},
+    ]).to_list(None)
+    await _apply_max(db, "last_sold_at", sold, owner_id)
+
+    counted = await db.inventory_tasks.aggregate([
+        {"$match": {"user_id": owner_id, "status": "completed"}},
+        {"$group": {"_id": "$product_id", "at": {"$max": "$completed_at"}}},
+    ]).to_list(None)
+    await _apply_max(db, "last_counted_at", counted, owner_id)
+
+    await db.product_activity_state.update_one(
+        {"user_id": owner_id},
+        {"$set": {"backfilled_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+    logger.info(
+        "Product activity backfilled for %s: %s out, %s sold, %s counted",
+        owner_id, len(outs), len(sold), len(counted),
+    )
+
+
+async def ensure_product_activity(db, owner_id: str) -> None:
+    state = await db.product_activity_state.find_one({"user_id": owner_id}, {"_id": 1})
+    if not state:
+        await backfill_product_activity(db, owner_id)
+
+
+async def backfill_pending_owners(db, limit: int = 50) -> int:
+    """Background job: backfill owners that have products but no activity state yet."""
+    if await db.product_activity_state.find_one({"user_id": ALL_OWNERS_DONE}, {"_id": 1}):
+        return 0
+    done = {row["user_id"] for row in await db.product_activity_state.find({}, {"_id": 0, "user_id": 1}).to_list(None)}
+    pending = [owner for owner in await db.products.distinct("user_id") if owner and owner not in done]
+    failed = 0
+    for owner_id in pending[:limit]:
+        try:
+            await backfill_product_activity(db, owner_id)
+        except Exception as e:
+            failed += 1
+            logger.warning("Product activity backfill failed for %s: %s", owner_id, e)
+    if len(pending) <= limit and not failed:
+        await db.product_activity_state.update_one(
+            {"user_id": ALL_OWNERS_DONE},
+            {"$set": {"backfilled_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+        logger.info("Product activity backfill complete for every owner")
+    return min(len(pending), limit)
+
+
+async def ensure_product_activity_indexes(db) -> None:
+    await db.product_activity_state.create_index("user_id", unique=True)
+    await db.products.create_index([("user_id", 1), ("store_id", 1), ("last_movement_out_at", 1)])
+    await db.products.create_index([("user_id", 1), ("store_id", 1), ("last_sold_at", 1)])
+    await db.products.create_index([("user_id", 1), ("store_id", 1), ("last_counted_at", 1)])
@@ -0,0 +1,444 @@
+"""
+Pre-rendered public receipts.
+
+A receipt is rendered once per sale version and stored in ``receipt_renders``
+under a content address: ``render_key`` hashes the public token, the sale id,
+the sale's ``receipt_version`` and ``TEMPLATE_VERSION``.  Sale edits and
+cancellations ``$inc`` ``receipt_version``, so they move the receipt to a new
+key instead of rewriting a cached one; stale renders simply age out through
+the TTL on ``created_at``.
+
+Because the bytes behind a key never change, they are also kept in a small
+in-process LRU and served with ``IMMUTABLE_CACHE_CONTROL`` on the key URLs;
+the token URL revalidates with the key as its ETag.  The HTML page and the
+download variant are rendered inline (string formatting only); the PDF is
+rendered on a worker thread, right after sale completion or on its first
+request, and stored next to them.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from html import escape
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import quote
+
+from bson import Binary
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_VERSION = 2
+RENDER_KEEP_SECONDS = 180 * 24 * 3600
+MEMORY_CACHE_SIZE = 256
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PAGE_CACHE_CONTROL = "public, no-cache"
+
+_memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_pdf_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="receipt-pdf")
+
+LoadReceipt = Callable[[], Awaitable[Dict[str, Any]]]
+
+
+def render_key(public_token: str, sale_id: str, version: int) -> str:
+    seed = f"{public_token}:{sale_id}:{int(version or 0)}:{TEMPLATE_VERSION}"
+    return hashlib.sha256(seed.encode("utf-8")).hexdigest()[:40]
+
+
+def etag_for(key: str) -> str:
+    return f'"{key}"'
+
+
+def _fmt_amount(value: Any) -> str:
+    try:
+        return f"{float(value):,.0f}".replace(",", " ")
+    except Exception:
+        return str(value)
+
+
+def _created_label(receipt: Dict[str, Any]) -> str:
+    created_at = receipt.get("created_at")
+    if not isinstance(created_at, datetime):
+        return ""
+    created_at = created_at if created_at.tzinfo else created_at.replace(tzinfo=timezone.utc)
+    return created_at.astimezone(timezone.utc).strftime("%d/%m/%Y %H:%M UTC")
+
+
+def _quantity_label(item: Dict[str, Any]) -> str:
+    quantity = item.get("sold_quantity_input") if item.get("sold_quantity_input") is not None else item.get("quantity")
+    unit = item.get("sold_unit")
+    return f"{quantity} {unit}" if unit else str(quantity)
+
+
+def _number_html(receipt: Dict[str, Any]) -> str:
+    number = receipt.get("receipt_number")
+    return f"N° ticket : {escape(number)}<br />" if number else ""
+
+
+def _items_html(receipt: Dict[str, Any]) -> str:
+    return "".join(
+        f"""
+        <tr>
+            <td>{escape(str(item.get("product_name") or ""))}</td>
+            <td style="text-align:center;">{escape(_quantity_label(item))}</td>
+            <td style="text-align:right;">{_fmt_amount(item.get("selling_price"))}</td>
+            <td style="text-align:right;">{_fmt_amount(item.get("total"))}</td>
+        </tr>
+        """
+        for item in receipt.get("items") or []
+    )
+
+
+def render_download_html(receipt: Dict[str, Any]) -> str:
+    return f"""<!DOCTYPE html>
+<html lang="fr">
+<head>
+    <meta charset="utf-8" />
+    <meta name="viewport" content="width=device-width, initial-scale=1" />
+    <title>Reçu {escape(receipt["sale_id"])}</title>
+    <style>
+        body {{ font-family: Arial, sans-serif; color: #1f2937; margin: 0; padding: 24px; }}
+        .card {{ max-width: 760px; margin: 0 auto; border: 1px solid #eadfcb; border-radius: 20px; padding: 24px; }}
+        .eyebrow {{ color: #2563eb; font-size: 12px; font-weight: 700; letter-spacing: 0.12em; text-transform: uppercase; }}
+        h1 {{ margin: 8px 0 4px; }}
+        .meta, .footer {{ color: #6b7280; font-size: 14px; }}
+        .total {{ display: flex; justify-content: space-between; margin: 20px 0; padding: 16px; background: #eff6ff; border-radius: 14px; font-weight: 700; }}
+        table {{ width: 100%; border-collapse: collapse; }}
+        th, td {{ padding: 12px 8px; border-bottom: 1px solid #eadfcb; font-size: 14px; }}
+        th {{ color: #6b7280; font-size: 12px; text-align: left; text-transform: uppercase; }}
+        .footer {{ margin-top: 20px; text-align: center; }}
+    </style>
+</head>
+<body>
+    <div class="card">
+        <div class="eyebrow">Reçu numérique</div>
+        <h1>{escape(receipt["store_name"])}</h1>
+        <div class="meta">
+            {escape(receipt.get("store_address") or "")}<br />
+            {_number_html(receipt)}
+            Référence vente : {escape(receipt["sale_id"])}<br />
+            Date : {escape(_created_label(receipt))}<br />
+            Paiement : {escape(str(receipt.get("payment_method") or ""))}
+        </div>
+        <div class="total"><span>Total</span><span>{_fmt_amount(receipt.get("total_amount"))}</span></div>
+        <table>
+            <thead>
+                <tr>
+                    <th>Produit</th>
+                    <th style="text-align:center;">Quantité</th>
+                    <th style="text-align:right;">Prix</th>
+                    <th style="text-align:right;">Total</th>
+                </tr>
+            </thead>
+            <tbody>{_items_html(receipt)}</tbody>
+        </table>
+        <div class="footer">{escape(receipt.get("receipt_footer") or "Merci de votre visite.")}</div>
+    </div>
+</body>
+</html>"""
+
+
+def render_page_html(receipt: Dict[str, Any], public_token: str, key: str) -> str:
+    return f"""
+        <!DOCTYPE html>
+        <html lang="fr">
+        <head>
+            <meta charset="utf-8" />
+            <meta name="viewport" content="width=device-width, initial-scale=1" />
+            <title>Reçu {escape(receipt["sale_id"])}</title>
+            <style>
+                :root {{
+                    color-scheme: light;
+                    --bg: #f5f1e8;
+                    --card: #fffdf8;
+                    --ink: #1f2937;
+                    --muted: #6b7280;
+                    --line: #eadfcb;
+                    --accent: #2563eb;
+                }}
+                * {{ box-sizing: border-box; }}
+                body {{
+                    margin: 0;
+                    font-family: Arial, sans-serif;
+                    background: linear-gradient(180deg, #f8f4ec 0%, #efe7d8 100%);
+                    color: var(--ink);
+                    padding: 20px;
+                }}
+                .wrap {{
+                    max-width: 760px;
+                    margin: 0 auto;
+                }}
+                .card {{
+                    background: var(--card);
+                    border: 1px solid var(--line);
+                    border-radius: 24px;
+                    padding: 24px;
+                    box-shadow: 0 16px 40px rgba(15, 23, 42, 0.08);
+                }}
+                .eyebrow {{
+                    font-size: 12px;
+                    text-transform: uppercase;
+                    letter-spacing: 0.12em;
+                    color: var(--accent);
+                    font-weight: 700;
+                }}
+                h1 {{
+                    margin: 8px 0 4px;
+                    font-size: 28px;
+                    line-height: 1.1;
+                }}
+                .meta {{
+                    color: var(--muted);
+                    font-size: 14px;
+                    margin-bottom: 20px;
+                }}
+                .total {{
+                    margin: 20px 0;
+                    padding: 16px 18px;
+                    border-radius: 16px;
+                    background: #eff6ff;
+                    display: flex;
+                    justify-content: space-between;
+                    align-items: center;
+                    gap: 12px;
+                    font-weight: 700;
+                }}
+                table {{
+                    width: 100%;
+                    border-collapse: collapse;
+                    margin-top: 8px;
+                }}
+                th, td {{
+                    padding: 12px 8px;
+                    border-bottom: 1px solid var(--line);
+                    font-size: 14px;
+                    vertical-align: top;
+                }}
+                th {{
+                    text-align: left;
+                    color: var(--muted);
+                    font-size: 12px;
+                    text-transform: uppercase;
+                    letter-spacing: 0.04em;
+                }}
+                .footer {{
+                    margin-top: 20px;
+                    color: var(--muted);
+                    font-size: 14px;
+                    text-align: center;
+                }}
+                .actions {{
+                    display: flex;
+                    gap: 12px;
+                    flex-wrap: wrap;
+                    margin-top: 20px;
+                }}
+                .btn {{
+                    display: inline-flex;
+                    align-items: center;
+                    justify-content: center;
+                    padding: 12px 16px;
+                    border-radius: 999px;
+                    text-decoration: none;
+                    font-weight: 700;
+                    border: 1px solid var(--line);
+                    color: var(--ink);
+                    background: white;
+                }}
+                .btn-primary {{
+                    background: var(--accent);
+                    color: white;
+                    border-color: var(--accent);
+                }}
+                @media print {{
+                    body {{
+                        background: white;
+                        padding: 0;
+                    }}
+                    .card {{
+                        box-shadow: none;
+                        border: none;
+                        border-radius: 0;
+                        padding: 0;
+                    }}
+                    .actions {{ display: none; }}
+                }}
+            </style>
+        </head>
+        <body>
+            <div class="wrap">
+                <div class="card">
+                    <div class="eyebrow">Reçu numérique</div>
+                    <h1>{escape(receipt["store_name"])}</h1>
+                    <div class="meta">
+                        {escape(receipt.get("store_address") or "")}<br />
+                        {_number_html(receipt)}
+                        Référence vente : {escape(receipt["sale_id"])}<br />
+                        Date : {escape(_created_label(receipt))}<br />
+                        Paiement : {escape(str(receipt.get("payment_method") or ""))}
+                    </div>
+
+                    <div class="total">
+                        <span>Total</span>
+                        <span>{_fmt_amount(receipt.get("total_amount"))}</span>
+                    </div>
+
+                    <table>
+                        <thead>
+                            <tr>
+                                <th>Produit</th>
+                                <th style="text-align:center;">Quantité</th>
+                                <th style="text-align:right;">Prix</th>
+                                <th style="text-align:right;">Total</th>
+                            </tr>
+                        </thead>
+                        <tbody>
+                            {_items_html(receipt)}
+                        </tbody>
+                    </table>
+
+                    <div class="actions">
+                        <a class="btn btn-primary" href="javascript:window.print()">Imprimer</a>
+                        <a class="btn" href="/public/receipts/r/{key}.pdf">Télécharger le PDF</a>
+                        <a class="btn" href="/public/receipts/t/{quote(public_token)}?download=1">Télécharger le reçu</a>
+                    </div>
+
+                    <div class="footer">{escape(receipt.get("receipt_footer") or "Merci de votre visite.")}</div>
+                </div>
+            </div>
+        </body>
+        </html>
+    """
+
+
+def _pdf_text(value: str) -> str:
+    encoded = value.encode("cp1252", errors="replace").decode("latin-1")
+    return encoded.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def receipt_lines(receipt: Dict[str, Any], width: int = 78) -> List[str]:
+    lines = [receipt["store_name"]]
+    if receipt.get("store_address"):
+        lines.append(receipt["store_address"])
+    if receipt.get("receipt_number"):
+        lines.append(f"N° ticket : {receipt['receipt_number']}")
+    lines += [
+        f"Référence vente : {receipt['sale_id']}",
+        f"Date : {_created_label(receipt)}",
+        f"Paiement : {receipt.get('payment_method') or ''}",
+        "-" * width,
+        f"{'Produit':<38}{'Quantité':>12}{'Prix':>14}{'Total':>14}",
+        "-" * width,
+    ]
+    for item in receipt.get("items") or []:
+        name = str(item.get("product_name") or "")
+        lines.append(
+            f"{name[:37]:<38}{_quantity_label(item)[:11]:>12}"
+            f"{_fmt_amount(item.get('selling_price')):>14}{_fmt_amount(item.get('total')):>14}"
+        )
+    lines += ["-" * width, f"{'Total':<50}{_fmt_amount(receipt.get('total_amount')):>28}", ""]
+    lines.append(receipt.get("receipt_footer") or "Merci de votre visite.")
+    return lines
+
+
+def render_pdf(receipt: Dict[str, Any]) -> bytes:
+    """A4 text PDF of the receipt (Courier, WinAnsi), without external dependencies."""
+    lines = receipt_lines(receipt)
+    per_page = 60
+    pages = [lines[start:start + per_page] for start in range(0, len(lines), per_page)] or [[]]
+    objects: List[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",  # page tree, filled once the page objects are numbered
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>",
+    ]
+    page_ids = []
+    for page in pages:
+        stream = "BT /F1 9 Tf 12 TL 40 800 Td " + " ".join(f"({_pdf_text(line)}) '" for line in page) + " ET"
+        content = stream.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode("ascii")
+    objects[1] = b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(page_ids)
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_at = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_at)
+    return bytes(output)
+
+
+def _remember(key: str, render: Dict[str, Any]) -> Dict[str, Any]:
+    _memory[key] = render
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_CACHE_SIZE:
+        _memory.popitem(last=False)
+    return render
+
+
+async def cached(db, key: str) -> Optional[Dict[str, Any]]:
+    """The render stored under ``key``, from memory first."""
+    render = _memory.get(key)
+    if render is not None:
+        _memory.move_to_end(key)
+        return render
+    render = await db.receipt_renders.find_one({"_id": key})
+    return _remember(key, render) if render else None
+
+
+async def get_or_render(db, sale: Dict[str, Any], load_receipt: LoadReceipt) -> Dict[str, Any]:
+    """The render of the current version of ``sale``, rendering it on first access."""
+    key = render_key(sale["public_receipt_token"], sale["sale_id"], sale.get("receipt_version") or 0)
+    render = await cached(db, key)
+    if render is not None:
+        return render
+    receipt = await load_receipt()
+    render = {
+        "_id": key,
+        "sale_id": sale["sale_id"],
+        "receipt_version": int(sale.get("receipt_version") or 0),
+        "public_token": sale["public_receipt_token"],
+        "receipt": receipt,
+        "html": render_page_html(receipt, sale["public_receipt_token"], key),
+        "download_html": render_download_html(receipt),
+        "pdf": None,
+        "created_at": datetime.now(timezone.utc),
+    }
+    await db.receipt_renders.update_one({"_id": key}, {"$setOnInsert": render}, upsert=True)
+    return _remember(key, render)
+
+
+async def ensure_pdf(db, render: Dict[str, Any]) -> bytes:
+    """Render (on the worker pool) and store the PDF of a render that has none yet."""
+    if render.get("pdf"):
+        return bytes(render["pdf"])
+    loop = asyncio.get_running_loop()
+    pdf = await loop.run_in_executor(_pdf_executor, render_pdf, render["receipt"])
+    render["pdf"] = pdf
+    try:
+        await db.receipt_renders.update_one({"_id": render["_id"]}, {"$set": {"pdf": Binary(pdf)}})
+    except Exception as exc:
+        logger.warning("Receipt PDF %s could not be stored: %s", render["_id"], exc)
+    return pdf
+
+
+def clear() -> None:
+    _memory.clear()
+
+
+async def ensure_receipt_render_indexes(db) -> None:
+    await db.receipt_renders.create_index("created_at", expireAfterSeconds=RENDER_KEEP_SECONDS)
+    await db.receipt_renders.create_index("sale_id")
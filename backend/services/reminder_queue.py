@@ -0,0 +1,64 @@
+"""
+Dispatch queue for planner reminders.
+
+Due reminders are read from the ``(is_completed, last_notified_at,
+reminder_at)`` index, oldest first.  A worker claims a batch by stamping a
+lease token and expiry on the items that are still unclaimed (or whose lease
+expired); the conditional ``update_many`` makes each item go to exactly one
+worker, so several processes can drain the queue together.  Delivered items
+get ``last_notified_at`` and lose their lease; items whose delivery failed
+keep it until it expires, which spaces out the retries.
+"""
+
+from __future__ import annotations
+
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+CLAIM_BATCH = 100
+LEASE_DURATION = timedelta(minutes=2)
+MAX_BATCHES_PER_RUN = 50
+
+WORKER_ID = uuid.uuid4().hex[:8]
+
+
+def due_query(now: datetime) -> Dict[str, Any]:
+    return {
+        "is_completed": False,
+        "last_notified_at": None,
+        "reminder_at": {"$lte": now},
+        "$or": [{"reminder_lease_until": None}, {"reminder_lease_until": {"$lte": now}}],
+    }
+
+
+async def claim_batch(db, now: datetime, size: int = CLAIM_BATCH) -> Tuple[str, List[Dict[str, Any]]]:
+    """(lease token, items) for up to ``size`` due reminders claimed by this worker."""
+    candidates = await db.user_planner_items.find(due_query(now), {"_id": 0, "item_id": 1}).sort(
+        "reminder_at", 1
+    ).limit(size).to_list(size)
+    item_ids = [doc["item_id"] for doc in candidates]
+    if not item_ids:
+        return "", []
+    token = f"{WORKER_ID}:{uuid.uuid4().hex[:12]}"
+    await db.user_planner_items.update_many(
+        {**due_query(now), "item_id": {"$in": item_ids}},
+        {"$set": {"reminder_lease": token, "reminder_lease_until": now + LEASE_DURATION}},
+    )
+    items = await db.user_planner_items.find(
+        {"item_id": {"$in": item_ids}, "reminder_lease": token}, {"_id": 0},
+    ).to_list(size)
+    return token, items
+
+
+async def complete(db, token: str, item_ids: List[str], now: datetime) -> None:
+    if not item_ids:
+        return
+    await db.user_planner_items.update_many(
+        {"item_id": {"$in": item_ids}, "reminder_lease": token},
+        {"$set": {"last_notified_at": now}, "$unset": {"reminder_lease": "", "reminder_lease_until": ""}},
+    )
+
+
+async def ensure_reminder_queue_indexes(db) -> None:
+    await db.user_planner_items.create_index([("is_completed", 1), ("last_notified_at", 1), ("reminder_at", 1)])
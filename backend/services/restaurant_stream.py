@@ -0,0 +1,163 @@
+"""
+Real-time stream of restaurant orders and tables, per store.
+
+Order and table writes publish small events (``order_created``,
+``items_added``, ``items_removed``, ``status_changed``, ``table_updated``,
+``table_freed``) instead of making kitchen screens and floor plans poll
+``/kitchen/pending``.  Each store has its own monotonic sequence; events are
+addressed by the cursor ``"<epoch>:<seq>"`` so a screen that reconnects
+resumes right after the last event it saw.  When the cursor cannot be
+honoured (older than the backlog, or issued before a restart) the stream
+sends a single ``resync`` event and the screen reloads its snapshot once.
+
+Publishing goes through ``broker``, an ``InProcessBroker`` by default: it only
+sees the writes of its own process, which is what a single-worker deployment
+needs.  ``set_broker`` swaps in any object with the same ``publish``,
+``subscribe`` and ``cursor`` coroutines/methods (a Redis pub/sub or a MongoDB
+change stream reader) without touching the routes.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+BACKLOG_SIZE = 500
+SUBSCRIBER_QUEUE_SIZE = 1000
+HEARTBEAT_S = 15.0
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[str, int]]:
+    if not cursor:
+        return None
+    epoch, _, seq = str(cursor).strip().rpartition(":")
+    try:
+        return epoch, int(seq)
+    except ValueError:
+        return None
+
+
+class InProcessBroker:
+    def __init__(self, backlog_size: int = BACKLOG_SIZE):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.backlog_size = backlog_size
+        self._seq: Dict[str, int] = {}
+        self._backlog: Dict[str, Deque[Dict[str, Any]]] = {}
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def cursor(self, store_id: str) -> str:
+        return f"{self.epoch}:{self._seq.get(store_id, 0)}"
+
+    async def publish(self, store_id: str, event_type: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        seq = self._seq.get(store_id, 0) + 1
+        self._seq[store_id] = seq
+        event = {"id": f"{self.epoch}:{seq}", "seq": seq, "type": event_type, "store_id": store_id, **payload}
+        self._backlog.setdefault(store_id, deque(maxlen=self.backlog_size)).append(event)
+        for queue in list(self._subscribers.get(store_id, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # A subscriber that cannot keep up gets a resync instead of an unbounded queue.
+                self._subscribers[store_id].discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+        return event
+
+    def _replay(self, store_id: str, after: Optional[str]) -> Tuple[list, bool]:
+        parsed = parse_cursor(after)
+        if parsed is None:
+            return [], after is not None
+        epoch, seq = parsed
+        current = self._seq.get(store_id, 0)
+        backlog = self._backlog.get(store_id) or ()
+        oldest = backlog[0]["seq"] if backlog else current + 1
+        if epoch != self.epoch or seq > current or seq < oldest - 1:
+            return [], True
+        return [event for event in backlog if event["seq"] > seq], False
+
+    def _resync(self, store_id: str) -> Dict[str, Any]:
+        return {"id": self.cursor(store_id), "seq": self._seq.get(store_id, 0), "type": "resync", "store_id": store_id}
+
+    async def subscribe(
+        self,
+        store_id: str,
+        after: Optional[str] = None,
+        heartbeat: float = HEARTBEAT_S,
+    ) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """Events of ``store_id`` after the cursor ``after``; yields None as a heartbeat when idle."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        # Registered before the replay so nothing published meanwhile is lost.
+        self._subscribers.setdefault(store_id, set()).add(queue)
+        try:
+            replay, resync = self._replay(store_id, after)
+            if resync:
+                yield self._resync(store_id)
+            last = parse_cursor(after)[1] if replay else self._seq.get(store_id, 0)
+            for event in replay:
+                last = event["seq"]
+                yield event
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event is None:
+                    yield self._resync(store_id)
+                    return
+                if event["seq"] <= last:
+                    continue
+                last = event["seq"]
+                yield event
+        finally:
+            subscribers = self._subscribers.get(store_id)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    self._subscribers.pop(store_id, None)
+
+    def subscriber_count(self, store_id: str) -> int:
+        return len(self._subscribers.get(store_id, ()))
+
+
+broker: Any = InProcessBroker()
+
+
+def set_broker(new_broker: Any) -> None:
+    global broker
+    broker = new_broker
+
+
+async def publish(store_id: Optional[str], event_type: str, **payload: Any) -> None:
+    """Publish an event; failures are logged, never raised into the write path."""
+    if not store_id:
+        return
+    try:
+        await broker.publish(store_id, event_type, payload)
+    except Exception as exc:
+        logger.warning("Restaurant stream publish %s failed for store %s: %s", event_type, store_id, exc)
+
+
+def current_cursor(store_id: str) -> str:
+    return broker.cursor(store_id)
+
+
+async def sse_frames(source: Any, key: str, after: Optional[str] = None, heartbeat: float = HEARTBEAT_S) -> AsyncIterator[str]:
+    """Server-Sent Events framing of ``source.subscribe`` (any broker with this interface)."""
+    yield f"retry: 3000\n: cursor {source.cursor(key)}\n\n"
+    async for event in source.subscribe(key, after, heartbeat):
+        if event is None:
+            yield ": keep-alive\n\n"
+            continue
+        data = json.dumps(event, ensure_ascii=False, default=str)
+        yield f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+def sse(store_id: str, after: Optional[str] = None, heartbeat: float = HEARTBEAT_S) -> AsyncIterator[str]:
+    return sse_frames(broker, store_id, after, heartbeat)
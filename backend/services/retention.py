@@ -0,0 +1,139 @@
+"""
+Declarative data retention.
+
+Log-like collections carry an ``expires_at`` date computed when the record is
+written, from the retention of the owner's plan (``RETENTION_DAYS``, which
+``RETENTION_POLICY_JSON`` can override per collection and plan).  A TTL
+index with ``expireAfterSeconds=0`` on that field lets MongoDB delete expired
+records continuously instead of a nightly ``delete_many`` burst.  Demo data
+expires from ``demo_expires_at`` (plus a grace period) through partial TTL
+indexes on ``is_demo`` documents, and idle sessions from ``last_active``.
+
+When ``RETENTION_ARCHIVE_DIR`` is set, ``archive_expiring`` copies records
+that will expire within ``ARCHIVE_LEAD`` to gzip-compressed monthly JSON
+Lines files (``<dir>/<collection>/<YYYY-MM>.jsonl.gz``) before the TTL
+monitor removes them.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from bson import json_util
+
+logger = logging.getLogger(__name__)
+
+RETENTION_DAYS: Dict[str, Dict[str, int]] = {
+    "activity_logs": {"default": 90, "pro": 180, "enterprise": 365},
+    "security_events": {"default": 90},
+    # The admin AI usage dashboard looks back up to a year.
+    "ai_usage": {"default": 400},
+    # Storefront stats read the rollups; raw events are only kept for audit.
+    "ecommerce_events": {"default": 35},
+}
+
+SESSION_IDLE_SECONDS = 24 * 3600
+DEMO_GRACE_SECONDS = 24 * 3600
+ARCHIVE_LEAD = timedelta(days=2)
+ARCHIVE_BATCH = 1000
+
+
+def _policy() -> Dict[str, Dict[str, int]]:
+    policy = {collection: dict(days) for collection, days in RETENTION_DAYS.items()}
+    raw = os.environ.get("RETENTION_POLICY_JSON", "").strip()
+    if raw:
+        try:
+            for collection, days in json.loads(raw).items():
+                policy.setdefault(collection, {}).update({str(k): int(v) for k, v in days.items()})
+        except (ValueError, AttributeError, TypeError) as exc:
+            logger.warning("Ignoring invalid RETENTION_POLICY_JSON: %s", exc)
+    return policy
+
+
+def retention_days(collection: str, plan: Optional[str] = None) -> int:
+    days = _policy().get(collection) or {}
+    return int(days.get(plan or "default") or days.get("default") or 90)
+
+
+def expires_at(collection: str, plan: Optional[str] = None, at: Optional[datetime] = None) -> datetime:
+    return (at or datetime.now(timezone.utc)) + timedelta(days=retention_days(collection, plan))
+
+
+async def backfill_expires_at(db) -> Dict[str, int]:
+    """Give records written before retention was declarative the default retention."""
+    now = datetime.now(timezone.utc)
+    counts: Dict[str, int] = {}
+    for collection in _policy():
+        days_ms = retention_days(collection) * 86400 * 1000
+        result = await db[collection].update_many(
+            {"expires_at": {"$exists": False}},
+            [{"$set": {"expires_at": {"$add": [
+                {"$convert": {"input": "$created_at", "to": "date", "onError": now, "onNull": now}},
+                days_ms,
+            ]}}}],
+        )
+        counts[collection] = result.modified_count
+    return counts
+
+
+async def ensure_retention_indexes(db, demo_collections: Iterable[str]) -> None:
+    for collection in _policy():
+        await db[collection].create_index("expires_at", expireAfterSeconds=0, name="retention_ttl")
+    for collection in demo_collections:
+        await db[collection].create_index(
+            "demo_expires_at",
+            expireAfterSeconds=DEMO_GRACE_SECONDS,
+            partialFilterExpression={"is_demo": True},
+            name="demo_data_ttl",
+        )
+    await db.user_sessions.create_index("last_active", expireAfterSeconds=SESSION_IDLE_SECONDS, name="session_idle_ttl")
+
+
+def archive_path(archive_dir: str, collection: str, created_at: Any) -> Path:
+    month = created_at.strftime("%Y-%m") if isinstance(created_at, datetime) else "unknown"
+    return Path(archive_dir) / collection / f"{month}.jsonl.gz"
+
+
+def _append_archive(files: Dict[Path, List[str]]) -> None:
+    for path, lines in files.items():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Each append is a new gzip member; readers see one continuous stream.
+        with gzip.open(path, "at", encoding="utf-8") as handle:
+            handle.write("".join(lines))
+
+
+async def archive_expiring(db, archive_dir: Optional[str] = None, now: Optional[datetime] = None) -> int:
+    """Copy records expiring within ``ARCHIVE_LEAD`` to monthly archive files."""
+    archive_dir = archive_dir if archive_dir is not None else os.environ.get("RETENTION_ARCHIVE_DIR", "").strip()
+    if not archive_dir:
+        return 0
+    horizon = (now or datetime.now(timezone.utc)) + ARCHIVE_LEAD
+    loop = asyncio.get_running_loop()
+    archived = 0
+    for collection in _policy():
+        while True:
+            docs = await db[collection].find(
+                {"expires_at": {"$lte": horizon}, "archived_at": {"$exists": False}},
+            ).sort("expires_at", 1).limit(ARCHIVE_BATCH).to_list(ARCHIVE_BATCH)
+            if not docs:
+                break
+            files: Dict[Path, List[str]] = defaultdict(list)
+            for doc in docs:
+                files[archive_path(archive_dir, collection, doc.get("created_at"))].append(json_util.dumps(doc) + "\n")
+            await loop.run_in_executor(None, _append_archive, files)
+            await db[collection].update_many(
+                {"_id": {"$in": [doc["_id"] for doc in docs]}},
+                {"$set": {"archived_at": datetime.now(timezone.utc)}},
+            )
+            archived += len(docs)
+            if len(docs) < ARCHIVE_BATCH:
+                break
+    return archived
@@ -0,0 +1,143 @@
+"""
+Contiguous document numbers per owner, series and fiscal year.
+
+Each counter is one document of ``sequences`` (``_id`` =
+``"<owner>:<series>:<year>"``) and a number is taken with a single
+``find_one_and_update`` + ``$inc``: no ``count_documents``, no scan, and two
+concurrent callers can never get the same value.  Allocating inside the
+transaction that inserts the numbered document (pass its ``session``) keeps
+the series gap-free, since an aborted insert also rolls the counter back.
+
+Offline clients reserve a block with ``reserve_block``: the range is taken
+from the same counter in one ``$inc`` and recorded in ``sequence_blocks`` so
+a number sent later by the device can be checked with ``reserved_block`` and
+the unused tail of a block explained to an auditor.
+
+The fiscal year is the calendar year in UTC; no setting in the accounts
+defines another one.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+MAX_BLOCK_SIZE = 500
+
+_NUMBER_RE = re.compile(r"^(?P<prefix>[A-Z0-9]+)-(?P<year>\d{4})-(?P<value>\d+)$")
+
+
+def fiscal_year(at: Optional[datetime] = None) -> int:
+    at = at or datetime.now(timezone.utc)
+    return (at if at.tzinfo else at.replace(tzinfo=timezone.utc)).astimezone(timezone.utc).year
+
+
+def clean_prefix(prefix: Optional[str], default: str) -> str:
+    return "".join(ch for ch in (prefix or default).upper() if ch.isalnum()) or default
+
+
+def format_number(prefix: str, year: int, value: int, width: int = 5) -> str:
+    return f"{prefix}-{year}-{value:0{width}d}"
+
+
+def parse_number(number: Optional[str]) -> Optional[Tuple[str, int, int]]:
+    match = _NUMBER_RE.match((number or "").strip().upper())
+    if not match:
+        return None
+    return match["prefix"], int(match["year"]), int(match["value"])
+
+
+def _counter_id(owner_id: str, series: str, year: int) -> str:
+    return f"{owner_id}:{series}:{year}"
+
+
+async def allocate(db, owner_id: str, series: str, year: int, count: int = 1, session=None) -> int:
+    """Take ``count`` consecutive numbers; returns the first one."""
+    query = {"_id": _counter_id(owner_id, series, year)}
+    update = {
+        "$inc": {"value": count},
+        "$set": {"updated_at": datetime.now(timezone.utc)},
+        "$setOnInsert": {"owner_id": owner_id, "series": series, "year": year},
+    }
+    try:
+        counter = await db.sequences.find_one_and_update(
+            query, update, upsert=True, return_document=ReturnDocument.AFTER, session=session,
+        )
+    except DuplicateKeyError:
+        # Two first allocations raced on the upsert; the counter exists now.
+        counter = await db.sequences.find_one_and_update(
+            query, update, upsert=True, return_document=ReturnDocument.AFTER, session=session,
+        )
+    return int(counter["value"]) - count + 1
+
+
+async def next_number(
+    db,
+    owner_id: str,
+    series: str,
+    prefix: str,
+    at: Optional[datetime] = None,
+    width: int = 5,
+    session=None,
+) -> str:
+    year = fiscal_year(at)
+    value = await allocate(db, owner_id, series, year, session=session)
+    return format_number(prefix, year, value, width)
+
+
+async def reserve_block(
+    db,
+    owner_id: str,
+    series: str,
+    prefix: str,
+    count: int,
+    reserved_by: Optional[str] = None,
+    at: Optional[datetime] = None,
+    width: int = 5,
+) -> Dict[str, Any]:
+    """Reserve ``count`` numbers for an offline client and record the block."""
+    count = min(max(int(count), 1), MAX_BLOCK_SIZE)
+    year = fiscal_year(at)
+    first = await allocate(db, owner_id, series, year, count)
+    block = {
+        "block_id": f"seqb_{uuid.uuid4().hex[:12]}",
+        "owner_id": owner_id,
+        "series": series,
+        "year": year,
+        "prefix": prefix,
+        "first": first,
+        "last": first + count - 1,
+        "reserved_by": reserved_by,
+        "reserved_at": at or datetime.now(timezone.utc),
+    }
+    await db.sequence_blocks.insert_one(dict(block))
+    return {
+        **block,
+        "first_number": format_number(prefix, year, first, width),
+        "last_number": format_number(prefix, year, first + count - 1, width),
+    }
+
+
+async def reserved_block(db, owner_id: str, series: str, number: Optional[str]) -> Optional[Dict[str, Any]]:
+    """The block reserved by ``owner_id`` that contains ``number``, if any."""
+    parsed = parse_number(number)
+    if not parsed:
+        return None
+    prefix, year, value = parsed
+    return await db.sequence_blocks.find_one(
+        {"owner_id": owner_id, "series": series, "year": year, "prefix": prefix,
+         "first": {"$lte": value}, "last": {"$gte": value}},
+        {"_id": 0},
+    )
+
+
+async def ensure_sequence_indexes(db) -> None:
+    await db.sequence_blocks.create_index([("owner_id", 1), ("series", 1), ("year", 1), ("first", 1)])
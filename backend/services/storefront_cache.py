@@ -0,0 +1,188 @@
+"""
+Versioned snapshots of the public storefront.
+
+Every e-commerce account carries ``ecommerce_catalog_version``, bumped by
+``bump_version`` whenever a write changes what its storefront shows
+(products, stock, categories, store or site settings).  The storefront of a
+shop is built once per version and kept in memory, so an anonymous visit
+costs one lookup in ``_snapshots`` instead of a catalog scan.  Each rendered
+variant (whole catalog, or one page of one category) is serialized once and
+carries a strong ETag computed from its bytes, which lets browsers and CDNs
+revalidate with ``If-None-Match`` and get a 304 without a body.
+
+Stock writes (sales, receptions, adjustments) only bump the version when a
+product goes in or out of stock (``changes_listing``), so a shop selling in
+person keeps serving the same snapshot; the quantities it shows may lag by
+up to ``SNAPSHOT_TTL_S``.
+
+Snapshots also expire after ``SNAPSHOT_TTL_S`` as a safety net for writes
+that do not bump the version (owner profile edits, stock levels).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_CACHE_SIZE = 512
+SNAPSHOT_TTL_S = 600
+PAGE_SIZE = 48
+MAX_PAGE_SIZE = 200
+CACHE_CONTROL = "public, max-age=30, stale-while-revalidate=300"
+
+VERSION_FIELD = "ecommerce_catalog_version"
+
+_snapshots: "OrderedDict[Tuple[str, int], Dict[str, Any]]" = OrderedDict()
+_building: Dict[Tuple[str, int], asyncio.Future] = {}
+
+
+async def bump_version(db, owner_ids: Iterable[Optional[str]]) -> None:
+    """Invalidate the storefront snapshots of the given owners."""
+    owner_ids = [owner_id for owner_id in dict.fromkeys(owner_ids) if owner_id]
+    if not owner_ids:
+        return
+    await db.business_accounts.update_many(
+        {"owner_user_id": {"$in": owner_ids}, "ecommerce_enabled": True},
+        {"$inc": {VERSION_FIELD: 1}},
+    )
+
+
+def changes_listing(old_class: Optional[Dict[str, Any]], new_class: Optional[Dict[str, Any]]) -> bool:
+    """Whether an inventory class transition adds, removes or (un)stocks a product on the storefront."""
+    old_class, new_class = old_class or {}, new_class or {}
+    return any(bool(old_class.get(flag)) != bool(new_class.get(flag)) for flag in ("active", "out"))
+
+
+async def bump_version_for_products(db, product_ids: Iterable[str]) -> None:
+    product_ids = [product_id for product_id in dict.fromkeys(product_ids) if product_id]
+    if not product_ids:
+        return
+    owner_ids = await db.products.distinct("user_id", {"product_id": {"$in": product_ids}})
+    await bump_version(db, owner_ids)
+
+
+def snapshot_key(account_doc: Dict[str, Any]) -> Tuple[str, int]:
+    return str(account_doc.get("account_id") or account_doc.get("ecommerce_slug")), int(account_doc.get(VERSION_FIELD) or 0)
+
+
+def build_snapshot(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Index a storefront payload (``site`` + ``products``) by category."""
+    by_category: Dict[str, List[Dict[str, Any]]] = {}
+    for product in payload.get("products") or []:
+        by_category.setdefault(product.get("category") or "", []).append(product)
+    categories = [
+        {"name": name or None, "key": name, "product_count": len(products)}
+        for name, products in sorted(by_category.items(), key=lambda item: (item[0] == "", item[0].lower()))
+    ]
+    return {
+        "site": payload.get("site") or {},
+        "products": payload.get("products") or [],
+        "categories": categories,
+        "by_category": by_category,
+        "by_id": {product.get("product_id"): product for product in payload.get("products") or []},
+        "built_at": time.monotonic(),
+        "bodies": {},
+    }
+
+
+async def get_snapshot(
+    key: Tuple[str, int],
+    build: Callable[[], Awaitable[Dict[str, Any]]],
+) -> Dict[str, Any]:
+    """Return the snapshot of ``key``, building it once even under concurrent misses."""
+    snapshot = _snapshots.get(key)
+    if snapshot and time.monotonic() - snapshot["built_at"] < SNAPSHOT_TTL_S:
+        _snapshots.move_to_end(key)
+        return snapshot
+    pending = _building.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    future = asyncio.get_running_loop().create_future()
+    _building[key] = future
+    try:
+        snapshot = build_snapshot(await build())
+    except BaseException as exc:
+        future.set_exception(exc)
+        # Nobody may be waiting; retrieve the exception so it is not reported as unhandled.
+        future.exception()
+        raise
+    else:
+        future.set_result(snapshot)
+        for stale in [cached for cached in _snapshots if cached[0] == key[0]]:
+            _snapshots.pop(stale, None)
+        _snapshots[key] = snapshot
+        while len(_snapshots) > SNAPSHOT_CACHE_SIZE:
+            _snapshots.popitem(last=False)
+        return snapshot
+    finally:
+        _building.pop(key, None)
+
+
+def cached_product(key: Tuple[str, int], product_id: str) -> Optional[Dict[str, Any]]:
+    """A product of an already built snapshot, without building one."""
+    snapshot = _snapshots.get(key)
+    return snapshot["by_id"].get(product_id) if snapshot else None
+
+
+def _view(snapshot: Dict[str, Any], category: Optional[str], page: Optional[int], page_size: int) -> Dict[str, Any]:
+    if category is None and page is None:
+        return {"site": snapshot["site"], "categories": snapshot["categories"], "products": snapshot["products"]}
+    products = snapshot["products"] if category is None else snapshot["by_category"].get(category, [])
+    page = max(page or 1, 1)
+    start = (page - 1) * page_size
+    return {
+        "site": snapshot["site"],
+        "categories": snapshot["categories"],
+        "category": category,
+        "products": products[start:start + page_size],
+        "pagination": {
+            "page": page,
+            "page_size": page_size,
+            "total": len(products),
+            "pages": math.ceil(len(products) / page_size) if products else 0,
+        },
+    }
+
+
+def render(
+    snapshot: Dict[str, Any],
+    category: Optional[str] = None,
+    page: Optional[int] = None,
+    page_size: int = PAGE_SIZE,
+) -> Tuple[bytes, str]:
+    """Serialized body and strong ETag of one view of a snapshot, memoized per snapshot."""
+    page_size = min(max(page_size or PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    variant = (category, page, page_size)
+    cached = snapshot["bodies"].get(variant)
+    if cached:
+        return cached
+    body = json.dumps(_view(snapshot, category, page, page_size), ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+    rendered = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+    total = len(snapshot["products"] if category is None else snapshot["by_category"].get(category, []))
+    # Out-of-range pages and unknown categories are not memoized, so callers cannot grow the cache.
+    if (category is None or category in snapshot["by_category"]) and (page is None or (page - 1) * page_size < max(total, 1)):
+        snapshot["bodies"][variant] = rendered
+    return rendered
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of ``If-None-Match`` against an ETag, as RFC 9110 requires for GET."""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    if "*" in candidates:
+        return True
+    return any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+
+def clear() -> None:
+    _snapshots.clear()
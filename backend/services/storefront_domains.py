@@ -0,0 +1,199 @@
+"""
+Custom-domain routing and DNS verification for storefronts.
+
+Public requests on a custom domain are routed through ``_routes``, an
+in-memory host -> account id table.  Only the mapping is cached: the account
+itself is read by id on every request, so its settings and storefront
+version (hence snapshots and ETags) are never older than the database.  The
+domain query runs when an entry is missing or older than ``ROUTE_TTL_S``.
+Unknown hosts are cached as misses for ``NEGATIVE_TTL_S`` so scans with
+random Host headers do not reach MongoDB.  ``forget`` drops hosts right away
+when the domain settings of a shop change; other workers pick the change up
+when their entry expires, or at once if the account no longer serves the host.
+
+DNS checks never run in a request.  ``request_check`` stamps
+``ecommerce_domain_check_requested_at`` on the account.  ``run_due_checks``
+then leases the accounts waiting for a check (requested, or pending and not
+checked for ``RECHECK_INTERVAL``), resolves the domain and the platform
+target with a timeout, and stores the outcome: the status, the
+verification date and ``ecommerce_domain_last_check``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+ROUTE_TTL_S = 30
+NEGATIVE_TTL_S = 60
+MAX_ROUTES = 10000
+
+DNS_TIMEOUT_S = 5.0
+CHECK_BATCH = 50
+CHECK_CONCURRENCY = 8
+CHECK_LEASE = timedelta(minutes=2)
+RECHECK_INTERVAL = timedelta(minutes=15)
+
+WORKER_ID = uuid.uuid4().hex[:8]
+
+_routes: "OrderedDict[str, Tuple[float, Optional[str]]]" = OrderedDict()
+
+# lookup(host, account_id): the enabled account serving ``host``, restricted to ``account_id`` when given.
+Lookup = Callable[[str, Optional[str]], Awaitable[Optional[Dict[str, Any]]]]
+Resolver = Callable[[str], Awaitable[Set[str]]]
+
+
+async def route(host: str, lookup: Lookup) -> Optional[Dict[str, Any]]:
+    """The account serving ``host``, or None; a cached host is read by account id."""
+    cached = _routes.get(host)
+    if cached and cached[0] > time.monotonic():
+        _routes.move_to_end(host)
+        if cached[1] is None:
+            return None
+        account_doc = await lookup(host, cached[1])
+        if account_doc:
+            return account_doc
+        # The account no longer serves this host (domain moved, shop disabled).
+        _routes.pop(host, None)
+    account_doc = await lookup(host, None)
+    ttl = ROUTE_TTL_S if account_doc else NEGATIVE_TTL_S
+    _routes[host] = (time.monotonic() + ttl, account_doc["account_id"] if account_doc else None)
+    _routes.move_to_end(host)
+    while len(_routes) > MAX_ROUTES:
+        _routes.popitem(last=False)
+    return account_doc
+
+
+def forget(*hosts: Optional[str]) -> None:
+    for host in hosts:
+        if host:
+            _routes.pop(host, None)
+
+
+def clear() -> None:
+    _routes.clear()
+
+
+async def resolve_host_ip_set(host: Optional[str], timeout: float = DNS_TIMEOUT_S) -> Set[str]:
+    if not host:
+        return set()
+    loop = asyncio.get_running_loop()
+    try:
+        addrinfo = await asyncio.wait_for(
+            loop.run_in_executor(None, socket.getaddrinfo, host, 443, socket.AF_UNSPEC, socket.SOCK_STREAM),
+            timeout,
+        )
+    except Exception:
+        return set()
+    return {str(entry[4][0]) for entry in addrinfo if entry[4] and entry[4][0]}
+
+
+async def check_domain(domain: str, target_ips: Set[str], resolve: Resolver = resolve_host_ip_set) -> Dict[str, Any]:
+    domain_ips = await resolve(domain)
+    return {
+        "verified": bool(domain_ips & target_ips),
+        "domain_ips": sorted(domain_ips),
+        "target_ips": sorted(target_ips),
+        "error": None if domain_ips else "dns_unresolved",
+    }
+
+
+async def request_check(db, account_id: str, now: datetime) -> None:
+    await db.business_accounts.update_one(
+        {"account_id": account_id},
+        {"$set": {"ecommerce_domain_check_requested_at": now}},
+    )
+
+
+def _due_query(now: datetime) -> Dict[str, Any]:
+    return {
+        "ecommerce_custom_domain": {"$nin": [None, ""]},
+        "$and": [
+            {"$or": [
+                {"ecommerce_domain_check_requested_at": {"$ne": None}},
+                {
+                    "ecommerce_domain_status": "pending_verification",
+                    "$or": [
+                        {"ecommerce_domain_last_check_at": None},
+                        {"ecommerce_domain_last_check_at": {"$lte": now - RECHECK_INTERVAL}},
+                    ],
+                },
+            ]},
+            {"$or": [
+                {"ecommerce_domain_check_lease_until": None},
+                {"ecommerce_domain_check_lease_until": {"$lte": now}},
+            ]},
+        ],
+    }
+
+
+async def claim_checks(db, now: datetime, size: int = CHECK_BATCH) -> Tuple[str, List[Dict[str, Any]]]:
+    candidates = await db.business_accounts.find(_due_query(now), {"_id": 0, "account_id": 1}).limit(size).to_list(size)
+    account_ids = [doc["account_id"] for doc in candidates]
+    if not account_ids:
+        return "", []
+    token = f"{WORKER_ID}:{uuid.uuid4().hex[:12]}"
+    await db.business_accounts.update_many(
+        {**_due_query(now), "account_id": {"$in": account_ids}},
+        {"$set": {"ecommerce_domain_check_lease": token, "ecommerce_domain_check_lease_until": now + CHECK_LEASE}},
+    )
+    accounts = await db.business_accounts.find(
+        {"account_id": {"$in": account_ids}, "ecommerce_domain_check_lease": token},
+        {"_id": 0, "account_id": 1, "ecommerce_custom_domain": 1, "ecommerce_domain_status": 1,
+         "ecommerce_domain_verified_at": 1},
+    ).to_list(size)
+    return token, accounts
+
+
+async def run_due_checks(
+    db,
+    target_host: str,
+    now: datetime,
+    resolve: Resolver = resolve_host_ip_set,
+    concurrency: int = CHECK_CONCURRENCY,
+) -> Dict[str, int]:
+    """Check one leased batch of domains and persist the results."""
+    token, accounts = await claim_checks(db, now)
+    if not accounts:
+        return {}
+    target_ips = await resolve(target_host)
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = {"verified": 0, "pending": 0}
+
+    async def check(account: Dict[str, Any]) -> None:
+        domain = account["ecommerce_custom_domain"]
+        async with semaphore:
+            result = await check_domain(domain, target_ips, resolve)
+        if not target_ips:
+            result["error"] = "target_unresolved"
+        fields: Dict[str, Any] = {
+            "ecommerce_domain_status": "verified" if result["verified"] else "pending_verification",
+            "ecommerce_domain_verified_at": (account.get("ecommerce_domain_verified_at") or now) if result["verified"] else None,
+            "ecommerce_domain_last_check_at": now,
+            "ecommerce_domain_last_check": {**result, "checked_at": now},
+            "ecommerce_domain_check_requested_at": None,
+            "ecommerce_domain_check_lease": None,
+            "ecommerce_domain_check_lease_until": None,
+        }
+        # The domain may have been changed while it was being checked; that result is then dropped.
+        await db.business_accounts.update_one(
+            {"account_id": account["account_id"], "ecommerce_domain_check_lease": token, "ecommerce_custom_domain": domain},
+            {"$set": fields},
+        )
+        counts["verified" if result["verified"] else "pending"] += 1
+
+    await asyncio.gather(*(check(account) for account in accounts))
+    return counts
+
+
+async def ensure_domain_indexes(db) -> None:
+    await db.business_accounts.create_index("ecommerce_custom_domain", sparse=True)
+    await db.business_accounts.create_index("ecommerce_domain_check_requested_at", sparse=True)
@@ -0,0 +1,221 @@
+"""
+Buffered ingestion of public storefront events (page views, add to cart).
+
+``record`` only appends the event to an in-memory buffer of the worker;
+``flush`` drains it every few seconds (or as soon as ``FLUSH_SIZE`` events
+are waiting) and, per batch:
+
+* folds the events into ``ecommerce_event_rollups`` with one ``$inc`` upsert
+  per shop, UTC day and product (``product_id: None`` holds the shop totals);
+* refreshes ``ecommerce_visitors`` (one document per shop and visitor,
+  ``last_seen`` expiring after ``VISITOR_WINDOW_DAYS``) for unique visitors;
+* inserts the raw events with ``insert_many``.  Raw events expire through
+  the ``ecommerce_events`` retention policy and are only kept for audit.
+
+The stats endpoint reads the rollups and the visitor index only.  Events
+still in the buffer when a worker dies are lost, which is acceptable for
+these counters; a flush that fails puts its batch back (up to
+``MAX_BUFFER`` events).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = 500
+MAX_BUFFER = 20000
+VISITOR_WINDOW_DAYS = 31
+BACKFILL_BATCH = 1000
+
+EVENT_TYPES = ("site_view", "add_to_cart")
+
+_buffer: List[Dict[str, Any]] = []
+_flush_task: Optional[asyncio.Task] = None
+
+
+def day_of(at: datetime) -> datetime:
+    at = at if at.tzinfo else at.replace(tzinfo=timezone.utc)
+    return at.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def record(db, event: Dict[str, Any]) -> None:
+    """Queue one event; a full buffer is flushed in the background."""
+    global _flush_task
+    _buffer.append(event)
+    if len(_buffer) >= FLUSH_SIZE and (_flush_task is None or _flush_task.done()):
+        _flush_task = asyncio.create_task(flush(db))
+
+
+def pending() -> int:
+    return len(_buffer)
+
+
+def _rollup_key(event: Dict[str, Any], product_id: Optional[str]) -> Tuple[Any, ...]:
+    return (event.get("user_id"), event.get("site_slug"), event.get("store_id"), day_of(event["created_at"]), product_id)
+
+
+def rollup_operations(events: List[Dict[str, Any]], now: Optional[datetime] = None) -> Dict[str, List[UpdateOne]]:
+    """Fold a batch of events into rollup and visitor upserts, one per key."""
+    now = now or datetime.now(timezone.utc)
+    rollups: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+    visitors: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+    for event in events:
+        event_type = event.get("event_type")
+        if event_type not in EVENT_TYPES:
+            continue
+        keys = [None] + ([event["product_id"]] if event.get("product_id") else [])
+        for product_id in keys:
+            entry = rollups.setdefault(_rollup_key(event, product_id), {"inc": {}, "name": None})
+            entry["inc"][f"counts.{event_type}"] = entry["inc"].get(f"counts.{event_type}", 0) + 1
+            if event_type == "add_to_cart":
+                entry["inc"]["cart_quantity"] = entry["inc"].get("cart_quantity", 0) + float(event.get("quantity") or 1)
+            if product_id:
+                entry["name"] = event.get("product_name") or entry["name"]
+        if event_type == "site_view" and event.get("visitor_key"):
+            key = (event.get("user_id"), event.get("site_slug"), event["visitor_key"])
+            seen = visitors.setdefault(key, {"first": event["created_at"], "last": event["created_at"], "store_id": event.get("store_id")})
+            seen["first"] = min(seen["first"], event["created_at"])
+            seen["last"] = max(seen["last"], event["created_at"])
+
+    rollup_ops = []
+    for (owner_id, slug, store_id, day, product_id), entry in rollups.items():
+        update: Dict[str, Any] = {"$inc": entry["inc"], "$set": {"updated_at": now}}
+        if entry["name"]:
+            update["$set"]["product_name"] = entry["name"]
+        rollup_ops.append(UpdateOne(
+            {"user_id": owner_id, "site_slug": slug, "store_id": store_id, "day": day, "product_id": product_id},
+            update,
+            upsert=True,
+        ))
+    visitor_ops = [
+        UpdateOne(
+            {"user_id": owner_id, "site_slug": slug, "visitor_key": visitor_key},
+            {
+                "$min": {"first_seen": seen["first"]},
+                "$max": {"last_seen": seen["last"]},
+                "$set": {"store_id": seen["store_id"]},
+            },
+            upsert=True,
+        )
+        for (owner_id, slug, visitor_key), seen in visitors.items()
+    ]
+    return {"rollups": rollup_ops, "visitors": visitor_ops}
+
+
+async def _apply(db, events: List[Dict[str, Any]]) -> None:
+    operations = rollup_operations(events)
+    if operations["rollups"]:
+        await db.ecommerce_event_rollups.bulk_write(operations["rollups"], ordered=False)
+    if operations["visitors"]:
+        await db.ecommerce_visitors.bulk_write(operations["visitors"], ordered=False)
+
+
+async def flush(db) -> int:
+    """Write the buffered events; returns how many were flushed."""
+    global _buffer
+    events, _buffer = _buffer, []
+    if not events:
+        return 0
+    try:
+        await _apply(db, events)
+    except Exception as exc:
+        logger.warning("Storefront event rollup failed for %s event(s), keeping them: %s", len(events), exc)
+        _buffer = (events + _buffer)[-MAX_BUFFER:]
+        return 0
+    for event in events:
+        event["rolled_up"] = True
+    try:
+        await db.ecommerce_events.insert_many(events, ordered=False)
+    except Exception as exc:
+        logger.warning("Raw storefront events insert failed for %s event(s): %s", len(events), exc)
+    return len(events)
+
+
+async def backfill_rollups(db) -> int:
+    """Fold raw events stored before rollups existed; folded events are marked ``rolled_up``."""
+    folded = 0
+    while True:
+        events = await db.ecommerce_events.find(
+            {"rolled_up": {"$exists": False}},
+            {"_id": 1, "event_type": 1, "user_id": 1, "site_slug": 1, "store_id": 1, "created_at": 1,
+             "product_id": 1, "product_name": 1, "quantity": 1, "visitor_key": 1},
+        ).limit(BACKFILL_BATCH).to_list(BACKFILL_BATCH)
+        if not events:
+            return folded
+        dated = [event for event in events if isinstance(event.get("created_at"), datetime)]
+        if dated:
+            await _apply(db, dated)
+        await db.ecommerce_events.update_many(
+            {"_id": {"$in": [event["_id"] for event in events]}},
+            {"$set": {"rolled_up": True}},
+        )
+        folded += len(dated)
+        if len(events) < BACKFILL_BATCH:
+            return folded
+
+
+async def read_stats(
+    db,
+    owner_id: str,
+    slug: Optional[str],
+    store_id: Optional[str],
+    now: datetime,
+    days: int = 30,
+    top: int = 5,
+) -> Dict[str, Any]:
+    """Storefront traffic figures for the stats endpoint, from the rollups only."""
+    scope: Dict[str, Any] = {"user_id": owner_id, "site_slug": slug}
+    if store_id:
+        scope["store_id"] = store_id
+    today = day_of(now)
+    window_start = today - timedelta(days=days - 1)
+    totals = await db.ecommerce_event_rollups.aggregate([
+        {"$match": {**scope, "product_id": None}},
+        {"$group": {
+            "_id": None,
+            "visits_total": {"$sum": {"$ifNull": ["$counts.site_view", 0]}},
+            "visits_window": {"$sum": {"$cond": [{"$gte": ["$day", window_start]}, {"$ifNull": ["$counts.site_view", 0]}, 0]}},
+            "visits_today": {"$sum": {"$cond": [{"$gte": ["$day", today]}, {"$ifNull": ["$counts.site_view", 0]}, 0]}},
+            "add_to_cart_window": {"$sum": {"$cond": [{"$gte": ["$day", window_start]}, {"$ifNull": ["$counts.add_to_cart", 0]}, 0]}},
+        }},
+    ]).to_list(1)
+    products = await db.ecommerce_event_rollups.aggregate([
+        {"$match": {**scope, "product_id": {"$ne": None}, "day": {"$gte": window_start}, "counts.add_to_cart": {"$gt": 0}}},
+        {"$group": {
+            "_id": "$product_id",
+            "name": {"$last": "$product_name"},
+            "quantity": {"$sum": "$cart_quantity"},
+            "events": {"$sum": "$counts.add_to_cart"},
+        }},
+        {"$sort": {"quantity": -1, "events": -1}},
+    ]).to_list(None)
+    unique_visitors = await db.ecommerce_visitors.count_documents(
+        {**scope, "last_seen": {"$gte": now - timedelta(days=days)}}
+    )
+    row = totals[0] if totals else {}
+    return {
+        "visits_total": int(row.get("visits_total") or 0),
+        "visits_window": int(row.get("visits_window") or 0),
+        "visits_today": int(row.get("visits_today") or 0),
+        "unique_visitors_window": unique_visitors,
+        "add_to_cart_window": int(row.get("add_to_cart_window") or 0),
+        "products_in_cart_window": len(products),
+        "top_cart_products": products[:top],
+    }
+
+
+async def ensure_storefront_event_indexes(db) -> None:
+    await db.ecommerce_event_rollups.create_index(
+        [("user_id", 1), ("site_slug", 1), ("store_id", 1), ("day", 1), ("product_id", 1)], unique=True,
+    )
+    await db.ecommerce_event_rollups.create_index([("user_id", 1), ("site_slug", 1), ("product_id", 1), ("day", -1)])
+    await db.ecommerce_visitors.create_index([("user_id", 1), ("site_slug", 1), ("visitor_key", 1)], unique=True)
+    await db.ecommerce_visitors.create_index([("user_id", 1), ("site_slug", 1), ("last_seen", -1)])
+    await db.ecommerce_visitors.create_index("last_seen", expireAfterSeconds=VISITOR_WINDOW_DAYS * 86400)
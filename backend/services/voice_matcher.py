@@ -0,0 +1,252 @@
+"""
+Voice-to-cart product matcher.
+
+Builds, per store, a token-level Aho-Corasick automaton over normalized
+product names, aliases and variant names.  A transcript is then scanned once,
+left to right, and every product mention is returned together with the
+quantity spoken around it ("2 kg de riz", "coca fois 3", "trois pains").
+
+Automatons are built lazily, cached in memory and dropped by
+``invalidate_store_matcher`` whenever the catalog of a store changes.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import time
+import unicodedata
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MATCHER_CACHE_TTL_S = 900  # safety net; explicit invalidation is the primary path
+MATCHER_MAX_PRODUCTS = 20000
+MAX_VOICE_QTY = 999
+
+NUMBER_WORDS: Dict[str, int] = {
+    "un": 1, "une": 1, "one": 1, "uno": 1, "una": 1,
+    "deux": 2, "two": 2, "dos": 2,
+    "trois": 3, "three": 3, "tres": 3,
+    "quatre": 4, "four": 4, "cuatro": 4,
+    "cinq": 5, "five": 5, "cinco": 5,
+    "six": 6, "seis": 6,
+    "sept": 7, "seven": 7, "siete": 7,
+    "huit": 8, "eight": 8, "ocho": 8,
+    "neuf": 9, "nine": 9, "nueve": 9,
+    "dix": 10, "ten": 10, "diez": 10,
+    "douze": 12, "twelve": 12,
+    "quinze": 15, "vingt": 20, "twenty": 20,
+}
+
+# Words that may sit between a quantity and the product name ("3 sacs de riz").
+UNIT_WORDS = {
+    "piece", "pieces", "unite", "unites", "unit", "units",
+    "kg", "kilo", "kilos", "kilogramme", "kilogrammes", "g", "gramme", "grammes",
+    "l", "litre", "litres", "liter", "liters", "ml", "cl",
+    "sac", "sacs", "bag", "bags", "carton", "cartons", "boite", "boites", "box", "boxes",
+    "bouteille", "bouteilles", "bottle", "bottles", "paquet", "paquets", "pack", "packs",
+    "canette", "canettes", "can", "cans", "sachet", "sachets", "pot", "pots",
+    "botte", "bottes", "tas", "plateau", "plateaux", "douzaine", "douzaines",
+}
+FILLER_WORDS = {"de", "d", "du", "des", "of", "la", "le", "les", "x"}
+MULTIPLIER_WORDS = {"x", "fois", "times", "por"}
+
+_UNFOLDED_WORDS = set(NUMBER_WORDS) | FILLER_WORDS | MULTIPLIER_WORDS
+_TOKEN_RE = re.compile(r"\d+(?:[.,]\d+)?|[a-z]+")
+
+
+def normalize_voice_text(value: Any) -> str:
+    text = str(value or "").strip().lower()
+    nfkd = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in nfkd if not unicodedata.combining(c))
+
+
+def _fold_plural(token: str) -> str:
+    # "pains" -> "pain", applied to names and transcripts alike so both sides agree.
+    if len(token) > 3 and token.endswith("s") and token not in _UNFOLDED_WORDS:
+        return token[:-1]
+    return token
+
+
+def tokenize_voice_text(value: Any) -> List[str]:
+    return [_fold_plural(token) for token in _TOKEN_RE.findall(normalize_voice_text(value))]
+
+
+def _parse_number(token: str) -> Optional[float]:
+    if token in NUMBER_WORDS:
+        return float(NUMBER_WORDS[token])
+    if token and token[0].isdigit():
+        try:
+            return float(token.replace(",", "."))
+        except ValueError:
+            return None
+    return None
+
+
+def _product_phrases(product: Dict[str, Any]) -> Iterable[str]:
+    yield product.get("name") or ""
+    for alias in product.get("aliases") or []:
+        yield alias
+    for variant in product.get("variants") or []:
+        variant_name = (variant or {}).get("name")
+        if variant_name:
+            yield f"{product.get('name') or ''} {variant_name}"
+
+
+class ProductNameMatcher:
+    """Token-level Aho-Corasick automaton over a store's product phrases."""
+
+    def __init__(self, products: Iterable[Dict[str, Any]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # state -> list of (pattern_length_in_tokens, product_id)
+        self._out: List[List[Tuple[int, str]]] = [[]]
+        self.products: Dict[str, Dict[str, Any]] = {}
+        self.pattern_count = 0
+
+        for product in products:
+            product_id = product.get("product_id")
+            if not product_id:
+                continue
+            self.products[product_id] = product
+            seen = set()
+            for phrase in _product_phrases(product):
+                tokens = tuple(tokenize_voice_text(phrase))
+                if not tokens or tokens in seen or len("".join(tokens)) < 2:
+                    continue
+                seen.add(tokens)
+                self._add(tokens, product_id)
+        self._build_failure_links()
+
+    def _add(self, tokens: Tuple[str, ...], product_id: str) -> None:
+        state = 0
+        for token in tokens:
+            nxt = self._goto[state].get(token)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][token] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append((len(tokens), product_id))
+        self.pattern_count += 1
+
+    def _build_failure_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and token not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                candidate = self._goto[fallback].get(token, 0)
+                self._fail[nxt] = candidate if candidate != nxt else 0
+                self._out[nxt].extend(self._out[self._fail[nxt]])
+
+    def _scan(self, tokens: List[str]) -> List[Tuple[int, int, str]]:
+        """Return (start, end, product_id) for every mention, end exclusive."""
+        hits: List[Tuple[int, int, str]] = []
+        state = 0
+        for index, token in enumerate(tokens):
+            while state and token not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(token, 0)
+            for length, product_id in self._out[state]:
+                hits.append((index - length + 1, index + 1, product_id))
+        return hits
+
+    @staticmethod
+    def _select_leftmost_longest(hits: List[Tuple[int, int, str]]) -> List[Tuple[int, int, str]]:
+        hits.sort(key=lambda h: (h[0], -(h[1] - h[0])))
+        selected: List[Tuple[int, int, str]] = []
+        cursor = 0
+        for start, end, product_id in hits:
+            if start < cursor:
+                continue
+            selected.append((start, end, product_id))
+            cursor = end
+        return selected
+
+    @staticmethod
+    def _quantity_around(tokens: List[str], start: int, end: int, floor: int) -> Optional[float]:
+        # "coca x 3" / "coca fois 3"
+        if end + 1 < len(tokens) and tokens[end] in MULTIPLIER_WORDS:
+            value = _parse_number(tokens[end + 1])
+            if value is not None:
+                return value
+        # "3 bouteilles de coca" / "deux pains" — walk back over unit and filler words
+        cursor = start - 1
+        while cursor >= floor and (tokens[cursor] in UNIT_WORDS or tokens[cursor] in FILLER_WORDS):
+            cursor -= 1
+        if cursor >= floor:
+            return _parse_number(tokens[cursor])
+        return None
+
+    def match(self, text: str) -> List[Dict[str, Any]]:
+        """Return ``[{"product": doc, "qty": n}]`` in transcript order."""
+        tokens = tokenize_voice_text(text)
+        if not tokens:
+            return []
+        selected = self._select_leftmost_longest(self._scan(tokens))
+        results: List[Dict[str, Any]] = []
+        previous_end = 0
+        for start, end, product_id in selected:
+            product = self.products[product_id]
+            qty = self._quantity_around(tokens, start, end, previous_end)
+            previous_end = end
+            if qty is None or qty <= 0:
+                qty = 1
+            if not product.get("allows_fractional_sale"):
+                qty = max(1, int(round(qty)))
+            results.append({"product": product, "qty": min(qty, MAX_VOICE_QTY)})
+        return results
+
+
+# ---------------------------------------------------------------------------
+# Per-store cache
+# ---------------------------------------------------------------------------
+_matcher_cache: Dict[str, Tuple[ProductNameMatcher, float]] = {}
+
+MATCHER_PROJECTION = {
+    "_id": 0,
+    "product_id": 1,
+    "name": 1,
+    "aliases": 1,
+    "variants.name": 1,
+    "allows_fractional_sale": 1,
+}
+
+
+def _matcher_key(owner_id: str, store_id: Optional[str]) -> str:
+    return f"{owner_id}:{store_id or ''}"
+
+
+async def get_store_matcher(db, owner_id: str, store_id: Optional[str] = None) -> ProductNameMatcher:
+    key = _matcher_key(owner_id, store_id)
+    entry = _matcher_cache.get(key)
+    if entry and time.monotonic() < entry[1]:
+        return entry[0]
+
+    query: Dict[str, Any] = {"user_id": owner_id, "is_active": {"$ne": False}}
+    if store_id:
+        query["store_id"] = store_id
+    products = await db.products.find(query, MATCHER_PROJECTION).limit(MATCHER_MAX_PRODUCTS).to_list(None)
+    started = time.monotonic()
+    matcher = ProductNameMatcher(products)
+    logger.info(
+        "Voice matcher built for %s: %s products, %s phrases in %.1f ms",
+        key, len(matcher.products), matcher.pattern_count, (time.monotonic() - started) * 1000,
+    )
+    _matcher_cache[key] = (matcher, time.monotonic() + MATCHER_CACHE_TTL_S)
+    return matcher
+
+
+def invalidate_store_matcher(owner_id: str) -> None:
+    """Drop every cached matcher of an owner (per-store and owner-wide)."""
+    prefix = f"{owner_id}:"
+    for key in [k for k in _matcher_cache if k.startswith(prefix)]:
+        _matcher_cache.pop(key, None)
@@ -0,0 +1,455 @@
+"""
+In-memory stand-in for the Motor collections the service tests touch.
+
+``FakeCollection`` keeps plain dict documents and honours the query and update
+operators the services use (equality, ``$in``/``$nin``/``$ne``/``$exists``,
+range operators, ``$or``/``$and``; ``$set``, ``$setOnInsert``, ``$inc``,
+``$unset``, ``$push``, ``$pull``, ``$max``, ``$min``).  Every call is appended to
+``calls`` so tests can assert how often a collection was read.  Aggregations
+evaluate ``$match``, ``$sort``, ``$unwind`` and ``$group`` stages; a test that only cares about the
+rows handed back sets ``aggregate_rows`` to a list or to a callable taking the
+pipeline.  ``FakeDb`` creates collections on first access, by attribute or by
+name.
+"""
+
+from __future__ import annotations
+
+import copy
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+
+def _get(doc: Dict[str, Any], path: str) -> Any:
+    value: Any = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        elif isinstance(value, list):
+            found = [item.get(part, _MISSING) for item in value if isinstance(item, dict)]
+            value = [item for item in found if item is not _MISSING] or _MISSING
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _set(doc: Dict[str, Any], path: str, value: Any) -> None:
+    *parents, leaf = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[leaf] = value
+
+
+def _unset(doc: Dict[str, Any], path: str) -> None:
+    *parents, leaf = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(leaf, None)
+
+
+def _compare(value: Any, op: str, operand: Any) -> bool:
+    if value is None or value is _MISSING:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        return value <= operand
+    except TypeError:
+        return False
+
+
+def _equals(value: Any, expected: Any) -> bool:
+    if hasattr(expected, "search") and isinstance(value, str):
+        return bool(expected.search(value))
+    if expected is None:
+        return value is None or value is _MISSING
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value == expected
+
+
+def _condition_matches(value: Any, condition: Any) -> bool:
+    if not (isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition)):
+        return _equals(value, condition)
+    for op, operand in condition.items():
+        if op == "$exists":
+            if (value is not _MISSING) != bool(operand):
+                return False
+        elif op == "$ne":
+            if _equals(value, operand):
+                return False
+        elif op == "$in":
+            if not any(_equals(value, candidate) for candidate in operand):
+                return False
+        elif op == "$nin":
+            if any(_equals(value, candidate) for candidate in operand):
+                return False
+        elif op in ("$gt", "$gte", "$lt", "$lte"):
+            if not _compare(value, op, operand):
+                return False
+        elif op == "$not":
+            if _condition_matches(value, operand):
+                return False
+        elif op == "$type":
+            continue
+        else:
+            raise NotImplementedError(f"fake_mongo does not support {op}")
+    return True
+
+
+def matches(doc: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+    """Whether ``doc`` satisfies the MongoDB ``query``."""
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, branch) for branch in condition):
+                return False
+        elif not _condition_matches(_get(doc, key), condition):
+            return False
+    return True
+
+
+def apply_update(doc: Dict[str, Any], update: Dict[str, Any], inserting: bool = False) -> None:
+    """Apply the update operators of ``update`` to ``doc`` in place."""
+    for path, value in update.get("$set", {}).items():
+        _set(doc, path, copy.deepcopy(value))
+    if inserting:
+        for path, value in update.get("$setOnInsert", {}).items():
+            _set(doc, path, copy.deepcopy(value))
+    for path, delta in update.get("$inc", {}).items():
+        current = _get(doc, path)
+        _set(doc, path, (0 if current is _MISSING or current is None else current) + delta)
+    for path in update.get("$unset", {}):
+        _unset(doc, path)
+    for path, value in update.get("$push", {}).items():
+        current = _get(doc, path)
+        items = [] if current is _MISSING else current
+        items.extend(value["$each"] if isinstance(value, dict) and "$each" in value else [value])
+        _set(doc, path, items)
+    for path, condition in update.get("$pull", {}).items():
+        current = _get(doc, path)
+        if isinstance(current, list):
+            _set(doc, path, [item for item in current if not _condition_matches(item, condition)])
+    for op, better in (("$max", lambda new, old: new > old), ("$min", lambda new, old: new < old)):
+        for path, value in update.get(op, {}).items():
+            current = _get(doc, path)
+            if current is _MISSING or current is None or better(value, current):
+                _set(doc, path, value)
+
+
+def _seed(query: Dict[str, Any]) -> Dict[str, Any]:
+    doc: Dict[str, Any] = {}
+    for key, value in query.items():
+        if not key.startswith("$") and not (isinstance(value, dict) and any(k.startswith("$") for k in value)):
+            _set(doc, key, copy.deepcopy(value))
+    return doc
+
+
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    return (0, None) if value is None or value is _MISSING else (1, value)
+
+
+class FakeResult:
+    def __init__(self, matched_count=0, modified_count=0, upserted_id=None, inserted_id=None, deleted_count=0):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+        self.upserted_ids = {0: upserted_id} if upserted_id is not None else {}
+        self.inserted_id = inserted_id
+        self.deleted_count = deleted_count
+
+
+class FakeCursor:
+    """Async cursor over copies of ``docs``; ``on_next`` is awaited after each yielded document."""
+
+    def __init__(self, docs: Iterable[Dict[str, Any]], on_next: Optional[Callable[[int], Any]] = None):
+        self.docs = [copy.deepcopy(doc) for doc in docs]
+        self.on_next = on_next
+        self.closed = False
+
+    def sort(self, key_or_list, direction=None):
+        keys = [(key_or_list, direction or 1)] if isinstance(key_or_list, str) else list(key_or_list)
+        for field, order in reversed(keys):
+            self.docs.sort(key=lambda doc: _sort_key(_get(doc, field)), reverse=order < 0)
+        return self
+
+    def skip(self, count):
+        self.docs = self.docs[count:]
+        return self
+
+    def limit(self, count):
+        if count:
+            self.docs = self.docs[:count]
+        return self
+
+    def batch_size(self, _size):
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        index = 0
+        while self.docs and not self.closed:
+            yield self.docs.pop(0)
+            if self.on_next:
+                await self.on_next(index)
+            index += 1
+
+    async def to_list(self, length=None):
+        docs, self.docs = (self.docs, []) if length is None else (self.docs[:length], self.docs[length:])
+        return docs
+
+    async def close(self):
+        self.closed = True
+        self.docs = []
+
+
+class FakeCollection:
+    def __init__(self, docs: Iterable[Dict[str, Any]] = (), unique: Optional[Sequence[str]] = None,
+                 aggregate_rows: Any = None):
+        self.docs: List[Dict[str, Any]] = [dict(doc) for doc in docs]
+        self.unique = tuple(unique) if unique else None
+        self.aggregate_rows = aggregate_rows
+        self.on_next: Optional[Callable[[int], Any]] = None
+        self.calls: List[Tuple[Any, ...]] = []
+
+    def count_calls(self, method: str) -> int:
+        return sum(1 for call in self.calls if call[0] == method)
+
+    def _first(self, query):
+        return next((doc for doc in self.docs if matches(doc, query)), None)
+
+    def _check_unique(self, doc):
+        if not self.unique:
+            return
+        for other in self.docs:
+            if all(_get(other, key) == _get(doc, key) for key in self.unique):
+                raise DuplicateKeyError(f"duplicate key {self.unique}")
+
+    def _insert(self, doc):
+        doc = copy.deepcopy(doc)
+        self._check_unique(doc)
+        self.docs.append(doc)
+        return doc
+
+    def find(self, query=None, projection=None, **_kwargs):
+        self.calls.append(("find", query, projection))
+        return FakeCursor([doc for doc in self.docs if matches(doc, query)], self.on_next)
+
+    async def find_one(self, query=None, projection=None, **_kwargs):
+        self.calls.append(("find_one", query, projection))
+        doc = self._first(query)
+        return copy.deepcopy(doc) if doc is not None else None
+
+    async def count_documents(self, query, **_kwargs):
+        self.calls.append(("count_documents", query))
+        return sum(1 for doc in self.docs if matches(doc, query))
+
+    async def distinct(self, field, query=None, **_kwargs):
+        self.calls.append(("distinct", field, query))
+        values = [_get(doc, field) for doc in self.docs if matches(doc, query)]
+        return list(dict.fromkeys(value for value in values if value is not _MISSING))
+
+    async def insert_one(self, doc, session=None):
+        self.calls.append(("insert_one", doc, session))
+        self._insert(doc)
+        return FakeResult(inserted_id=doc.get("_id"))
+
+    async def insert_many(self, docs, ordered=True, session=None):
+        docs = list(docs)
+        self.calls.append(("insert_many", docs, session))
+        for doc in docs:
+            self._insert(doc)
+        return FakeResult()
+
+    async def _update(self, query, update, upsert, many):
+        targets = [doc for doc in self.docs if matches(doc, query)]
+        if not many:
+            targets = targets[:1]
+        if not targets:
+            if not upsert:
+                return FakeResult()
+            doc = _seed(query)
+            apply_update(doc, update, inserting=True)
+            self._insert(doc)
+            return FakeResult(upserted_id=doc.get("_id", len(self.docs)))
+        for doc in targets:
+            apply_update(doc, update)
+        return FakeResult(matched_count=len(targets), modified_count=len(targets))
+
+    async def update_one(self, query, update, upsert=False, session=None):
+        self.calls.append(("update_one", query, update))
+        return await self._update(query, update, upsert, many=False)
+
+    async def update_many(self, query, update, upsert=False, session=None):
+        self.calls.append(("update_many", query, update))
+        return await self._update(query, update, upsert, many=True)
+
+    async def replace_one(self, query, replacement, upsert=False, session=None):
+        self.calls.append(("replace_one", query, replacement))
+        doc = self._first(query)
+        if doc is None:
+            if upsert:
+                self._insert(replacement)
+            return FakeResult(upserted_id=replacement.get("_id") if upsert else None)
+        doc.clear()
+        doc.update(copy.deepcopy(replacement))
+        return FakeResult(matched_count=1, modified_count=1)
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False,
+                                  return_document=ReturnDocument.BEFORE, session=None):
+        self.calls.append(("find_one_and_update", query, update))
+        doc = self._first(query)
+        if doc is None:
+            if not upsert:
+                return None
+            doc = _seed(query)
+            apply_update(doc, update, inserting=True)
+            doc = self._insert(doc)
+            return copy.deepcopy(doc) if return_document == ReturnDocument.AFTER else None
+        before = copy.deepcopy(doc)
+        apply_update(doc, update)
+        return copy.deepcopy(doc) if return_document == ReturnDocument.AFTER else before
+
+    async def delete_one(self, query, session=None):
+        self.calls.append(("delete_one", query))
+        doc = self._first(query)
+        if doc is None:
+            return FakeResult()
+        self.docs.remove(doc)
+        return FakeResult(deleted_count=1)
+
+    async def delete_many(self, query, session=None):
+        self.calls.append(("delete_many", query))
+        kept = [doc for doc in self.docs if not matches(doc, query)]
+        deleted, self.docs = len(self.docs) - len(kept), kept
+        return FakeResult(deleted_count=deleted)
+
+    async def bulk_write(self, requests, ordered=True, session=None):
+        requests = list(requests)
+        self.calls.append(("bulk_write", requests))
+        upserted = {}
+        for index, request in enumerate(requests):
+            name = type(request).__name__
+            if name == "InsertOne":
+                self._insert(request._doc)
+            elif name in ("UpdateOne", "UpdateMany"):
+                result = await self._update(request._filter, request._doc, request._upsert, many=name == "UpdateMany")
+                if result.upserted_id is not None:
+                    upserted[index] = result.upserted_id
+            elif name == "ReplaceOne":
+                await self.replace_one(request._filter, request._doc, upsert=request._upsert)
+            elif name in ("DeleteOne", "DeleteMany"):
+                await (self.delete_one if name == "DeleteOne" else self.delete_many)(request._filter)
+            else:
+                raise NotImplementedError(f"fake_mongo does not support {name}")
+        result = FakeResult()
+        result.upserted_ids = upserted
+        return result
+
+    def aggregate(self, pipeline, session=None, **_kwargs):
+        self.calls.append(("aggregate", pipeline))
+        if callable(self.aggregate_rows):
+            return FakeCursor(self.aggregate_rows(pipeline))
+        if self.aggregate_rows is not None:
+            return FakeCursor(self.aggregate_rows)
+        return FakeCursor(run_pipeline(self.docs, pipeline))
+
+    async def create_index(self, *_args, **_kwargs):
+        return None
+
+
+def run_pipeline(docs: Iterable[Dict[str, Any]], pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Evaluate the ``$match``, ``$sort``, ``$unwind`` and ``$group`` stages of ``pipeline`` over ``docs``."""
+    rows = list(docs)
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            rows = [doc for doc in rows if matches(doc, spec)]
+        elif name == "$sort":
+            for field, order in reversed(list(spec.items())):
+                rows.sort(key=lambda doc: _sort_key(_get(doc, field)), reverse=order < 0)
+        elif name == "$unwind":
+            path = spec[1:]
+            rows = [{**doc, path: item} for doc in rows for item in (_get(doc, path) if isinstance(_get(doc, path), list) else [])]
+        elif name == "$group":
+            rows = _group(rows, spec)
+        else:
+            raise NotImplementedError(f"fake_mongo does not evaluate {name}; set aggregate_rows")
+    return rows
+
+
+def _field(doc: Dict[str, Any], ref: Any) -> Any:
+    if isinstance(ref, dict):
+        return tuple(sorted((key, _field(doc, value)) for key, value in ref.items()))
+    if isinstance(ref, str) and ref.startswith("$"):
+        value = _get(doc, ref[1:])
+        return None if value is _MISSING else value
+    return ref
+
+
+def _group(docs: List[Dict[str, Any]], spec: Dict[str, Any]) -> List[Dict[str, Any]]:
+    grouped: Dict[Any, Dict[str, Any]] = {}
+    for doc in docs:
+        key = _field(doc, spec["_id"])
+        row = grouped.setdefault(key, {"_id": dict(key) if isinstance(key, tuple) else key})
+        for name, accumulator in spec.items():
+            if name == "_id":
+                continue
+            (op, ref), = accumulator.items()
+            value = _field(doc, ref)
+            if op == "$sum":
+                row[name] = row.get(name, 0) + (value or 0)
+            elif op == "$first":
+                row.setdefault(name, value)
+            elif op == "$last":
+                row[name] = value
+            elif op in ("$max", "$min"):
+                current = row.get(name)
+                if current is None or (value is not None and (value > current if op == "$max" else value < current)):
+                    row[name] = value
+            else:
+                raise NotImplementedError(f"fake_mongo does not support {op}")
+    return list(grouped.values())
+
+
+class FakeDb:
+    """Collections created on first access, by attribute (``db.sales``) or by name (``db["sales"]``).
+
+    There is no ``client`` unless a test sets one, so code needing sessions sees none.
+    """
+
+    def __init__(self, **collections: FakeCollection):
+        self._collections: Dict[str, FakeCollection] = dict(collections)
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name not in self._collections and name == "client":
+            raise AttributeError(name)
+        return self._collections.setdefault(name, FakeCollection())
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        return getattr(self, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            self._collections[name] = value
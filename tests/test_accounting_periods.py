@@ -0,0 +1,76 @@
+import sys
+import unittest
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services.accounting_periods import (  # noqa: E402
+    merge_stats, plan_segments, purchase_status_update, purchased_at, scope_key,
+)
+
+NOW = datetime(2026, 10, 19, 15, 30, tzinfo=timezone.utc)
+
+
+def _utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class AccountingPeriodTests(unittest.TestCase):
+    def test_year_to_date_uses_closed_months_then_days_then_live(self):
+        segments = plan_segments(_utc(2026, 1, 1), NOW, NOW)
+        kinds = [kind for kind, _, _ in segments]
+        self.assertEqual(kinds[:9], ["month"] * 9)
+        self.assertEqual(segments[9], ("day", date(2026, 10, 1), None))
+        self.assertEqual(kinds[-1], "live")
+        self.assertEqual(segments[-1][1], _utc(2026, 10, 19))
+        self.assertEqual(len(segments), 9 + 18 + 1)
+
+    def test_rolling_window_starts_with_partial_live_day(self):
+        segments = plan_segments(_utc(2026, 10, 17, 15, 30), NOW, NOW)
+        self.assertEqual(segments[0], ("live", _utc(2026, 10, 17, 15, 30), _utc(2026, 10, 18)))
+        self.assertEqual(segments[1], ("day", date(2026, 10, 18), None))
+        self.assertEqual(segments[2][0], "live")
+
+    def test_closed_month_inside_explicit_range(self):
+        segments = plan_segments(_utc(2026, 8, 1), _utc(2026, 8, 31, 23, 59, 59), NOW)
+        self.assertEqual(segments, [("month", (2026, 8), None)])
+
+    def test_merge_sums_scalars_keyed_rows_and_days(self):
+        part = {
+            "revenue": 100.0, "sales_count": 2, "payment": [{"key": "cash", "amount": 100.0}],
+            "daily": [{"date": "2026-10-01", "revenue": 100.0, "profit": 40.0}],
+            "products": [{"id": "p1", "name": "P", "qty_sold": 2, "revenue": 100.0, "cogs": 60.0, "loss": 0.0}],
+        }
+        merged = merge_stats([part, part])
+        self.assertEqual(merged["revenue"], 200.0)
+        self.assertEqual(merged["payment"], [{"key": "cash", "amount": 200.0}])
+        self.assertEqual(merged["daily"][0]["profit"], 80.0)
+        self.assertEqual(merged["products"][0]["qty_sold"], 4)
+
+    def test_scope_key(self):
+        self.assertEqual(scope_key({}), "all")
+        self.assertEqual(scope_key({"store_id": "s1"}), "store:s1")
+        self.assertEqual(scope_key({"store_id": {"$in": ["b", "a"]}}), "in:a,b")
+
+    def test_delivery_date_is_set_once_and_dropped_when_leaving_delivered(self):
+        delivered = purchase_status_update("delivered", NOW)[0]["$set"]
+        self.assertEqual(delivered["status"], "delivered")
+        self.assertEqual(delivered["delivered_at"], {"$cond": [
+            {"$eq": ["$status", "delivered"]},
+            {"$ifNull": ["$delivered_at", {"$ifNull": ["$updated_at", "$created_at"]}]},
+            NOW,
+        ]})
+        self.assertEqual(purchase_status_update("cancelled", NOW)[0]["$set"]["delivered_at"], "$$REMOVE")
+
+    def test_purchase_counts_on_delivery_date_before_last_update(self):
+        order = {"created_at": _utc(2026, 9, 1), "updated_at": NOW, "delivered_at": _utc(2026, 9, 3)}
+        self.assertEqual(purchased_at(order), _utc(2026, 9, 3))
+        self.assertEqual(purchased_at({"created_at": _utc(2026, 9, 1), "updated_at": _utc(2026, 9, 2)}), _utc(2026, 9, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
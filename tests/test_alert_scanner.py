@@ -0,0 +1,77 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from pymongo.errors import BulkWriteError  # noqa: E402
+
+from services import alert_scanner  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeCursor, FakeDb  # noqa: E402
+
+
+class _FailingAlerts(FakeCollection):
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    async def bulk_write(self, requests, ordered=True, session=None):
+        raise self.error
+
+
+class AlertScannerTests(unittest.TestCase):
+    def test_expiry_scan_compares_native_dates(self):
+        until = datetime(2026, 10, 26, tzinfo=timezone.utc)
+        match = alert_scanner.expiring_batches_pipeline(until)[0]["$match"]
+        self.assertEqual(match["expiry_date"], {"$type": "date", "$lte": until})
+
+    def test_upsert_selects_on_the_structured_key(self):
+        key = alert_scanner.dedupe_key("expiry", "owner_1", "prod_1", "batch_1")
+        op = alert_scanner.upsert_op({"alert_id": "alert_1", "type": "expiry"}, key)
+        selector = {"user_id": "owner_1", "dedupe_rule": "expiry", "product_id": "prod_1",
+                    "batch_id": "batch_1", "is_dismissed": False}
+        self.assertEqual(op._filter, selector)
+        self.assertEqual(op._doc["$setOnInsert"]["alert_id"], "alert_1")
+        self.assertEqual(op._doc["$setOnInsert"]["dedupe_rule"], "expiry")
+        self.assertTrue(op._upsert)
+
+    def test_active_keys_honour_structured_and_legacy_alerts(self):
+        alerts = FakeCollection([
+            {"user_id": "o", "type": "expiry", "is_dismissed": False, "product_id": "p1", "dedupe_rule": "expiry", "batch_id": "b1"},
+            {"user_id": "o", "type": "expiry", "is_dismissed": False, "product_id": "p2"},
+        ])
+        candidates = [
+            alert_scanner.dedupe_key("expiry", "o", "p1", "b1"),
+            alert_scanner.dedupe_key("expiry", "o", "p1", "b2"),
+            alert_scanner.dedupe_key("expiry", "o", "p2", "b3"),
+        ]
+        covered = asyncio.run(alert_scanner.active_keys(FakeDb(alerts=alerts), "expiry", candidates))
+        self.assertEqual(covered, {candidates[0], candidates[2]})
+
+    def test_upsert_alerts_reports_created_indexes(self):
+        pending = [({"alert_id": "a"}, ("low_stock", "o", "p1", None)), ({"alert_id": "b"}, ("low_stock", "o", "p2", None))]
+        alerts = FakeCollection([alert_scanner.upsert_op(*pending[0])._filter])
+        self.assertEqual(asyncio.run(alert_scanner.upsert_alerts(FakeDb(alerts=alerts), pending)), [1])
+        self.assertEqual(len(alerts.docs), 2)
+
+    def test_duplicate_key_races_are_not_reported_as_created(self):
+        error = BulkWriteError({
+            "writeErrors": [{"index": 0, "code": 11000, "errmsg": "dup"}],
+            "upserted": [{"index": 1, "_id": "y"}],
+        })
+        pending = [({"alert_id": "a"}, ("low_stock", "o", "p1", None)), ({"alert_id": "b"}, ("low_stock", "o", "p2", None))]
+        self.assertEqual(asyncio.run(alert_scanner.upsert_alerts(FakeDb(alerts=_FailingAlerts(error)), pending)), [1])
+
+    def test_chunks(self):
+        async def collect():
+            return [len(chunk) async for chunk in alert_scanner.chunks(FakeCursor(range(5)), 2)]
+        self.assertEqual(asyncio.run(collect()), [2, 2, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import sys
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services.analytics_snapshot import build_sales_match, line_totals  # noqa: E402
+
+NOW = datetime(2026, 10, 19, tzinfo=timezone.utc)
+
+
+class AnalyticsSnapshotTests(unittest.TestCase):
+    def test_line_totals_uses_line_prices_when_present(self):
+        group = {"quantity": 3, "revenue": 300.0, "cost": 180.0, "missing_price_qty": 0, "missing_cost_qty": 0}
+        self.assertEqual(line_totals(group, {"selling_price": 999, "purchase_price": 999}), (3.0, 300.0, 180.0))
+
+    def test_line_totals_falls_back_to_catalog_prices(self):
+        group = {
+            "quantity": 5, "revenue": 200.0, "cost": 120.0,
+            "missing_price_qty": 2, "missing_price_discount": 10.0, "missing_cost_qty": 1,
+        }
+        quantity, revenue, cogs = line_totals(group, {"selling_price": 50, "purchase_price": 30})
+        self.assertEqual(quantity, 5.0)
+        self.assertEqual(revenue, 290.0)
+        self.assertEqual(cogs, 150.0)
+
+    def test_sales_match_keeps_legacy_sales_only_for_single_store(self):
+        single = build_sales_match("u1", NOW, NOW, {"s1"}, True)
+        self.assertIn({"store_id": {"$in": ["s1", None, ""]}}, single["$and"])
+        multi = build_sales_match("u1", NOW, NOW, ["s1", "s2"], False)
+        self.assertIn({"store_id": {"$in": ["s1", "s2"]}}, multi["$and"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import anomaly_scheduler  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+
+NOW = datetime(2026, 10, 19, 12, tzinfo=timezone.utc)
+
+
+class AnomalySchedulerTests(unittest.TestCase):
+    def test_only_tenants_whose_watermark_advanced_are_due_paying_first(self):
+        activity = {
+            ("free", "s1"): NOW - timedelta(minutes=5),
+            ("paying", "s2"): NOW - timedelta(hours=3),
+            ("idle", "s3"): NOW - timedelta(hours=2),
+            ("done", "s4"): NOW - timedelta(hours=1),
+        }
+        state = FakeCollection([
+            {"user_id": "idle", "store_id": "s3", "watermark": NOW - timedelta(hours=2), "cycle_id": "old"},
+            {"user_id": "done", "store_id": "s4", "watermark": NOW - timedelta(days=1), "cycle_id": "c1"},
+        ])
+        tenants = list(activity) + [("quiet", "s5")]
+        due = asyncio.run(anomaly_scheduler.due_tenants(FakeDb(ai_anomaly_state=state), "c1", activity, tenants, {"paying"}))
+        self.assertEqual(due, [("paying", "s2"), ("free", "s1")])
+
+    def test_unfinished_cycle_is_resumed(self):
+        running = {"_id": "scheduler", "cycle_id": "c1", "since": NOW - timedelta(hours=12), "completed_at": None}
+        cycles = FakeCollection([running])
+        cycle = asyncio.run(anomaly_scheduler.start_or_resume_cycle(FakeDb(ai_anomaly_cycles=cycles), NOW))
+        self.assertEqual(cycle["cycle_id"], "c1")
+        self.assertEqual(cycles.count_calls("replace_one"), 0)
+
+    def test_new_cycle_covers_activity_since_previous_start(self):
+        previous = {"_id": "scheduler", "cycle_id": "c1", "started_at": NOW - timedelta(hours=12), "completed_at": NOW}
+        cycles = FakeCollection([previous])
+        cycle = asyncio.run(anomaly_scheduler.start_or_resume_cycle(FakeDb(ai_anomaly_cycles=cycles), NOW))
+        self.assertNotEqual(cycle["cycle_id"], "c1")
+        self.assertEqual(cycle["since"], NOW - timedelta(hours=12))
+        self.assertEqual(cycles.docs, [cycle])
+
+    def test_pool_bounds_concurrency_and_survives_failures(self):
+        in_flight = 0
+        peak = 0
+
+        async def worker(item):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+            if item == 3:
+                raise RuntimeError("boom")
+
+        processed = asyncio.run(anomaly_scheduler.run_pool(list(range(10)), worker, concurrency=3))
+        self.assertEqual(processed, 9)
+        self.assertLessEqual(peak, 3)
+
+    def test_failed_tenants_are_reported_and_folded_into_next_activity(self):
+        failed = []
+
+        async def worker(item):
+            if item == "bad":
+                raise RuntimeError("boom")
+
+        async def on_error(item):
+            failed.append(item)
+
+        processed = asyncio.run(anomaly_scheduler.run_pool(["ok", "bad"], worker, on_error=on_error))
+        self.assertEqual((processed, failed), (1, ["bad"]))
+
+        db = FakeDb(
+            sales=FakeCollection([
+                {"user_id": "u1", "store_id": "s1", "created_at": NOW - timedelta(minutes=20)},
+                {"user_id": "u1", "store_id": "s1", "created_at": NOW - timedelta(minutes=5)},
+                {"user_id": "u1", "store_id": "s1", "created_at": NOW - timedelta(hours=3)},
+            ]),
+            ai_anomaly_state=FakeCollection([
+                {"user_id": "u2", "store_id": "s2", "pending": (NOW - timedelta(days=2)).replace(tzinfo=None)},
+            ]),
+        )
+        activity = asyncio.run(anomaly_scheduler.tenant_activity(db, NOW - timedelta(hours=1)))
+        self.assertEqual(activity, {("u1", "s1"): NOW - timedelta(minutes=5), ("u2", "s2"): NOW - timedelta(days=2)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import basket_analysis  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb, matches  # noqa: E402
+
+
+NOW = datetime.now(timezone.utc)
+
+
+class _Db(FakeDb):
+    def __init__(self):
+        super().__init__(basket_state=FakeCollection(unique=("user_id",)))
+
+
+def _items(*product_ids):
+    return [{"product_id": product_id, "product_name": product_id.upper()} for product_id in product_ids]
+
+
+def _sale(sale_id, *product_ids, status="completed", days_ago=1):
+    return {"sale_id": sale_id, "user_id": "u1", "store_id": "s1", "status": status,
+            "created_at": NOW - timedelta(days=days_ago), "items": _items(*product_ids)}
+
+
+def _count(collection, **query):
+    return sum(int(doc.get("count", doc.get("baskets", 0))) for doc in collection.docs if matches(doc, query))
+
+
+class BasketCounterTests(unittest.TestCase):
+    def test_record_then_forget_restores_the_counters(self):
+        db = _Db()
+
+        async def scenario():
+            await basket_analysis.record_basket(db, "u1", "s1", _items("a", "b"), NOW, "sale_1")
+            await basket_analysis.record_basket(db, "u1", "s1", _items("a", "b", "c"), NOW, "sale_2")
+            await basket_analysis.forget_basket(db, "u1", "s1", _items("a", "b", "c"), NOW, "sale_2")
+
+        asyncio.run(scenario())
+        self.assertEqual(_count(db.basket_totals, user_id="u1"), 1)
+        self.assertEqual(_count(db.basket_product_stats, product_id="a"), 1)
+        self.assertEqual(_count(db.basket_product_stats, product_id="c"), 0)
+        self.assertEqual(_count(db.basket_pair_stats, a="a", b="b"), 1)
+        self.assertEqual(_count(db.basket_pair_stats, a="a", b="c"), 0)
+        weight = sum(doc["weight"] for doc in db.basket_totals.docs)
+        self.assertAlmostEqual(weight, basket_analysis.decay_weight(NOW))
+
+    def test_forget_never_creates_counters(self):
+        db = _Db()
+        asyncio.run(basket_analysis.forget_basket(db, "u1", "s1", _items("a", "b"), NOW, "sale_1"))
+        self.assertEqual(db.basket_product_stats.docs, [])
+        self.assertEqual(db.basket_pair_stats.docs, [])
+        self.assertEqual(db.basket_totals.docs, [])
+
+
+class BasketRebuildTests(unittest.TestCase):
+    def test_history_is_loaded_even_when_sales_arrived_after_deploy(self):
+        db = _Db()
+        db.sales.docs = [_sale("old_1", "a", "b"), _sale("old_2", "a", "b"), _sale("gone", "a", "c", status="cancelled")]
+
+        async def scenario():
+            # A sale recorded after deploy creates basket_totals before any rebuild ran.
+            db.sales.docs.append(_sale("new_1", "a", "b", days_ago=0))
+            await basket_analysis.record_basket(db, "u1", "s1", _items("a", "b"), NOW, "new_1")
+            pending = await basket_analysis.get_basket_insights(db, "u1", min_support=1)
+            # The history is loaded off the request path, once however many reads arrive.
+            again = await basket_analysis.get_basket_insights(db, "u1", min_support=1)
+            await basket_analysis._rebuild_tasks["u1"]
+            first = await basket_analysis.get_basket_insights(db, "u1", min_support=1)
+            db.basket_insights.docs.clear()
+            await basket_analysis.get_basket_insights(db, "u1", min_support=1)
+            return pending, again, first
+
+        pending, again, insights = asyncio.run(scenario())
+        self.assertTrue(pending["pending"])
+        self.assertEqual(pending["pairs"], [])
+        self.assertTrue(again["pending"])
+        self.assertEqual(db.sales.count_calls("find"), 1)
+        self.assertNotIn("pending", insights)
+        self.assertEqual(insights["total_baskets"], 3)
+        self.assertEqual(_count(db.basket_pair_stats, a="a", b="b"), 3)
+        self.assertEqual(_count(db.basket_pair_stats, a="a", b="c"), 0)
+        self.assertEqual(db.basket_state.docs[0]["status"], basket_analysis.STATE_READY)
+        self.assertNotIn("pending", db.basket_state.docs[0])
+
+    def test_updates_during_a_rebuild_are_queued_and_replayed_once(self):
+        db = _Db()
+        db.sales.docs = [_sale("old_1", "a", "b"), _sale("old_2", "a", "b"), _sale("old_3", "b", "c", status="cancelled")]
+
+        async def during_scan(index):
+            if index != 0:
+                return
+            # Already scanned: must not be counted twice.
+            await basket_analysis.record_basket(db, "u1", "s1", _items("a", "b"), NOW, "old_1")
+            # Completed while the rebuild runs: counted once, from the queue.
+            await basket_analysis.record_basket(db, "u1", "s1", _items("c", "d"), NOW, "new_1")
+            # Cancelled after the scan counted it: withdrawn.
+            await basket_analysis.forget_basket(db, "u1", "s1", _items("a", "b"), NOW, "old_1")
+            # Cancelled before the scan reached it: never counted, nothing to withdraw.
+            await basket_analysis.forget_basket(db, "u1", "s1", _items("b", "c"), NOW, "old_3")
+            self.assertEqual(db.basket_pair_stats.docs, [])
+            self.assertEqual(len(db.basket_state.docs[0]["pending"]), 4)
+
+        db.sales.on_next = during_scan
+        stats = asyncio.run(basket_analysis.rebuild_basket_stats(db, "u1"))
+        self.assertEqual(stats["baskets"], 2)
+        self.assertEqual(_count(db.basket_totals, user_id="u1"), 2)
+        self.assertEqual(_count(db.basket_pair_stats, a="a", b="b"), 1)
+        self.assertEqual(_count(db.basket_pair_stats, a="c", b="d"), 1)
+        self.assertEqual(_count(db.basket_pair_stats, a="b", b="c"), 0)
+
+    def test_a_second_rebuild_backs_off_while_the_lease_is_held(self):
+        db = _Db()
+        db.basket_state.docs.append({
+            "user_id": "u1", "status": basket_analysis.STATE_REBUILDING, "lease_id": "other",
+            "lease_until": NOW + timedelta(minutes=5), "pending": [],
+        })
+        self.assertIsNone(asyncio.run(basket_analysis.rebuild_basket_stats(db, "u1")))
+        self.assertEqual(db.sales.count_calls("find"), 0)
+
+
+class BasketInsightTests(unittest.TestCase):
+    def test_insights_rank_pairs_by_lift(self):
+        db = _Db()
+        db.sales.docs = (
+            [_sale(f"ab_{i}", "a", "b") for i in range(4)]
+            + [_sale(f"c_{i}", "c", "d") for i in range(2)]
+            + [_sale(f"e_{i}", "e", "f") for i in range(3)]
+            + [_sale("x_0", "a", "c")]
+        )
+
+        async def scenario():
+            await basket_analysis.rebuild_basket_stats(db, "u1")
+            return await basket_analysis.get_basket_insights(db, "u1", min_support=1)
+
+        insights = asyncio.run(scenario())
+        pairs = {(pair["product_a_id"], pair["product_b_id"]): pair for pair in insights["pairs"]}
+        self.assertIn(("a", "b"), pairs)
+        self.assertIn(("c", "d"), pairs)
+        self.assertNotIn(("a", "c"), pairs)
+        self.assertEqual(pairs[("a", "b")]["co_occurrence"], 4)
+        self.assertEqual(pairs[("a", "b")]["product_a_name"], "A")
+        self.assertEqual(basket_analysis.pairs_for_product(insights, "d")[0]["product_a_id"], "c")
+        self.assertEqual(insights["total_baskets"], 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
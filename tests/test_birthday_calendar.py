@@ -0,0 +1,41 @@
+import sys
+import unittest
+from datetime import date, datetime
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import birthday_calendar as bc  # noqa: E402
+
+
+class BirthdayCalendarTests(unittest.TestCase):
+    def test_birthday_formats_share_one_day_of_year(self):
+        self.assertEqual(bc.birthday_doy("03-01"), 61)
+        self.assertEqual(bc.birthday_doy("1990-03-01"), 61)
+        self.assertEqual(bc.birthday_doy(datetime(1985, 3, 1)), 61)
+        self.assertEqual(bc.birthday_doy("02-29"), 60)
+        self.assertIsNone(bc.birthday_doy("13-40"))
+        self.assertIsNone(bc.birthday_doy(None))
+
+    def test_window_is_a_single_range_inside_the_year(self):
+        self.assertEqual(bc.window_query(date(2026, 6, 1), 7), {"birthday_doy": {"$gte": 153, "$lte": 160}})
+
+    def test_window_wraps_around_new_year(self):
+        query = bc.window_query(date(2026, 12, 28), 7)
+        self.assertEqual(query, {"$or": [{"birthday_doy": {"$gte": 363}}, {"birthday_doy": {"$gte": 1, "$lte": 4}}]})
+
+    def test_leap_day_birthdays_fall_on_march_first_in_common_years(self):
+        self.assertEqual(bc.window_query(date(2026, 3, 1), 0), {"birthday_doy": {"$gte": 60, "$lte": 61}})
+        self.assertEqual(bc.days_until(60, date(2026, 2, 27)), 2)
+        self.assertEqual(bc.days_until(60, date(2028, 2, 27)), 2)
+
+    def test_days_until_counts_today_as_zero_and_wraps(self):
+        self.assertEqual(bc.days_until_birthday("10-19", date(2026, 10, 19)), 0)
+        self.assertEqual(bc.days_until_birthday("01-02", date(2026, 12, 30)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import broadcast_campaigns  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+
+NOW = datetime(2026, 10, 19, 11, tzinfo=timezone.utc)
+SEGMENT = {"collection": "users", "key": "user_id", "query": {"is_active": {"$ne": False}}, "projection": None}
+
+
+def _db(user_count, campaign):
+    return FakeDb(
+        users=FakeCollection({"user_id": f"u{index:04d}"} for index in range(user_count)),
+        broadcast_campaigns=FakeCollection([campaign]),
+    )
+
+
+def _campaign(**extra):
+    campaign = broadcast_campaigns.new_campaign("admin_message", {"type": "users", "target": "all"}, {}, NOW)
+    campaign.update(status="running", lease="worker:1", **extra)
+    return campaign
+
+
+def _run(db, campaign, send_chunk, **kwargs):
+    return asyncio.run(broadcast_campaigns.run_campaign(db, campaign, SEGMENT, send_chunk, lambda: NOW, **kwargs))
+
+
+class BroadcastCampaignTests(unittest.TestCase):
+    def test_segment_is_paged_chunked_and_counted(self):
+        chunks = []
+
+        async def send_chunk(recipients):
+            chunks.append(len(recipients))
+            return {"push_sent": len(recipients)}
+
+        campaign = _campaign()
+        db = _db(1230, campaign)
+        result = _run(db, campaign, send_chunk)
+        self.assertEqual(result["status"], "completed")
+        self.assertEqual(sum(chunks), 1230)
+        self.assertLessEqual(max(chunks), broadcast_campaigns.CHUNK_SIZE)
+        stored = db.broadcast_campaigns.docs[0]
+        self.assertEqual(stored["counters"]["recipients"], 1230)
+        self.assertEqual(stored["counters"]["push_sent"], 1230)
+        self.assertEqual(stored["cursor"], "u1229")
+        self.assertEqual(stored["status"], "completed")
+        self.assertIsNone(stored["lease"])
+
+    def test_interrupted_campaign_resumes_after_its_cursor(self):
+        seen = []
+
+        async def send_chunk(recipients):
+            seen.extend(doc["user_id"] for doc in recipients)
+            return {}
+
+        campaign = _campaign(cursor="u0499")
+        _run(_db(600, campaign), campaign, send_chunk)
+        self.assertEqual(seen[0], "u0500")
+        self.assertEqual(len(seen), 100)
+
+    def test_failed_chunks_are_counted_and_the_run_continues(self):
+        async def send_chunk(recipients):
+            if recipients[0]["user_id"] == "u0100":
+                raise RuntimeError("provider down")
+            return {"push_sent": len(recipients)}
+
+        campaign = _campaign()
+        db = _db(300, campaign)
+        _run(db, campaign, send_chunk)
+        counters = db.broadcast_campaigns.docs[0]["counters"]
+        self.assertEqual(counters["failed"], 100)
+        self.assertEqual(counters["failed_chunks"], 1)
+        self.assertEqual(counters["push_sent"], 200)
+
+    def test_run_stops_when_another_worker_took_the_lease(self):
+        pages = []
+
+        async def send_chunk(recipients):
+            pages.append(recipients[0]["user_id"])
+            db.broadcast_campaigns.docs[0]["lease"] = "worker:2"
+            return {}
+
+        campaign = _campaign()
+        db = _db(1000, campaign)
+        result = _run(db, campaign, send_chunk, page_size=100, chunk_size=100)
+        self.assertEqual(result["status"], "lease_lost")
+        self.assertEqual(pages, ["u0000"])
+
+    def test_page_senders_are_bounded(self):
+        in_flight = 0
+        peak = 0
+
+        async def send_chunk(recipients):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+            return {}
+
+        page = [{"user_id": str(index)} for index in range(1000)]
+        totals = asyncio.run(broadcast_campaigns.send_page(page, send_chunk, senders=3, chunk_size=50))
+        self.assertEqual(totals["chunks"], 20)
+        self.assertLessEqual(peak, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import chat_inbox  # noqa: E402
+from services.restaurant_stream import InProcessBroker  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+
+NOW = datetime(2026, 10, 19, 14, tzinfo=timezone.utc)
+
+
+def _unread_rows(docs):
+    def rows(pipeline):
+        user_id = pipeline[0]["$match"]["$or"][0]["shopkeeper_id"]
+        total = sum(
+            doc.get("unread_supplier" if doc["supplier_id"] == user_id else "unread_shopkeeper", 0)
+            for doc in docs if user_id in (doc["shopkeeper_id"], doc["supplier_id"])
+        )
+        return [{"total": total}]
+    return rows
+
+
+def _db(conversations):
+    db = FakeDb(conversations=FakeCollection(conversations))
+    db.conversations.aggregate_rows = _unread_rows(db.conversations.docs)
+    return db
+
+
+def _conversation(conversation_id, unread_shopkeeper=0):
+    return {"conversation_id": conversation_id, "shopkeeper_id": "shop", "supplier_id": "supp",
+            "unread_shopkeeper": unread_shopkeeper, "unread_supplier": 0}
+
+
+def _message(sender_id="supp"):
+    return {"message_id": "msg_1", "conversation_id": "c1", "sender_id": sender_id, "content": "Bonjour", "created_at": NOW}
+
+
+class ChatInboxTests(unittest.TestCase):
+    def setUp(self):
+        chat_inbox.set_broker(InProcessBroker())
+
+    def test_badge_is_built_once_then_kept_by_send_and_read(self):
+        db = _db([_conversation("c1", 2), _conversation("c2", 3)])
+
+        async def scenario():
+            totals = [await chat_inbox.unread_total(db, "shop")]
+            await chat_inbox.record_message(db, db.conversations.docs[0], _message())
+            totals.append(await chat_inbox.unread_total(db, "shop"))
+            cleared = await chat_inbox.mark_read(db, db.conversations.docs[0], "shop")
+            totals.append(await chat_inbox.unread_total(db, "shop"))
+            return totals, cleared
+
+        totals, cleared = asyncio.run(scenario())
+        self.assertEqual(totals, [5, 6, 3])
+        self.assertEqual(cleared, 3)
+        self.assertEqual(db.conversations.docs[0]["unread_shopkeeper"], 0)
+        self.assertEqual(db.conversations.docs[0]["last_message"], "Bonjour")
+
+    def test_message_before_the_first_badge_is_not_counted_twice(self):
+        db = _db([_conversation("c1", 2)])
+
+        async def scenario():
+            await chat_inbox.record_message(db, db.conversations.docs[0], _message())
+            stub = dict(db.chat_inbox.docs[0])
+            return stub, await chat_inbox.unread_total(db, "shop")
+
+        stub, total = asyncio.run(scenario())
+        self.assertTrue(stub["stale"])
+        self.assertEqual(total, 3)
+        self.assertNotIn("stale", db.chat_inbox.docs[0])
+
+    def test_sending_pushes_the_message_and_the_new_badge(self):
+        db = _db([_conversation("c1")])
+        db.chat_inbox.docs.append({"user_id": "shop", "unread": 0})
+
+        async def scenario():
+            stream = chat_inbox.broker.subscribe("shop", heartbeat=0.01)
+            events = []
+
+            async def read():
+                async for event in stream:
+                    if event is not None:
+                        events.append(event)
+                    if len(events) == 2:
+                        return
+
+            reader = asyncio.create_task(read())
+            await asyncio.sleep(0.02)
+            await chat_inbox.record_message(db, db.conversations.docs[0], _message())
+            await reader
+            await stream.aclose()
+            return events
+
+        events = asyncio.run(scenario())
+        self.assertEqual([event["type"] for event in events], ["message", "unread"])
+        self.assertEqual(events[1]["unread_total"], 1)
+        self.assertEqual(events[1]["conversation_unread"], 1)
+
+    def test_cursor_round_trips_and_rejects_garbage(self):
+        message = {"message_id": "msg_2", "created_at": NOW - timedelta(minutes=5)}
+        self.assertEqual(chat_inbox.decode_cursor(chat_inbox.encode_cursor(message)), (message["created_at"], "msg_2"))
+        with self.assertRaises(chat_inbox.InvalidChatCursor):
+            chat_inbox.decode_cursor("not-a-cursor")
+
+
+if __name__ == "__main__":
+    unittest.main()
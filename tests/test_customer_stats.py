@@ -0,0 +1,70 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import customer_stats  # noqa: E402
+from tests.fake_mongo import FakeDb  # noqa: E402
+
+NOW = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+
+class CustomerStatsTests(unittest.TestCase):
+    def test_recency_score_buckets(self):
+        self.assertEqual(customer_stats.recency_score(None, NOW), 0)
+        self.assertEqual(customer_stats.recency_score(NOW - timedelta(days=3), NOW), 5)
+        self.assertEqual(customer_stats.recency_score((NOW - timedelta(days=45)).isoformat(), NOW), 3)
+        self.assertEqual(customer_stats.recency_score(NOW - timedelta(days=400), NOW), 1)
+
+    def test_rfm_scores_read_stored_components(self):
+        stats = {"last_purchase_at": NOW - timedelta(days=10), "rfm": {"frequency_score": 3, "monetary_score": 4}}
+        self.assertEqual(customer_stats.rfm_scores(stats, NOW), {"recency": 4, "frequency": 3, "monetary": 4})
+        self.assertEqual(customer_stats.rfm_scores(None, NOW), {"recency": 0, "frequency": 0, "monetary": 0})
+
+    def test_raw_stats_merge_sales_and_orders_with_defaults(self):
+        raw = customer_stats._raw_stats({"sale_count": 2, "sales_amount": 300.0}, {"open_order_count": 1})
+        self.assertEqual(raw["sale_count"], 2)
+        self.assertEqual(raw["open_order_count"], 1)
+        self.assertEqual(raw["ecommerce_order_count"], 0)
+        self.assertIsNone(raw["last_order_at"])
+
+    def test_increment_pipeline_keeps_dates_monotonic_and_recomputes(self):
+        pipeline = customer_stats._increment_pipeline(
+            {"sale_count": 1}, first_at={"first_sale_at": NOW}, last_at={"last_sale_at": NOW},
+        )
+        changes = pipeline[0]["$set"]
+        self.assertEqual(changes["stats.sale_count"], {"$add": [{"$ifNull": ["$stats.sale_count", 0]}, 1]})
+        self.assertEqual(changes["stats.first_sale_at"], {"$min": ["$stats.first_sale_at", NOW]})
+        self.assertEqual(changes["stats.last_sale_at"], {"$max": ["$stats.last_sale_at", NOW]})
+        self.assertIn("stats.average_basket", pipeline[1]["$set"])
+
+    def test_first_read_builds_stats_in_the_background_once(self):
+        db = FakeDb()
+        builds = []
+
+        async def rebuild_owner(db, owner_id):
+            builds.append(owner_id)
+            await asyncio.sleep(0)
+            db.customer_stats_state.docs.append({"user_id": owner_id})
+
+        async def scenario():
+            first = [await customer_stats.ensure_customer_stats(db, "u1") for _ in range(3)]
+            await customer_stats._rebuild_tasks["u1"]
+            return first, await customer_stats.ensure_customer_stats(db, "u1")
+
+        with mock.patch.object(customer_stats, "rebuild_owner", rebuild_owner):
+            first, ready = asyncio.run(scenario())
+        self.assertEqual(first, [False, False, False])
+        self.assertTrue(ready)
+        self.assertEqual(builds, ["u1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import demand_forecast  # noqa: E402
+from services.demand_forecast import (  # noqa: E402
+    HISTORY_DAYS,
+    NO_STOCKOUT_DAYS,
+    compute_forecasts,
+    replenishment_candidates,
+)
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+TODAY = datetime(2026, 10, 19, tzinfo=timezone.utc)
+
+
+def _model_reads(db):
+    return sum(1 for call in db.products.calls if call[0] == "find" and "name" in (call[2] or {}))
+
+
+class DemandForecastTests(unittest.TestCase):
+    def test_steady_seller_runs_out_when_stock_is_consumed(self):
+        qty = np.full((1, HISTORY_DAYS), 2.0)
+        result = compute_forecasts(qty, np.array([10.0]), TODAY)
+        self.assertAlmostEqual(result["velocity"][0], 2.0)
+        self.assertAlmostEqual(result["days_of_stock"][0], 5.0)
+        self.assertEqual(result["trend"][0], "stable")
+
+    def test_weekly_seller_velocity_does_not_depend_on_sale_weekday(self):
+        qty = np.zeros((2, HISTORY_DAYS))
+        qty[0, ::7] = 14
+        qty[1, 3::7] = 14
+        result = compute_forecasts(qty, np.array([100.0, 100.0]), TODAY)
+        self.assertAlmostEqual(result["velocity"][0], 2.0, places=1)
+        self.assertAlmostEqual(result["velocity"][1], 2.0, places=1)
+
+    def test_recent_surge_is_flagged_as_up_trend(self):
+        qty = np.zeros((1, HISTORY_DAYS))
+        qty[0, -7:] = 5
+        result = compute_forecasts(qty, np.array([50.0]), TODAY)
+        self.assertEqual(result["trend"][0], "up")
+
+    def test_product_without_sales_never_runs_out(self):
+        result = compute_forecasts(np.zeros((1, HISTORY_DAYS)), np.array([5.0]), TODAY)
+        self.assertEqual(result["days_of_stock"][0], NO_STOCKOUT_DAYS)
+
+    def test_replenishment_candidates_priorities(self):
+        base = {"name": "P", "min_stock": 2, "max_stock": 20, "lead_time_days": 3, "velocity": 1.0}
+        rows = [
+            {**base, "product_id": "empty", "current_stock": 0, "days_of_stock": 0},
+            {**base, "product_id": "soon", "current_stock": 4, "days_of_stock": 4},
+            {**base, "product_id": "fine", "current_stock": 15, "days_of_stock": 15},
+        ]
+        candidates = replenishment_candidates(rows)
+        self.assertEqual([c["product_id"] for c in candidates], ["empty", "soon"])
+        self.assertEqual(candidates[0]["priority"], "critical")
+        self.assertEqual(candidates[1]["suggested_quantity"], 16)
+
+
+class ForecastCacheTests(unittest.TestCase):
+    def setUp(self):
+        demand_forecast._model_cache.clear()
+        demand_forecast._model_builds.clear()
+
+    def _db(self):
+        today = demand_forecast.day_key(datetime.now(timezone.utc))
+        return FakeDb(
+            products=FakeCollection([
+                {"product_id": "p1", "user_id": "u1", "store_id": "s1", "name": "Riz", "quantity": 20, "selling_price": 500},
+            ]),
+            product_daily_sales=FakeCollection([
+                {"product_id": "p1", "user_id": "u1", "store_id": "s1", "day": today, "qty": 14, "revenue": 7000},
+            ]),
+            forecast_rollup_state=FakeCollection([{"_id": "backfilled", "user_id": "u1", "store_id": "s1"}]),
+        )
+
+    def test_stock_writes_are_read_live_without_rebuilding_the_model(self):
+        db = self._db()
+
+        async def scenario():
+            before = await demand_forecast.get_store_forecast(db, "u1", "s1")
+            db.products.docs[0]["quantity"] = 0
+            after = await demand_forecast.get_store_forecast(db, "u1", "s1")
+            return before, after
+
+        before, after = asyncio.run(scenario())
+        self.assertEqual(_model_reads(db), 1)
+        self.assertEqual(before["products"]["p1"]["current_stock"], 20)
+        self.assertGreater(before["products"]["p1"]["days_of_stock"], 0)
+        self.assertEqual(after["products"]["p1"]["current_stock"], 0)
+        self.assertEqual(after["products"]["p1"]["risk_level"], "critical")
+        self.assertEqual(after["replenishment"][0]["product_id"], "p1")
+        self.assertIs(after["shared"], before["shared"])
+
+    def test_concurrent_misses_share_one_build(self):
+        db = self._db()
+
+        async def scenario():
+            return await asyncio.gather(*(demand_forecast.get_store_forecast(db, "u1", "s1") for _ in range(5)))
+
+        forecasts = asyncio.run(scenario())
+        self.assertEqual(_model_reads(db), 1)
+        self.assertEqual(len({id(forecast["shared"]) for forecast in forecasts}), 1)
+
+    def test_catalog_write_drops_the_store_and_owner_wide_models(self):
+        for key in ("u1:s1", "u1:", "u1:s2", "u2:s1"):
+            demand_forecast._model_cache[key] = ({}, float("inf"))
+        demand_forecast.invalidate_store_forecast("u1", "s1")
+        self.assertEqual(sorted(demand_forecast._model_cache), ["u1:s2", "u2:s1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
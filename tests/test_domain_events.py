@@ -0,0 +1,167 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock
+
+from pymongo.errors import OperationFailure
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import domain_events  # noqa: E402
+from tests.fake_mongo import FakeDb  # noqa: E402
+
+
+NOW = datetime(2026, 10, 19, 12, tzinfo=timezone.utc)
+
+
+class _Transaction:
+    def __init__(self, session):
+        self.session = session
+
+    async def __aenter__(self):
+        if self.session.error:
+            raise self.session.error
+        return self
+
+    async def __aexit__(self, *exc):
+        self.session.committed = exc[0] is None
+
+
+class _Session:
+    def __init__(self, error=None):
+        self.error = error
+        self.committed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def start_transaction(self):
+        return _Transaction(self)
+
+
+class _Client:
+    def __init__(self, session):
+        self.session = session
+
+    async def start_session(self):
+        return self.session
+
+
+def _db(session=None):
+    db = FakeDb()
+    if session is not None:
+        db.client = _Client(session)
+    return db
+
+
+def _write(calls):
+    async def write(session):
+        calls.append(session)
+        return "order", [domain_events.new_event("push.notify_user", {"user_id": "u1"}, "ord_1", NOW)]
+    return write
+
+
+class DomainEventTests(unittest.TestCase):
+    def setUp(self):
+        domain_events._transactions_supported = None
+
+    def test_events_are_saved_in_the_write_transaction(self):
+        calls = []
+        session = _Session()
+        db = _db(session)
+        result = asyncio.run(domain_events.commit(db, _write(calls)))
+        self.assertEqual(result, "order")
+        self.assertEqual(calls, [session])
+        self.assertEqual([call[2] for call in db.domain_events.calls if call[0] == "insert_many"], [session])
+        self.assertTrue(session.committed)
+
+    def test_commit_falls_back_without_transactions(self):
+        calls = []
+        db = _db(_Session(OperationFailure("Transaction numbers are only allowed on a replica set", code=20)))
+        asyncio.run(domain_events.commit(db, _write(calls)))
+        self.assertEqual(calls, [None])
+        self.assertEqual(len(db.domain_events.docs), 1)
+        self.assertFalse(domain_events._transactions_supported)
+
+    def test_transient_transaction_errors_are_retried(self):
+        calls = []
+        session = _Session()
+        db = _db(session)
+        conflict = OperationFailure("WriteConflict", code=112, details={"errorLabels": ["TransientTransactionError"]})
+
+        async def write(session):
+            calls.append(session)
+            if len(calls) == 1:
+                raise conflict
+            return "order", []
+
+        self.assertEqual(asyncio.run(domain_events.commit(db, write)), "order")
+        self.assertEqual(calls, [session, session])
+        self.assertTrue(domain_events._transactions_supported)
+
+    def test_transient_errors_give_up_once_the_retry_window_is_over(self):
+        db = _db(_Session())
+
+        async def write(session):
+            raise OperationFailure("WriteConflict", code=112, details={"errorLabels": ["TransientTransactionError"]})
+
+        with mock.patch.object(domain_events, "TRANSACTION_TIMEOUT_S", 0), self.assertRaises(OperationFailure):
+            asyncio.run(domain_events.commit(db, write))
+
+    def test_transaction_backoff_is_jittered_and_capped(self):
+        with mock.patch.object(domain_events.random, "uniform", side_effect=lambda low, high: high):
+            self.assertEqual(domain_events.transaction_backoff(1), domain_events.TRANSACTION_BACKOFF_BASE_S * 2)
+            self.assertEqual(domain_events.transaction_backoff(30), domain_events.TRANSACTION_BACKOFF_MAX_S)
+
+    def test_dispatch_marks_done_retry_and_failed(self):
+        db = _db()
+        db.domain_events.docs = [
+            domain_events.new_event("ok", {}, now=NOW),
+            domain_events.new_event("flaky", {}, now=NOW),
+            domain_events.new_event("unknown", {}, now=NOW),
+        ]
+
+        async def flaky(payload):
+            raise RuntimeError("provider down")
+
+        async def ok(payload):
+            return None
+
+        counts = asyncio.run(domain_events.dispatch_due(db, {"ok": ok, "flaky": flaky}, NOW))
+        self.assertEqual(counts, {"done": 1, "retry": 1, "failed": 1})
+        done, retried, failed = db.domain_events.docs
+        self.assertEqual(done["status"], "done")
+        self.assertEqual(retried["status"], "pending")
+        self.assertEqual(retried["next_attempt_at"], NOW + timedelta(seconds=15))
+        self.assertEqual(retried["last_error"], "provider down")
+        self.assertIsNone(retried["lease"])
+        self.assertEqual(failed["status"], "failed")
+
+    def test_event_fails_once_attempts_are_exhausted(self):
+        db = _db()
+        event = domain_events.new_event("flaky", {}, now=NOW)
+        event["attempts"] = domain_events.MAX_ATTEMPTS - 1
+        db.domain_events.docs = [event]
+
+        async def flaky(payload):
+            raise RuntimeError("provider down")
+
+        asyncio.run(domain_events.dispatch_due(db, {"flaky": flaky}, NOW))
+        self.assertEqual(db.domain_events.docs[0]["status"], "failed")
+        self.assertEqual(db.domain_events.docs[0]["finished_at"], NOW)
+
+    def test_backoff_doubles_up_to_the_cap(self):
+        self.assertEqual(domain_events.backoff_delay(3), timedelta(seconds=60))
+        self.assertEqual(domain_events.backoff_delay(30), domain_events.BACKOFF_MAX)
+
+
+if __name__ == "__main__":
+    unittest.main()
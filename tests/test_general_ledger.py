@@ -0,0 +1,101 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import general_ledger  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb, run_pipeline  # noqa: E402
+
+
+def _at(hour):
+    return datetime(2026, 3, 1, hour, tzinfo=timezone.utc)
+
+
+def _movements(docs):
+    # Movements already carry their product, so only the match and sort stages run.
+    return FakeCollection(docs, aggregate_rows=lambda pipeline: run_pipeline(docs, pipeline[:2]))
+
+
+def _sources():
+    return general_ledger.build_sources(
+        "owner", {}, _at(0), _at(23), {"type": "out"}, lambda m: m.get("reason") != "vente",
+    )
+
+
+class GeneralLedgerTests(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDb(
+            sales=FakeCollection([
+                {"_id": "a1", "user_id": "owner", "sale_id": "sale_aaaaaa", "total_amount": 100, "created_at": _at(9)},
+                {"_id": "a2", "user_id": "owner", "sale_id": "sale_bbbbbb", "total_amount": 50, "created_at": _at(12)},
+            ]),
+            expenses=FakeCollection([
+                {"_id": "e1", "user_id": "owner", "expense_id": "exp_cccccc", "amount": 30, "category": "loyer",
+                 "created_at": _at(10)},
+            ]),
+            stock_movements=_movements([
+                {"_id": "m1", "user_id": "owner", "type": "out", "movement_id": "mov_dddddd", "quantity": 2,
+                 "reason": "casse", "product": {"name": "Riz", "purchase_price": 5}, "created_at": _at(9)},
+                {"_id": "m2", "user_id": "owner", "type": "out", "movement_id": "mov_eeeeee", "quantity": 1,
+                 "reason": "vente", "created_at": _at(11)},
+            ]),
+            orders=FakeCollection([
+                {"_id": "o1", "user_id": "owner", "status": "delivered", "order_id": "ord_ffffff", "total_amount": 40,
+                 "updated_at": _at(13)},
+            ]),
+        )
+
+    def test_merge_is_chronological_with_running_balance(self):
+        entries, last_key, balance, has_more = asyncio.run(
+            general_ledger.read_page(self.db, _sources(), limit=10)
+        )
+        self.assertEqual([e["type_code"] for e in entries], ["sale", "loss", "expense", "sale", "purchase"])
+        self.assertEqual([e["balance"] for e in entries], [100, 90, 60, 110, 70])
+        self.assertEqual(balance, 70)
+        self.assertFalse(has_more)
+        self.assertEqual(last_key, (_at(13), 3, "o1"))
+
+    def test_page_stops_at_limit(self):
+        entries, last_key, balance, has_more = asyncio.run(
+            general_ledger.read_page(self.db, _sources(), limit=2)
+        )
+        self.assertEqual(len(entries), 2)
+        self.assertTrue(has_more)
+        self.assertEqual(balance, 90)
+        self.assertEqual(last_key, (_at(9), 2, "m1"))
+
+    def test_after_clause_orders_by_date_source_then_id(self):
+        sources = _sources()
+        after = (_at(9), 1, "0123456789abcdef01234567")
+        self.assertEqual(general_ledger._after_clause(sources[0], 0, after), {"created_at": {"$gt": _at(9)}})
+        self.assertEqual(general_ledger._after_clause(sources[2], 2, after), {"created_at": {"$gte": _at(9)}})
+        same = general_ledger._after_clause(sources[1], 1, after)
+        self.assertEqual(same["$or"][0], {"created_at": {"$gt": _at(9)}})
+        self.assertEqual(str(same["$or"][1]["_id"]["$gt"]), "0123456789abcdef01234567")
+
+    def test_token_round_trip(self):
+        state = {"after": (_at(9), 2, "m1"), "balance": 90.5, "totals": {"total_in": 1.0}}
+        decoded = general_ledger.decode_token(general_ledger.encode_token(state))
+        self.assertEqual(decoded["after"], (_at(9), 2, "m1"))
+        self.assertEqual(decoded["balance"], 90.5)
+        with self.assertRaises(general_ledger.InvalidLedgerToken):
+            general_ledger.decode_token("not-a-token")
+
+    def test_csv_stream_has_header_and_balance(self):
+        async def collect():
+            return "".join([chunk async for chunk in general_ledger.iter_csv(self.db, _sources())])
+
+        lines = asyncio.run(collect()).strip().splitlines()
+        self.assertEqual(lines[0].split(";")[0], "Date")
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[-1].endswith(";70.0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
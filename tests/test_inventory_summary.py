@@ -0,0 +1,62 @@
+import sys
+import unittest
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services.inventory_summary import classify_product, merge_summaries, summary_delta  # noqa: E402
+
+
+def _product(**overrides):
+    base = {"quantity": 10, "min_stock": 5, "max_stock": 50, "purchase_price": 100, "selling_price": 150}
+    base.update(overrides)
+    return base
+
+
+class InventorySummaryTests(unittest.TestCase):
+    def test_classification_matches_dashboard_buckets(self):
+        self.assertFalse(classify_product(_product())["critical"])
+        low = classify_product(_product(quantity=3))
+        self.assertTrue(low["low"] and low["critical"] and not low["out"])
+        out = classify_product(_product(quantity=0))
+        self.assertTrue(out["out"] and out["critical"] and not out["low"])
+        self.assertTrue(classify_product(_product(quantity=50))["over"])
+
+    def test_inactive_product_contributes_nothing(self):
+        inactive = classify_product(_product(quantity=0, is_active=False))
+        self.assertEqual(summary_delta(None, inactive), {})
+
+    def test_delta_moves_counts_and_values(self):
+        before = classify_product(_product(quantity=10))
+        after = classify_product(_product(quantity=2))
+        self.assertEqual(
+            summary_delta(before, after),
+            {"low_stock_count": 1, "critical_count": 1, "total_stock_value": -800.0, "potential_revenue": -1200.0},
+        )
+
+    def test_new_and_removed_products(self):
+        snapshot = classify_product(_product(quantity=0))
+        self.assertEqual(summary_delta(None, snapshot)["total_products"], 1)
+        removed = summary_delta(snapshot, None)
+        self.assertEqual(removed["total_products"], -1)
+        self.assertEqual(removed["out_of_stock_count"], -1)
+
+    def test_owner_summary_adds_every_store(self):
+        merged = merge_summaries([
+            {"total_products": 3, "critical_count": 2, "total_stock_value": 500.0, "critical_product_ids": ["a1", "a2"]},
+            {"total_products": 1, "critical_count": 1, "total_stock_value": 250.5, "critical_product_ids": ["b1"]},
+            {"total_products": 2},
+        ])
+        self.assertEqual(merged["total_products"], 6)
+        self.assertEqual(merged["critical_count"], 3)
+        self.assertEqual(merged["total_stock_value"], 750.5)
+        self.assertEqual(merged["potential_revenue"], 0.0)
+        self.assertEqual(merged["critical_product_ids"], ["a1", "b1", "a2"])
+        self.assertEqual(merged["overstock_product_ids"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import notification_service as notifications  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+
+NOW = datetime(2026, 10, 19, 10, tzinfo=timezone.utc)
+
+
+def _db(users):
+    return FakeDb(users=FakeCollection(users))
+
+
+def _updates(collection):
+    return [call[1:] for call in collection.calls if call[0] == "update_many"]
+
+
+def _service(handler):
+    return notifications.NotificationService(transport=httpx.MockTransport(handler))
+
+
+def _user(index, *tokens):
+    return {"user_id": f"u{index}", "push_tokens": list(tokens) or [f"ExponentPushToken[{index}]"]}
+
+
+def _ok_tickets(request):
+    return httpx.Response(200, json={"data": [{"status": "ok", "id": f"t-{m['to']}"} for m in json.loads(request.content)]})
+
+
+class NotificationDispatcherTests(unittest.TestCase):
+    def test_backoff_doubles_up_to_the_cap(self):
+        self.assertEqual(notifications.backoff_delay(1), timedelta(seconds=30))
+        self.assertEqual(notifications.backoff_delay(3), timedelta(seconds=120))
+        self.assertEqual(notifications.backoff_delay(20), notifications.BACKOFF_MAX)
+
+    def test_burst_is_sent_in_expo_sized_batches_over_one_client(self):
+        sizes = []
+
+        def handler(request):
+            sizes.append(len(json.loads(request.content)))
+            return _ok_tickets(request)
+
+        db = _db([_user(index) for index in range(150)])
+        service = _service(handler)
+        client = service.client
+        asyncio.run(service.enqueue(db, [
+            {"user_id": f"u{index}", "title": "Stock", "body": "Bas"} for index in range(150)
+        ]))
+        docs = db.notification_outbox.docs
+        self.assertEqual(sizes, [100, 50])
+        self.assertEqual(db.users.count_calls("find"), 1)
+        self.assertIs(service.client, client)
+        self.assertEqual({doc["status"] for doc in docs}, {"sent"})
+        self.assertEqual(docs[0]["tickets"][0]["id"], "t-ExponentPushToken[0]")
+
+    def test_transient_failures_are_retried_with_backoff_for_the_failed_tokens_only(self):
+        def handler(request):
+            return httpx.Response(200, json={"data": [
+                {"status": "ok", "id": "t1"},
+                {"status": "error", "details": {"error": "MessageRateExceeded"}},
+                {"status": "error", "details": {"error": "DeviceNotRegistered"}},
+            ]})
+
+        db = _db([_user(1, "ExponentPushToken[a]", "ExponentPushToken[b]", "ExponentPushToken[dead]")])
+        doc = dict(user_id="u1", title="T", body="B", outbox_id="ntf_1", attempts=0, lease="L")
+        db.notification_outbox.docs.append(doc)
+        counts = asyncio.run(_service(handler).dispatch(db, [doc], NOW))
+        self.assertEqual(counts["retry"], 1)
+        self.assertEqual(doc["status"], "pending")
+        self.assertEqual(doc["pending_tokens"], ["ExponentPushToken[b]"])
+        self.assertEqual(doc["next_attempt_at"], NOW + timedelta(seconds=30))
+        self.assertEqual(_updates(db.users)[0][1], {"$pull": {"push_tokens": {"$in": ["ExponentPushToken[dead]"]}}})
+
+    def test_notification_fails_once_attempts_are_exhausted(self):
+        db = _db([_user(1)])
+        doc = dict(user_id="u1", title="T", body="B", outbox_id="ntf_1", attempts=notifications.MAX_ATTEMPTS - 1, lease="L")
+        db.notification_outbox.docs.append(doc)
+        asyncio.run(_service(lambda request: httpx.Response(503)).dispatch(db, [doc], NOW))
+        self.assertEqual(doc["status"], "failed")
+        self.assertEqual(doc["finished_at"], NOW)
+
+    def test_receipts_prune_unregistered_tokens(self):
+        def handler(request):
+            return httpx.Response(200, json={"data": {
+                "t1": {"status": "ok"},
+                "t2": {"status": "error", "details": {"error": "DeviceNotRegistered"}},
+            }})
+
+        db = _db([])
+        db.notification_outbox.docs.append({
+            "outbox_id": "ntf_1", "status": "sent", "receipts_due_at": NOW,
+            "tickets": [{"id": "t1", "token": "ExponentPushToken[a]"}, {"id": "t2", "token": "ExponentPushToken[b]"}],
+        })
+        read = asyncio.run(_service(handler).process_receipts(db, NOW))
+        self.assertEqual(read, 2)
+        self.assertEqual(db.notification_outbox.docs[0]["status"], "delivered")
+        self.assertEqual(_updates(db.users)[0][0], {"push_tokens": {"$in": ["ExponentPushToken[b]"]}})
+        self.assertEqual(_updates(db.push_installations)[0][1], {"$set": {"is_active": False}})
+
+
+if __name__ == "__main__":
+    unittest.main()
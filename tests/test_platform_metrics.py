@@ -0,0 +1,95 @@
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import platform_metrics as pm  # noqa: E402
+
+
+def _utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def _profile(account):
+    return {"plan": account.get("plan", "starter"), "paying": bool(account.get("subscription_provider")),
+            "currency": "XOF", "amount": 5000.0}
+
+
+class PlatformMetricsTests(unittest.TestCase):
+    def test_payment_event_moves_provider_source_and_volume_counters(self):
+        counters = pm.add_flat({}, pm.event_increments({
+            "event_type": "payment_succeeded", "provider": "Stripe", "source": "webhook",
+            "currency": "eur", "plan": "Pro", "amount": "29.9",
+        }))
+        self.assertEqual(counters["payments"]["count"], 1)
+        self.assertEqual(counters["payments"]["by_provider"], {"stripe": 1})
+        self.assertEqual(counters["payments"]["volume"], {"EUR": 29.9})
+        self.assertEqual(counters["payments"]["volume_by_plan"], {"pro": {"EUR": 29.9}})
+
+    def test_churn_events_and_unrelated_events(self):
+        self.assertEqual(pm.event_increments({"event_type": "payment_failed"}, 3),
+                         {"churn.count": 3, "churn.by_type.payment_failed": 3})
+        self.assertEqual(pm.event_increments({"event_type": "checkout_started"}), {})
+
+    def test_unknown_roles_are_counted_as_other(self):
+        self.assertEqual(pm.signup_increments("staff"), {"signups.total": 1, "signups.by_role.staff": 1})
+        self.assertEqual(pm.signup_increments("a.b$c"), {"signups.total": 1, "signups.by_role.other": 1})
+        self.assertEqual(pm.signup_increments(None), {"signups.total": 1, "signups.by_role.other": 1})
+
+    def test_merge_counters_sums_nested_values(self):
+        merged = pm.merge_counters({"sales": {"count": 1, "revenue": 10.0}}, {"sales": {"count": 2, "revenue": 5.5}})
+        self.assertEqual(merged, {"sales": {"count": 3, "revenue": 15.5}})
+
+    def test_window_uses_days_for_the_middle_and_hours_for_the_edges(self):
+        query = pm.window_query(_utc(2026, 10, 12, 9, 30), _utc(2026, 10, 19, 14, 5))
+        self.assertEqual(query["$or"], [
+            {"granularity": "day", "period_start": {"$gte": _utc(2026, 10, 13), "$lt": _utc(2026, 10, 19)}},
+            {"granularity": "hour", "period_start": {"$gte": _utc(2026, 10, 12, 9), "$lt": _utc(2026, 10, 13)}},
+            {"granularity": "hour", "period_start": {"$gte": _utc(2026, 10, 19), "$lt": _utc(2026, 10, 19, 14, 5)}},
+        ])
+
+    def test_short_window_reads_hours_only(self):
+        query = pm.window_query(_utc(2026, 10, 19), _utc(2026, 10, 19, 14, 5))
+        self.assertEqual(query, {"granularity": "hour", "period_start": {"$gte": _utc(2026, 10, 19), "$lt": _utc(2026, 10, 19, 14, 5)}})
+
+    def test_monthly_counters_group_daily_documents(self):
+        months = pm.monthly_counters([
+            {"period_start": _utc(2026, 9, 30), "signups": {"total": 2}},
+            {"period_start": _utc(2026, 10, 1), "signups": {"total": 1}, "churn": {"count": 1}},
+            {"period_start": _utc(2026, 10, 2), "signups": {"total": 4}},
+        ])
+        self.assertEqual(months["2026-09"], {"signups": {"total": 2}, "payments": {}, "churn": {}, "sales": {}})
+        self.assertEqual(months["2026-10"]["signups"], {"total": 5})
+        self.assertEqual(months["2026-10"]["churn"], {"count": 1})
+
+    def test_account_state(self):
+        now = _utc(2026, 10, 19, 12)
+        accounts = [
+            {"plan": "pro", "subscription_provider": "stripe", "subscription_status": "active",
+             "subscription_end": now + timedelta(days=2), "currency": "xof"},
+            {"plan": "starter", "subscription_status": "active", "trial_ends_at": now + timedelta(days=2)},
+            {"plan": "starter", "subscription_status": "expired"},
+        ]
+        state = pm._account_state([(account, _profile(account)) for account in accounts], now)
+        self.assertEqual(state["total_accounts"], 3)
+        self.assertEqual(state["active_paid_accounts"], 1)
+        self.assertEqual(state["mrr"], {"XOF": 5000.0})
+        self.assertEqual(state["mrr_by_plan"], {"pro": {"XOF": 5000.0}, "starter": {"XOF": 5000.0}})
+        self.assertEqual(state["subscriptions_expiring_soon"], 1)
+        self.assertEqual((state["active_trials"], state["trials_expiring_3d"], state["trials_expiring_soon"]), (1, 1, 1))
+        self.assertEqual(state["expired_accounts"], 1)
+        self.assertEqual(state["by_plan"], {"pro": 1, "starter": 2})
+        self.assertEqual(state["by_currency"], {"XOF": 1})
+
+    def test_format_amount(self):
+        self.assertEqual(pm.format_amount(5000.0), "5000")
+        self.assertEqual(pm.format_amount(12.5), "12.5")
+
+
+if __name__ == "__main__":
+    unittest.main()
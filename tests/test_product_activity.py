@@ -0,0 +1,76 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import product_activity  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+
+NOW = datetime(2026, 10, 19, 12, tzinfo=timezone.utc)
+
+
+def _db(products, outs=(), sold=(), counted=()):
+    return FakeDb(
+        products=FakeCollection(products),
+        stock_movements=FakeCollection(outs),
+        sales=FakeCollection(sold),
+        inventory_tasks=FakeCollection(counted),
+    )
+
+
+def _product(product_id, owner_id="u1", **fields):
+    return {"product_id": product_id, "user_id": owner_id, **fields}
+
+
+class ProductActivityTests(unittest.TestCase):
+    def test_sale_stamps_last_sold_without_moving_it_back(self):
+        db = _db([_product("p1", last_sold_at=NOW), _product("p2"), _product("p3", owner_id="u2")])
+        sale = {
+            "user_id": "u1",
+            "created_at": NOW - timedelta(days=2),
+            "items": [{"product_id": "p1"}, {"product_id": "p2"}, {"product_id": "p2"}, {"product_id": "p3"}],
+        }
+        asyncio.run(product_activity.record_sale(db, sale))
+        by_id = {doc["product_id"]: doc for doc in db.products.docs}
+        self.assertEqual(by_id["p1"]["last_sold_at"], NOW)
+        self.assertEqual(by_id["p2"]["last_sold_at"], NOW - timedelta(days=2))
+        self.assertNotIn("last_sold_at", by_id["p3"])
+
+    def test_backfill_derives_timestamps_from_history(self):
+        db = _db(
+            [_product("p1"), _product("p2", last_movement_out_at=NOW)],
+            outs=[{"user_id": "u1", "type": "out", "product_id": "p1", "created_at": NOW - timedelta(days=5)},
+                  {"user_id": "u1", "type": "out", "product_id": "p1", "created_at": NOW - timedelta(days=8)},
+                  {"user_id": "u1", "type": "out", "product_id": "p2", "created_at": NOW - timedelta(days=9)}],
+            sold=[{"user_id": "u1", "items": [{"product_id": "p1"}], "created_at": (NOW - timedelta(days=3)).isoformat()}],
+            counted=[{"user_id": "u1", "status": "completed", "product_id": "p2", "completed_at": NOW - timedelta(days=1)}],
+        )
+        asyncio.run(product_activity.ensure_product_activity(db, "u1"))
+        by_id = {doc["product_id"]: doc for doc in db.products.docs}
+        self.assertEqual(by_id["p1"]["last_movement_out_at"], NOW - timedelta(days=5))
+        self.assertEqual(by_id["p1"]["last_sold_at"], NOW - timedelta(days=3))
+        self.assertEqual(by_id["p2"]["last_movement_out_at"], NOW)
+        self.assertEqual(by_id["p2"]["last_counted_at"], NOW - timedelta(days=1))
+        self.assertEqual([doc["user_id"] for doc in db.product_activity_state.docs], ["u1"])
+
+    def test_pending_owner_scan_stops_once_every_owner_is_done(self):
+        db = _db([_product("p1", owner_id="u1"), _product("p2", owner_id="u2"), _product("p3", owner_id="u3")])
+
+        async def scenario():
+            return [await product_activity.backfill_pending_owners(db, limit=2) for _ in range(4)]
+
+        self.assertEqual(asyncio.run(scenario()), [2, 1, 0, 0])
+        self.assertEqual(db.products.count_calls("distinct"), 2)
+        states = {doc["user_id"] for doc in db.product_activity_state.docs}
+        self.assertEqual(states, {"u1", "u2", "u3", product_activity.ALL_OWNERS_DONE})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import receipt_renderer  # noqa: E402
+from tests.fake_mongo import FakeDb  # noqa: E402
+
+
+RECEIPT = {
+    "sale_id": "sale_1",
+    "items": [
+        {"product_name": "Riz (5kg)", "quantity": 2, "selling_price": 4500, "total": 9000,
+         "sold_quantity_input": None, "sold_unit": None},
+    ],
+    "total_amount": 9000,
+    "payment_method": "cash",
+    "created_at": datetime(2026, 10, 19, 14, tzinfo=timezone.utc),
+    "store_name": "Boutique <Dakar>",
+    "store_address": None,
+    "receipt_footer": None,
+}
+
+
+class ReceiptRendererTests(unittest.TestCase):
+    def setUp(self):
+        receipt_renderer.clear()
+
+    def test_key_changes_with_the_sale_version(self):
+        first = receipt_renderer.render_key("rcpt_x", "sale_1", 0)
+        self.assertEqual(first, receipt_renderer.render_key("rcpt_x", "sale_1", None))
+        self.assertNotEqual(first, receipt_renderer.render_key("rcpt_x", "sale_1", 1))
+
+    def test_receipt_is_rendered_once_per_version(self):
+        db = FakeDb()
+        loads = []
+
+        async def load():
+            loads.append(1)
+            return dict(RECEIPT)
+
+        sale = {"sale_id": "sale_1", "public_receipt_token": "rcpt_x"}
+
+        async def scenario():
+            first = await receipt_renderer.get_or_render(db, sale, load)
+            receipt_renderer.clear()
+            again = await receipt_renderer.get_or_render(db, sale, load)
+            edited = await receipt_renderer.get_or_render(db, {**sale, "receipt_version": 1}, load)
+            return first, again, edited
+
+        first, again, edited = asyncio.run(scenario())
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(first["html"], again["html"])
+        self.assertNotEqual(first["_id"], edited["_id"])
+        self.assertIn("Boutique &lt;Dakar&gt;", first["html"])
+        self.assertIn(f"/public/receipts/r/{first['_id']}.pdf", first["html"])
+
+    def test_pdf_is_rendered_once_and_stored(self):
+        db = FakeDb()
+
+        async def load():
+            return dict(RECEIPT)
+
+        async def scenario():
+            render = await receipt_renderer.get_or_render(db, {"sale_id": "sale_1", "public_receipt_token": "rcpt_x"}, load)
+            return render, await receipt_renderer.ensure_pdf(db, render)
+
+        render, pdf = asyncio.run(scenario())
+        self.assertTrue(pdf.startswith(b"%PDF-1.4"))
+        self.assertTrue(pdf.rstrip().endswith(b"%%EOF"))
+        self.assertIn(b"Riz \\(5kg\\)", pdf)
+        self.assertIn("R\xe9f\xe9rence".encode("latin-1"), pdf)
+        self.assertEqual(bytes(db.receipt_renders.docs[0]["pdf"]), pdf)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import reminder_queue  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+
+NOW = datetime(2026, 10, 19, 9, tzinfo=timezone.utc)
+
+
+def _db(docs):
+    return FakeDb(user_planner_items=FakeCollection(docs))
+
+
+def _item(item_id, minutes_ago, **extra):
+    return {"item_id": item_id, "is_completed": False, "last_notified_at": None,
+            "reminder_at": NOW - timedelta(minutes=minutes_ago), **extra}
+
+
+class ReminderQueueTests(unittest.TestCase):
+    def test_claims_are_exclusive_until_the_lease_expires(self):
+        db = _db([_item("a", 3), _item("b", 2), _item("c", 1), _item("later", -5)])
+        token_1, first = asyncio.run(reminder_queue.claim_batch(db, NOW, size=2))
+        token_2, second = asyncio.run(reminder_queue.claim_batch(db, NOW, size=10))
+        self.assertEqual([item["item_id"] for item in first], ["a", "b"])
+        self.assertEqual([item["item_id"] for item in second], ["c"])
+        self.assertNotEqual(token_1, token_2)
+
+        after_lease = NOW + reminder_queue.LEASE_DURATION
+        _, retried = asyncio.run(reminder_queue.claim_batch(db, after_lease, size=10))
+        self.assertEqual([item["item_id"] for item in retried], ["a", "b", "c"])
+
+    def test_completed_items_leave_the_queue(self):
+        db = _db([_item("a", 3), _item("b", 2)])
+        token, items = asyncio.run(reminder_queue.claim_batch(db, NOW))
+        asyncio.run(reminder_queue.complete(db, token, [item["item_id"] for item in items], NOW))
+        _, again = asyncio.run(reminder_queue.claim_batch(db, NOW + timedelta(hours=1)))
+        self.assertEqual(again, [])
+        self.assertNotIn("reminder_lease", db.user_planner_items.docs[0])
+
+    def test_completion_requires_the_lease_token(self):
+        db = _db([_item("a", 3)])
+        asyncio.run(reminder_queue.claim_batch(db, NOW))
+        asyncio.run(reminder_queue.complete(db, "other:token", ["a"], NOW))
+        self.assertIsNone(db.user_planner_items.docs[0]["last_notified_at"])
+
+
+if __name__ == "__main__":
+    unittest.main()
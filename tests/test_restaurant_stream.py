@@ -0,0 +1,71 @@
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import restaurant_stream  # noqa: E402
+
+
+async def _take(stream, count):
+    events = []
+    async for event in stream:
+        if event is not None:
+            events.append(event)
+        if len(events) == count:
+            break
+    await stream.aclose()
+    return events
+
+
+class RestaurantStreamTests(unittest.TestCase):
+    def test_live_events_are_delivered_per_store_in_order(self):
+        broker = restaurant_stream.InProcessBroker()
+
+        async def scenario():
+            stream = broker.subscribe("store_a", heartbeat=0.01)
+            reader = asyncio.create_task(_take(stream, 2))
+            await asyncio.sleep(0.02)
+            await broker.publish("store_a", "order_created", {"sale": {"sale_id": "s1"}})
+            await broker.publish("store_b", "order_created", {"sale": {"sale_id": "other"}})
+            await broker.publish("store_a", "items_added", {"sale": {"sale_id": "s1"}})
+            events = await reader
+            return events, broker.subscriber_count("store_a")
+
+        events, subscribers = asyncio.run(scenario())
+        self.assertEqual([(event["type"], event["seq"]) for event in events], [("order_created", 1), ("items_added", 2)])
+        self.assertEqual(subscribers, 0)
+
+    def test_resume_replays_what_was_missed(self):
+        broker = restaurant_stream.InProcessBroker()
+
+        async def scenario():
+            first = await broker.publish("store_a", "order_created", {})
+            await broker.publish("store_a", "status_changed", {"status": "sent"})
+            await broker.publish("store_a", "table_freed", {})
+            return await _take(broker.subscribe("store_a", after=first["id"], heartbeat=0.01), 2)
+
+        events = asyncio.run(scenario())
+        self.assertEqual([event["type"] for event in events], ["status_changed", "table_freed"])
+
+    def test_unknown_or_expired_cursor_asks_for_a_resync(self):
+        broker = restaurant_stream.InProcessBroker(backlog_size=2)
+
+        async def scenario():
+            for _ in range(5):
+                await broker.publish("store_a", "items_added", {})
+            expired = await _take(broker.subscribe("store_a", after=f"{broker.epoch}:1", heartbeat=0.01), 1)
+            restarted = await _take(broker.subscribe("store_a", after="old:4", heartbeat=0.01), 1)
+            return expired + restarted
+
+        events = asyncio.run(scenario())
+        self.assertEqual([event["type"] for event in events], ["resync", "resync"])
+        self.assertEqual(events[0]["id"], f"{broker.epoch}:5")
+
+
+if __name__ == "__main__":
+    unittest.main()
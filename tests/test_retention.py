@@ -0,0 +1,58 @@
+import asyncio
+import gzip
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import retention  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+
+NOW = datetime(2026, 10, 19, 3, tzinfo=timezone.utc)
+
+
+class RetentionTests(unittest.TestCase):
+    def test_retention_follows_the_plan_and_env_overrides(self):
+        self.assertEqual(retention.retention_days("activity_logs", "enterprise"), 365)
+        self.assertEqual(retention.retention_days("activity_logs", "starter"), 90)
+        self.assertEqual(retention.retention_days("activity_logs"), 90)
+        with mock.patch.dict(os.environ, {"RETENTION_POLICY_JSON": '{"activity_logs": {"starter": 30}}'}):
+            self.assertEqual(retention.retention_days("activity_logs", "starter"), 30)
+            self.assertEqual(retention.retention_days("activity_logs", "pro"), 180)
+        self.assertEqual(retention.expires_at("security_events", at=NOW), NOW + timedelta(days=90))
+
+    def test_invalid_env_policy_is_ignored(self):
+        with mock.patch.dict(os.environ, {"RETENTION_POLICY_JSON": "not json"}):
+            self.assertEqual(retention.retention_days("activity_logs", "pro"), 180)
+
+    def test_expiring_records_are_archived_once_by_month(self):
+        db = FakeDb(activity_logs=FakeCollection([
+            {"_id": 1, "created_at": datetime(2026, 7, 20), "expires_at": NOW + timedelta(days=1)},
+            {"_id": 2, "created_at": datetime(2026, 8, 1), "expires_at": NOW + timedelta(hours=1)},
+            {"_id": 3, "created_at": datetime(2026, 10, 1), "expires_at": NOW + timedelta(days=60)},
+        ]))
+        with tempfile.TemporaryDirectory() as archive_dir:
+            self.assertEqual(asyncio.run(retention.archive_expiring(db, archive_dir, NOW)), 2)
+            self.assertEqual(asyncio.run(retention.archive_expiring(db, archive_dir, NOW)), 0)
+            july = retention.archive_path(archive_dir, "activity_logs", datetime(2026, 7, 20))
+            with gzip.open(july, "rt", encoding="utf-8") as handle:
+                self.assertEqual(len(handle.readlines()), 1)
+            self.assertTrue(retention.archive_path(archive_dir, "activity_logs", datetime(2026, 8, 1)).exists())
+        self.assertNotIn("archived_at", db["activity_logs"].docs[2])
+
+    def test_archiving_is_disabled_without_a_directory(self):
+        with mock.patch.dict(os.environ, {"RETENTION_ARCHIVE_DIR": ""}):
+            self.assertEqual(asyncio.run(retention.archive_expiring(FakeDb(), now=NOW)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+from pymongo.errors import OperationFailure
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import domain_events, sequences  # noqa: E402
+from tests.fake_mongo import FakeDb  # noqa: E402
+
+
+AT = datetime(2026, 10, 19, 14, tzinfo=timezone.utc)
+
+
+class _SnapshotCounters:
+    """Counters written through snapshot transactions: committing over a newer version aborts."""
+
+    def __init__(self):
+        self.docs = {}
+        self.conflicts = 0
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=None, session=None):
+        key = query["_id"]
+        doc = session.staged.get(key)
+        if doc is None:
+            committed = self.docs.get(key) or {"_id": key, **update["$setOnInsert"], "value": 0, "version": 0}
+            session.read_versions[key] = committed["version"]
+            doc = dict(committed)
+        doc["value"] += update["$inc"]["value"]
+        session.staged[key] = doc
+        # Let the other terminals' transactions run between the read and the commit.
+        await asyncio.sleep(0)
+        return dict(doc)
+
+    def commit(self, session):
+        if any((self.docs.get(key) or {"version": 0})["version"] != version
+               for key, version in session.read_versions.items()):
+            self.conflicts += 1
+            raise OperationFailure("WriteConflict", code=112, details={"errorLabels": ["TransientTransactionError"]})
+        for key, doc in session.staged.items():
+            self.docs[key] = {**doc, "version": doc["version"] + 1}
+
+
+class _Transaction:
+    def __init__(self, session):
+        self.session = session
+
+    async def __aenter__(self):
+        self.session.staged, self.session.read_versions = {}, {}
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.session.counters.commit(self.session)
+        return False
+
+
+class _Session:
+    def __init__(self, counters):
+        self.counters = counters
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def start_transaction(self):
+        return _Transaction(self)
+
+
+class _Client:
+    def __init__(self, db):
+        self.db = db
+
+    async def start_session(self):
+        return _Session(self.db.sequences)
+
+
+class _TransactionalDb:
+    def __init__(self):
+        self.sequences = _SnapshotCounters()
+        self.client = _Client(self)
+
+
+class SequenceTests(unittest.TestCase):
+    def test_numbers_are_contiguous_per_owner_series_and_year(self):
+        db = FakeDb()
+
+        async def scenario():
+            numbers = [await sequences.next_number(db, "u1", "invoice:FAC", "FAC", AT) for _ in range(3)]
+            numbers.append(await sequences.next_number(db, "u2", "invoice:FAC", "FAC", AT))
+            numbers.append(await sequences.next_number(db, "u1", "invoice:FAC", "FAC", AT.replace(year=2027)))
+            return numbers
+
+        self.assertEqual(asyncio.run(scenario()), [
+            "FAC-2026-00001", "FAC-2026-00002", "FAC-2026-00003", "FAC-2026-00001", "FAC-2027-00001",
+        ])
+
+    def test_reserved_block_is_taken_from_the_same_counter(self):
+        db = FakeDb()
+
+        async def scenario():
+            await sequences.next_number(db, "u1", "receipt", "TK", AT, width=6)
+            block = await sequences.reserve_block(db, "u1", "receipt", "TK", 10, reserved_by="pos_1", at=AT, width=6)
+            after = await sequences.next_number(db, "u1", "receipt", "TK", AT, width=6)
+            inside = await sequences.reserved_block(db, "u1", "receipt", "tk-2026-000005")
+            outside = await sequences.reserved_block(db, "u1", "receipt", after)
+            return block, after, inside, outside
+
+        block, after, inside, outside = asyncio.run(scenario())
+        self.assertEqual((block["first"], block["last"]), (2, 11))
+        self.assertEqual(block["first_number"], "TK-2026-000002")
+        self.assertEqual(after, "TK-2026-000012")
+        self.assertEqual(inside["block_id"], block["block_id"])
+        self.assertIsNone(outside)
+
+    def test_concurrent_terminals_get_contiguous_numbers_despite_write_conflicts(self):
+        domain_events._transactions_supported = None
+        db = _TransactionalDb()
+
+        async def checkout():
+            async def write(session):
+                return await sequences.next_number(db, "u1", "receipt", "TK", AT, width=6, session=session), []
+            return await domain_events.commit(db, write)
+
+        async def scenario():
+            return await asyncio.gather(*(checkout() for _ in range(6)))
+
+        numbers = asyncio.run(scenario())
+        self.assertEqual(sorted(numbers), [f"TK-2026-{value:06d}" for value in range(1, 7)])
+        self.assertGreater(db.sequences.conflicts, 0)
+        self.assertEqual(db.sequences.docs["u1:receipt:2026"]["value"], 6)
+
+    def test_prefix_and_number_parsing(self):
+        self.assertEqual(sequences.clean_prefix("fac/2", "FAC"), "FAC2")
+        self.assertEqual(sequences.clean_prefix("--", "FAC"), "FAC")
+        self.assertEqual(sequences.parse_number("FAC2-2026-00042"), ("FAC2", 2026, 42))
+        self.assertIsNone(sequences.parse_number("FAC-20261019-ABC123"))
+
+
+if __name__ == "__main__":
+    unittest.main()
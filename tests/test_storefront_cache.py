@@ -0,0 +1,89 @@
+import asyncio
+import json
+import sys
+import unittest
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import storefront_cache  # noqa: E402
+
+
+def _payload(count=5):
+    products = [
+        {"product_id": f"p{index}", "name": f"Produit {index}", "category": "Boissons" if index % 2 else None}
+        for index in range(count)
+    ]
+    return {"site": {"slug": "ma-boutique"}, "products": products}
+
+
+class StorefrontCacheTests(unittest.TestCase):
+    def setUp(self):
+        storefront_cache.clear()
+
+    def test_snapshot_is_built_once_per_version(self):
+        builds = []
+
+        async def build():
+            builds.append(1)
+            await asyncio.sleep(0)
+            return _payload()
+
+        async def scenario():
+            first = await asyncio.gather(*(storefront_cache.get_snapshot(("acc", 1), build) for _ in range(10)))
+            again = await storefront_cache.get_snapshot(("acc", 1), build)
+            bumped = await storefront_cache.get_snapshot(("acc", 2), build)
+            return first, again, bumped
+
+        first, again, bumped = asyncio.run(scenario())
+        self.assertEqual(len(builds), 2)
+        self.assertTrue(all(snapshot is first[0] for snapshot in first))
+        self.assertIs(again, first[0])
+        self.assertIsNot(bumped, first[0])
+        self.assertEqual(list(storefront_cache._snapshots), [("acc", 2)])
+
+    def test_products_are_paged_by_category(self):
+        snapshot = storefront_cache.build_snapshot(_payload(7))
+        self.assertEqual(
+            [(category["name"], category["product_count"]) for category in snapshot["categories"]],
+            [("Boissons", 3), (None, 4)],
+        )
+        body, _ = storefront_cache.render(snapshot, category="", page=2, page_size=3)
+        view = json.loads(body)
+        self.assertEqual([product["product_id"] for product in view["products"]], ["p6"])
+        self.assertEqual(view["pagination"], {"page": 2, "page_size": 3, "total": 4, "pages": 2})
+
+        legacy = json.loads(storefront_cache.render(snapshot)[0])
+        self.assertEqual(len(legacy["products"]), 7)
+        self.assertNotIn("pagination", legacy)
+
+    def test_etag_is_stable_and_answers_conditional_requests(self):
+        snapshot = storefront_cache.build_snapshot(_payload())
+        body, etag = storefront_cache.render(snapshot, category="Boissons", page=1)
+        self.assertEqual(storefront_cache.render(storefront_cache.build_snapshot(_payload()), category="Boissons", page=1), (body, etag))
+        self.assertNotEqual(storefront_cache.render(snapshot)[1], etag)
+        self.assertTrue(storefront_cache.etag_matches(f'"other", W/{etag}', etag))
+        self.assertTrue(storefront_cache.etag_matches("*", etag))
+        self.assertFalse(storefront_cache.etag_matches('"other"', etag))
+        self.assertFalse(storefront_cache.etag_matches(None, etag))
+
+    def test_out_of_range_pages_are_not_memoized(self):
+        snapshot = storefront_cache.build_snapshot(_payload())
+        storefront_cache.render(snapshot, category="Inconnue", page=1)
+        storefront_cache.render(snapshot, page=999)
+        self.assertEqual(snapshot["bodies"], {})
+
+    def test_only_stock_outs_and_returns_change_the_listing(self):
+        in_stock = {"active": True, "out": False, "low": False}
+        self.assertFalse(storefront_cache.changes_listing(in_stock, {**in_stock, "low": True}))
+        self.assertTrue(storefront_cache.changes_listing(in_stock, {**in_stock, "out": True}))
+        self.assertTrue(storefront_cache.changes_listing({**in_stock, "out": True}, in_stock))
+        self.assertTrue(storefront_cache.changes_listing(None, in_stock))
+        self.assertTrue(storefront_cache.changes_listing(in_stock, {"active": False}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import storefront_domains  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+
+NOW = datetime(2026, 10, 19, 14, tzinfo=timezone.utc)
+
+
+def _db(accounts):
+    return FakeDb(business_accounts=FakeCollection(accounts))
+
+
+def _account(account_id, domain):
+    return {"account_id": account_id, "ecommerce_custom_domain": domain,
+            "ecommerce_domain_status": "pending_verification", "ecommerce_domain_check_requested_at": NOW}
+
+
+class StorefrontDomainTests(unittest.TestCase):
+    def setUp(self):
+        storefront_domains.clear()
+
+    def test_routes_and_misses_are_cached_until_forgotten(self):
+        lookups = []
+        accounts = {"www.shop.sn": {"account_id": "acc_1", "ecommerce_catalog_version": 1}}
+
+        async def lookup(host, account_id):
+            lookups.append((host, account_id))
+            account = accounts.get(host)
+            if account and account_id in (None, account["account_id"]):
+                return dict(account)
+            return None
+
+        async def scenario():
+            for _ in range(3):
+                await storefront_domains.route("www.shop.sn", lookup)
+                await storefront_domains.route("www.unknown.sn", lookup)
+            accounts["www.shop.sn"]["ecommerce_catalog_version"] = 2
+            fresh = await storefront_domains.route("www.shop.sn", lookup)
+            storefront_domains.forget("www.shop.sn")
+            await storefront_domains.route("www.shop.sn", lookup)
+            return fresh
+
+        account = asyncio.run(scenario())
+        self.assertEqual(account, {"account_id": "acc_1", "ecommerce_catalog_version": 2})
+        self.assertEqual(lookups, [
+            ("www.shop.sn", None), ("www.unknown.sn", None),
+            ("www.shop.sn", "acc_1"), ("www.shop.sn", "acc_1"), ("www.shop.sn", "acc_1"),
+            ("www.shop.sn", None),
+        ])
+
+    def test_a_host_that_moved_is_looked_up_again(self):
+        accounts = {"www.shop.sn": {"account_id": "acc_1"}}
+
+        async def lookup(host, account_id):
+            account = accounts.get(host)
+            if account and account_id in (None, account["account_id"]):
+                return dict(account)
+            return None
+
+        async def scenario():
+            await storefront_domains.route("www.shop.sn", lookup)
+            accounts["www.shop.sn"] = {"account_id": "acc_2"}
+            return await storefront_domains.route("www.shop.sn", lookup)
+
+        self.assertEqual(asyncio.run(scenario()), {"account_id": "acc_2"})
+
+    def test_checks_persist_their_result_and_clear_the_request(self):
+        async def resolve(host):
+            return {"www.ok.sn": {"1.2.3.4"}, "app.example.com": {"1.2.3.4"}}.get(host, set())
+
+        db = _db([_account("acc_ok", "www.ok.sn"), _account("acc_ko", "www.ko.sn")])
+        counts = asyncio.run(storefront_domains.run_due_checks(db, "app.example.com", NOW, resolve=resolve))
+        self.assertEqual(counts, {"verified": 1, "pending": 1})
+        ok, ko = db.business_accounts.docs
+        self.assertEqual(ok["ecommerce_domain_status"], "verified")
+        self.assertEqual(ok["ecommerce_domain_verified_at"], NOW)
+        self.assertIsNone(ok["ecommerce_domain_check_requested_at"])
+        self.assertIsNone(ok["ecommerce_domain_check_lease"])
+        self.assertEqual(ko["ecommerce_domain_status"], "pending_verification")
+        self.assertEqual(ko["ecommerce_domain_last_check"]["error"], "dns_unresolved")
+        self.assertEqual(ko["ecommerce_domain_last_check_at"], NOW)
+
+    def test_result_is_dropped_when_the_domain_changed_during_the_check(self):
+        db = _db([_account("acc_1", "www.old.sn")])
+
+        async def resolve(host):
+            db.business_accounts.docs[0]["ecommerce_custom_domain"] = "www.new.sn"
+            return {"1.2.3.4"}
+
+        asyncio.run(storefront_domains.run_due_checks(db, "app.example.com", NOW, resolve=resolve))
+        self.assertNotIn("ecommerce_domain_last_check", db.business_accounts.docs[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
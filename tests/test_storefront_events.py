@@ -0,0 +1,75 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services import storefront_events  # noqa: E402
+from tests.fake_mongo import FakeCollection, FakeDb  # noqa: E402
+
+
+MORNING = datetime(2026, 10, 19, 9, tzinfo=timezone.utc)
+EVENING = datetime(2026, 10, 19, 21, tzinfo=timezone.utc)
+DAY = datetime(2026, 10, 19, tzinfo=timezone.utc)
+
+
+def _event(event_type, at, visitor="v1", **extra):
+    return {"event_type": event_type, "user_id": "u1", "site_slug": "shop", "store_id": "s1",
+            "created_at": at, "visitor_key": visitor, **extra}
+
+
+class _SteppedDown(FakeCollection):
+    async def bulk_write(self, requests, ordered=True, session=None):
+        raise RuntimeError("primary stepped down")
+
+
+class StorefrontEventTests(unittest.TestCase):
+    def setUp(self):
+        storefront_events._buffer.clear()
+
+    def test_batch_folds_into_one_increment_per_shop_day_and_product(self):
+        events = [
+            _event("site_view", MORNING),
+            _event("site_view", EVENING),
+            _event("site_view", EVENING, visitor="v2"),
+            _event("add_to_cart", MORNING, product_id="p1", product_name="Riz", quantity=2),
+            _event("add_to_cart", EVENING, product_id="p1", product_name="Riz", quantity=3),
+        ]
+        operations = storefront_events.rollup_operations(events, MORNING)
+        rollups = {op._filter["product_id"]: op for op in operations["rollups"]}
+        self.assertEqual(set(rollups), {None, "p1"})
+        self.assertEqual(rollups[None]._filter["day"], DAY)
+        self.assertEqual(rollups[None]._doc["$inc"], {"counts.site_view": 3, "counts.add_to_cart": 2, "cart_quantity": 5.0})
+        self.assertEqual(rollups["p1"]._doc["$inc"], {"counts.add_to_cart": 2, "cart_quantity": 5.0})
+        self.assertEqual(rollups["p1"]._doc["$set"]["product_name"], "Riz")
+        visitors = {op._filter["visitor_key"]: op._doc for op in operations["visitors"]}
+        self.assertEqual(visitors["v1"]["$min"], {"first_seen": MORNING})
+        self.assertEqual(visitors["v1"]["$max"], {"last_seen": EVENING})
+        self.assertEqual(len(visitors), 2)
+
+    def test_flush_writes_rollups_then_raw_events_in_one_batch(self):
+        db = FakeDb()
+        for index in range(3):
+            storefront_events.record(db, _event("site_view", MORNING, visitor=f"v{index}"))
+        flushed = asyncio.run(storefront_events.flush(db))
+        self.assertEqual(flushed, 3)
+        self.assertEqual(storefront_events.pending(), 0)
+        self.assertEqual(len(db.ecommerce_event_rollups.docs), 1)
+        self.assertEqual(len(db.ecommerce_events.docs), 3)
+        self.assertTrue(all(event["rolled_up"] for event in db.ecommerce_events.docs))
+
+    def test_failed_rollup_keeps_the_batch_for_the_next_flush(self):
+        db = FakeDb(ecommerce_event_rollups=_SteppedDown())
+        storefront_events.record(db, _event("site_view", MORNING))
+        self.assertEqual(asyncio.run(storefront_events.flush(db)), 0)
+        self.assertEqual(storefront_events.pending(), 1)
+        self.assertEqual(db.ecommerce_events.docs, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import sys
+import unittest
+from pathlib import Path
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from services.voice_matcher import ProductNameMatcher  # noqa: E402
+
+
+def _matches(matcher, text):
+    return [(m["product"]["product_id"], m["qty"]) for m in matcher.match(text)]
+
+
+class ProductNameMatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.matcher = ProductNameMatcher([
+            {"product_id": "coca", "name": "Coca"},
+            {"product_id": "coca_zero", "name": "Coca Cola Zéro"},
+            {"product_id": "riz", "name": "Riz parfumé", "allows_fractional_sale": True},
+            {"product_id": "pain", "name": "Pain", "aliases": ["baguette"]},
+        ])
+
+    def test_longest_name_wins_over_its_prefix(self):
+        self.assertEqual(_matches(self.matcher, "2 coca cola zero"), [("coca_zero", 2)])
+
+    def test_quantities_from_digits_words_and_multipliers(self):
+        self.assertEqual(
+            _matches(self.matcher, "trois pains et coca fois 4"),
+            [("pain", 3), ("coca", 4)],
+        )
+
+    def test_unit_words_and_fractional_quantities(self):
+        self.assertEqual(_matches(self.matcher, "1,5 kg de riz parfume"), [("riz", 1.5)])
+
+    def test_aliases_and_default_quantity(self):
+        self.assertEqual(_matches(self.matcher, "une baguette et du coca"), [("pain", 1), ("coca", 1)])
+
+    def test_no_match_returns_empty(self):
+        self.assertEqual(_matches(self.matcher, "bonjour"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
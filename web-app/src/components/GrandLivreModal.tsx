@@ -52,6 +52,39 @@ export default function GrandLivreModal({ isOpen, onClose, period, startDate, en
         }
     };
 
+    const loadMore = async () => {
+        if (!data?.next_cursor) return;
+        setLoading(true);
+        try {
+            const res = await accountingApi.getGrandLivre(period, startDate, endDate, data.next_cursor);
+            setData({ ...res, entries: [...data.entries, ...res.entries] });
+        } catch (err: any) {
+            setError(err?.message || 'Impossible de charger la suite du grand livre.');
+        } finally {
+            setLoading(false);
+        }
+    };
+
+    // Exports cover the whole period, like the totals: follow the cursor past the entries loaded so far.
+    const loadFullLedger = async () => {
+        if (!data?.next_cursor) return data;
+        setLoading(true);
+        try {
+            let full = data;
+            while (full.next_cursor) {
+                const res = await accountingApi.getGrandLivre(period, startDate, endDate, full.next_cursor);
+                full = { ...res, entries: [...full.entries, ...res.entries] };
+            }
+            setData(full);
+            return full;
+        } catch (err: any) {
+            setError(err?.message || 'Impossible de charger tout le grand livre pour l\'export.');
+            return null;
+        } finally {
+            setLoading(false);
+        }
+    };
+
     const entries = useMemo(() => {
         if (!data?.entries) return [];
         let list = data.entries;
@@ -67,8 +100,10 @@ export default function GrandLivreModal({ isOpen, onClose, period, startDate, en
         return list;
     }, [data, typeFilter, search]);
 
-    const handleExportExcel = () => {
+    const handleExportExcel = async () => {
         if (!data?.entries) return;
+        const ledger = await loadFullLedger();
+        if (!ledger) return;
         const cols: ExcelColumn[] = [
             { key: 'date', label: 'Date / Heure', width: 22, type: 'date' },
             { key: 'type', label: 'Type', width: 20 },
@@ -81,38 +116,40 @@ export default function GrandLivreModal({ isOpen, onClose, period, startDate, en
         ];
         exportToExcel({
             title: 'Grand Livre Comptable',
-            period: data.period_start ? `${new Date(data.period_start).toLocaleDateString('fr-FR')} → ${new Date(data.period_end).toLocaleDateString('fr-FR')}` : `Derniers ${period} jours`,
+            period: ledger.period_start ? `${new Date(ledger.period_start).toLocaleDateString('fr-FR')} → ${new Date(ledger.period_end).toLocaleDateString('fr-FR')}` : `Derniers ${period} jours`,
             filename: 'Stockman_GrandLivre',
             sheets: [
                 {
                     name: 'Grand Livre',
                     columns: cols,
-                    data: data.entries,
+                    data: ledger.entries,
                     summaryRows: [
-                        ['TOTAL ENTRÉES (+)', data.total_in],
-                        ['TOTAL SORTIES (–)', data.total_out],
-                        ['SOLDE NET', data.net_balance],
-                        ['NOMBRE D\'ÉCRITURES', data.count],
+                        ['TOTAL ENTRÉES (+)', ledger.total_in],
+                        ['TOTAL SORTIES (–)', ledger.total_out],
+                        ['SOLDE NET', ledger.net_balance],
+                        ['NOMBRE D\'ÉCRITURES', ledger.count],
                     ],
                 },
                 {
                     name: 'Ventes uniquement',
                     columns: cols,
-                    data: data.entries.filter((e: any) => e.type_code === 'sale'),
-                    summaryRows: [['TOTAL VENTES', data.entries.filter((e: any) => e.type_code === 'sale').reduce((s: number, e: any) => s + e.amount_in, 0)]],
+                    data: ledger.entries.filter((e: any) => e.type_code === 'sale'),
+                    summaryRows: [['TOTAL VENTES', ledger.entries.filter((e: any) => e.type_code === 'sale').reduce((s: number, e: any) => s + e.amount_in, 0)]],
                 },
                 {
                     name: 'Dépenses & Pertes',
                     columns: cols,
-                    data: data.entries.filter((e: any) => ['expense', 'loss', 'purchase'].includes(e.type_code)),
-                    summaryRows: [['TOTAL SORTIES', data.total_out]],
+                    data: ledger.entries.filter((e: any) => ['expense', 'loss', 'purchase'].includes(e.type_code)),
+                    summaryRows: [['TOTAL SORTIES', ledger.total_out]],
                 },
             ],
         });
     };
 
-    const handleExportPDF = () => {
+    const handleExportPDF = async () => {
         if (!data?.entries) return;
+        const ledger = await loadFullLedger();
+        if (!ledger) return;
         const cols: ExcelColumn[] = [
             { key: 'date', label: 'Date', width: 18, type: 'date' },
             { key: 'type', label: 'Type', width: 18 },
@@ -122,8 +159,8 @@ export default function GrandLivreModal({ isOpen, onClose, period, startDate, en
             { key: 'amount_out', label: 'Sortie', width: 16, type: 'number' },
             { key: 'balance', label: 'Solde', width: 16, type: 'number' },
         ];
-        const periodLabel = data.period_start
-            ? `${new Date(data.period_start).toLocaleDateString('fr-FR')} → ${new Date(data.period_end).toLocaleDateString('fr-FR')}`
+        const periodLabel = ledger.period_start
+            ? `${new Date(ledger.period_start).toLocaleDateString('fr-FR')} → ${new Date(ledger.period_end).toLocaleDateString('fr-FR')}`
             : `Derniers ${period} jours`;
         exportToPDF({
             title: 'Grand Livre Comptable',
@@ -135,16 +172,16 @@ export default function GrandLivreModal({ isOpen, onClose, period, startDate, en
                     columns: [],
                     data: [],
                     kpiCards: [
-                        { label: 'Total Entrées', value: `${(data.total_in || 0).toLocaleString('fr-FR')} F` },
-                        { label: 'Total Sorties', value: `${(data.total_out || 0).toLocaleString('fr-FR')} F` },
-                        { label: 'Solde Net', value: `${(data.net_balance || 0).toLocaleString('fr-FR')} F` },
-                        { label: 'Nb Écritures', value: String(data.count || 0) },
+                        { label: 'Total Entrées', value: `${(ledger.total_in || 0).toLocaleString('fr-FR')} F` },
+                        { label: 'Total Sorties', value: `${(ledger.total_out || 0).toLocaleString('fr-FR')} F` },
+                        { label: 'Solde Net', value: `${(ledger.net_balance || 0).toLocaleString('fr-FR')} F` },
+                        { label: 'Nb Écritures', value: String(ledger.count || 0) },
                     ],
                 },
                 {
                     title: 'Journal Chronologique',
                     columns: cols,
-                    data: data.entries,
+                    data: ledger.entries,
                 },
             ],
         });
@@ -283,6 +320,15 @@ export default function GrandLivreModal({ isOpen, onClose, period, startDate, en
                         {typeFilter !== 'Tous' || search ? ` (filtrées sur ${data.count} total)` : ''}
                     </p>
                 )}
+                {data?.has_more && (
+                    <button
+                        onClick={loadMore}
+                        disabled={loading}
+                        className="w-full py-2 rounded-2xl border border-white/10 text-slate-300 text-xs font-bold hover:bg-white/5 transition-all disabled:opacity-40"
+                    >
+                        Charger la suite ({data.entries.length} / {data.count})
+                    </button>
+                )}
 
                 {/* Footer actions */}
                 <div className="flex gap-3 pt-2">
@@ -2112,11 +2112,12 @@ export const accounting = {
         if (endDate) qs.set('end_date', endDate);
         return request<AccountingStats>(`/accounting/stats?${qs.toString()}`);
     },
-    getGrandLivre: (days?: number, startDate?: string, endDate?: string) => {
+    getGrandLivre: (days?: number, startDate?: string, endDate?: string, cursor?: string) => {
         const qs = new URLSearchParams();
         if (days) qs.set('days', days.toString());
         if (startDate) qs.set('start_date', startDate);
         if (endDate) qs.set('end_date', endDate);
+        if (cursor) qs.set('cursor', cursor);
         return request<any>(`/grand-livre?${qs.toString()}`);
     },
     getSalesHistory: (days?: number, startDate?: string, endDate?: string, skip = 0, limit = 50, storeId?: string) => {